@@ -0,0 +1,447 @@
+'''
+Created on 19.10.2026
+
+ASGI entry point of the critique API, for the asyncio servers (uvicorn,
+hypercorn...)::
+
+    uvicorn main:asgi_application
+
+It serves the same routes and representations as the WSGI application:
+
+ * The event streams of the users are served by coroutines. An open stream
+   costs no thread, however long it waits for events.
+ * The other requests run the WSGI application on a bounded pool of
+   threads. Their bodies are received and their responses sent by the event
+   loop, so a slow client only holds a thread while a streamed response is
+   produced. The requests that write (POST, PUT, DELETE...) run one at a time
+   on a dedicated writer thread, so SQLite writers never wait for each
+   other's locks.
+ * :py:class:`AsyncDatabase` gives coroutines the database API, on the same
+   threads.
+'''
+
+import asyncio
+import io
+import json
+import math
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+from app import resources
+from app.model.mason import MasonObject
+
+MASON = "application/vnd.mason+json"
+
+# Methods run by the reader threads, the other ones by the writer thread.
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Chunks of a WSGI response produced but not sent yet. The thread producing
+# the response waits when there are more.
+BUFFERED_CHUNKS = 8
+
+
+def error_response(status_code, title, message=None, path=None):
+    '''
+    Mason error document, the same as
+    :py:func:`app.resources.create_error_response`.
+
+    :returns: tuple with the status code, the headers and the body.
+    '''
+    envelope = MasonObject(resource_url=path)
+    envelope.add_error(title, message)
+    body = json.dumps(envelope).encode("utf-8")
+    return status_code, [(b"content-type", MASON.encode("latin-1")),
+                         (b"content-length", str(len(body)).encode())], body
+
+
+def rate_limit_headers(admission):
+    '''
+    Headers telling the client the state of its bucket, the same as
+    :py:func:`app.resources.add_rate_limit_headers`.
+
+    :param admission: the :py:class:`app.ratelimit.Admission` of the
+        request, or None.
+    :returns: list of headers.
+    '''
+    if admission is None:
+        return []
+    return [(b"x-ratelimit-limit", str(admission.limit).encode()),
+            (b"x-ratelimit-remaining", str(admission.remaining).encode()),
+            (b"x-ratelimit-reset",
+             str(math.ceil(admission.reset)).encode())]
+
+
+class AsyncDatabase(object):
+    '''
+    Asynchronous facade of the database API. Every call runs on a thread of
+    a bounded pool, with its own :py:class:`app.database.Connection`, and
+    the methods that write (create_*, modify_*, delete_*) run one at a time
+    on a dedicated writer thread.
+
+    :Example:
+
+    >>> user = await db.get_user("Scott")
+    >>> await db.create_rating("Kim", "Scott", 5)
+
+    :param connect: function opening a :py:class:`app.database.Connection`,
+        e.g. :py:func:`app.resources.open_connection`.
+    :param context: function returning the context manager in which the
+        calls run, e.g. the application context the listeners of the
+        connection need.
+    :param int readers: number of threads running the reads.
+    :param float deadline: seconds each call may spend on the database, see
+        :py:meth:`app.database.Connection.set_deadline`. None for no limit.
+    '''
+
+    WRITE_PREFIXES = ("create_", "modify_", "delete_")
+
+    def __init__(self, connect, context=None, readers=8, deadline=None):
+        super(AsyncDatabase, self).__init__()
+        self.connect = connect
+        self.context = context or ExitStack
+        self.deadline = deadline
+        self.readers = ThreadPoolExecutor(readers,
+                                          thread_name_prefix="critique-read")
+        self.writer = ThreadPoolExecutor(1,
+                                         thread_name_prefix="critique-write")
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        write = name.startswith(self.WRITE_PREFIXES)
+
+        async def call(*args, **kwargs):
+            return await self.run(self._call, name, args, kwargs,
+                                  write=write)
+        call.__name__ = name
+        return call
+
+    def _call(self, name, args, kwargs):
+        with self.context():
+            con = self.connect()
+            try:
+                con.set_deadline(self.deadline)
+                return getattr(con, name)(*args, **kwargs)
+            finally:
+                con.close()
+
+    async def run(self, function, *args, write=False):
+        '''
+        Runs a function on the reader threads, or on the writer thread.
+
+        :returns: what the function returns.
+        '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.writer if write else self.readers, function, *args)
+
+    def close(self):
+        '''
+        Stops the threads, once the calls in progress are done.
+        '''
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+
+
+class ASGIApplication(object):
+    '''
+    ASGI application serving the critique API.
+
+    :param app: the :py:class:`flask.Flask` application of the API.
+    :param wsgi_app: the WSGI application to run, e.g. ``app`` wrapped by
+        the compression middleware. ``app`` by default.
+    :param int threads: number of threads running the WSGI application for
+        the reads.
+    '''
+
+    def __init__(self, app, wsgi_app=None, threads=8):
+        super(ASGIApplication, self).__init__()
+        self.app = app
+        self.wsgi_app = wsgi_app or app
+        self.db = AsyncDatabase(resources.open_connection, app.app_context,
+                                readers=threads,
+                                deadline=app.config.get("REQUEST_DEADLINE"))
+        # Requests served by coroutines, by endpoint
+        self.handlers = {"events": self.events}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            handler, values = self.route(scope)
+            if handler is not None:
+                await handler(scope, receive, send, **values)
+            else:
+                await self.call_wsgi(scope, receive, send)
+        else:
+            raise ValueError("Unsupported scope %s" % scope["type"])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self.db.close)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def route(self, scope):
+        '''
+        :returns: tuple with the coroutine serving the request and the
+            arguments of its route, or None and an empty dictionary if the
+            WSGI application serves it.
+        '''
+        urls = self.app.url_map.bind("localhost",
+                                     script_name=scope.get("root_path", ""))
+        try:
+            endpoint, values = urls.match(scope["path"], scope["method"])
+        except (HTTPException, RequestRedirect):
+            return None, {}
+        if endpoint not in self.handlers:
+            return None, {}
+        return self.handlers[endpoint], values
+
+    async def send_response(self, send, status_code, headers, body):
+        await send({"type": "http.response.start", "status": status_code,
+                    "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def events(self, scope, receive, send, nickname):
+        '''
+        Event stream of a user, see :py:class:`app.resources.UserEvents`.
+        Like the WSGI requests, the streams of a client take a token of its
+        "read" bucket and are refused with 429 beyond its rate.
+        '''
+        # Admission, as in app.resources.check_admission
+        client = scope.get("client") or ("", 0)
+        limiter = resources.rate_limiters.get("read")
+        admission = None
+        if limiter is not None:
+            admission = limiter.acquire((client[0], "read"))
+            if not admission.allowed:
+                retry_after = math.ceil(admission.retry_after)
+                status_code, headers, body = error_response(
+                    429, "Too many requests",
+                    "Too many read requests, try again in %d seconds" %
+                    retry_after, scope["path"])
+                headers.append((b"retry-after", str(retry_after).encode()))
+                return await self.send_response(
+                    send, status_code, headers + rate_limit_headers(admission),
+                    body)
+
+        headers = dict(scope["headers"])
+        last_event_id = headers.get(b"last-event-id")
+        if last_event_id is not None:
+            last_event_id = last_event_id.decode("latin-1")
+        else:
+            query = parse_qs(scope["query_string"].decode("latin-1"))
+            last_event_id = query.get("lastEventId", [None])[-1]
+        if last_event_id is not None:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                return await self.send_response(send, *error_response(
+                    400, "Wrong request format",
+                    "The last event id must be an integer", scope["path"]))
+
+        if not await self.db.contains_user(nickname):
+            return await self.send_response(send, *error_response(
+                404, "User not found.", path=scope["path"]))
+
+        hub = resources.event_hub
+        subscription = hub.subscribe(nickname, last_event_id)
+        stream = hub.stream_async(
+            subscription, heartbeat=self.app.config["EVENTS_HEARTBEAT"])
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [
+                        (b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache"),
+                        (b"x-accel-buffering", b"no")] +
+                    rate_limit_headers(admission)})
+
+        async def write():
+            async for text in stream:
+                await send({"type": "http.response.body",
+                            "body": text.encode("utf-8"), "more_body": True})
+
+        async def disconnected():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        tasks = [asyncio.ensure_future(write()),
+                 asyncio.ensure_future(disconnected())]
+        try:
+            done, _ = await asyncio.wait(tasks,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                # Raise the errors of the stream
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await stream.aclose()
+
+    async def read_body(self, scope, receive):
+        '''
+        :returns: the body of the request, or None if it is bigger than the
+            MAX_CONTENT_LENGTH of the application.
+        '''
+        limit = self.app.config.get("MAX_CONTENT_LENGTH")
+        headers = dict(scope["headers"])
+        length = headers.get(b"content-length")
+        if limit is not None and length is not None and \
+                length.isdigit() and int(length) > limit:
+            # Rejected by the application without reading the body
+            return b""
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            body.write(message.get("body", b""))
+            if limit is not None and body.tell() > limit:
+                return None
+            if not message.get("more_body", False):
+                break
+        return body.getvalue()
+
+    def environ(self, scope, body):
+        '''
+        :returns: the WSGI environment of a request.
+        '''
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        # PEP 3333: the decoded path is passed as latin-1
+        path = scope["path"].encode("utf-8").decode("latin-1")
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": path,
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+                continue
+            if name == "CONTENT_LENGTH":
+                # The real length of the body read
+                if value != "0" and not body:
+                    environ["CONTENT_LENGTH"] = value
+                continue
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ \
+                else value
+        return environ
+
+    async def call_wsgi(self, scope, receive, send):
+        '''
+        Serves a request with the WSGI application, on the reader threads or
+        on the writer thread.
+        '''
+        body = await self.read_body(scope, receive)
+        if body is None:
+            return await self.send_response(send, *error_response(
+                413, "Request Entity Too Large",
+                "The body must not exceed %d bytes" %
+                self.app.config["MAX_CONTENT_LENGTH"], scope["path"]))
+        environ = self.environ(scope, body)
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        # Room for the chunks in the queue, and whether the client left
+        room = threading.Semaphore(BUFFERED_CHUNKS)
+        cancelled = threading.Event()
+
+        def put(message):
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+        def run():
+            response = []
+
+            def start_response(status, headers, exc_info=None):
+                response[:] = [status, headers]
+
+            started = False
+            try:
+                result = self.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if not chunk:
+                            continue
+                        if not started:
+                            put(("start", response))
+                            started = True
+                        while not room.acquire(timeout=1):
+                            if cancelled.is_set():
+                                return
+                        put(("body", chunk))
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                if not started:
+                    put(("start", response))
+            except Exception:
+                if not started:
+                    put(("error", None))
+                raise
+            finally:
+                put(("end", None))
+
+        task = loop.run_in_executor(
+            self.db.readers if scope["method"] in READ_METHODS
+            else self.db.writer, run)
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == "start":
+                    status, headers = value
+                    await send({
+                        "type": "http.response.start",
+                        "status": int(status.split(" ", 1)[0]),
+                        "headers": [(name.lower().encode("latin-1"),
+                                     value.encode("latin-1"))
+                                    for name, value in headers]})
+                elif kind == "body":
+                    room.release()
+                    await send({"type": "http.response.body", "body": value,
+                                "more_body": True})
+                elif kind == "error":
+                    await self.send_response(send, *error_response(
+                        500, "Error", "The system has failed. Please, "
+                        "contact the administrator", scope["path"]))
+                    break
+                else:
+                    await send({"type": "http.response.body", "body": b""})
+                    break
+        finally:
+            # Stops the thread if the client is gone
+            cancelled.set()
+            try:
+                await task
+            except Exception:
+                self.app.logger.exception("Error serving %s", scope["path"])
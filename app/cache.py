@@ -0,0 +1,242 @@
+'''
+Created on 19.10.2026
+
+In-memory cache of the rendered responses of the critique API.
+
+The cache keeps the serialized Mason documents of the read resources, so a
+document requested again is sent without reading the database or building
+it. Every entry has tags naming the data it was built from, e.g.
+``("user", "Scott")`` or ``("inbox", "Scott")``. The resources invalidate the
+tags concerned by each write notified by the database connection, so only the
+documents that really changed are dropped.
+
+The cache is local to the process. Each entry also stores the version of the
+data (see :py:meth:`app.database.Connection.get_change_version`) it was built
+from, which allows to detect writes made by other processes.
+
+:py:class:`SingleFlight` lets concurrent requests of a response missing from
+the cache wait for the one that builds it instead of building it too.
+'''
+
+import threading
+
+from collections import OrderedDict, namedtuple
+
+# Cached response: the body, the version of the data it was built from and
+# the tags used to invalidate it.
+CachedResponse = namedtuple("CachedResponse", ("body", "version", "tags"))
+
+
+class ResponseCache(object):
+    '''
+    Bounded LRU cache of rendered responses with tag based invalidation. It
+    is safe to share between threads.
+
+    :param int max_entries: maximum number of responses kept.
+    :param int max_bytes: maximum size of all the bodies kept together.
+        Bodies bigger than a tenth of it are not stored.
+    '''
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024):
+        super(ResponseCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        # Generation of the last invalidation of each tag, oldest first. The
+        # oldest ones are forgotten, raising _floor to their generation.
+        self._invalidated = OrderedDict()
+        self._floor = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def max_body(self):
+        '''
+        Size of the biggest body stored, in bytes.
+        '''
+        return self.max_bytes // 10
+
+    def get(self, key, version=None):
+        '''
+        :param key: the key of the response.
+        :param version: if given, the version of the data the response must
+            have been built from. An older response is dropped.
+        :returns: the :py:class:`CachedResponse` stored for ``key`` or None.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and version is not None and \
+                    entry.version != version:
+                # Written by another process
+                self._remove(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, version=None, tags=(), generation=None):
+        '''
+        Stores a response, evicting the least recently used ones if the cache
+        is full.
+
+        :param key: the key of the response.
+        :param bytes body: the serialized response.
+        :param version: the version of the data the response was built from.
+        :param tags: iterable of the tags of the response.
+        :param int generation: value of :py:attr:`generation` before the data
+            of the response was read. If one of ``tags`` was invalidated
+            since, the response may be outdated and it is not stored. None
+            for the responses checked with their ``version`` instead.
+        '''
+        if len(body) > self.max_body:
+            return
+        entry = CachedResponse(body, version, frozenset(tags))
+        with self._lock:
+            if generation is not None and (generation < self._floor or any(
+                    self._invalidated.get(tag, 0) > generation
+                    for tag in entry.tags)):
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._size += len(body)
+            for tag in entry.tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or \
+                    self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        '''
+        Removes the responses having any of the given tags.
+
+        :returns: the number of responses removed.
+        '''
+        removed = 0
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                self._invalidated.pop(tag, None)
+                self._invalidated[tag] = self.generation
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    removed += 1
+            while len(self._invalidated) > self.max_entries:
+                _, self._floor = self._invalidated.popitem(last=False)
+            self.invalidations += removed
+        return removed
+
+    def clear(self):
+        '''
+        Removes all the stored responses.
+        '''
+        with self._lock:
+            self.generation += 1
+            self._invalidated.clear()
+            self._floor = self.generation
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+            self._size = 0
+
+    def stats(self):
+        '''
+        :returns: dictionary with the number of ``entries``, their ``size`` in
+            bytes, the ``hits``, ``misses``, ``hitRatio``, ``evictions`` and
+            ``invalidations``.
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+    def _remove(self, key):
+        '''
+        Removes a response. Called with the lock held.
+        '''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= len(entry.body)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SingleFlight(object):
+    '''
+    Coalesces concurrent computations of the same key: the first caller, the
+    leader, computes the result while the other ones wait for it. It is safe
+    to share between threads.
+
+    :Example:
+
+    >>> flight, leader = flights.join(key)
+    >>> if leader:
+    ...     try:
+    ...         compute_and_store(key)
+    ...     finally:
+    ...         flights.leave(key, flight)
+    ... elif not flight.wait(timeout):
+    ...     compute_and_store(key)  # The leader is too slow
+    '''
+
+    def __init__(self):
+        super(SingleFlight, self).__init__()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key):
+        '''
+        Joins the computation of a key.
+
+        :returns: tuple with the :py:class:`threading.Event` set when the
+            computation ends and True if the caller is the leader. The leader
+            must call :py:meth:`leave` when it is done, even if it fails.
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                return flight, False
+            flight = self._flights[key] = threading.Event()
+            self.leaders += 1
+            return flight, True
+
+    def leave(self, key, flight):
+        '''
+        Ends the computation of a key and wakes up the callers waiting for it.
+        '''
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.set()
+
+    def in_flight(self):
+        '''
+        :returns: the number of keys being computed.
+        '''
+        with self._lock:
+            return len(self._flights)
@@ -0,0 +1,318 @@
+'''
+Created on 19.10.2026
+
+WSGI middleware compressing the responses of the critique API.
+
+The encoding is negotiated with the ``Accept-Encoding`` header of the request.
+Small bodies are sent as they are, since compressing them does not pay off.
+Compressed bodies are kept in a bounded cache keyed by the representation
+(its ETag when it has one, otherwise a digest of the body) so responses that
+are requested over and over are compressed only once. Streamed responses,
+which do not announce their length, are compressed chunk by chunk instead.
+'''
+
+import gzip
+import hashlib
+import threading
+import zlib
+
+from collections import OrderedDict
+
+# Encodings supported by the middleware in order of preference.
+ENCODINGS = ("gzip", "deflate")
+
+# Media types worth compressing.
+COMPRESSIBLE_MIMETYPES = (
+    "application/vnd.mason+json",
+    "application/json",
+    "text/html",
+    "text/plain"
+)
+
+
+def negotiate_encoding(accept_encoding):
+    '''
+    Chooses the content coding to use for a response.
+
+    :param str accept_encoding: value of the ``Accept-Encoding`` header.
+    :returns: ``"gzip"``, ``"deflate"`` or None if the body must be sent
+        without compression.
+    '''
+    if not accept_encoding:
+        return None
+
+    qvalues = {}
+    for part in accept_encoding.split(","):
+        params = part.strip().split(";")
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qvalues[coding] = quality
+
+    best = None
+    best_quality = 0.0
+    for coding in ENCODINGS:
+        quality = qvalues.get(coding, qvalues.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(body, encoding, level):
+    '''
+    Compresses ``body`` with the given content coding.
+
+    :param bytes body: the body to compress.
+    :param str encoding: ``"gzip"`` or ``"deflate"``.
+    :param int level: compression level from 1 (fastest) to 9 (smallest).
+    :returns: the compressed body.
+    '''
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=level, mtime=0)
+    return zlib.compress(body, level)
+
+
+def compressor(encoding, level):
+    '''
+    Creates an incremental compressor for the given content coding.
+
+    :param str encoding: ``"gzip"`` or ``"deflate"``.
+    :param int level: compression level from 1 (fastest) to 9 (smallest).
+    :returns: a :py:func:`zlib.compressobj` producing the right container.
+    '''
+    # 16 + MAX_WBITS writes a gzip header and trailer, MAX_WBITS a zlib one.
+    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+class CompressedBodyCache(object):
+    '''
+    Bounded LRU cache of compressed bodies. It is safe to share between
+    threads.
+
+    :param int max_entries: maximum number of bodies kept.
+    :param int max_bytes: maximum size of all the bodies kept together.
+    '''
+
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024):
+        super(CompressedBodyCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        '''
+        :returns: the compressed body stored for ``key`` or None.
+        '''
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        '''
+        Stores a compressed body, evicting the least recently used ones if
+        the cache is full.
+        '''
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = body
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or \
+                    self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        '''
+        Removes all the stored bodies.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class CompressionMiddleware(object):
+    '''
+    Compresses the responses of the wrapped WSGI application.
+
+    :Example:
+
+    >>> application = CompressionMiddleware(app, level=6, min_size=500)
+
+    :param app: the WSGI application to wrap.
+    :param int level: compression level from 1 (fastest) to 9 (smallest).
+    :param int min_size: bodies smaller than this number of bytes are not
+        compressed.
+    :param cache: :py:class:`CompressedBodyCache` used to store the compressed
+        bodies. If None a new one is created. Pass ``False`` to disable it.
+    '''
+
+    def __init__(self, app, level=6, min_size=500, cache=None):
+        super(CompressionMiddleware, self).__init__()
+        if not 1 <= level <= 9:
+            raise ValueError("Compression level must be between 1 and 9")
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        if cache is None:
+            cache = CompressedBodyCache()
+        self.cache = cache or None
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+        if encoding is None or environ.get("REQUEST_METHOD") == "HEAD":
+            return self.app(environ, start_response)
+
+        captured = {}
+        chunks = []
+
+        def _start_response(status, headers, exc_info=None):
+            compressible = self._is_compressible(headers)
+            if compressible is None:
+                captured["streamed"] = True
+                headers = list(headers)
+                self._add_vary(headers)
+                headers.append(("Content-Encoding", encoding))
+                return start_response(status, headers, exc_info)
+            if not compressible:
+                captured["passthrough"] = True
+                return start_response(status, headers, exc_info)
+            captured["status"] = status
+            captured["headers"] = headers
+            captured["exc_info"] = exc_info
+            return chunks.append
+
+        app_iter = self.app(environ, _start_response)
+        if captured.get("passthrough"):
+            return app_iter
+        if captured.get("streamed"):
+            return self._compress_stream(app_iter, encoding)
+
+        try:
+            chunks.extend(app_iter)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+        if captured.get("passthrough"):
+            # The application called start_response lazily.
+            return chunks
+        body = b"".join(chunks)
+
+        headers = [(name, value) for name, value in captured["headers"]
+                   if name.lower() != "content-length"]
+        self._add_vary(headers)
+        if len(body) < self.min_size:
+            headers.append(("Content-Length", str(len(body))))
+            start_response(captured["status"], headers, captured["exc_info"])
+            return [body]
+
+        body = self._compress(environ, headers, body, encoding)
+        headers = [(name, self._weaken(value)) if name.lower() == "etag"
+                   else (name, value) for name, value in headers]
+        headers.append(("Content-Encoding", encoding))
+        headers.append(("Content-Length", str(len(body))))
+        start_response(captured["status"], headers, captured["exc_info"])
+        return [body]
+
+    def _is_compressible(self, headers):
+        '''
+        :returns: True if the response with the given headers may be
+            compressed as a whole: it has a known length, a compressible media
+            type and is not encoded yet. None if it is a compressible response
+            streamed without a known length. False otherwise.
+        '''
+        mimetype = None
+        has_length = False
+        for name, value in headers:
+            name = name.lower()
+            if name == "content-encoding":
+                return False
+            if name == "content-type":
+                mimetype = value.split(";")[0].strip().lower()
+            elif name == "content-length":
+                has_length = True
+        if mimetype not in COMPRESSIBLE_MIMETYPES:
+            return False
+        return True if has_length else None
+
+    def _compress_stream(self, app_iter, encoding):
+        '''
+        Compresses a streamed body chunk by chunk. Every chunk is flushed so
+        the client receives data as soon as the application produces it.
+        '''
+        stream = compressor(encoding, self.level)
+        try:
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+                data = stream.compress(chunk) + stream.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield stream.flush(zlib.Z_FINISH)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+    def _compress(self, environ, headers, body, encoding):
+        '''
+        Compresses the body, reusing a cached result when the same
+        representation was already compressed.
+        '''
+        if self.cache is None:
+            return compress(body, encoding, self.level)
+
+        etag = None
+        for name, value in headers:
+            if name.lower() == "etag":
+                etag = value
+        if etag is not None:
+            representation = (environ.get("PATH_INFO", ""),
+                              environ.get("QUERY_STRING", ""), etag)
+        else:
+            representation = hashlib.sha1(body).digest()
+        key = (representation, encoding, self.level)
+
+        compressed = self.cache.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding, self.level)
+            self.cache.put(key, compressed)
+        return compressed
+
+    def _add_vary(self, headers):
+        '''
+        Adds Accept-Encoding to the Vary header of the response.
+        '''
+        for index, (name, value) in enumerate(headers):
+            if name.lower() == "vary":
+                if "accept-encoding" not in value.lower():
+                    headers[index] = (name, value + ", Accept-Encoding")
+                return
+        headers.append(("Vary", "Accept-Encoding"))
+
+    def _weaken(self, etag):
+        '''
+        The compressed body is not byte for byte the same representation so a
+        strong ETag becomes a weak one.
+        '''
+        return etag if etag.startswith("W/") else "W/" + etag
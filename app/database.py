@@ -11,17 +11,160 @@ Provides the database API to access the critique persistent data.
     -   [1] Programmable Web Project, Exercise1, forum.database.py
 '''
 
+from contextlib import contextmanager
 from datetime import datetime
+import functools
+import heapq
+import itertools
+import random
 import time
 import sqlite3
 import re
 import os
 
+# Returned by Connection._loaded for the rows not read yet.
+_NOT_LOADED = object()
+
 # Default paths for .db and .sql files to create and populate the database.
 DEFAULT_DB_PATH = 'db/critique.db'
 DEFAULT_SCHEMA = "db/critique_schema_dump.sql"
 DEFAULT_DATA_DUMP = "db/critique_data_dump.sql"
 
+# Seconds a connection waits for the locks held by the other connections
+# before an operation fails with "database is locked".
+DEFAULT_BUSY_TIMEOUT = 5.0
+# Attempts of an idempotent operation failing because the database is busy,
+# and delay in seconds before the second one. The delays double at every
+# attempt and are jittered, so the connections retrying do not collide again.
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 0.05
+# Seconds after which the clients may retry an operation given up.
+BUSY_RETRY_AFTER = 1
+# Messages of the sqlite3.OperationalError raised when waiting longer for
+# the database could make the operation succeed. "interrupted" is raised when
+# the deadline of the connection passed while running a statement.
+BUSY_MESSAGES = ('database is locked', 'database table is locked',
+                 'database schema is locked', 'interrupted')
+# Virtual machine instructions run by sqlite between two checks of the
+# deadline of a connection, a fraction of a millisecond.
+DEADLINE_CHECK_STEPS = 10000
+
+
+class DatabaseBusyError(sqlite3.OperationalError):
+    '''
+    Raised when an operation of a :py:class:`Connection` gives up because the
+    database stayed locked by other connections, or because the deadline of
+    the connection passed.
+
+    :param str message: the reason.
+    :param int retry_after: seconds after which the operation may succeed.
+    '''
+
+    def __init__(self, message, retry_after=BUSY_RETRY_AFTER):
+        super(DatabaseBusyError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+def _is_busy(error):
+    '''
+    :returns: ``True`` if the sqlite3 error ``error`` means that the database
+        was locked by another connection or the deadline passed.
+    '''
+    return isinstance(error, sqlite3.OperationalError) and \
+        str(error).startswith(BUSY_MESSAGES)
+
+
+def busy_aware(retry=True):
+    '''
+    Decorates the methods of :py:class:`Connection` so that they fail with
+    :py:class:`DatabaseBusyError` when the database is locked or the deadline
+    set with :py:meth:`Connection.set_deadline` passed.
+
+    The changes of the failed attempt are rolled back. The idempotent methods
+    (reads, updates and deletes) are attempted again after a jittered
+    backoff, as long as the deadline allows it. A method called inside an
+    open :py:meth:`Connection.transaction` is not attempted again: the whole
+    transaction is rolled back and must be run again by its owner.
+
+    :param bool retry: ``False`` for the methods which must run at most once,
+        such as the inserts.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            # The methods called by a method are part of its operation
+            if self._operation_depth:
+                return method(self, *args, **kwargs)
+            self._check_deadline()
+            attempt = 0
+            while True:
+                self._operation_depth += 1
+                try:
+                    return method(self, *args, **kwargs)
+                except sqlite3.OperationalError as excp:
+                    if not _is_busy(excp):
+                        raise
+                    error = excp
+                finally:
+                    self._operation_depth -= 1
+
+                if self._transaction_depth == 0:
+                    self.con.rollback()
+                    self._forget()
+                delay = random.uniform(0, BUSY_BACKOFF * 2 ** attempt)
+                left = self.time_left()
+                if not retry or attempt + 1 >= BUSY_RETRIES or \
+                        self._transaction_depth or \
+                        (left is not None and left <= delay):
+                    raise DatabaseBusyError(str(error)) from error
+                if left is not None:
+                    # The next attempt must not wait past the deadline
+                    self._set_busy_timeout(min(self.busy_timeout,
+                                               left - delay))
+                time.sleep(delay)
+                attempt += 1
+        return wrapper
+    return decorator
+
+# Columns selected for each key of the dictionaries returned by the users
+# API. When the caller asks only for some of the keys, just the matching
+# columns are put in the projection of the query.
+USER_COLUMNS = {
+    'nickname': 'users.nickname',
+    'registrationdate': 'users.regDate',
+    'lastlogindate': 'users.lastLoginDate',
+    'firstname': 'users_profile.firstname',
+    'lastname': 'users_profile.lastname',
+    'email': 'users_profile.email',
+    'mobile': 'users_profile.mobile',
+    'gender': 'users_profile.gender',
+    'avatar': 'users_profile.avatar',
+    'birthdate': 'users_profile.birthdate',
+    'bio': 'users_profile.bio',
+}
+
+# Same as USER_COLUMNS for the dictionaries returned by the posts API.
+POST_COLUMNS = {
+    'post_id': 'posts.post_id',
+    'timestamp': 'posts.timestamp',
+    'sender': 'sender.nickname sender',
+    'receiver': 'receiver.nickname receiver',
+    'reply_to': 'posts.reply_to',
+    'post_text': 'posts.post_text',
+    'rating': 'posts.rating',
+    'anonymous': 'posts.anonymous',
+    'public': 'posts.public',
+}
+
+# Same as USER_COLUMNS for the dictionaries returned by the ratings API.
+RATING_COLUMNS = {
+    'rating_id': 'ratings.rating_id',
+    'timestamp': 'ratings.timestamp',
+    'sender': 'sender.nickname sender',
+    'receiver': 'receiver.nickname receiver',
+    'rating': 'ratings.rating',
+}
+
 
 class Engine(object):
 
@@ -90,10 +233,12 @@ class Engine(object):
     :param db_path: The path of the database file (always with respect to the
         calling script. If not specified, the Engine will use the file located
         at *db/critique.db*
+    :param float busy_timeout: seconds the connections wait for the locks of
+        the other connections, see :py:data:`DEFAULT_BUSY_TIMEOUT`.
 
     '''
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, busy_timeout=DEFAULT_BUSY_TIMEOUT):
         '''
         :references:
 
@@ -105,6 +250,7 @@ class Engine(object):
             self.db_path = db_path
         else:
             self.db_path = DEFAULT_DB_PATH
+        self.busy_timeout = busy_timeout
 
     def connect(self):
         '''
@@ -118,7 +264,7 @@ class Engine(object):
         :rtype: Connection
 
         '''
-        return Connection(self.db_path)
+        return Connection(self.db_path, self.busy_timeout)
 
     def remove_database(self):
         '''
@@ -154,6 +300,11 @@ class Engine(object):
             # NOTE Since we have delete on cascade on all the tables to users
             # deleting the user will also delete all other entries
             cur.execute("DELETE FROM users")
+            # The change log is not linked to the users and it is filled
+            # again by the deletes above
+            cur.execute("DELETE FROM changes")
+            cur.execute("DELETE FROM idempotency_keys")
+            cur.execute("DELETE FROM reputation_state")
 
     # METHODS TO CREATE AND POPULATE A DATABASE USING DIFFERENT SCRIPTS
     def create_tables(self, schema=None):
@@ -305,10 +456,12 @@ class Connection(object):
 
     :param db_path: Location of the database file.
     :type dbpath: str
+    :param float busy_timeout: seconds to wait for the locks of the other
+        connections.
 
     '''
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, busy_timeout=DEFAULT_BUSY_TIMEOUT):
         '''
         :references:
 
@@ -316,8 +469,17 @@ class Connection(object):
 
         '''
         super(Connection, self).__init__()
-        self.con = sqlite3.connect(db_path)
+        self.con = sqlite3.connect(db_path, timeout=busy_timeout)
+        self.busy_timeout = busy_timeout
+        self._deadline = None
+        # Nesting of the busy_aware methods being run
+        self._operation_depth = 0
         self._isclosed = False
+        self._transaction_depth = 0
+        self._listeners = []
+        self._pending_changes = []
+        # Identity map, see _loaded
+        self._identity_map = {'user': {}, 'post': {}, 'rating': {}}
 
     def isclosed(self):
         '''
@@ -343,6 +505,201 @@ class Connection(object):
             self.con.close()
             self._isclosed = True
 
+    # DEADLINE
+    def set_deadline(self, budget):
+        '''
+        Limits the time left to the operations of the connection, typically
+        to the time budget of the request using it. The operations do not
+        wait for the locks of other connections past the deadline, and the
+        ones started after it fail at once with :py:class:`DatabaseBusyError`.
+
+        The statements of the :py:func:`busy_aware` methods still running at
+        the deadline are interrupted by sqlite. The rows read afterwards
+        from the iterators of the ``iter_*`` methods, e.g. while a response
+        is streamed, are not: the status of the response was already sent.
+
+        :param float budget: seconds from now, or None to remove the deadline.
+        '''
+        if budget is None:
+            self._deadline = None
+            self.con.set_progress_handler(None, 0)
+            self._set_busy_timeout(self.busy_timeout)
+            return
+        self._deadline = time.monotonic() + budget
+        self.con.set_progress_handler(self._past_deadline,
+                                      DEADLINE_CHECK_STEPS)
+        self._set_busy_timeout(min(self.busy_timeout, budget))
+
+    def _past_deadline(self):
+        '''
+        Progress handler of the sqlite connection: a true value interrupts
+        the running statement, which fails with "interrupted".
+        '''
+        return self._operation_depth > 0 and \
+            time.monotonic() >= self._deadline
+
+    def time_left(self):
+        '''
+        :returns: seconds until the deadline, or None without deadline.
+        '''
+        if self._deadline is None:
+            return None
+        return self._deadline - time.monotonic()
+
+    def _check_deadline(self):
+        '''
+        :raises DatabaseBusyError: if the deadline passed.
+        '''
+        left = self.time_left()
+        if left is not None and left <= 0:
+            raise DatabaseBusyError('The deadline of the connection passed')
+
+    def _set_busy_timeout(self, timeout):
+        self.con.execute('PRAGMA busy_timeout = %d' %
+                         max(0, int(timeout * 1000)))
+
+    # TRANSACTIONS
+    @contextmanager
+    def transaction(self):
+        '''
+        Groups several calls of the database API in one transaction. The
+        changes are committed when the outermost block ends, or rolled back
+        if it raises an exception. Blocks can be nested.
+
+        :Example:
+
+        >>> with con.transaction():
+        ...     con.create_rating('Scott', 'Kim', 7)
+        ...     con.modify_post_publicity('p-4', 1)
+        '''
+        self._transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.con.rollback()
+                # The changes were not saved, nobody is notified
+                self._pending_changes = []
+                self._forget()
+            raise
+        self._transaction_depth -= 1
+        if self._transaction_depth == 0:
+            self.con.commit()
+            changes, self._pending_changes = self._pending_changes, []
+            for change in changes:
+                self._dispatch(change)
+
+    def in_transaction(self):
+        '''
+        :returns: ``True`` if a :py:meth:`transaction` block is open.
+        '''
+        return self._transaction_depth > 0
+
+    # IDENTITY MAP
+    def _loaded(self, kind, key, fields=None, required=()):
+        '''
+        Looks up a user, post or rating already read through this connection.
+        A connection lives as long as a request, so each row is read at most
+        once per request. The entries are forgotten when they are written.
+
+        :param str kind: ``'user'`` (the key is the nickname and the value
+            the user id), ``'post'`` or ``'rating'`` (the key is the integer
+            id and the value the whole dictionary).
+        :param key: the key of the entry. None is never loaded.
+        :param fields: keys of the dictionary the caller is interested in,
+            the other ones are set to None as when they are not selected.
+        :param required: keys always kept.
+        :returns: a copy of the entry, None if it is known not to exist or
+            ``_NOT_LOADED``.
+        '''
+        entries = self._identity_map[kind]
+        if key is None or key not in entries:
+            return _NOT_LOADED
+        value = entries[key]
+        if not isinstance(value, dict):
+            return value
+        return dict((name, item if fields is None or name in fields or
+                     name in required else None)
+                    for name, item in value.items())
+
+    def _remember(self, kind, key, value):
+        '''
+        Stores an entry of the identity map, see :py:meth:`_loaded`. value is
+        None for rows that do not exist.
+        '''
+        if key is not None:
+            self._identity_map[kind][key] = \
+                dict(value) if isinstance(value, dict) else value
+
+    def _forget(self, kind=None, key=None):
+        '''
+        Removes an entry of the identity map, all the entries of a kind if
+        ``key`` is None, or everything if ``kind`` is None too.
+        '''
+        if kind is None:
+            for entries in self._identity_map.values():
+                entries.clear()
+        elif key is None:
+            self._identity_map[kind].clear()
+        else:
+            self._identity_map[kind].pop(key, None)
+
+    # LISTENERS
+    def add_listener(self, listener):
+        '''
+        Registers a function called after each change made through this
+        connection is committed. The function receives a dictionary with the
+        keys ``entity`` (``'user'``, ``'post'`` or ``'rating'``), ``action``
+        (``'insert'``, ``'update'``, ``'publish'``, ``'unpublish'`` or
+        ``'delete'``) and further keys depending on the entity:
+
+            * ``post``: the post as returned by :py:meth:`get_post`.
+            * ``parent``: for replies, the post answered.
+            * ``rating``: the rating as returned by :py:meth:`get_rating`.
+            * ``nickname``: the nickname of the user. When a user is
+              deleted their posts and ratings are deleted too, without
+              further notifications.
+
+        Listeners are only called when the change is committed, that is at the
+        end of the outermost :py:meth:`transaction` if one is open.
+
+        :param listener: a callable receiving one argument.
+        '''
+        self._listeners.append(listener)
+
+    def _notify(self, entity, action, **details):
+        '''
+        Tells the listeners about a change, or queues it until the open
+        transaction is committed.
+        '''
+        if not self._listeners:
+            return
+        change = dict(details, entity=entity, action=action)
+        if self._transaction_depth > 0:
+            self._pending_changes.append(change)
+        else:
+            self._dispatch(change)
+
+    def _dispatch(self, change):
+        '''
+        Calls the listeners with a committed change. A failing listener does
+        not affect the write or the other listeners.
+        '''
+        for listener in self._listeners:
+            try:
+                listener(change)
+            except Exception as excp:
+                print("Error in change listener: %s" % excp)
+
+    def _commit(self):
+        '''
+        Commits the changes of a write method, unless they are part of an
+        open :py:meth:`transaction`.
+        '''
+        if self._transaction_depth == 0:
+            self.con.commit()
+
     # FOREIGN KEY STATUS
     def check_foreign_keys_status(self):
         '''
@@ -424,6 +781,36 @@ class Connection(object):
             return False
 
     # Helpers
+    def _projection(self, columns, fields=None, required=()):
+        '''
+        Builds the list of columns of a SELECT statement.
+
+        :param dict columns: one of ``USER_COLUMNS``, ``POST_COLUMNS`` or
+            ``RATING_COLUMNS``.
+        :param fields: keys of the resulting dictionaries the caller is
+            interested in. If None, all the columns are selected.
+        :param required: keys that are always selected, for instance the ones
+            needed to build the links of a resource.
+
+        :returns: the selected columns separated by commas.
+        :raises ValueError: if ``fields`` contains an unknown key.
+
+        '''
+        if fields is None:
+            return ', '.join(columns.values())
+        unknown = set(fields) - set(columns)
+        if unknown:
+            raise ValueError('Unknown fields: %s' % ', '.join(sorted(unknown)))
+        return ', '.join(column for key, column in columns.items()
+                         if key in fields or key in required)
+
+    def _value(self, row, key):
+        '''
+        :returns: the value of the column ``key`` of ``row`` or None if the
+            column was not selected.
+        '''
+        return row[key] if key in row.keys() else None
+
     # Users Helpers
     def _create_user_list_object(self, row):
         '''
@@ -438,11 +825,11 @@ class Connection(object):
 
         '''
         return {
-            'nickname': row['nickname'],
-            'bio': row['bio'],
-            'avatar': row['avatar'],
-            'firstname': row['firstname'],
-            'lastname': row['lastname']
+            'nickname': self._value(row, 'nickname'),
+            'bio': self._value(row, 'bio'),
+            'avatar': self._value(row, 'avatar'),
+            'firstname': self._value(row, 'firstname'),
+            'lastname': self._value(row, 'lastname')
         }
 
     def _create_user_object(self, row):
@@ -488,23 +875,24 @@ class Connection(object):
             * ``bio``: text chosen by the user for biography
 
             Note that all values are string if they are not otherwise indicated.
+            Columns that were not selected are None.
 
         '''
         return {
             'summary': {
-                'nickname': row['nickname'],
-                'registrationdate': row['regDate'],
-                'bio': row['bio'],
-                'avatar': row['avatar']
+                'nickname': self._value(row, 'nickname'),
+                'registrationdate': self._value(row, 'regDate'),
+                'bio': self._value(row, 'bio'),
+                'avatar': self._value(row, 'avatar')
             },
             'details': {
-                'lastlogindate': row['lastLoginDate'],
-                'firstname': row['firstname'],
-                'lastname': row['lastname'],
-                'email': row['email'],
-                'mobile': row['mobile'],
-                'gender': row['gender'],
-                'birthdate': row['birthdate'],
+                'lastlogindate': self._value(row, 'lastLoginDate'),
+                'firstname': self._value(row, 'firstname'),
+                'lastname': self._value(row, 'lastname'),
+                'email': self._value(row, 'email'),
+                'mobile': self._value(row, 'mobile'),
+                'gender': self._value(row, 'gender'),
+                'birthdate': self._value(row, 'birthdate'),
             }
         }
 
@@ -521,29 +909,53 @@ class Connection(object):
         '''
         return {
             'rating_id': 'rtg-' + str(row['rating_id']),
-            'timestamp': row['timestamp'],
-            'sender': row['sender'],
-            'receiver': row['receiver'],
-            'rating': row['rating']
+            'timestamp': self._value(row, 'timestamp'),
+            'sender': self._value(row, 'sender'),
+            'receiver': self._value(row, 'receiver'),
+            'rating': self._value(row, 'rating')
         }
 
     # Database API
 
     # User API
-    def get_users(self):
+    @busy_aware()
+    def get_users(self, fields=None):
         '''
         Extracts all users in the database.
 
+        :param fields: keys of :py:meth:`_create_user_list_object` to select.
+            If None all of them are selected. The nickname is always selected.
         :returns: list of Users of the database. Each user is a dictionary
             that contains following keys: ``nickname`` (str), ``registrationdate``
             (long representing UNIX timestamp), ``bio`` (str) and ``avatar`` (str). None is returned if the database
             has no users.
+        :raises ValueError: if ``fields`` contains an unknown key.
+
+        '''
+        return list(self.iter_users(fields))
+
+    @busy_aware()
+    def iter_users(self, fields=None):
+        '''
+        Same as :py:meth:`get_users`, but the users are read from the
+        database one by one as the returned iterator is consumed, so the
+        whole list is never kept in memory. The statement is run at once: a
+        locked database fails here, not while the users are read.
+
+        :param fields: keys of :py:meth:`_create_user_list_object` to select.
+            If None all of them are selected. The nickname is always selected.
+        :returns: iterator of dictionaries with the format provided in
+            :py:meth:`_create_user_list_object`
+        :raises ValueError: if ``fields`` contains an unknown key.
 
         '''
         # Create the SQL Statements
-        # SQL Statement for retrieving the users
-        query = 'SELECT users.*, users_profile.* FROM users, users_profile \
-                 WHERE users.user_id = users_profile.user_id'
+        # SQL Statement for retrieving the users. The profile table is only
+        # joined when one of its columns is requested.
+        columns = self._projection(USER_COLUMNS, fields, ('nickname',))
+        query = 'SELECT ' + columns + ' FROM users'
+        if 'users_profile.' in columns:
+            query += ', users_profile WHERE users.user_id = users_profile.user_id'
 
         # Activate foreign key support
         self.set_foreign_keys_support()
@@ -555,38 +967,73 @@ class Connection(object):
         # Execute main SQL Statement
         cur.execute(query)
 
-        # Process the results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
+        # Process the results while they are fetched
+        return (self._create_user_list_object(row) for row in cur)
 
-        # Process the response.
-        users = []
-        for row in rows:
-            users.append(self._create_user_list_object(row))
-        return users
+    @busy_aware()
+    def get_users_by_nicknames(self, nicknames, fields=None):
+        '''
+        Extracts several users with one query.
+
+        :param list nicknames: the nicknames of the users.
+        :param fields: keys of :py:meth:`_create_user_list_object` to select.
+            If None all of them are selected. The nickname is always selected.
+        :returns: list with one element per nickname, in the same order. The
+            element is a dictionary with the format provided in
+            :py:meth:`_create_user_list_object` or None if the user does not
+            exist.
+        :raises ValueError: if ``fields`` contains an unknown key.
+        '''
+        unique = list(dict.fromkeys(nicknames))
+        if not unique:
+            return []
+
+        # Create the SQL Statement
+        columns = self._projection(USER_COLUMNS, fields, ('nickname',))
+        query = 'SELECT ' + columns + ' FROM users'
+        if 'users_profile.' in columns:
+            query += ' INNER JOIN users_profile \
+                       ON users_profile.user_id = users.user_id'
+        query += ' WHERE users.nickname IN (%s)' % ', '.join('?' * len(unique))
+
+        # Activate foreign key support
+        self.set_foreign_keys_support()
+
+        # Cursor and row initialization
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+
+        # Execute main SQL Statement
+        cur.execute(query, unique)
 
-    def get_user(self, nickname):
+        # Put the users back in the order of the request
+        users = dict((row['nickname'], self._create_user_list_object(row))
+                     for row in cur)
+        return [users.get(nickname) for nickname in nicknames]
+
+    @busy_aware()
+    def get_user(self, nickname, fields=None):
         '''
         Extracts all the information of a user.
 
         :param str nickname: The nickname of the user to search for.
+        :param fields: keys of :py:meth:`_create_user_object` to select (for
+            instance ``('avatar', 'firstname')``). If None all of them are
+            selected. The nickname is always selected.
         :returns: dictionary with the format provided in the method:
-            :py:meth:`_create_user_object`
+            :py:meth:`_create_user_object` or None if the user does not exist.
+        :raises ValueError: if ``fields`` contains an unknown key.
 
         '''
         # Create the SQL Statements
 
-        # SQL Statement for retrieving the user given a nickname
-        query1 = 'SELECT user_id from users WHERE nickname = ?'
-
-        # SQL Statement for retrieving the user information
-        query2 = 'SELECT users.*, users_profile.* FROM users, users_profile \
-                  WHERE users.user_id = ? \
-                  AND users_profile.user_id = users.user_id'
-
-        # Variable to be used in the second query.
-        user_id = None
+        # SQL Statement for retrieving the user information given a nickname
+        columns = self._projection(USER_COLUMNS, fields, ('nickname',))
+        query = 'SELECT ' + columns + ' FROM users'
+        if 'users_profile.' in columns:
+            query += ' INNER JOIN users_profile \
+                       ON users_profile.user_id = users.user_id'
+        query += ' WHERE users.nickname = ?'
 
         # Activate foreign key support
         self.set_foreign_keys_support()
@@ -595,86 +1042,303 @@ class Connection(object):
         self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
 
-        # Execute SQL Statement to retrieve the id given a nickname
+        # Execute SQL Statement to retrieve the user given a nickname
         pvalue = (nickname,)
-        cur.execute(query1, pvalue)
+        cur.execute(query, pvalue)
 
-        # Extract the user id
+        # Process the response. Only one possible row is expected.
         row = cur.fetchone()
         if row is None:
             return None
-        user_id = row["user_id"]
-
-        # Execute the SQL Statement to retrieve the user information.
-        # Create first the valuse
-        pvalue = (user_id, )
-        # execute the statement
-        cur.execute(query2, pvalue)
-
-        # Process the response. Only one possible row is expected.
-        row = cur.fetchone()
         return self._create_user_object(row)
 
     # Ratings API
-    def get_ratings(self, sender=None, receiver=None):
+    @busy_aware()
+    def get_ratings(self, sender=None, receiver=None, fields=None,
+                    after=None, limit=None):
         '''
         Extracts ratings in the database for a user
 
+        :param fields: keys of :py:meth:`_create_rating_object` to select. If
+            None all of them are selected. The rating id is always selected.
+        :param int after: only the ratings with a greater id are returned.
+            Used to read the next page of ratings.
+        :param int limit: maximum number of ratings to return.
         :returns: ratings for each user
             contains following keys: ``id`` (integer), ``timestamp``
             (long representing UNIX timestamp), ``sender`` (str), ``receiver`` (str) and ``rating`` (integer).
             None is returned if the database has no ratings.
+        :raises ValueError: if ``fields`` contains an unknown key.
+
+        '''
+        return list(self.iter_ratings(sender, receiver, fields, after, limit))
+
+    @busy_aware()
+    def iter_ratings(self, sender=None, receiver=None, fields=None,
+                     after=None, limit=None):
+        '''
+        Same as :py:meth:`get_ratings`, but the ratings are read from the
+        database one by one as the returned iterator is consumed.
+
+        :returns: iterator of dictionaries with the format provided in
+            :py:meth:`_create_rating_object`
+        :raises ValueError: if ``fields`` contains an unknown key.
 
         '''
 
         # Create the SQL Statements
         # SQL Statement for retrieving the ratings
-        query = 'SELECT ratings.*, sender.nickname sender, receiver.nickname receiver FROM ratings INNER JOIN users sender on sender.user_id = ratings.sender_id INNER JOIN users receiver on receiver.user_id = ratings.receiver_id'
+        columns = self._projection(RATING_COLUMNS, fields, ('rating_id',))
+        query = 'SELECT ' + columns + ' FROM ratings INNER JOIN users sender on sender.user_id = ratings.sender_id INNER JOIN users receiver on receiver.user_id = ratings.receiver_id'
+
+        # The users are resolved first, so that the ratings of a user are
+        # read in order of id from the ratings_sender or ratings_receiver
+        # index, starting at the last rating of the previous page
+        conditions = []
+        pval = []
+        if sender is not None:
+            sender_id = self.get_user_id_w_nickname(sender)
+            if sender_id is None:
+                return iter(())
+            conditions.append("ratings.sender_id = ?")
+            pval.append(sender_id)
+        if receiver is not None:
+            receiver_id = self.get_user_id_w_nickname(receiver)
+            if receiver_id is None:
+                return iter(())
+            conditions.append("ratings.receiver_id = ?")
+            pval.append(receiver_id)
+        if after is not None:
+            conditions.append("ratings.rating_id > ?")
+            pval.append(after)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY ratings.rating_id"
+        if limit is not None:
+            query += " LIMIT ?"
+            pval.append(limit)
+
+        # Activate foreign key support
+        self.set_foreign_keys_support()
 
-        pval = None
+        # Create the cursor
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+
+        # Execute main SQL Statement
+        cur.execute(query, pval)
+
+        # Process the results while they are fetched
+        return (self._create_rating_object(row) for row in cur)
+
+    @busy_aware()
+    def get_rating_stats(self, group_by='receiver', sender=None,
+                         receiver=None, after=None, limit=None):
+        '''
+        Aggregates the ratings per user. The aggregates are computed by the
+        database from the ratings indexes, without reading the ratings.
+
+        :param str group_by: ``'receiver'`` to aggregate the ratings received
+            by each user or ``'sender'`` to aggregate the ratings given by
+            each user.
+        :param str sender: only aggregate the ratings given by this user.
+        :param str receiver: only aggregate the ratings received by this user.
+        :param str after: only the users with a nickname that sorts after
+            this one are returned. Used to read the next page.
+        :param int limit: maximum number of users to return.
+        :returns: list of dictionaries ordered by nickname. Users without
+            ratings are not included. Each dictionary has the keys
+            ``nickname`` (str), ``count`` (int), ``average`` (float) and
+            ``histogram`` (dict mapping each rating value from 1 to 10 to the
+            number of ratings with that value).
+        :raises ValueError: if ``group_by`` is not ``'receiver'`` or
+            ``'sender'``.
+        '''
+        if group_by not in ('receiver', 'sender'):
+            raise ValueError('Ratings can only be grouped by receiver or sender')
+        other = 'sender' if group_by == 'receiver' else 'receiver'
+
+        # Create the SQL Statement. The histogram is one SUM per value.
+        histogram = ', '.join('SUM(ratings.rating = %d) rating_%d' % (value, value)
+                              for value in range(1, 11))
+        query = 'SELECT users.nickname nickname, COUNT(*) count, \
+                 AVG(ratings.rating) average, ' + histogram + ' \
+                 FROM users INNER JOIN ratings \
+                 ON ratings.' + group_by + '_id = users.user_id'
+        conditions = []
+        pvalue = []
         if sender is not None or receiver is not None:
-            query += " WHERE "
-            if sender is not None:
-                query += "sender = ?"
-                pval = (sender,)
-            if receiver is not None:
-                if sender is not None:
-                    query += " AND "
-                query += "receiver = ?"
-                if pval is not None:
-                    pval = (sender, receiver)
-                else:
-                    pval = (receiver,)
+            query += ' INNER JOIN users ' + other + ' ON ' + other + \
+                '.user_id = ratings.' + other + '_id'
+        if sender is not None:
+            conditions.append(
+                ('users' if group_by == 'sender' else 'sender') + '.nickname = ?')
+            pvalue.append(sender)
+        if receiver is not None:
+            conditions.append(
+                ('users' if group_by == 'receiver' else 'receiver') + '.nickname = ?')
+            pvalue.append(receiver)
+        if after is not None:
+            conditions.append('users.nickname > ?')
+            pvalue.append(after)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' GROUP BY users.nickname ORDER BY users.nickname'
+        if limit is not None:
+            query += ' LIMIT ?'
+            pvalue.append(limit)
 
         # Activate foreign key support
         self.set_foreign_keys_support()
 
-        # Create the cursor
+        # Cursor and row initialization
         self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
 
         # Execute main SQL Statement
-        if pval is None:
-            cur.execute(query)
+        cur.execute(query, pvalue)
+
+        # Build the return objects
+        return [{
+            'nickname': row['nickname'],
+            'count': row['count'],
+            'average': row['average'],
+            'histogram': dict((value, row['rating_%d' % value])
+                              for value in range(1, 11))
+        } for row in cur]
+
+    @busy_aware()
+    def get_user_leaderboard(self, since=None, min_count=1, after=None,
+                             limit=None):
+        '''
+        Ranks the users by the average of the ratings they received, best
+        first. The users with the same average are ordered by decreasing id.
+
+        Without ``since`` the users are read in order from the index
+        rating_totals_average, kept up to date by the triggers of the
+        ratings, so the cost does not depend on the number of ratings. With
+        ``since`` the daily totals of the window are added up again for every
+        page, so the cost grows with the days and the users of the window.
+
+        :param int since: only the ratings given this UNIX timestamp or
+            later. It is rounded down to the start of its day (UTC).
+        :param int min_count: only the users with at least this number of
+            ratings.
+        :param tuple after: ``(average, user_id)`` of the last user of the
+            previous page. Only the users ranked after it are returned.
+        :param int limit: maximum number of users to return.
+        :returns: list of dictionaries with the keys ``nickname`` (str),
+            ``user_id`` (int, used for paging), ``count`` (int) and
+            ``average`` (float).
+        '''
+        pvalue = []
+        if since is None:
+            average = 'rating_totals.total * 1.0 / rating_totals.count'
+            query = 'SELECT users.nickname nickname, users.user_id user_id, \
+                     rating_totals.count count, ' + average + ' average \
+                     FROM rating_totals INNER JOIN users \
+                     ON users.user_id = rating_totals.user_id \
+                     WHERE rating_totals.count >= ?'
+            pvalue.append(max(min_count, 1))
+            if after is not None:
+                # Written as a range of the index, to start reading at the
+                # last user of the previous page
+                query += ' AND ' + average + ' <= ? AND (' + average + \
+                    ' < ? OR rating_totals.user_id < ?)'
+                pvalue.extend((after[0], after[0], after[1]))
+            query += ' ORDER BY ' + average + ' DESC, rating_totals.user_id DESC'
         else:
-            cur.execute(query, pval)
+            # The days of the window are read first from the primary key
+            average = 'SUM(days.total) * 1.0 / SUM(days.count)'
+            query = 'WITH days AS MATERIALIZED (SELECT user_id, count, total \
+                     FROM rating_days WHERE day >= ?) \
+                     SELECT users.nickname nickname, users.user_id user_id, \
+                     SUM(days.count) count, ' + average + ' average \
+                     FROM days INNER JOIN users ON users.user_id = days.user_id \
+                     GROUP BY users.user_id HAVING SUM(days.count) >= ?'
+            pvalue.extend((since // 86400, max(min_count, 1)))
+            if after is not None:
+                query += ' AND (' + average + ' < ? OR (' + average + \
+                    ' = ? AND users.user_id < ?))'
+                pvalue.extend((after[0], after[0], after[1]))
+            query += ' ORDER BY ' + average + ' DESC, users.user_id DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            pvalue.append(limit)
 
-        # Process the results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
+        # Cursor and row initialization
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
 
-        # Process the response.
-        rating = []
-        for row in rows:
-            rating.append(self._create_rating_object(row))
-        return rating
+        # Execute main SQL Statement
+        cur.execute(query, pvalue)
+        return [{
+            'nickname': row['nickname'],
+            'user_id': row['user_id'],
+            'count': row['count'],
+            'average': row['average']
+        } for row in cur]
+
+    @busy_aware()
+    def get_post_leaderboard(self, since=None, after=None, limit=None,
+                             fields=None):
+        '''
+        Ranks the public posts by rating, best first, and the posts with the
+        same rating from the newest to the oldest. The posts without rating
+        are not ranked.
+
+        The ratings are the values from 1 to 10, so each one is read in turn
+        from the index posts_public_rating until the page is full: the cost
+        only depends on the size of the page.
+
+        :param int since: only the posts with this UNIX timestamp or a later
+            one.
+        :param tuple after: ``(rating, timestamp, post_id)`` of the last post
+            of the previous page. Only the posts ranked after it are returned.
+        :param int limit: maximum number of posts to return.
+        :param fields: keys of :py:meth:`_create_post_list_object` to select.
+            If None all of them are selected. The post id, the rating and the
+            timestamp are always selected.
+        :returns: list of posts with the format provided in
+            :py:meth:`_create_post_list_object`.
+        :raises ValueError: if ``fields`` contains an unknown key.
+        '''
+        if fields is not None:
+            fields = set(fields) | set(('rating', 'timestamp'))
+
+        # Activate foreign key support
+        self.set_foreign_keys_support()
+
+        # Cursor and row initialization
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
 
-    def get_rating(self, rating_id):
+        posts = []
+        for rating in range(10, 0, -1):
+            if limit is not None and len(posts) >= limit:
+                break
+            position = None
+            if after is not None:
+                if rating > after[0]:
+                    continue
+                if rating == after[0]:
+                    position = after[1:]
+            query, pvalue = self._posts_query(
+                since=since, public=True, after=position,
+                limit=None if limit is None else limit - len(posts),
+                fields=fields, rating=rating)
+            cur.execute(query, pvalue)
+            posts.extend(self._create_post_list_object(row) for row in cur)
+        return posts
+
+    @busy_aware()
+    def get_rating(self, rating_id, fields=None):
         '''
         Extracts rating in the database for given rating id
 
         :param str rating_id: rating id in the database in format ``rtg-(\d+)``
+        :param fields: keys of :py:meth:`_create_rating_object` to select. If
+            None all of them are selected.
 
         :returns: rating information for the given rating id
             contains following keys: ``id`` (integer), ``timestamp``
@@ -690,9 +1354,14 @@ class Connection(object):
             raise ValueError('rating id is malformed')
         rating_id = int(m.group(1))
 
+        columns = self._projection(RATING_COLUMNS, fields, ('rating_id',))
+        rating = self._loaded('rating', rating_id, fields, ('rating_id',))
+        if rating is not _NOT_LOADED:
+            return rating
+
         # Create the SQL Statements
         # SQL Statement for retrieving the ratings
-        query = 'SELECT ratings.*, sender.nickname sender, receiver.nickname receiver FROM ratings INNER JOIN users sender on sender.user_id = ratings.sender_id INNER JOIN users receiver on receiver.user_id = ratings.receiver_id WHERE ratings.rating_id = ?'
+        query = 'SELECT ' + columns + ' FROM ratings INNER JOIN users sender on sender.user_id = ratings.sender_id INNER JOIN users receiver on receiver.user_id = ratings.receiver_id WHERE ratings.rating_id = ?'
 
         # Activate foreign key support
         self.set_foreign_keys_support()
@@ -707,9 +1376,14 @@ class Connection(object):
         # Process the results
         row = cur.fetchone()
         if row is None:
+            self._remember('rating', rating_id, None)
             return None
-        return self._create_rating_object(row)
+        rating = self._create_rating_object(row)
+        if fields is None:
+            self._remember('rating', rating_id, rating)
+        return rating
 
+    @busy_aware()
     def modify_rating(self, rating_id, new_rating):
         '''
         Modify the rating of the rating with id ``rating_id``
@@ -746,16 +1420,23 @@ class Connection(object):
             # Execute the statement to extract the id associated to a nickname
             pvalue = (new_rating, rating_id)
             cur.execute(query, pvalue)
-            self.con.commit()
+            self._commit()
+            self._forget('rating', rating_id)
         except sqlite3.Error as excp:
+            if _is_busy(excp):
+                raise
             print("Error %s:" % excp.args[0])
             return None
 
         # Check that I have modified the user
         if cur.rowcount < 1:
             return None
+        if self._listeners:
+            self._notify('rating', 'update',
+                         rating=self.get_rating('rtg-' + str(rating_id)))
         return 'rtg-' + str(rating_id)
 
+    @busy_aware()
     def delete_rating(self, rating_id):
         '''
         Delete the rating with id given as parameter.
@@ -772,6 +1453,11 @@ class Connection(object):
         rating_id_db = m.group(1)
         queryParameter = (rating_id_db, )
 
+        # The listeners receive the deleted rating
+        rating = None
+        if self._listeners:
+            rating = self.get_rating('rtg-' + rating_id_db)
+
         # Create the SQL Statement
         query = 'DELETE FROM ratings WHERE rating_id = ?'
 
@@ -788,16 +1474,22 @@ class Connection(object):
             cur = self.con.cursor()
             # execute the pragma command, OFF
             cur.execute(query, queryParameter)
+            self._forget('rating', int(rating_id_db))
             if cur.rowcount < 1:
                 print("No ratings with rating_id = %s" % str(rating_id))
                 return False
             print("%s rating deleted" % str(rating_id))
-            self.con.commit()
+            self._commit()
         except sqlite3.Error as excp:
+            if _is_busy(excp):
+                raise
             print("Error %s:" % excp.args[0])
             return False
+        if rating is not None:
+            self._notify('rating', 'delete', rating=rating)
         return True
 
+    @busy_aware()
     def delete_user(self, nickname):
         '''
         Deletes the user from the database.
@@ -821,11 +1513,19 @@ class Connection(object):
         try:
             cur.execute(query, pvalue)
             # Commit the delete
-            self.con.commit()
+            self._commit()
+            # Their posts and ratings are deleted too
+            self._forget()
         except sqlite3.Error as e:
+            if _is_busy(e):
+                raise
             print("Error %s:" % (e.args[0]))
+        if cur.rowcount > 0:
+            # The posts and ratings of the user are deleted too
+            self._notify('user', 'delete', nickname=nickname)
         return bool(cur.rowcount)
 
+    @busy_aware(retry=False)
     def create_rating(self, sender, receiver, rating):
         '''
         Create a new rating with the data provided as arguments.
@@ -851,20 +1551,14 @@ class Connection(object):
             raise ValueError(
                 'rating is already given by this sender to the receiver. try modifying the rating.')
 
-        # Create the SQL statment
-        # SQL Statement for getting the user id given a nickname
-        query_user_id = 'SELECT user_id from users WHERE nickname = ?'
-
         # SQL Statement for inserting the data
         stmnt = 'INSERT INTO ratings(timestamp,sender_id,receiver_id,rating) \
                  VALUES(?,?,?,?)'
 
-        # Variables for the statement.
-        # sender_id is obtained from first statement.
-        sender_id = None
-
-        # receiver_id is obtained from first statement.
-        receiver_id = None
+        # Variables for the statement. The ids of the users are usually known
+        # already, since the caller checked that they exist.
+        sender_id = self.get_user_id_w_nickname(sender)
+        receiver_id = self.get_user_id_w_nickname(receiver)
         timestamp = time.mktime(datetime.now().timetuple())
 
         # Activate foreign key support
@@ -874,25 +1568,6 @@ class Connection(object):
         self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
 
-        # Provide support for foreign keys
-        # Execute SQL Statement to get user_id given nickname
-        pvalue = (sender,)
-        cur.execute(query_user_id, pvalue)
-
-        # Extract user id
-        row = cur.fetchone()
-        if row is not None:
-            sender_id = row["user_id"]
-
-        # Execute SQL Statement to get user_id given nickname
-        pvalue = (receiver,)
-        cur.execute(query_user_id, pvalue)
-
-        # Extract user id
-        row = cur.fetchone()
-        if row is not None:
-            receiver_id = row["user_id"]
-
         if sender_id is None or receiver_id is None:
             raise ValueError('sender or receiver nickname is not found')
 
@@ -901,14 +1576,18 @@ class Connection(object):
 
         # Execute the statement
         cur.execute(stmnt, pvalue)
-        self.con.commit()
+        self._commit()
 
         # Extract the id of the added rating
         lid = cur.lastrowid
+        self._forget('rating', lid)
 
         # Return the id in
         if lid is None:
             return None
+        if self._listeners:
+            self._notify('rating', 'insert',
+                         rating=self.get_rating('rtg-' + str(lid)))
         return 'rtg-' + str(lid)
 
     def _create_post_object(self, row):
@@ -943,31 +1622,30 @@ class Connection(object):
         REFERENCEs:
         -   [1]
         '''
-        try:
-            receiver = row['receiver']
-        except:
-            receiver = None
         post = {
             'post_id': row['post_id'],
-            'timestamp': row['timestamp'],
-            'sender': row['sender'],
-            'receiver': receiver,
-            'reply_to': row['reply_to'],
-            'post_text': row['post_text'],
-            'rating': row['rating'],
-            'anonymous': row['anonymous'],
-            'public': row['public'],
+            'timestamp': self._value(row, 'timestamp'),
+            'sender': self._value(row, 'sender'),
+            'receiver': self._value(row, 'receiver'),
+            'reply_to': self._value(row, 'reply_to'),
+            'post_text': self._value(row, 'post_text'),
+            'rating': self._value(row, 'rating'),
+            'anonymous': self._value(row, 'anonymous'),
+            'public': self._value(row, 'public'),
         }
 
         return post
 
-    def get_post(self, post_id=None):
+    @busy_aware()
+    def get_post(self, post_id=None, fields=None):
         '''
         GETs a post from the database using the post_id
         as a query parameter
 
         :param post_id: post id in the database, which is of
             the type (int)
+        :param fields: keys of :py:meth:`_create_post_object` to select. If
+            None all of them are selected. The post id is always selected.
 
         :return: returns a dictionary with all the attributes
             of the message. the format is provided in
@@ -987,12 +1665,19 @@ class Connection(object):
         m = re.match('p-(\d+)', post_id)
         if m is not None and m.group(1) is not None:
             post_id = int(m.group(1))
+        key = self._post_key(post_id)
+
+        columns = self._projection(POST_COLUMNS, fields, ('post_id',))
+        post = self._loaded('post', key, fields, ('post_id',))
+        if post is not _NOT_LOADED:
+            return post
 
         # setting foreign keys support
         self.set_foreign_keys_support()
 
-        # initializing the SQL query
-        query = 'SELECT posts.*, sender.nickname sender, receiver.nickname receiver FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id INNER JOIN users receiver ON receiver.user_id = posts.receiver_id WHERE post_id = ? '
+        # initializing the SQL query. Replies have no receiver, hence the
+        # left join.
+        query = 'SELECT ' + columns + ' FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id LEFT JOIN users receiver ON receiver.user_id = posts.receiver_id WHERE post_id = ? '
 
         # using cursor and row initalization to enable
         # reading and returning the data in a dictionary
@@ -1009,24 +1694,27 @@ class Connection(object):
         # or not. if not, function will return None
         row = cur.fetchone()
         if row is None:
-            # try if its a reply
-            query = 'SELECT posts.*, sender.nickname sender FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id WHERE post_id = ? '
-
-            # putting the query parameter in a tuple
-            # to be able to execute.
-            queryPostId = (post_id,)
-            cur.execute(query, queryPostId)
-
-            # checking if the returned value contains a post
-            # or not. if not, function will return None
-            row = cur.fetchone()
-            if row is None:
-                return None
+            self._remember('post', key, None)
+            return None
 
         # however, in case it has returned an actual post
         # it has to be parsed before returning
-        return self._create_post_object(row)
+        post = self._create_post_object(row)
+        if fields is None:
+            self._remember('post', key, post)
+        return post
 
+    def _post_key(self, post_id):
+        '''
+        :returns: the key of a post in the identity map, None if ``post_id``
+            is not a valid id.
+        '''
+        try:
+            return int(post_id)
+        except (TypeError, ValueError):
+            return None
+
+    @busy_aware()
     def modify_user(self, nickname, summary, details):
         '''
         Modifies the user in the database.
@@ -1113,13 +1801,15 @@ class Connection(object):
             user_id,
         )
         cur.execute(query, pvalue)
-        self.con.commit()
+        self._commit()
 
         # Check that I have modified the user
         if cur.rowcount < 1:
             return None
+        self._notify('user', 'update', nickname=nickname)
         return nickname
 
+    @busy_aware(retry=False)
     def create_user(self, nickname, user):
         '''
         Create a new user in the database.
@@ -1247,7 +1937,9 @@ class Connection(object):
         )
 
         cur.execute(query2, pvalue)
-        self.con.commit()
+        self._commit()
+        self._forget('user', nickname)
+        self._notify('user', 'insert', nickname=nickname)
 
         # We do not do any comprobation and return the nickname
         return nickname
@@ -1289,6 +1981,7 @@ class Connection(object):
         else:
             return row[0]
 
+    @busy_aware()
     def get_user_id_w_nickname(self, nickname):
         '''
         Get the key of the database row which contains the user with the given
@@ -1300,8 +1993,13 @@ class Connection(object):
         :rtype: str
 
         '''
-        return self._get_user_w('nickname', nickname)
+        user_id = self._loaded('user', nickname)
+        if user_id is _NOT_LOADED:
+            user_id = self._get_user_w('nickname', nickname)
+            self._remember('user', nickname, user_id)
+        return user_id
 
+    @busy_aware()
     def get_user_id_w_email(self, email):
         '''
         Get the key of the database row which contains the user with the given
@@ -1315,6 +2013,7 @@ class Connection(object):
         '''
         return self._get_user_w('email', email)
 
+    @busy_aware()
     def get_user_id_w_mobile(self, mobile):
         '''
         Get the key of the database row which contains the user with the given
@@ -1349,69 +2048,233 @@ class Connection(object):
                     0 is False, 1 is True
         Note: all returned values are strings, unless otherwise stated.
         '''
-        try:
-            receiver = row['receiver']
-        except:
-            receiver = None
         post = {
             'post_id': str(row['post_id']),
-            'receiver': receiver,
-            'sender': row['sender'],
-            'timestamp': row['timestamp'],
-            'reply_to': str(row['reply_to']),
-            'post_text': row['post_text'],
-            'rating': row['rating'],
-            'anonymous': row['anonymous'],
-            'public': row['public']
+            'receiver': self._value(row, 'receiver'),
+            'sender': self._value(row, 'sender'),
+            'timestamp': self._value(row, 'timestamp'),
+            'reply_to': str(self._value(row, 'reply_to')),
+            'post_text': self._value(row, 'post_text'),
+            'rating': self._value(row, 'rating'),
+            'anonymous': self._value(row, 'anonymous'),
+            'public': self._value(row, 'public')
         }
         return post
 
 
-    def get_posts(self):
-        '''
-        Used to retrieve some posts posted by a user.
+    @busy_aware()
+    def get_posts(self, sender=None, receiver=None, since=None, until=None,
+                  min_rating=None, public=None, replies_only=False,
+                  descending=True, after=None, limit=None, fields=None):
+        '''
+        Extracts the posts of the database matching the given filters. All
+        the filters are optional and they are combined with AND.
+
+        :param str sender: nickname of the sender of the posts.
+        :param str receiver: nickname of the receiver of the posts.
+        :param int since: only posts with this UNIX timestamp or a later one.
+        :param int until: only posts with this UNIX timestamp or an older one.
+        :param int min_rating: only posts rated with at least this value.
+        :param public: if not None only public (True) or private (False)
+            posts.
+        :param bool replies_only: only replies to other posts.
+        :param bool descending: newest posts first if True (default), oldest
+            first otherwise. Posts with the same timestamp are ordered by id.
+        :param tuple after: ``(timestamp, post_id)`` of the last post of the
+            previous page. Only the posts coming after it in the requested
+            order are returned.
+        :param int limit: maximum number of posts to return.
+        :param fields: keys of :py:meth:`_create_post_list_object` to select.
+            If None all of them are selected. The post id is always selected.
+        :returns: list of posts. Each post is a dictionary with the keys
+            mentioned in :py:meth:`_create_post_list_object`. The list is
+            empty if no post matches, including when ``sender`` or
+            ``receiver`` does not exist.
+        :raises ValueError: if ``fields`` contains an unknown key.
+        '''
+        return list(self.iter_posts(sender, receiver, since, until,
+                                    min_rating, public, replies_only,
+                                    descending, after, limit, fields))
+
+    @busy_aware()
+    def iter_posts(self, sender=None, receiver=None, since=None, until=None,
+                   min_rating=None, public=None, replies_only=False,
+                   descending=True, after=None, limit=None, fields=None):
+        '''
+        Same as :py:meth:`get_posts`, but the posts are read from the
+        database one by one as the returned iterator is consumed.
+
+        :returns: iterator of dictionaries with the format provided in
+            :py:meth:`_create_post_list_object`
+        :raises ValueError: if ``fields`` contains an unknown key.
+        '''
+        # Resolve the nicknames first so the posts are filtered by the
+        # indexed user ids
+        sender_id = receiver_id = None
+        if sender is not None:
+            sender_id = self.get_user_id_w_nickname(sender)
+            if sender_id is None:
+                return iter(())
+        if receiver is not None:
+            receiver_id = self.get_user_id_w_nickname(receiver)
+            if receiver_id is None:
+                return iter(())
+
+        ratings = [None]
+        if min_rating is not None and sender_id is None and \
+                receiver_id is None:
+            # One query per rating, each one reading its posts in the order
+            # of posts_rating_timestamp or posts_public_rating, merged below
+            ratings = range(max(min_rating, 1), 11)
+            min_rating = None
+            if fields is not None:
+                fields = set(fields) | set(('timestamp',))
 
-        :param user_id: default is None, takes the user id of the user
-            that you want the posts of. if the parameter is None, it
-            will raise a ValueError exception.
-        :type nickname: nickname of the user
-
-        :return: a list of posts made by the mentioned user. each
-            message is a dictionary containing the keys mentioned in
-            :py:meth:`_create_posts_list_object`
+        # Activate foreign key support
+        self.set_foreign_keys_support()
 
-            or returns None, if no posts found for the specified
-            user.
-        '''
-        query = 'SELECT posts.*, sender.nickname sender, receiver.nickname receiver FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id INNER JOIN users receiver ON receiver.user_id = posts.receiver_id ORDER BY timestamp DESC'
+        # Cursor and row initialization
+        self.con.row_factory = sqlite3.Row
+        cursors = []
+        for rating in ratings:
+            query, pvalue = self._posts_query(sender_id, receiver_id, since,
+                                              until, min_rating, public,
+                                              replies_only, descending, after,
+                                              limit, fields, rating)
+            cursors.append(self.con.execute(query, pvalue))
+        rows = cursors[0]
+        if len(cursors) > 1:
+            rows = heapq.merge(*cursors, reverse=descending,
+                               key=lambda row: (row['timestamp'],
+                                                row['post_id']))
+            rows = itertools.islice(rows, limit)
+
+        # Process the posts while they are fetched
+        return (self._create_post_list_object(row) for row in rows)
+
+    def _posts_query(self, sender_id=None, receiver_id=None, since=None,
+                     until=None, min_rating=None, public=None,
+                     replies_only=False, descending=True, after=None,
+                     limit=None, fields=None, rating=None):
+        '''
+        Builds the SQL statement used by :py:meth:`iter_posts`.
+
+        Every combination of filters is answered by one of the posts
+        indexes (see critique_schema_dump.sql) and the rows are read in
+        the order of the index, so neither the table is scanned nor the
+        result is sorted. ``min_rating`` is only checked on the rows of the
+        index of the sender or of the receiver; without them
+        :py:meth:`iter_posts` runs one query per ``rating`` instead.
+
+        :returns: a tuple with the SQL statement and its parameters.
+        '''
+        conditions = []
+        pvalue = []
+        if sender_id is not None:
+            conditions.append('posts.sender_id = ?')
+            pvalue.append(sender_id)
+        if receiver_id is not None:
+            conditions.append('posts.receiver_id = ?')
+            pvalue.append(receiver_id)
+        if since is not None:
+            conditions.append('posts.timestamp >= ?')
+            pvalue.append(since)
+        if until is not None:
+            conditions.append('posts.timestamp <= ?')
+            pvalue.append(until)
+        if min_rating is not None:
+            # The unary + keeps the planner on the index of the user, a
+            # range of ratings can not give the posts in timestamp order
+            conditions.append('+posts.rating >= ?')
+            pvalue.append(min_rating)
+        if rating is not None:
+            conditions.append('posts.rating = ?')
+            pvalue.append(rating)
+        if public is not None:
+            conditions.append('posts.public = ?')
+            pvalue.append(1 if public else 0)
+        if replies_only:
+            # Matches the partial index posts_replies_timestamp
+            conditions.append('posts.reply_to IS NOT NULL')
+        if after is not None:
+            # Keyset paging: continue after the last post of the previous
+            # page instead of skipping rows with OFFSET
+            conditions.append('(posts.timestamp, posts.post_id) %s (?, ?)' %
+                              ('<' if descending else '>'))
+            pvalue.extend(after)
+
+        columns = self._projection(POST_COLUMNS, fields, ('post_id',))
+        query = 'SELECT ' + columns + ' FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id LEFT JOIN users receiver ON receiver.user_id = posts.receiver_id'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        direction = 'DESC' if descending else 'ASC'
+        query += ' ORDER BY posts.timestamp %s, posts.post_id %s' % (
+            direction, direction)
+        if limit is not None:
+            query += ' LIMIT ?'
+            pvalue.append(limit)
+        return query, tuple(pvalue)
+
+    @busy_aware()
+    def get_posts_by_ids(self, post_ids, fields=None):
+        '''
+        Extracts several posts with one query.
+
+        :param list post_ids: ids of the posts, in the format ``p-\\d+`` or
+            just the number.
+        :param fields: keys of :py:meth:`_create_post_list_object` to select.
+            If None all of them are selected. The post id is always selected.
+        :returns: list with one element per id, in the same order. The element
+            is a dictionary with the format provided in
+            :py:meth:`_create_post_list_object` or None if the post does not
+            exist or the id is not valid.
+        :raises ValueError: if ``fields`` contains an unknown key.
+        '''
+        numbers = []
+        for post_id in post_ids:
+            m = re.match(r'(?:p-)?(\d+)$', str(post_id))
+            numbers.append(int(m.group(1)) if m is not None else None)
+        unique = list(dict.fromkeys(n for n in numbers if n is not None))
+
+        # Put the posts back in the order of the request
+        posts = self._select_posts(unique, self._create_post_list_object,
+                                   fields)
+        return [posts.get(number) for number in numbers]
+
+    def _select_posts(self, numbers, create, fields=None):
+        '''
+        Selects several posts with one query.
+
+        :param list numbers: the numbers of the posts.
+        :param create: function making the returned dictionaries from the
+            rows, :py:meth:`_create_post_object` or
+            :py:meth:`_create_post_list_object`.
+        :param fields: keys of the dictionaries to select. If None all of them
+            are selected. The post id is always selected.
+        :returns: dictionary with the number of each existing post mapped to
+            the post.
+        '''
+        if not numbers:
+            return {}
+
+        # Create the SQL Statement. Replies have no receiver, hence the left
+        # join.
+        columns = self._projection(POST_COLUMNS, fields, ('post_id',))
+        query = 'SELECT ' + columns + ' FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id LEFT JOIN users receiver ON receiver.user_id = posts.receiver_id WHERE posts.post_id IN (%s)' % ', '.join('?' * len(numbers))
 
-        # set foreign keys support
+        # Activate foreign key support
         self.set_foreign_keys_support()
 
-        # using cursor and row initalization to enable
-        # reading and returning the data in a dictionary
-        # format, with key-value pairs
+        # Cursor and row initialization
         self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
 
-        # execute the SQL query
-        cur.execute(query)
-
-        # fetching the results
-        rows = cur.fetchall()
-
-        # check if there are posts fetched or not
-        if rows is None:
-            return None
-
-        # initiate the list object to hold the returned posts
-        posts = []
-        for row in rows:
-            post = self._create_post_list_object(row)
-            posts.append(post)
-        return posts
+        # Execute main SQL Statement
+        cur.execute(query, list(numbers))
+        return dict((row['post_id'], create(row)) for row in cur)
 
-    def get_posts_by_user(self, nickname=None, is_sender=True):
+    @busy_aware()
+    def get_posts_by_user(self, nickname=None, is_sender=True, fields=None):
         '''
         Used to retrieve some posts posted by a user.
 
@@ -1419,6 +2282,9 @@ class Connection(object):
             that you want the posts of. if the parameter is None, it
             will raise a ValueError exception.
         :type nickname: nickname of the user
+        :param fields: keys of :py:meth:`_create_post_list_object` to
+            select. If None all of them are selected. The post id is always
+            selected.
 
         :return: a list of posts made by the mentioned user. each
             message is a dictionary containing the keys mentioned in
@@ -1427,11 +2293,20 @@ class Connection(object):
             or returns None, if no posts found for the specified
             user.
         '''
-        postsCounter = 1
         # check if the user_id is not None
         if nickname is None:
             raise ValueError("No input user nickname input")
+        return list(self.iter_posts_by_user(nickname, is_sender, fields))
 
+    @busy_aware()
+    def iter_posts_by_user(self, nickname, is_sender=True, fields=None):
+        '''
+        Same as :py:meth:`get_posts_by_user`, but the posts are read from the
+        database one by one as the returned iterator is consumed.
+
+        :returns: iterator of dictionaries with the format provided in
+            :py:meth:`_create_post_list_object`
+        '''
         # initialize the query parameter as a tuple
         queryParameter = (nickname, )
 
@@ -1440,7 +2315,8 @@ class Connection(object):
         field = 'sender'
         if not is_sender:
             field = 'receiver'
-        query = 'SELECT posts.*, sender.nickname sender, receiver.nickname receiver FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id INNER JOIN users receiver ON receiver.user_id = posts.receiver_id WHERE ' + field + ' = ? ORDER BY timestamp DESC'
+        columns = self._projection(POST_COLUMNS, fields, ('post_id',))
+        query = 'SELECT ' + columns + ' FROM posts INNER JOIN users sender ON sender.user_id = posts.sender_id INNER JOIN users receiver ON receiver.user_id = posts.receiver_id WHERE ' + field + '.nickname = ? ORDER BY posts.timestamp DESC'
 
         # set foreign keys support
         self.set_foreign_keys_support()
@@ -1454,20 +2330,10 @@ class Connection(object):
         # execute the SQL query
         cur.execute(query, queryParameter)
 
-        # fetching the results
-        rows = cur.fetchall()
-
-        # check if there are posts fetched or not
-        if rows is None:
-            return None
-
-        # initiate the list object to hold the returned posts
-        posts = []
-        for row in rows:
-            post = self._create_post_list_object(row)
-            posts.append(post)
-        return posts
+        # process the posts while they are fetched
+        return (self._create_post_list_object(row) for row in cur)
 
+    @busy_aware()
     def delete_post(self, post_id=None):
         '''
         Delete the post with id given as parameter.
@@ -1487,6 +2353,11 @@ class Connection(object):
 
         queryParameter = (post_id, )
 
+        # The listeners receive the deleted post
+        post = None
+        if self._listeners:
+            post = self.get_post(str(post_id))
+
         # Create the SQL Statement
         query = 'DELETE FROM posts WHERE post_id = ?'
 
@@ -1503,34 +2374,378 @@ class Connection(object):
             cur = self.con.cursor()
             # execute the pragma command, OFF
             cur.execute(query, queryParameter)
+            self._forget('post', self._post_key(post_id))
             if cur.rowcount < 1:
                 print("No posts with post_id = %s" % str(post_id))
                 return False
             print("%s post deleted" % str(post_id))
-            self.con.commit()
+            self._commit()
         except sqlite3.Error as excp:
+            if _is_busy(excp):
+                raise
             print("Error %s:" % excp.args[0])
             return False
+        if post is not None:
+            self._notify('post', 'delete', post=post)
         return True
 
+    # Changes API
+    def _create_change_object(self, row):
+        '''
+        Creates the change object
+
+        :param row: The row obtained from the database.
+        :type row: sqlite3.Row
+
+        :returns: a dictionary with the keys ``seq`` (int), ``timestamp``
+            (int), ``entity`` (``'user'``, ``'post'`` or ``'rating'``),
+            ``entity_id`` (str: the nickname, the post id or the rating id),
+            ``owner`` (str, None if the owner was deleted at the same time)
+            and ``action`` (``'insert'``, ``'update'``, ``'delete'``,
+            ``'publish'`` or ``'unpublish'``)
+
+        '''
+        return {
+            'seq': row['seq'],
+            'timestamp': row['timestamp'],
+            'entity': row['entity'],
+            'entity_id': row['entity_id'],
+            'owner': row['owner'],
+            'action': row['action']
+        }
+
+    @busy_aware()
+    def get_changes(self, since=0, owner=None, limit=None, entity=None):
+        '''
+        Extracts the changes recorded after a given sequence number. The
+        changes are compacted: for each user, post or rating only its last
+        change is returned.
+
+        :param int since: sequence number of the last change already known.
+        :param str owner: only the changes concerning this nickname.
+        :param int limit: maximum number of changes to return.
+        :param str entity: only the changes of this kind of entity,
+            ``'user'``, ``'post'`` or ``'rating'``.
+        :returns: list of changes ordered by sequence number, with the format
+            provided in :py:meth:`_create_change_object`.
+
+        '''
+        # Create the SQL Statement. The subquery keeps the last change of
+        # each entity: it is a lookup in changes_entity_seq for each change
+        # read, so only the changes after since are read.
+        condition = 'seq > ?'
+        later = ''
+        pvalue = [since]
+        if owner is not None:
+            condition += ' AND owner = ?'
+            later = ' AND later.owner = changes.owner'
+            pvalue.append(owner)
+        if entity is not None:
+            condition += ' AND entity = ?'
+            pvalue.append(entity)
+        query = 'SELECT * FROM changes WHERE ' + condition + ' \
+                 AND NOT EXISTS (SELECT 1 FROM changes later \
+                 WHERE later.entity = changes.entity \
+                 AND later.entity_id = changes.entity_id \
+                 AND later.seq > changes.seq' + later + ') ORDER BY seq'
+        if limit is not None:
+            query += ' LIMIT ?'
+            pvalue.append(limit)
+
+        # Cursor and row initialization
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+
+        # Execute main SQL Statement
+        cur.execute(query, pvalue)
+        return [self._create_change_object(row) for row in cur]
+
+    @busy_aware()
+    def get_last_change_seq(self):
+        '''
+        :returns: the sequence number of the last recorded change, 0 if there
+            is none.
+        '''
+        cur = self.con.cursor()
+        cur.execute('SELECT MAX(seq) FROM changes')
+        return cur.fetchone()[0] or 0
+
+    @busy_aware()
+    def get_change_bounds(self):
+        '''
+        :returns: tuple with the sequence numbers of the first and of the
+            last recorded changes, ``(0, 0)`` if there is none. Changes older
+            than the first one were deleted, e.g. by
+            :py:meth:`Engine.clear`.
+        '''
+        cur = self.con.cursor()
+        cur.execute('SELECT MIN(seq), MAX(seq) FROM changes')
+        first, last = cur.fetchone()
+        return first or 0, last or 0
+
+    @busy_aware()
+    def get_change_version(self, entity=None, entity_id=None, owner=None):
+        '''
+        Gets the last change of an entity or of the entities of an owner. It
+        is a version of the data that changes whenever it is written, cheap to
+        read thanks to the indexes of the changes table.
+
+        :param str entity: ``'user'``, ``'post'`` or ``'rating'``. Without
+            ``entity_id`` nor ``owner``, the last change of any entity of
+            this kind.
+        :param str entity_id: nickname of the user, id of the post (with or
+            without the ``p-`` prefix) or id of the rating.
+        :param str owner: nickname of the user whose changes are considered.
+        :returns: tuple with the sequence number and the UNIX timestamp of the
+            last change, ``(0, None)`` if nothing was recorded.
+        :raises ValueError: if neither an entity nor an owner is given.
+        '''
+        if entity is not None and entity_id is not None:
+            if entity == 'post':
+                m = re.match(r'p-(\d+)$', entity_id)
+                if m is not None:
+                    entity_id = m.group(1)
+            condition = 'entity = ? AND entity_id = ?'
+            pvalue = (entity, entity_id)
+        elif owner is not None:
+            condition = 'owner = ?'
+            pvalue = (owner,)
+        elif entity is not None:
+            condition = 'entity = ?'
+            pvalue = (entity,)
+        else:
+            raise ValueError('Give an entity and its id or an owner')
+
+        cur = self.con.cursor()
+        cur.execute('SELECT seq, timestamp FROM changes WHERE ' + condition +
+                    ' ORDER BY seq DESC LIMIT 1', pvalue)
+        row = cur.fetchone()
+        if row is None:
+            return 0, None
+        return row[0], row[1]
+
+    # Counters API
+    @busy_aware()
+    def get_user_counts(self, nickname):
+        '''
+        Extracts the counters of a user, kept up to date by the triggers of
+        the database, with one lookup.
+
+        :param str nickname: the nickname of the user.
+        :returns: None if the user does not exist, else a dictionary with the
+            keys ``inbox`` (private posts received), ``river`` (public posts
+            received), ``ratings`` (ratings received) and ``sent`` (posts and
+            replies sent).
+        '''
+        query = 'SELECT user_counters.* FROM users, user_counters \
+                 WHERE users.user_id = user_counters.user_id \
+                 AND users.nickname = ?'
+
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+        cur.execute(query, (nickname,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return {
+            'inbox': row['inbox'],
+            'river': row['river'],
+            'ratings': row['ratings'],
+            'sent': row['sent']
+        }
+
+    # Reputation API
+    @busy_aware()
+    def iter_user_ids(self):
+        '''
+        :returns: iterator of the ids of all the users, in increasing order.
+        '''
+        cur = self.con.cursor()
+        cur.execute('SELECT user_id FROM users ORDER BY user_id')
+        return (row[0] for row in cur)
+
+    @busy_aware()
+    def iter_rating_edges(self, size=65536):
+        '''
+        Reads the graph of the ratings in chunks, without building a
+        dictionary per rating.
+
+        :param int size: maximum number of ratings of a chunk.
+        :returns: iterator of lists of ``(sender_id, receiver_id, rating)``
+            tuples.
+        '''
+        cur = self.con.cursor()
+        cur.execute('SELECT sender_id, receiver_id, rating FROM ratings')
+        return iter(lambda: cur.fetchmany(size), [])
+
+    @busy_aware()
+    def get_reputation(self, nickname):
+        '''
+        :param str nickname: the nickname of the user.
+        :returns: the reputation score of the user, None if the user does not
+            exist or was created after the last computation.
+        '''
+        cur = self.con.cursor()
+        cur.execute('SELECT reputation.score FROM users, reputation \
+                     WHERE users.user_id = reputation.user_id \
+                     AND users.nickname = ?', (nickname,))
+        row = cur.fetchone()
+        return None if row is None else row[0]
+
+    @busy_aware()
+    def get_reputation_scores(self):
+        '''
+        :returns: dictionary mapping the id of each user to its reputation
+            score, as computed the last time.
+        '''
+        cur = self.con.cursor()
+        cur.execute('SELECT user_id, score FROM reputation')
+        return dict(cur)
+
+    @busy_aware()
+    def get_reputation_state(self):
+        '''
+        :returns: tuple with the sequence number of the last change included
+            in the reputation scores and the UNIX time they were computed,
+            ``(0, None)`` if they were never computed.
+        '''
+        cur = self.con.cursor()
+        cur.execute('SELECT seq, computed FROM reputation_state WHERE id = 0')
+        row = cur.fetchone()
+        if row is None:
+            return 0, None
+        return row[0], row[1]
+
+    @busy_aware()
+    def save_reputation_scores(self, scores, seq):
+        '''
+        Replaces all the reputation scores in one transaction.
+
+        :param scores: iterable of ``(user_id, score)`` tuples.
+        :param int seq: sequence number of the last change included.
+        '''
+        computed = int(time.mktime(datetime.now().timetuple()))
+        with self.transaction():
+            cur = self.con.cursor()
+            cur.execute('DELETE FROM reputation')
+            # The users deleted during the computation are skipped
+            cur.executemany('INSERT INTO reputation(user_id, score) \
+                             SELECT user_id, ? FROM users WHERE user_id = ?',
+                            ((score, user_id) for user_id, score in scores))
+            cur.execute('INSERT OR REPLACE INTO reputation_state(id, seq, computed) \
+                         VALUES (0, ?, ?)', (seq, computed))
+
+    @busy_aware()
+    def save_reputation_seq(self, seq):
+        '''
+        Records that the reputation scores are up to date with the changes
+        until ``seq``, when none of them changed the scores. The time of the
+        computation is kept.
+
+        :param int seq: sequence number of the last change included.
+        '''
+        cur = self.con.cursor()
+        cur.execute('UPDATE reputation_state SET seq = ? WHERE id = 0', (seq,))
+        self._commit()
+
+    # Idempotency keys API
+    @busy_aware()
+    def get_idempotency_key(self, key, since=None):
+        '''
+        Extracts the outcome recorded for an idempotency key.
+
+        :param str key: the value of the Idempotency-Key header.
+        :param int since: UNIX time before which the keys are expired.
+        :returns: None if the key is unknown or expired, else a dictionary
+            with the keys ``key``, ``fingerprint``, ``status``, ``location``
+            and ``created``.
+        '''
+        query = 'SELECT * FROM idempotency_keys WHERE idempotency_key = ?'
+        pvalue = [key]
+        if since is not None:
+            query += ' AND created >= ?'
+            pvalue.append(since)
+
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+        cur.execute(query, pvalue)
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return {
+            'key': row['idempotency_key'],
+            'fingerprint': row['fingerprint'],
+            'status': row['status'],
+            'location': row['location'],
+            'created': row['created']
+        }
+
+    @busy_aware(retry=False)
+    def create_idempotency_key(self, key, fingerprint, status, location=None,
+                               since=None):
+        '''
+        Records the outcome of the request sent with an idempotency key.
+        Call it in the :py:meth:`transaction` of the writes of the request, so
+        that the key is recorded if and only if they are.
+
+        :param str key: the value of the Idempotency-Key header.
+        :param str fingerprint: identifies the request.
+        :param int status: the status code of the response.
+        :param str location: the Location header of the response, if any.
+        :param int since: UNIX time before which the keys are expired. An
+            expired record of the key is replaced.
+        :raises ValueError: if the key is already recorded and not expired.
+        '''
+        stmnt = 'INSERT INTO idempotency_keys(idempotency_key, fingerprint, \
+                 status, location, created) VALUES(?,?,?,?,?) \
+                 ON CONFLICT(idempotency_key) DO UPDATE SET \
+                 fingerprint = excluded.fingerprint, status = excluded.status, \
+                 location = excluded.location, created = excluded.created \
+                 WHERE created < ?'
+        pvalue = (key, fingerprint, status, location,
+                  int(time.mktime(datetime.now().timetuple())), since or 0)
+        cur = self.con.cursor()
+        cur.execute(stmnt, pvalue)
+        if cur.rowcount < 1:
+            raise ValueError('The idempotency key %s is already used' % key)
+        self._commit()
+
+    @busy_aware()
+    def delete_idempotency_keys(self, before):
+        '''
+        Deletes the keys recorded before a given time.
+
+        :param int before: UNIX time.
+        :returns: the number of keys deleted.
+        '''
+        cur = self.con.cursor()
+        cur.execute('DELETE FROM idempotency_keys WHERE created < ?',
+                    (before,))
+        self._commit()
+        return cur.rowcount
+
+    @busy_aware()
     def contains_user(self, nickname):
         '''
         :returns: ``True`` if the user is in the database else ``False``
         '''
         return self.get_user_id_w_nickname(nickname) is not None
 
+    @busy_aware()
     def contains_user_email(self, email):
         '''
         :returns: ``True`` if the user is in the database else ``False``
         '''
         return self.get_user_id_w_email(email) is not None
 
+    @busy_aware()
     def contains_user_extended(self, nickname, email):
         '''
         :returns: ``True`` if the user is in the database else ``False``
         '''
         return self.get_user_id_w_nickname(nickname) is not None or self.get_user_id_w_email(email) is not None
 
+    @busy_aware()
     def contains_rating(self, rating_id):
         '''
         :returns: ``True`` if the rating is in the database else ``False``
@@ -1539,6 +2754,7 @@ class Connection(object):
 
         return rating is not None
 
+    @busy_aware()
     def contains_post(self, post_id):
         '''
         :returns: ``True`` if the post is in the database, else ``False``
@@ -1546,6 +2762,7 @@ class Connection(object):
 
         return self.get_post(post_id) is not None
 
+    @busy_aware()
     def modify_post(self, post_id, post_text, rating, publicity):
         '''
         Modify the body text with the id ``post_id``
@@ -1569,6 +2786,11 @@ class Connection(object):
         # SQL Statement to update the messages table
         query = 'UPDATE posts SET post_text = ?, rating = ?, public = ? WHERE post_id = ?'
 
+        # The listeners need to know if the publicity changed
+        old = None
+        if self._listeners:
+            old = self.get_post(str(post_id), fields=('public',))
+
         # Activate foreign key support
         self.set_foreign_keys_support()
 
@@ -1580,8 +2802,11 @@ class Connection(object):
             # Execute the statement to extract the id associated to a nickname
             pvalue = (post_text, rating, publicity, post_id)
             cur.execute(query, pvalue)
-            self.con.commit()
+            self._commit()
+            self._forget('post', self._post_key(post_id))
         except sqlite3.Error as excp:
+            if _is_busy(excp):
+                raise
             print("Error %s:" % excp.args[0])
             return None
 
@@ -1589,8 +2814,11 @@ class Connection(object):
         if cur.rowcount < 1:
             print("I am making NONE")
             return None
+        if old is not None:
+            self._notify_post_update(post_id, old['public'])
         return post_id
 
+    @busy_aware(retry=False)
     def create_post(self, sender_nickname=None, receiver_nickname=None, reply_to=None, post_text=None, anonymous=None, public=None, rating=None):
         '''
         Create a new post with the data provided as arguments.
@@ -1626,82 +2854,67 @@ class Connection(object):
         if public is None:
             public = 1
 
-        # Create the SQL statment
-        # SQL to test that the message which I am answering does exist
-        query1 = 'SELECT * from posts WHERE post_id = ?'
-
-        # SQL Statement for getting the user id given a nickname
-        query2 = 'SELECT user_id from users WHERE nickname = ?'
-
         # SQL Statement for inserting the data
         stmnt = 'INSERT INTO posts (timestamp,sender_id,receiver_id,reply_to, \
                  post_text,rating,anonymous,public) \
                  VALUES(?,?,?,?,?,?,?,?)'
 
-        # Variables for the statement.
-        # sender_id is obtained from executing query2 statement.
-        # and timestamp is calculated with a function
+        # Variables for the statement. The posts and users are usually
+        # loaded already, since the caller checked that they exist.
         sender_id = None
         receiver_id = None
         timestamp = time.mktime(datetime.now().timetuple())
 
-        # Activate foreign key support
-        self.set_foreign_keys_support()
-
-        # Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
-        cur = self.con.cursor()
-
         # If exists the replyto argument, check that the post exists in
         # the database table
         if reply_to is not None:
-            m = re.match('p-(\d+)', reply_to)
+            m = re.match('p-(\d+)', str(reply_to))
             if m is not None and m.group(1) is not None:
-                post_id = int(m.group(1))
-
-            pvalue = (reply_to,)
-            cur.execute(query1, pvalue)
-            posts = cur.fetchall()
-            if len(posts) < 1:
+                reply_to = int(m.group(1))
+            if self.get_post(str(reply_to)) is None:
                 return None
 
-        # Execute SQL Statement to get sender id given nickname
-        pvalue = (sender_nickname,)
-        cur.execute(query2, pvalue)
-
-        # Extract user id
-        row = cur.fetchone()
-        if row is not None:
-            sender_id = row["user_id"]
-        else:
+        # Get sender id given nickname
+        sender_id = self.get_user_id_w_nickname(sender_nickname)
+        if sender_id is None:
             return None
 
         if receiver_nickname is not None:
-            # Execute SQL Statement to get sender id given nickname
-            pvalue = (receiver_nickname,)
-            cur.execute(query2, pvalue)
-
-            # Extract user id
-            row = cur.fetchone()
-            if row is not None:
-                receiver_id = row["user_id"]
-            else:
+            # Get receiver id given nickname
+            receiver_id = self.get_user_id_w_nickname(receiver_nickname)
+            if receiver_id is None:
                 return None
 
+        # Activate foreign key support
+        self.set_foreign_keys_support()
+
+        # Cursor and row initialization
+        self.con.row_factory = sqlite3.Row
+        cur = self.con.cursor()
+
         # Generate the values for SQL statement
         pvalue = (timestamp, sender_id, receiver_id, reply_to,
                 post_text, rating, anonymous, public)
 
         # Execute the statement
         cur.execute(stmnt, pvalue)
-        self.con.commit()
+        self._commit()
 
         # Extract the id of the added message
         lid = cur.lastrowid
+        self._forget('post', lid)
+
+        if lid is not None and self._listeners:
+            parent = None
+            if reply_to is not None:
+                parent = self.get_post(str(reply_to))
+            self._notify('post', 'insert', post=self.get_post('p-' + str(lid)),
+                         parent=parent)
 
         # Return the id in
         return ('p-' + str(lid)) if lid is not None else None
 
+    @busy_aware()
     def modify_post_rating(self, post_id, rating):
         '''
         Modify the post rating with the post id ``post_id``
@@ -1727,8 +2940,11 @@ class Connection(object):
             # Execute the statement to extract the id associated to a nickname
             pvalue = (rating, post_id)
             cur.execute(query, pvalue)
-            self.con.commit()
+            self._commit()
+            self._forget('post', self._post_key(post_id))
         except sqlite3.Error as excp:
+            if _is_busy(excp):
+                raise
             print("Error %s:" % excp.args[0])
             return None
 
@@ -1739,6 +2955,7 @@ class Connection(object):
         return post_id
 
 
+    @busy_aware()
     def modify_post_publicity(self, post_id, public):
         '''
         Modify the post publicity with the post id ``post_id``
@@ -1753,6 +2970,11 @@ class Connection(object):
         # SQL Statement to update the messages table
         query = 'UPDATE posts SET public = ? WHERE post_id = ?'
 
+        # The listeners need to know if the publicity changed
+        old = None
+        if self._listeners:
+            old = self.get_post(str(post_id), fields=('public',))
+
         # Activate foreign key support
         self.set_foreign_keys_support()
 
@@ -1764,8 +2986,11 @@ class Connection(object):
             # Execute the statement to extract the id associated to a nickname
             pvalue = (public, post_id)
             cur.execute(query, pvalue)
-            self.con.commit()
+            self._commit()
+            self._forget('post', self._post_key(post_id))
         except sqlite3.Error as excp:
+            if _is_busy(excp):
+                raise
             print("Error %s:" % excp.args[0])
             return None
 
@@ -1773,4 +2998,207 @@ class Connection(object):
         if cur.rowcount < 1:
             print("I am making NONE")
             return None
+        if old is not None:
+            self._notify_post_update(post_id, old['public'])
         return post_id
+
+    def _notify_post_update(self, post_id, old_public):
+        '''
+        Tells the listeners that a post was modified. Publicity flips are
+        reported as ``'publish'`` or ``'unpublish'``.
+        '''
+        post = self.get_post(str(post_id))
+        action = 'update'
+        if post['public'] != old_public:
+            action = 'publish' if post['public'] else 'unpublish'
+        self._notify('post', action, post=post)
+
+    # Bulk posts API
+    def _received_posts(self, receiver, post_ids):
+        '''
+        Selects with one query the posts received by a user among several
+        ones.
+
+        :param str receiver: nickname of the receiver.
+        :param list post_ids: ids of the posts, in the format ``p-\\d+`` or
+            just the number.
+        :returns: the numbers of the posts of ``post_ids`` received by
+            ``receiver``, in the order of ``post_ids`` and without duplicates.
+        :raises ValueError: if an id is malformed.
+        '''
+        numbers = []
+        for post_id in post_ids:
+            m = re.match(r'(?:p-)?(\d+)$', str(post_id))
+            if m is None:
+                raise ValueError('The post id %s is malformed' % post_id)
+            numbers.append(int(m.group(1)))
+        numbers = list(dict.fromkeys(numbers))
+        receiver_id = self.get_user_id_w_nickname(receiver)
+        if receiver_id is None or not numbers:
+            return []
+
+        cur = self.con.cursor()
+        cur.execute('SELECT post_id FROM posts WHERE receiver_id = ? AND \
+                     post_id IN (%s)' % ', '.join('?' * len(numbers)),
+                    [receiver_id] + numbers)
+        found = set(row[0] for row in cur)
+        return [number for number in numbers if number in found]
+
+    def _modify_received_posts(self, receiver, post_ids, assignment, pvalue,
+                               action):
+        '''
+        Runs one UPDATE statement on the posts received by a user among
+        several ones, in a transaction.
+
+        :param str assignment: the SET clause of the statement.
+        :param tuple pvalue: the parameters of ``assignment``.
+        :param action: function receiving a post before and after the update
+            and returning the action notified to the listeners.
+        :returns: the ids (``p-\\d+``) of the modified posts.
+        '''
+        with self.transaction():
+            numbers = self._received_posts(receiver, post_ids)
+            if not numbers:
+                return []
+            old = {}
+            if self._listeners:
+                old = self._select_posts(numbers, self._create_post_object)
+
+            self.set_foreign_keys_support()
+            cur = self.con.cursor()
+            cur.execute('UPDATE posts SET ' + assignment + ' WHERE post_id IN \
+                         (%s)' % ', '.join('?' * len(numbers)),
+                        tuple(pvalue) + tuple(numbers))
+            self._forget('post')
+
+            if old:
+                new = self._select_posts(numbers, self._create_post_object)
+                for number in numbers:
+                    post = new[number]
+                    self._notify('post', action(old[number], post),
+                                 post=post)
+        return ['p-' + str(number) for number in numbers]
+
+    @busy_aware()
+    def modify_posts_publicity(self, receiver, post_ids, public):
+        '''
+        Sets the publicity of several posts received by a user with one
+        statement. The other posts of ``post_ids`` are left alone.
+
+        :param str receiver: nickname of the receiver of the posts.
+        :param list post_ids: ids of the posts, in the format ``p-\\d+`` or
+            just the number.
+        :param int public: the new publicity, 0 or 1.
+        :returns: the ids (``p-\\d+``) of the modified posts.
+        :raises ValueError: if an id is malformed.
+        '''
+        def action(old, post):
+            if old['public'] == post['public']:
+                return 'update'
+            return 'publish' if post['public'] else 'unpublish'
+        return self._modify_received_posts(receiver, post_ids, 'public = ?',
+                                           (public,), action)
+
+    @busy_aware()
+    def modify_posts_rating(self, receiver, post_ids, rating):
+        '''
+        Sets the rating of several posts received by a user with one
+        statement. The other posts of ``post_ids`` are left alone.
+
+        :param str receiver: nickname of the receiver of the posts.
+        :param list post_ids: ids of the posts, in the format ``p-\\d+`` or
+            just the number.
+        :param int rating: the new rating, from 1 to 10.
+        :returns: the ids (``p-\\d+``) of the modified posts.
+        :raises ValueError: if an id is malformed.
+        '''
+        return self._modify_received_posts(receiver, post_ids, 'rating = ?',
+                                           (rating,),
+                                           lambda old, post: 'update')
+
+    @busy_aware()
+    def delete_posts(self, receiver, post_ids):
+        '''
+        Deletes with one statement several posts received by a user, and
+        their replies. The other posts of ``post_ids`` are left alone.
+
+        :param str receiver: nickname of the receiver of the posts.
+        :param list post_ids: ids of the posts, in the format ``p-\\d+`` or
+            just the number.
+        :returns: the ids (``p-\\d+``) of the deleted posts.
+        :raises ValueError: if an id is malformed.
+        '''
+        with self.transaction():
+            numbers = self._received_posts(receiver, post_ids)
+            if not numbers:
+                return []
+            posts = []
+            if self._listeners:
+                selected = self._select_posts(numbers,
+                                              self._create_post_object)
+                posts = [selected[number] for number in numbers]
+
+            self.set_foreign_keys_support()
+            cur = self.con.cursor()
+            cur.execute('DELETE FROM posts WHERE post_id IN (%s)' %
+                        ', '.join('?' * len(numbers)), numbers)
+            self._forget('post')
+
+            for post in posts:
+                self._notify('post', 'delete', post=post)
+        return ['p-' + str(number) for number in numbers]
+
+    @busy_aware(retry=False)
+    def create_replies(self, receiver, post_ids, post_text):
+        '''
+        Answers with one statement several posts received by a user. The
+        replies are sent by the receiver, public and not anonymous, like the
+        ones created by :py:meth:`create_post`. The other posts of
+        ``post_ids`` are not answered.
+
+        :param str receiver: nickname of the receiver of the posts, who sends
+            the replies.
+        :param list post_ids: ids of the posts, in the format ``p-\\d+`` or
+            just the number.
+        :param str post_text: the body text of the replies.
+        :returns: dictionary with the id (``p-\\d+``) of each answered post
+            mapped to the id of its reply.
+        :raises ValueError: if an id is malformed.
+        '''
+        with self.transaction():
+            numbers = self._received_posts(receiver, post_ids)
+            if not numbers:
+                return {}
+            sender_id = self.get_user_id_w_nickname(receiver)
+            timestamp = time.mktime(datetime.now().timetuple())
+
+            self.set_foreign_keys_support()
+            cur = self.con.cursor()
+            # The replies get ids above the current ones
+            cur.execute('SELECT COALESCE(MAX(post_id), 0) FROM posts')
+            last = cur.fetchone()[0]
+            cur.execute('INSERT INTO posts (timestamp, sender_id, receiver_id, \
+                         reply_to, post_text, rating, anonymous, public) \
+                         SELECT ?, ?, NULL, post_id, ?, NULL, 0, 1 FROM posts \
+                         WHERE post_id IN (%s)' %
+                        ', '.join('?' * len(numbers)),
+                        [timestamp, sender_id, post_text] + numbers)
+            # The INSERT took the write lock, so the replies it added are the
+            # last ones of the receiver to these posts: in order of id, they
+            # overwrite the ones committed by others since the MAX was read
+            cur.execute('SELECT post_id, reply_to FROM posts WHERE \
+                         sender_id = ? AND reply_to IN (%s) AND post_id > ? \
+                         ORDER BY post_id' % ', '.join('?' * len(numbers)),
+                        [sender_id] + numbers + [last])
+            replies = dict((row[1], row[0]) for row in cur)
+
+            if self._listeners:
+                posts = self._select_posts(
+                    numbers + [replies[number] for number in numbers],
+                    self._create_post_object)
+                for number in numbers:
+                    self._notify('post', 'insert',
+                                 post=posts[replies[number]],
+                                 parent=posts[number])
+        return dict(('p-' + str(number), 'p-' + str(replies[number]))
+                    for number in numbers)
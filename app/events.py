@@ -0,0 +1,235 @@
+'''
+Created on 19.10.2026
+
+In-process hub delivering server-sent events to the users of the critique
+API.
+
+Every event is addressed to one nickname. The hub keeps the subscribers of
+each nickname and a bounded buffer with the last events, so a client that
+reconnects with the ``Last-Event-ID`` header receives what it missed. If the
+missed events are not in the buffer anymore the client gets a ``reset``
+event and has to synchronize again with the change feed.
+
+An idle subscriber only costs a small queue and a :py:class:`threading.Event`;
+publishing an event wakes up just the subscribers of its nickname. The
+streams can also be consumed by coroutines (see :py:meth:`EventHub.
+stream_async`), which are woken up in their event loop.
+'''
+
+import asyncio
+import json
+import threading
+
+from collections import deque, namedtuple
+
+# Event delivered to the subscribers. id grows with every published event.
+Event = namedtuple("Event", ("id", "nickname", "event", "data"))
+
+
+def format_event(event):
+    '''
+    Formats an event with the text/event-stream syntax.
+
+    :param Event event: the event to format.
+    :returns: the event as a string ending with a blank line.
+    '''
+    lines = []
+    if event.id is not None:
+        lines.append("id: %d" % event.id)
+    lines.append("event: %s" % event.event)
+    lines.append("data: %s" % json.dumps(event.data))
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscription(object):
+    '''
+    Queue of the events of one nickname for one client. Created with
+    :py:meth:`EventHub.subscribe`.
+    '''
+
+    def __init__(self, hub, nickname, max_pending):
+        super(Subscription, self).__init__()
+        self.hub = hub
+        self.nickname = nickname
+        self._pending = deque(maxlen=max_pending)
+        self._ready = threading.Event()
+        # Called when an event is queued, set by wait_async
+        self._waker = None
+
+    def _push(self, event):
+        '''
+        Queues an event. Called by the hub with its lock held.
+        '''
+        if len(self._pending) == self._pending.maxlen:
+            # The client is too slow: drop the queue and tell it to resync
+            self._pending.clear()
+            event = Event(None, self.nickname, "reset", {})
+        self._pending.append(event)
+        self._ready.set()
+        if self._waker is not None:
+            self._waker()
+
+    def wait(self, timeout=None):
+        '''
+        Waits until there are events for the client.
+
+        :param float timeout: maximum number of seconds to wait.
+        :returns: list of the queued events, empty if the timeout expired.
+        '''
+        self._ready.wait(timeout)
+        return self._take()
+
+    async def wait_async(self, timeout=None):
+        '''
+        Same as :py:meth:`wait` for a coroutine: the event loop is not
+        blocked while waiting.
+        '''
+        loop = asyncio.get_event_loop()
+        ready = asyncio.Event()
+        with self.hub._lock:
+            self._waker = lambda: loop.call_soon_threadsafe(ready.set)
+            if self._ready.is_set():
+                ready.set()
+        try:
+            await asyncio.wait_for(ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.hub._lock:
+                self._waker = None
+        return self._take()
+
+    def _take(self):
+        with self.hub._lock:
+            events = list(self._pending)
+            self._pending.clear()
+            self._ready.clear()
+        return events
+
+    def close(self):
+        '''
+        Stops receiving events.
+        '''
+        self.hub._unsubscribe(self)
+
+
+class EventHub(object):
+    '''
+    Fan-out of the events to the subscribers of each nickname. It is safe to
+    use from several threads.
+
+    :param int buffer_size: number of events kept to resume the streams of
+        the clients that reconnect. It is also the maximum number of events
+        queued for a client.
+    '''
+
+    def __init__(self, buffer_size=1024):
+        super(EventHub, self).__init__()
+        self.buffer_size = buffer_size
+        self._buffer = deque(maxlen=buffer_size)
+        self._subscribers = {}
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def publish(self, nickname, event, data):
+        '''
+        Sends an event to the subscribers of a nickname.
+
+        :param str nickname: the user the event is addressed to.
+        :param str event: the type of the event.
+        :param dict data: the JSON serializable content of the event.
+        :returns: the id of the event.
+        '''
+        with self._lock:
+            self._last_id += 1
+            published = Event(self._last_id, nickname, event, data)
+            self._buffer.append(published)
+            for subscription in self._subscribers.get(nickname, ()):
+                subscription._push(published)
+        return published.id
+
+    def subscribe(self, nickname, last_event_id=None):
+        '''
+        Subscribes to the events of a nickname.
+
+        :param str nickname: the user whose events are received.
+        :param int last_event_id: id of the last event the client received,
+            if it is resuming a stream. The events published after it are
+            queued right away.
+        :returns: a :py:class:`Subscription`. It must be closed when the
+            client goes away.
+        '''
+        subscription = Subscription(self, nickname, self.buffer_size)
+        with self._lock:
+            if last_event_id is not None:
+                oldest = self._buffer[0].id if self._buffer else \
+                    self._last_id + 1
+                if last_event_id > self._last_id or \
+                        last_event_id < oldest - 1:
+                    # Events were lost, or the server restarted
+                    subscription._push(Event(None, nickname, "reset", {}))
+                else:
+                    for event in self._buffer:
+                        if event.id > last_event_id and \
+                                event.nickname == nickname:
+                            subscription._push(event)
+            self._subscribers.setdefault(nickname, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.nickname)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.nickname]
+
+    def subscriber_count(self, nickname=None):
+        '''
+        :returns: the number of subscriptions of a nickname, or of all of
+            them if ``nickname`` is None.
+        '''
+        with self._lock:
+            if nickname is not None:
+                return len(self._subscribers.get(nickname, ()))
+            return sum(len(subscriptions) for subscriptions
+                       in self._subscribers.values())
+
+    def stream(self, subscription, heartbeat=15.0, retry=3000):
+        '''
+        Generator writing the events of a subscription as a text/event-stream
+        body. A comment is written when there are no events for
+        ``heartbeat`` seconds so proxies and clients keep the connection open.
+        The subscription is closed when the generator is closed.
+
+        :param Subscription subscription: the subscription to stream.
+        :param float heartbeat: seconds between heartbeats.
+        :param int retry: milliseconds the client waits before reconnecting.
+        '''
+        try:
+            yield "retry: %d\n\n" % retry
+            while True:
+                events = subscription.wait(heartbeat)
+                if not events:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield "".join(format_event(event) for event in events)
+        finally:
+            subscription.close()
+
+    async def stream_async(self, subscription, heartbeat=15.0, retry=3000):
+        '''
+        Asynchronous generator equivalent to :py:meth:`stream`, for the
+        asyncio servers. A waiting stream costs a coroutine instead of a
+        thread.
+        '''
+        try:
+            yield "retry: %d\n\n" % retry
+            while True:
+                events = await subscription.wait_async(heartbeat)
+                if not events:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield "".join(format_event(event) for event in events)
+        finally:
+            subscription.close()
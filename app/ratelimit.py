@@ -0,0 +1,132 @@
+'''
+Created on 19.10.2026
+
+Admission control of the critique API.
+
+:py:class:`RateLimiter` keeps a token bucket per key, e.g. per client and
+class of endpoint. Each request takes a token from its bucket and the bucket
+is refilled at a constant rate up to its burst size, so a client can send
+``burst`` requests at once and then ``rate`` requests per second. A bucket is
+two numbers updated in constant time; the buckets of the clients not seen
+for a while are dropped once there are ``max_keys`` of them.
+
+:py:class:`ConcurrencyLimiter` caps the requests running at once, whoever
+sends them, to protect the database from the expensive ones.
+
+Both are local to the process: with several workers, each one applies the
+limits to the requests it serves.
+'''
+
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+
+# Answer of a RateLimiter: whether the request is allowed, the burst size,
+# the tokens left, the seconds until the bucket is full again and, for the
+# refused requests, the seconds until they would be allowed.
+Admission = namedtuple("Admission", ("allowed", "limit", "remaining",
+                                     "reset", "retry_after"))
+
+
+class RateLimiter(object):
+    '''
+    Token buckets keyed by any hashable value. It is safe to share between
+    threads.
+
+    :param float rate: tokens added to each bucket per second.
+    :param int burst: maximum number of tokens of a bucket.
+    :param int max_keys: maximum number of buckets kept. The least recently
+        used bucket is dropped beyond it, which gives back a full bucket to
+        its key.
+    '''
+
+    def __init__(self, rate, burst, max_keys=10000):
+        super(RateLimiter, self).__init__()
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, monotonic time of the last update)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.refused = 0
+
+    def acquire(self, key, cost=1, now=None):
+        '''
+        Takes ``cost`` tokens from the bucket of ``key`` if it has them.
+
+        :param key: the key of the bucket.
+        :param int cost: tokens needed by the request.
+        :param float now: the current :py:func:`time.monotonic`, for testing.
+        :returns: an :py:class:`Admission`.
+        '''
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens, last = bucket
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            else:
+                self.refused += 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        retry_after = 0 if allowed else (cost - tokens) / self.rate
+        return Admission(allowed, self.burst, int(tokens),
+                         (self.burst - tokens) / self.rate, retry_after)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        '''
+        Gives back a full bucket to every key.
+        '''
+        with self._lock:
+            self._buckets.clear()
+
+
+class ConcurrencyLimiter(object):
+    '''
+    Caps the number of operations running at once. It is safe to share
+    between threads.
+
+    :param int limit: maximum number of operations running at once.
+    '''
+
+    def __init__(self, limit):
+        super(ConcurrencyLimiter, self).__init__()
+        self.limit = limit
+        self.active = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        '''
+        Starts an operation if the limit allows it, without waiting. Each
+        successful call must be followed by a call of :py:meth:`release`.
+
+        :returns: ``True`` if the operation may run.
+        '''
+        with self._lock:
+            if self.active >= self.limit:
+                self.refused += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        '''
+        Ends an operation started with :py:meth:`try_acquire`.
+        '''
+        with self._lock:
+            self.active -= 1
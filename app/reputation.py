@@ -0,0 +1,248 @@
+'''
+Created on 19.10.2026
+
+Reputation of the users of the critique API, computed from the graph of the
+ratings.
+
+Every rating is an edge from its sender to its receiver. The reputation is a
+PageRank of that graph weighted by the ratings: each user passes its
+reputation to the users it rated, each one receiving a share proportional to
+``rating / 10``. What a user does not pass, because its ratings are low or
+because it rated nobody, is spread over all the users like the random jumps
+of PageRank. So a 10 given by a reputed user counts more than a 10 given by
+an unknown one, and much more than a 2. The scores are scaled so that an
+average user has a reputation of 1.
+
+The scores are computed in batch and stored in the database::
+
+    python -m app.reputation --database db/critique.db
+
+With NumPy the graph is kept in arrays of edges and every iteration is a few
+vectorized operations, so millions of ratings take seconds. Without NumPy the
+same computation runs in pure Python, which is enough for small databases.
+
+The scores are only computed again if users or ratings changed since the
+last run. Such a refresh is still a full computation reading all the ratings,
+but it starts from the previous scores: when few ratings changed they
+converge in a few iterations.
+'''
+
+import argparse
+import sys
+import time
+
+from collections import namedtuple
+
+from app import database
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Probability of following a rating instead of jumping to any user.
+DAMPING = 0.85
+# The iterations stop when the scores, which add up to 1, move less than
+# this in total.
+TOLERANCE = 1e-9
+MAX_ITERATIONS = 100
+
+# Result of rank: the scores of the users in the order of the nodes, the
+# number of ratings used and the number of iterations run.
+Ranking = namedtuple("Ranking", ("scores", "ratings", "iterations"))
+
+
+def rank(nodes, edge_chunks, start=None, damping=DAMPING,
+         tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    '''
+    Computes the reputation of the users with NumPy if it is installed, in
+    pure Python otherwise.
+
+    :param list nodes: the ids of the users, in increasing order.
+    :param edge_chunks: iterable of lists of ``(sender_id, receiver_id,
+        rating)`` tuples, see
+        :py:meth:`app.database.Connection.iter_rating_edges`. The ratings of
+        users missing from ``nodes`` are ignored.
+    :param dict start: scores to start from, by user id, e.g. the ones of
+        the last computation. None to start from equal scores.
+    :param float damping: probability of following a rating.
+    :param float tolerance: total change of the scores at which to stop.
+    :param int max_iterations: maximum number of iterations.
+    :returns: a :py:class:`Ranking`, with a list of scores where 1 is the
+        reputation of an average user.
+    '''
+    if numpy is not None:
+        return rank_arrays(nodes, edge_chunks, start, damping, tolerance,
+                           max_iterations)
+    return rank_lists(nodes, edge_chunks, start, damping, tolerance,
+                      max_iterations)
+
+
+def rank_arrays(nodes, edge_chunks, start=None, damping=DAMPING,
+                tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    '''
+    Same as :py:func:`rank`, vectorized with NumPy. The edges are kept in
+    three arrays and each iteration sends the scores along all of them with
+    one :py:func:`numpy.bincount`.
+    '''
+    n = len(nodes)
+    if not n:
+        return Ranking([], 0, 0)
+    ids = numpy.asarray(nodes, dtype=numpy.int64)
+    edges = [numpy.asarray(chunk, dtype=numpy.int64).reshape(-1, 3)
+             for chunk in edge_chunks]
+    edges = numpy.concatenate(edges) if edges \
+        else numpy.empty((0, 3), dtype=numpy.int64)
+
+    # Positions of the senders and receivers in nodes
+    senders = numpy.searchsorted(ids, edges[:, 0])
+    receivers = numpy.searchsorted(ids, edges[:, 1])
+    known = (senders < n) & (receivers < n)
+    known[known] = (ids[senders[known]] == edges[known, 0]) & \
+        (ids[receivers[known]] == edges[known, 1])
+    senders, receivers = senders[known], receivers[known]
+
+    # Share of the score of the sender passed along each edge
+    out_degree = numpy.bincount(senders, minlength=n)
+    weights = edges[known, 2] / 10.0 / out_degree[senders]
+
+    if start is None:
+        scores = numpy.full(n, 1.0 / n)
+    else:
+        scores = numpy.fromiter((start.get(node, 1.0) for node in nodes),
+                                dtype=numpy.float64, count=n)
+        scores /= scores.sum()
+
+    iterations = 0
+    while iterations < max_iterations:
+        iterations += 1
+        passed = numpy.bincount(receivers, weights=weights * scores[senders],
+                                minlength=n)
+        # What was not passed is spread over everybody
+        new_scores = damping * passed + \
+            (damping * (1.0 - passed.sum()) + 1.0 - damping) / n
+        change = numpy.abs(new_scores - scores).sum()
+        scores = new_scores
+        if change < tolerance:
+            break
+    return Ranking((scores * n).tolist(), len(senders), iterations)
+
+
+def rank_lists(nodes, edge_chunks, start=None, damping=DAMPING,
+               tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
+    '''
+    Same as :py:func:`rank`, in pure Python.
+    '''
+    n = len(nodes)
+    if not n:
+        return Ranking([], 0, 0)
+    positions = dict((node, position) for position, node in enumerate(nodes))
+    edges = []
+    out_degree = [0] * n
+    for chunk in edge_chunks:
+        for sender, receiver, rating in chunk:
+            if sender in positions and receiver in positions:
+                edges.append((positions[sender], positions[receiver], rating))
+                out_degree[positions[sender]] += 1
+    edges = [(sender, receiver, rating / 10.0 / out_degree[sender])
+             for sender, receiver, rating in edges]
+
+    if start is None:
+        scores = [1.0 / n] * n
+    else:
+        scores = [start.get(node, 1.0) for node in nodes]
+        total = sum(scores)
+        scores = [score / total for score in scores]
+
+    iterations = 0
+    while iterations < max_iterations:
+        iterations += 1
+        passed = [0.0] * n
+        for sender, receiver, weight in edges:
+            passed[receiver] += weight * scores[sender]
+        jump = (damping * (1.0 - sum(passed)) + 1.0 - damping) / n
+        new_scores = [damping * value + jump for value in passed]
+        change = sum(abs(new - old) for new, old in zip(new_scores, scores))
+        scores = new_scores
+        if change < tolerance:
+            break
+    return Ranking([score * n for score in scores], len(edges), iterations)
+
+
+def refresh_reputation(con, full=False, damping=DAMPING):
+    '''
+    Computes the reputation of the users again and stores it, if users or
+    ratings changed since the last computation. The whole graph is read and
+    ranked, starting from the stored scores.
+
+    :param con: the :py:class:`app.database.Connection` to use.
+    :param bool full: compute the scores from scratch, even if nothing
+        changed.
+    :param float damping: probability of following a rating.
+    :returns: the :py:class:`Ranking` computed, None if the scores were up
+        to date.
+    '''
+    seq, computed = con.get_reputation_state()
+    # Read first: the changes made during the computation are included, or
+    # not, but the next refresh sees them anyway
+    first, last = con.get_change_bounds()
+    if computed is not None and not full:
+        if seq == last:
+            return None
+        # The users and ratings are found in the change feed, unless the
+        # changes after seq were deleted from it
+        if first <= seq + 1 and seq < last and \
+                not con.get_changes(since=seq, entity="user", limit=1) and \
+                not con.get_changes(since=seq, entity="rating", limit=1):
+            # The next refresh does not look at these changes again
+            con.save_reputation_seq(last)
+            return None
+    start = None if computed is None or full \
+        else con.get_reputation_scores()
+
+    nodes = list(con.iter_user_ids())
+    ranking = rank(nodes, con.iter_rating_edges(), start, damping)
+    con.save_reputation_scores(zip(nodes, ranking.scores), last)
+    return ranking
+
+
+def parse_args(argv=None):
+    '''
+    :param list argv: the command line arguments, sys.argv by default.
+    :returns: the parsed options.
+    '''
+    parser = argparse.ArgumentParser(
+        description="Computes the reputation of the users from their "
+                    "ratings.")
+    parser.add_argument("--database", default=database.DEFAULT_DB_PATH,
+                        help="path of the sqlite database")
+    parser.add_argument("--full", action="store_true",
+                        help="compute from scratch, even if nothing changed")
+    parser.add_argument("--damping", type=float, default=DAMPING,
+                        help="probability of following a rating "
+                             "(default: %(default)s)")
+    options = parser.parse_args(argv)
+    if not 0 < options.damping < 1:
+        parser.error("--damping must be between 0 and 1")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    con = database.Engine(options.database).connect()
+    try:
+        started = time.monotonic()
+        ranking = refresh_reputation(con, options.full, options.damping)
+    finally:
+        con.close()
+    if ranking is None:
+        print("The reputation is up to date")
+    else:
+        print("Ranked %d users from %d ratings in %d iterations, %.2f s" %
+              (len(ranking.scores), ranking.ratings, ranking.iterations,
+               time.monotonic() - started))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
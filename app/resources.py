@@ -7,17 +7,32 @@ Created on 31.03.2018
     -   [1] Programmable Web Project, Exercise3, resources.py
 '''
 
+import functools
+import hashlib
 import json
-
+import math
+import re
+import time
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import chain
 from urllib.parse import unquote
 
-from flask import Flask, request, Response, g, _request_ctx_stack, redirect, send_from_directory
+from flask import Flask, request, Response, g, _request_ctx_stack, redirect, send_from_directory, stream_with_context
 from flask_restful import Resource, Api, abort
 from werkzeug.exceptions import NotFound, UnsupportedMediaType
+from werkzeug.wsgi import ClosingIterator
 
 from app.utils import RegexConverter
 from app import database
+from app.cache import ResponseCache, SingleFlight
+from app.events import EventHub
 from app.model.mason import MasonObject
+from app.ratelimit import ConcurrencyLimiter, RateLimiter
+from app.search import PrefixIndex
+from app.validation import compile_schema
 
 # Constants for hypermedia formats and profiles
 MASON = "application/vnd.mason+json"
@@ -40,20 +55,164 @@ CREATE_POSTS_SCHEMA = json.load(open('app/schema/create_posts.json'))
 CREATE_REPLY_SCHEMA = json.load(open('app/schema/create_reply.json'))
 EDIT_RATING_SCHEMA = json.load(open('app/schema/edit_rating.json'))
 EDIT_POST_SCHEMA = json.load(open('app/schema/edit_post.json'))
+INBOX_ACTIONS_SCHEMA = json.load(open('app/schema/inbox_actions.json'))
+
+# Validators of the request bodies, compiled once (see app.validation).
+validate_create_user = compile_schema(CREATE_USER_SCHEMA)
+validate_create_rating = compile_schema(CREATE_RATING_SCHEMA)
+validate_edit_user = compile_schema(EDIT_USER_SCHEMA)
+validate_create_posts = compile_schema(CREATE_POSTS_SCHEMA)
+validate_create_reply = compile_schema(CREATE_REPLY_SCHEMA)
+validate_edit_rating = compile_schema(EDIT_RATING_SCHEMA)
+validate_edit_post = compile_schema(EDIT_POST_SCHEMA)
+validate_inbox_actions = compile_schema(INBOX_ACTIONS_SCHEMA)
 
 
 LINK_RELATIONS_URL = "/critique/link-relations/"
 
+# Approximate size in bytes of the chunks written by streamed collections.
+STREAM_CHUNK_SIZE = 8192
+
+# Maximum number of sub-requests of a batch and number of threads used to run
+# its independent reads concurrently.
+BATCH_MAX_REQUESTS = 20
+BATCH_WORKERS = 4
+BATCH_METHODS = ("GET", "POST", "PUT", "DELETE")
+
+# Sub-resources that can be included in a user with the ``embed`` query
+# parameter, the number of river posts included and the number of threads
+# reading them concurrently.
+USER_EMBEDS = ("counts", "ratings", "river")
+RIVER_PREVIEW_SIZE = 5
+EMBED_WORKERS = 4
+
+# Maximum number of posts handled by an action of the inbox.
+INBOX_ACTION_MAX_POSTS = 500
+
+# Default and maximum number of items in a page of the paged collections.
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Same for the change feed, whose items are much smaller.
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 1000
+
+# Ratings a user needs to enter the leaderboard, unless the client asks for
+# another minimum.
+LEADERBOARD_MIN_RATINGS = 3
+
+# Semantic descriptors that can be requested with the ``fields`` query
+# parameter, mapped to the key used by the database API. Descriptors mapped
+# to None do not come from the database.
+USER_DESCRIPTORS = {
+    "nickname": "nickname",
+    "givenName": "firstname",
+    "familyName": "lastname",
+    "avatar": "avatar",
+    "bio": "bio",
+    "email": "email",
+    "birthdate": "birthdate",
+    "telephone": "mobile",
+    "gender": "gender",
+    "reputation": None
+}
+USERS_LIST_DESCRIPTORS = {
+    "nickname": "nickname",
+    "givenName": "firstname",
+    "familyName": "lastname",
+    "avatar": "avatar",
+    "bio": "bio"
+}
+POST_DESCRIPTORS = {
+    "postId": "post_id",
+    "sender": "sender",
+    "receiver": "receiver",
+    "timestamp": "timestamp",
+    "replyTo": "reply_to",
+    "body": "post_text",
+    "ratingValue": "rating",
+    "bestRating": None,
+    "anonymous": "anonymous",
+    "public": "public"
+}
+RATING_DESCRIPTORS = {
+    "ratingId": "rating_id",
+    "sender": "sender",
+    "receiver": "receiver",
+    "ratingValue": "rating",
+    "bestRating": None
+}
+
 # Borrowed from lab exercises [1]
 # Define the application and the api
 app = Flask(__name__, static_folder="static", static_url_path="/.")
-app.debug = True
+# Run with the debugger in development only, see main.py
+app.debug = False
 # Set the database Engine. In order to modify the database file (e.g. for
 # testing) provide the database path   app.config to modify the
 # database to be used (for instance for testing)
 app.config.update({"Engine": database.Engine()})
+# Compression of the responses (see app.compression). Bodies smaller than
+# COMPRESSION_MIN_SIZE bytes are sent uncompressed.
+app.config.update({"COMPRESSION_LEVEL": 6, "COMPRESSION_MIN_SIZE": 500})
+# Seconds without events after which the event streams send a heartbeat.
+app.config.update({"EVENTS_HEARTBEAT": 15})
+# Number of rendered responses kept by the response cache, 0 disables it.
+app.config.update({"RESPONSE_CACHE_SIZE": 1024})
+# Seconds a request waits for a concurrent identical request building the
+# same response before building it itself, 0 disables the coalescing.
+app.config.update({"SINGLE_FLIGHT_TIMEOUT": 1})
+# Largest request body in bytes, bigger ones are answered with 413.
+app.config.update({"MAX_CONTENT_LENGTH": 1024 * 1024})
+# Seconds a request may spend waiting for the database, None for no limit.
+# A client or a proxy may send a shorter budget in the DEADLINE_HEADER
+# header. The requests running out of time are answered with 503.
+app.config.update({"REQUEST_DEADLINE": 10})
+DEADLINE_HEADER = "X-Request-Timeout"
+# Number of items of a collection, sent in the answers to HEAD requests.
+TOTAL_COUNT_HEADER = "X-Total-Count"
+# Admission control (see check_admission): rate in requests per second and
+# burst of each client for each class of endpoint, None for no limit, and
+# number of "list" requests served at once by the process, 0 for no limit.
+app.config.update({"RATE_LIMITS": {"read": (50, 100), "list": (10, 30),
+                                   "write": (10, 30)},
+                   "LIST_CONCURRENCY": 8})
+# Seconds the outcome of a POST request sent with an Idempotency-Key header
+# is kept (see idempotent), and seconds between two deletions of the expired
+# outcomes by a process.
+app.config.update({"IDEMPOTENCY_KEY_TTL": 24 * 60 * 60,
+                   "IDEMPOTENCY_PURGE_INTERVAL": 60 * 60})
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+class CritiqueApi(Api):
+    '''
+    Flask-RESTful API answering the database errors of its resources with
+    the Mason error documents of the application.
+    '''
+
+    def handle_error(self, e):
+        if isinstance(e, database.DatabaseBusyError):
+            return database_busy(e)
+        return super(CritiqueApi, self).handle_error(e)
+
+
 # Start the RESTFUL API.
-api = Api(app)
+api = CritiqueApi(app)
+
+# Server-sent events of the users (see UserEvents).
+event_hub = EventHub()
+
+# Rendered responses of the read resources (see cached_response).
+response_cache = ResponseCache(app.config["RESPONSE_CACHE_SIZE"])
+# Responses being built, shared through response_cache.
+single_flight = SingleFlight()
+# Token buckets of the clients, by class of endpoint.
+rate_limiters = dict((name, RateLimiter(*limit)) for name, limit
+                     in app.config["RATE_LIMITS"].items() if limit)
+# Expensive requests being served.
+list_limiter = ConcurrencyLimiter(app.config["LIST_CONCURRENCY"])
+# Names of the users, for the prefix searches (see sync_user_index).
+user_index = PrefixIndex()
 
 class CritiqueObject(MasonObject):  # Borrowed from lab exercises [1]
     '''
@@ -78,6 +237,20 @@ class CritiqueObject(MasonObject):  # Borrowed from lab exercises [1]
         super(CritiqueObject, self).__init__(**kwargs)
         self["@controls"] = {}
 
+    def restrict_fields(self, fields):
+        '''
+        Removes the semantic descriptors that are not in ``fields``. Mason
+        properties (controls, namespaces...) are always kept.
+
+        : param fields: set of descriptors to keep. If None nothing is removed.
+        '''
+
+        if fields is None:
+            return
+        for key in list(self.keys()):
+            if not key.startswith("@") and key not in fields:
+                del self[key]
+
     def add_control_up(self, href):
         '''
         This adds the up link to an object. Intended for the document object.
@@ -144,6 +317,22 @@ class CritiqueObject(MasonObject):  # Borrowed from lab exercises [1]
             "href": api.url_for(UserInbox, nickname=nickname),
         }
 
+    def add_control_inbox_actions(self, nickname):
+        '''
+        Adds the control to publish, unpublish, rate, answer or delete
+        several posts of the inbox of a user at once.
+
+        : param str nickname: The nickname of the user
+        '''
+
+        self["@controls"]["critique:inbox-actions"] = {
+            "href": api.url_for(UserInboxActions, nickname=nickname),
+            "title": "Act on several posts of the inbox",
+            "encoding": "json",
+            "method": "POST",
+            "schema": INBOX_ACTIONS_SCHEMA
+        }
+
     def add_control_user_river(self, nickname):
         '''
         This adds the user-river control to an object. Intended for the
@@ -156,6 +345,18 @@ class CritiqueObject(MasonObject):  # Borrowed from lab exercises [1]
             "href": api.url_for(UserRiver, nickname=nickname),
         }
 
+    def add_control_user_counts(self, nickname):
+        '''
+        This adds the user-counts control to an object. Intended for the
+        document object.
+
+        : param str nickname: The nickname of the user
+        '''
+
+        self["@controls"]["critique:user-counts"] = {
+            "href": api.url_for(UserCounts, nickname=nickname),
+        }
+
     def add_control_user_ratings(self, nickname):
         '''
         This adds the user-ratings control to an object. Intended for the
@@ -327,6 +528,387 @@ def create_error_response(status_code, title, message=None):
     return Response(json.dumps(envelope), status_code, mimetype=MASON)
 
 
+def idempotent(method):
+    '''
+    Decorator of the POST methods of the resources. When the request has an
+    Idempotency-Key header, the status and the Location of its first
+    successful execution are recorded together with its writes, and sent
+    again to the retries of the request without running it. A key reused
+    for another request is answered with 422.
+
+    : param method: the method of the resource.
+    '''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return method(*args, **kwargs)
+        if not 0 < len(key) <= 255:
+            return create_error_response(
+                400, "Wrong request format",
+                "The %s header must have 1 to 255 characters" %
+                IDEMPOTENCY_HEADER)
+
+        now = int(time.time())
+        since = now - app.config["IDEMPOTENCY_KEY_TTL"]
+        purge_idempotency_keys(now, since)
+        fingerprint = hashlib.sha256(
+            ("%s %s\n" % (request.method, request.full_path)).encode("utf-8")
+            + request.get_data()).hexdigest()
+
+        outcome = g.con.get_idempotency_key(key, since)
+        if outcome is None:
+            try:
+                with g.con.transaction():
+                    response = method(*args, **kwargs)
+                    if 200 <= response.status_code < 300:
+                        g.con.create_idempotency_key(
+                            key, fingerprint, response.status_code,
+                            response.headers.get("Location"), since)
+                return response
+            except ValueError:
+                # A concurrent retry recorded the key first, the writes of
+                # this one were rolled back
+                outcome = g.con.get_idempotency_key(key, since)
+                if outcome is None:
+                    raise
+
+        if outcome["fingerprint"] != fingerprint:
+            return create_error_response(
+                422, "Idempotency key reused",
+                "The %s was sent with another request" % IDEMPOTENCY_HEADER)
+        response = Response(status=outcome["status"])
+        if outcome["location"] is not None:
+            response.headers["Location"] = outcome["location"]
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+    return wrapper
+
+
+# UNIX time of the next deletion of the expired idempotency keys.
+next_idempotency_purge = 0
+
+
+def purge_idempotency_keys(now, since):
+    '''
+    Deletes in one statement the idempotency keys recorded before ``since``,
+    at most once per IDEMPOTENCY_PURGE_INTERVAL.
+    '''
+    global next_idempotency_purge
+    if now < next_idempotency_purge:
+        return
+    next_idempotency_purge = now + app.config["IDEMPOTENCY_PURGE_INTERVAL"]
+    try:
+        g.con.delete_idempotency_keys(since)
+    except database.DatabaseBusyError:
+        # The next request will do it
+        next_idempotency_purge = now
+
+
+def parse_fields(descriptors, required=()):
+    '''
+    Parses the ``fields`` query parameter of the current request. It is a
+    comma separated list of semantic descriptors, e.g.
+    ``?fields=nickname,avatar``.
+
+    : param dict descriptors: the descriptors supported by the resource mapped
+        to the keys used by the database API.
+    : param required: database keys the resource always needs, for instance to
+        build its controls.
+    : returns: a tuple with the set of requested descriptors and the set of
+        database keys to select. Both are None if the parameter is not given.
+    : raises ValueError: if an unknown descriptor is requested.
+    '''
+
+    value = request.args.get("fields", None)
+    if value is None:
+        return None, None
+
+    fields = set(field.strip() for field in value.split(",") if field.strip())
+    unknown = fields - set(descriptors)
+    if unknown:
+        raise ValueError("Unknown fields: %s" % ", ".join(sorted(unknown)))
+
+    columns = set(required)
+    columns.update(descriptors[field] for field in fields
+                   if descriptors[field] is not None)
+    return fields, columns
+
+
+def parse_int_arg(name, minimum=None, maximum=None):
+    '''
+    Parses an integer query parameter of the current request.
+
+    : param str name: name of the query parameter.
+    : param int minimum: smallest accepted value, if any.
+    : param int maximum: largest accepted value, if any.
+    : returns: the value of the parameter or None if it is not given.
+    : raises ValueError: if the value is not an integer in the range.
+    '''
+
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError("%s must be an integer" % name)
+    if (minimum is not None and value < minimum) or \
+            (maximum is not None and value > maximum):
+        if maximum is None:
+            raise ValueError("%s must be at least %d" % (name, minimum))
+        if minimum is None:
+            raise ValueError("%s must be at most %d" % (name, maximum))
+        raise ValueError("%s must be between %d and %d" %
+                         (name, minimum, maximum))
+    return value
+
+
+def parse_bool_arg(name):
+    '''
+    Parses a boolean query parameter of the current request. ``true``,
+    ``1``, ``false`` and ``0`` are accepted.
+
+    : param str name: name of the query parameter.
+    : returns: the value of the parameter or None if it is not given.
+    : raises ValueError: if the value is not a boolean.
+    '''
+
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    value = value.lower()
+    if value in ("true", "1"):
+        return True
+    if value in ("false", "0"):
+        return False
+    raise ValueError("%s must be true or false" % name)
+
+
+def parse_request_body(validate):
+    '''
+    Parses the JSON body of the current request and validates it. Called
+    before any query, so a malformed body costs no database access.
+
+    : param validate: the validator of the body, from
+        :py:func:`app.validation.compile_schema`.
+    : returns: the body, or None if it is empty.
+    : raises ValueError: if the body does not match the schema. The message
+        tells which value is wrong.
+    '''
+
+    body = request.get_json(force=True)
+    if not body:
+        return None
+    return validate(body)
+
+
+def create_collection_response(envelope, items, status_code=200):
+    '''
+    Creates a streamed :py:class:`flask.Response` for a collection resource.
+
+    The envelope is written first and then the items, one by one, as they
+    are produced by ``items``. Hence neither the list of items nor the whole
+    document is ever kept in memory and the first bytes are sent as soon as
+    the first rows are read from the database.
+
+    : param envelope: the :py:class:`CritiqueObject` of the collection,
+        without the items.
+    : param items: iterable of the items of the collection. It may use the
+        request context (e.g. ``g.con``), which is kept until the response
+        has been sent.
+    : rtype:: py: class:`flask.Response`
+    '''
+
+    head = json.dumps(envelope)
+    if len(envelope) > 0:
+        head = head[:-1] + ", "
+    else:
+        head = head[:-1]
+    head += '"items": ['
+
+    def generate():
+        chunk = [head]
+        size = len(head)
+        separator = ""
+        for item in items:
+            data = separator + json.dumps(item)
+            separator = ", "
+            chunk.append(data)
+            size += len(data)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        chunk.append("]}")
+        yield "".join(chunk)
+
+    return Response(stream_with_context(generate()), status_code,
+                    mimetype=MASON)
+
+
+def not_modified_response(version):
+    '''
+    Checks the conditional headers of a GET request against the version of
+    the requested resource, as returned by
+    :py:meth:`app.database.Connection.get_change_version`. Called before
+    reading and rendering the resource, so an up to date client costs just
+    the lookup of the version.
+
+    If-None-Match is compared weakly with the ETag of the version. When it
+    is missing, If-Modified-Since is compared with the time of the version.
+
+    : param tuple version: sequence number and timestamp of the last change
+        of the resource.
+    : returns: a 304 :py:class:`flask.Response` if the copy of the client is
+        up to date, None otherwise.
+    '''
+    seq, timestamp = version
+    if not seq:
+        # Nothing recorded: the resource does not exist
+        return None
+    etag = str(seq)
+    if request.if_none_match:
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    elif request.if_modified_since is None or \
+            request.if_modified_since.timestamp() < timestamp:
+        return None
+    return add_validators(Response(status=304), version)
+
+
+def add_validators(response, version):
+    '''
+    Sets the ETag and Last-Modified headers of a successful response from the
+    version of the resource. The clients have to revalidate their copy.
+
+    : param response: the :py:class:`flask.Response` to send.
+    : param tuple version: sequence number and timestamp of the last change
+        of the resource.
+    : returns: the response.
+    '''
+    seq, timestamp = version
+    if seq and response.status_code in (200, 304):
+        response.set_etag(str(seq), weak=True)
+        response.last_modified = timestamp
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def cached_response(version=None):
+    '''
+    Looks up the response of the request in the response cache.
+
+    If it is missing and an identical request is building it, waits for that
+    request to store it, at most SINGLE_FLIGHT_TIMEOUT seconds. Otherwise the
+    request becomes the one building the response, until the end of the
+    request (see :py:func:`close_connection`). A request that does not find
+    the response after waiting builds it too.
+
+    : param tuple version: the version of the data of the resource, as
+        returned by :py:meth:`app.database.Connection.get_change_version`.
+        A response built from another version is not used. None if the
+        resource has no version.
+    : returns: the cached :py:class:`flask.Response` or None.
+    '''
+    if not app.config["RESPONSE_CACHE_SIZE"]:
+        return None
+    # A response built during a write of its data must not be stored
+    g.cache_generation = response_cache.generation
+    key = (request.path, request.query_string)
+    entry = response_cache.get(key, version)
+    timeout = app.config["SINGLE_FLIGHT_TIMEOUT"]
+    if entry is None and timeout:
+        flight, leader = single_flight.join(key)
+        if leader:
+            g.flight = (key, flight)
+        elif flight.wait(timeout):
+            g.cache_generation = response_cache.generation
+            entry = response_cache.get(key, version)
+    if entry is None:
+        return None
+    response = Response(entry.body, 200, mimetype=MASON)
+    response.headers["X-Cache"] = "HIT"
+    if version is not None:
+        add_validators(response, version)
+    return response
+
+
+def cache_response(response, tags, version=None):
+    '''
+    Stores a successful response in the response cache. A streamed response
+    is still streamed: its chunks are collected as they are sent and the body
+    is stored once it has been sent completely. The collection stops as soon
+    as the body is too big to be stored.
+
+    : param response: the :py:class:`flask.Response` built for the request.
+    : param tags: tags invalidating the response, see
+        :py:func:`invalidate_cached_responses`.
+    : param tuple version: the version of the data of the resource or None.
+    : returns: the response.
+    '''
+    if not app.config["RESPONSE_CACHE_SIZE"] or response.status_code != 200:
+        return response
+    key = (request.path, request.query_string)
+    response.headers["X-Cache"] = "MISS"
+    flight = g.pop("flight", None)
+    # A versioned response built during a write is dropped by the next
+    # lookup, which asks for the new version
+    generation = g.cache_generation if version is None else None
+    if not response.is_streamed:
+        response_cache.put(key, response.get_data(), version, tags,
+                           generation)
+        leave_flight(flight)
+        return response
+
+    # collect must not reference the response, the body would then be
+    # released by the garbage collector, out of order with the contexts
+    body = response.response
+    charset = response.charset
+
+    def collect():
+        chunks = []
+        size = 0
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            if chunks is not None:
+                size += len(chunk)
+                if size > response_cache.max_body:
+                    # Too big to be stored, keep streaming in constant
+                    # memory
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            response_cache.put(key, b"".join(chunks), version, tags,
+                               generation)
+        leave_flight(flight)
+
+    # The body must be closed even if it is never read, and the requests
+    # waiting for it woken up even if it is not sent completely or the server
+    # drops it without closing it
+    callbacks = [lambda: leave_flight(flight)]
+    if hasattr(body, "close"):
+        callbacks.insert(0, body.close)
+    response.response = ClosingIterator(collect(), callbacks)
+    weakref.finalize(response.response, leave_flight, flight)
+    return response
+
+
+def leave_flight(flight):
+    '''
+    Wakes up the requests waiting for the response of this request, see
+    :py:func:`cached_response`.
+
+    : param flight: the key and the :py:class:`threading.Event` of the
+        response built, or None.
+    '''
+    if flight is not None:
+        single_flight.leave(*flight)
+
+
 @app.errorhandler(404)
 def resource_not_found(error):  # Borrowed from lab exercises [1]
     return create_error_response(404, "Resource not found",
@@ -345,8 +927,99 @@ def unknown_error(error):  # Borrowed from lab exercises [1]
                                  "The system has failed. Please, contact the administrator")
 
 
+@app.errorhandler(database.DatabaseBusyError)
+def database_busy(error):
+    response = create_error_response(503, "Service unavailable",
+                                     "The database is busy, try again later")
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
 # Borrowed from lab exercises [1]
 # HOOKS
+@app.before_request
+def check_content_length():
+    '''
+    Rejects the requests whose body is bigger than MAX_CONTENT_LENGTH before
+    reading it or opening a database connection.
+    '''
+
+    limit = app.config.get("MAX_CONTENT_LENGTH")
+    if limit is not None and (request.content_length or 0) > limit:
+        return create_error_response(413, "Request Entity Too Large",
+                                     "The body must not exceed %d bytes" %
+                                     limit)
+
+
+@app.before_request
+def check_admission():
+    '''
+    Refuses with 429 the requests of a client sending more than the rate of
+    their class of endpoint, and with 503 the "list" requests beyond the
+    LIST_CONCURRENCY being served, before opening a database connection.
+
+    The classes are "write" for the requests changing something, "list" for
+    the GET requests of the collections and "read" for the other ones. A
+    batch is not counted itself, each of its sub-requests is, in the bucket
+    of the client of the batch: a sub-request refused gets a 429 or 503 item
+    in the batch response.
+    '''
+
+    if request.endpoint == "batch":
+        return
+    name = admission_class()
+    limiter = rate_limiters.get(name)
+    if limiter is not None:
+        g.admission = limiter.acquire((request.remote_addr, name))
+        if not g.admission.allowed:
+            response = create_error_response(
+                429, "Too many requests",
+                "Too many %s requests, try again in %d seconds" %
+                (name, math.ceil(g.admission.retry_after)))
+            response.headers["Retry-After"] = str(
+                math.ceil(g.admission.retry_after))
+            return response
+    if name == "list" and list_limiter.limit:
+        if not list_limiter.try_acquire():
+            response = create_error_response(
+                503, "Service unavailable",
+                "Too many requests of collections, try again later")
+            response.headers["Retry-After"] = "1"
+            return response
+        g.list_slot = list_limiter
+
+
+def admission_class():
+    '''
+    : returns: the class of endpoint of the current request, see
+        :py:func:`check_admission`. The resources of collections have the
+        ``admission_class`` attribute "list": their GET requests are served
+        under LIST_CONCURRENCY.
+    '''
+    if request.method not in ("GET", "HEAD", "OPTIONS"):
+        return "write"
+    if request.method != "GET":
+        # Answered without building the collection
+        return "read"
+    view = app.view_functions.get(request.endpoint)
+    return getattr(getattr(view, "view_class", None), "admission_class",
+                   "read")
+
+
+@app.after_request
+def add_rate_limit_headers(response):
+    '''
+    Tells the client the state of the bucket used by the request.
+    '''
+    admission = g.get("admission")
+    if admission is not None:
+        response.headers["X-RateLimit-Limit"] = str(admission.limit)
+        response.headers["X-RateLimit-Remaining"] = str(admission.remaining)
+        response.headers["X-RateLimit-Reset"] = str(
+            math.ceil(admission.reset))
+    return response
+
+
 @app.before_request
 def connect_db():  # Borrowed from lab exercises [1]
     '''
@@ -356,7 +1029,118 @@ def connect_db():  # Borrowed from lab exercises [1]
     Hence it is accessible from the request object.
     '''
 
-    g.con = app.config["Engine"].connect()
+    # Sub-requests of a batch reuse the open connection of the batch, and
+    # its deadline
+    if "con" in g and not g.con.isclosed():
+        return
+    g.con = open_connection()
+    g.con.set_deadline(request_budget())
+
+
+def request_budget():
+    '''
+    Time budget of the current request: REQUEST_DEADLINE, or the budget
+    sent by the client in the DEADLINE_HEADER header if it is shorter.
+
+    : returns: the budget in seconds, or None.
+    '''
+    budget = app.config.get("REQUEST_DEADLINE")
+    try:
+        sent = float(request.headers[DEADLINE_HEADER])
+    except (KeyError, ValueError):
+        return budget
+    if sent != sent or sent < 0:
+        # NaN or negative
+        return budget
+    return sent if budget is None else min(budget, sent)
+
+
+def open_connection():
+    '''
+    Opens a connection to the database of the application, with the
+    listeners keeping the response cache and the event streams up to date.
+
+    : rtype:: py: class:`app.database.Connection`
+    '''
+    con = app.config["Engine"].connect()
+    con.add_listener(publish_post_events)
+    con.add_listener(invalidate_cached_responses)
+    return con
+
+
+def invalidate_cached_responses(change):
+    '''
+    Database listener removing the cached responses built from the written
+    data. The tags of the responses are:
+
+     * ("users",): the list of users.
+     * ("user", nickname): a user.
+     * ("inbox", nickname), ("river", nickname), ("ratings", nickname): the
+       collections of a user.
+     * ("post", post_id): a post.
+
+    : param dict change: the change notified by the database connection.
+    '''
+    if change["entity"] == "user":
+        if change["action"] == "delete":
+            # Their posts and ratings are gone from everywhere
+            response_cache.clear()
+        else:
+            response_cache.invalidate(("users",),
+                                      ("user", change["nickname"]))
+    elif change["entity"] == "post" and change["post"] is not None:
+        post = change["post"]
+        response_cache.invalidate(("post", str(post["post_id"])),
+                                  ("inbox", post["receiver"]),
+                                  ("river", post["receiver"]))
+    elif change["entity"] == "rating" and change["rating"] is not None:
+        response_cache.invalidate(("ratings", change["rating"]["receiver"]))
+
+
+def publish_post_events(change):
+    '''
+    Database listener sending the events of the written posts to the users
+    concerned:
+
+     * post: a new post, to its receiver.
+     * reply: a new reply, to the sender and the receiver of the post answered.
+     * publicity: a post was made public or private, to its receiver and
+       sender.
+
+    : param dict change: the change notified by the database connection.
+    '''
+    if change["entity"] != "post":
+        return
+    post = change["post"]
+    if post is None:
+        return
+    if change["action"] == "insert":
+        parent = change.get("parent")
+        if parent is not None:
+            event = "reply"
+            nicknames = (parent["sender"], parent["receiver"])
+        else:
+            event = "post"
+            nicknames = (post["receiver"],)
+    elif change["action"] in ("publish", "unpublish"):
+        event = "publicity"
+        nicknames = (post["receiver"], post["sender"])
+    else:
+        return
+
+    data = {
+        "postId": "p-" + str(post["post_id"]),
+        "sender": post["sender"],
+        "receiver": post["receiver"],
+        "replyTo": post["reply_to"],
+        "public": post["public"],
+        "timestamp": post["timestamp"],
+        "href": api.url_for(Post, postId=post["post_id"])
+    }
+    # Each user gets the event once, even if they wrote it
+    for nickname in set(nicknames):
+        if nickname is not None:
+            event_hub.publish(nickname, event, data)
 
 
 @app.teardown_request
@@ -370,9 +1154,70 @@ def close_connection(exc):  # Borrowed from lab exercises [1]
     if hasattr(g, "con"):
         g.con.close()
 
+    slot = g.pop("list_slot", None)
+    if slot is not None:
+        slot.release()
+
+    # The response was not stored, the identical requests waiting for it
+    # must build it themselves
+    leave_flight(g.pop("flight", None))
+
+
+def sync_user_index(con):
+    '''
+    Brings user_index up to date with the database before a search. The
+    users changed since the last search, by this process or another one, are
+    read from the change feed. The index is loaded again from the users
+    table the first time, when the database is replaced and when the changes
+    it has not applied were deleted from the feed.
+
+    : param con: the :py:class:`database.Connection` of the request.
+    '''
+    source = app.config["Engine"].db_path
+    first, last = con.get_change_bounds()
+    seq = user_index.seq
+    if seq is None or user_index.source != source or \
+            not (first <= seq + 1 and seq <= last):
+        # The users written after the last change read are read again at
+        # the next search
+        user_index.load(con.iter_users(fields=("firstname", "lastname")),
+                        last, source)
+        return
+    if seq == last:
+        return
+
+    changes = con.get_changes(since=seq, entity="user")
+    if not changes:
+        # Only posts and ratings changed
+        user_index.update([], [], last)
+        return
+    removed = [change["entity_id"] for change in changes
+               if change["action"] == "delete"]
+    changed = [change["entity_id"] for change in changes
+               if change["action"] != "delete"]
+    users = [user for user in con.get_users_by_nicknames(
+        changed, fields=("firstname", "lastname")) if user is not None]
+    user_index.update(users, removed, max(last, changes[-1]["seq"]))
+
+
+def warm_user_index():
+    '''
+    Loads user_index from the database of the application, so the first
+    search does not wait for it. Called by the launcher at startup.
+    '''
+    con = open_connection()
+    try:
+        sync_user_index(con)
+    finally:
+        con.close()
+
 
 class Users(Resource):
 
+    admission_class = "list"
+    # The retries of the POST requests are not run twice
+    method_decorators = {"post": [idempotent]}
+
     def get(self):
         '''
         Gets a list of all the users in the database.
@@ -395,45 +1240,128 @@ class Users(Resource):
 
         Semantic descriptors used in template: items
 
+        QUERY PARAMETERS:
+         * fields: comma separated list of the semantic descriptors to include
+           in the items. Only the matching columns are read from the database.
+         * nickname: comma separated list of nicknames. Only these users are
+           returned, in the same order and read with one query. A nickname
+           that does not exist gets an item with just the nickname and an
+           @error.
+         * prefix: only the users with a nickname, a given name or a family
+           name starting with it, ignoring the case, e.g. to complete what
+           a user types. They are ordered by the word matched and found in
+           an index kept in memory.
+         * limit: maximum number of users found with prefix, between 1 and
+           100, 20 by default.
+
+        RESPONSE STATUS CODE:
+         * Returns 200.
+         * Returns 304 if the ETag in If-None-Match or the date in
+           If-Modified-Since are still valid: no user changed since.
+         * Returns 400 if a query parameter is not valid.
+
         NOTE:
          * The attribute givenName is obtained from the column users_profile.firstname
          * The attribute familyName is obtained from the column users_profile.lastname
          * The rest of attributes match one-to-one with column names in the
            database.
         '''
+        try:
+            fields, columns = parse_fields(USERS_LIST_DESCRIPTORS,
+                                           ("nickname",))
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+
+        nicknames = request.args.get("nickname", None)
+        if nicknames is not None:
+            nicknames = [nickname.strip() for nickname in nicknames.split(",")
+                         if nickname.strip()]
+            if not 0 < len(nicknames) <= MAX_PAGE_SIZE:
+                return create_error_response(
+                    400, "Wrong request format",
+                    "Between 1 and %d nicknames can be requested" % MAX_PAGE_SIZE)
+
+        prefix = request.args.get("prefix", None)
+        try:
+            limit = parse_int_arg("limit", 1, MAX_PAGE_SIZE) or PAGE_SIZE
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if prefix is not None and nicknames is not None:
+            return create_error_response(
+                400, "Wrong request format",
+                "Users can be searched by nickname or by prefix, not both")
+
+        # The list changes with any user, whichever process writes it
+        version = g.con.get_change_version(entity="user")
+        not_modified = not_modified_response(version)
+        if not_modified is not None:
+            return not_modified
+        if prefix is None:
+            # The searches are answered from user_index, synced with the
+            # database below, and would fill the cache with every prefix
+            # typed
+            cached = cached_response(version)
+            if cached is not None:
+                return cached
+
         # PERFORM OPERATIONS
         # create users list
-        users_db = g.con.get_users()
+        if prefix is not None:
+            sync_user_index(g.con)
+            found = user_index.search(prefix, limit)
+            # Skip the users deleted since the index was updated
+            users_db = [user for user in
+                        g.con.get_users_by_nicknames(found, fields=columns)
+                        if user is not None]
+        elif nicknames is None:
+            users_db = g.con.iter_users(fields=columns)
+        else:
+            users_db = g.con.get_users_by_nicknames(nicknames, fields=columns)
 
         # FILTER AND GENERATE THE RESPONSE
         # Create the envelope
         envelope = CritiqueObject()
 
-        items = envelope["items"] = []
-
-        for user in users_db:
-            item = CritiqueObject(
-                nickname=user["nickname"],
-                givenName=user['firstname'],
-                familyName=user['lastname'],
-                avatar=user['avatar'],
-                bio=user['bio']
-            )
-            items.append(item)
-            item.add_control("self", href=api.url_for(
-                User, nickname=user["nickname"]))
-            item.add_control("profile", href=CRITIQUE_USER_PROFILE)
-            item.add_control_up(api.url_for(Users))
+        def generate_items():
+            users_url = api.url_for(Users)
+            for index, user in enumerate(users_db):
+                if user is None:
+                    item = CritiqueObject(nickname=nicknames[index])
+                    item.add_error("User not found",
+                                   "There is no user with nickname %s" %
+                                   nicknames[index])
+                    yield item
+                    continue
+                item = CritiqueObject(
+                    nickname=user["nickname"],
+                    givenName=user['firstname'],
+                    familyName=user['lastname'],
+                    avatar=user['avatar'],
+                    bio=user['bio']
+                )
+                item.restrict_fields(fields)
+                item.add_control("self", href=api.url_for(
+                    User, nickname=user["nickname"]))
+                item.add_control("profile", href=CRITIQUE_USER_PROFILE)
+                item.add_control_up(users_url)
+                yield item
 
         envelope.add_namespace("critique", LINK_RELATIONS_URL)
         envelope.add_control_all_posts()
 
         envelope.add_control_add_user()
-        envelope.add_control("self", href=api.url_for(Users))
+        envelope.add_control("self", href=api.url_for(
+            Users, **request.args.to_dict()))
 
         # RENDER
         # +";" + CRITIQUE_USER_PROFILE)
-        return Response(json.dumps(envelope), 200, mimetype=MASON)
+        response = add_validators(
+            create_collection_response(envelope, generate_items()), version)
+        if prefix is not None:
+            return response
+        return cache_response(response, [("users",)], version)
 
     def post(self):
         '''
@@ -487,20 +1415,19 @@ class Users(Resource):
             abort(415)
 
         # PARSE THE REQUEST:
-        request_body = request.get_json(force=True)
+        try:
+            request_body = parse_request_body(validate_create_user)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
         if not request_body:
             return create_error_response(415,
                                          "Unsupported Media Type")
 
         # pick up nickname, email, and firstName so we can check for conflicts
-        try:
-            nickname = request_body["nickname"]
-            firstName = request_body["givenName"]
-            email = request_body["email"]
-        except KeyError:
-            return create_error_response(400,
-                                         "Wrong request format")
-        # optional fields
+        nickname = request_body["nickname"]
+        firstName = request_body["givenName"]
+        email = request_body["email"]
 
         # Conflict if user already exist
         if g.con.contains_user_extended(nickname, email):
@@ -534,6 +1461,84 @@ class Users(Resource):
                         headers={"Location": api.url_for(User, nickname=nickname)})
 
 
+# Executor running the reads of the sub-resources embedded in a user.
+embed_executor = ThreadPoolExecutor(max_workers=EMBED_WORKERS)
+
+
+def parse_embed_arg(embeds):
+    '''
+    Parses the ``embed`` query parameter of the current request, a comma
+    separated list of sub-resources, e.g. ``?embed=counts,river``.
+
+    : param embeds: the sub-resources supported by the resource.
+    : returns: the set of requested sub-resources, empty if the parameter is
+        not given.
+    : raises ValueError: if an unknown sub-resource is requested.
+    '''
+
+    value = request.args.get("embed", "")
+    requested = set(embed.strip() for embed in value.split(",")
+                    if embed.strip())
+    unknown = requested - set(embeds)
+    if unknown:
+        raise ValueError("Unknown embedded resources: %s" %
+                         ", ".join(sorted(unknown)))
+    return requested
+
+
+def read_embedded(read, budget):
+    '''
+    Runs a read of an embedded sub-resource in a thread of
+    ``embed_executor``. A sqlite connection can not be shared by threads,
+    so the read has its own connection, with the deadline of the request.
+
+    : param read: function receiving the :py:class:`database.Connection`.
+    : param float budget: seconds left to the request, or None.
+    : returns: the value returned by ``read``.
+    '''
+
+    con = open_connection()
+    try:
+        con.set_deadline(budget)
+        return read(con)
+    finally:
+        con.close()
+
+
+def create_river_item(post, river_url, fields=None):
+    '''
+    Renders a post of the river of a user.
+
+    : param dict post: the post, as returned by the database API.
+    : param str river_url: the URL of the river.
+    : param fields: set of descriptors to keep, None to keep them all.
+    : returns: the :py:class:`CritiqueObject` of the post.
+    '''
+
+    item = CritiqueObject(
+        postId=post["post_id"],
+        ratingValue=post['rating'],
+        receiver=post['receiver'],
+        replyTo=post['reply_to'],
+        body=post['post_text'],
+        timestamp=post['timestamp'],
+        bestRating=10,
+        anonymous=post['anonymous'],
+        public=post['public'],
+        sender=post["sender"]
+    )
+    item.restrict_fields(fields)
+
+    item.add_control("self", href=river_url)
+    item.add_control("profile", href=CRITIQUE_POST_PROFILE)
+    item.add_control_delete_post(post['post_id'])
+    item.add_control_edit_post(post['post_id'])
+    item.add_control_sender(post['sender'])
+    item.add_control_receiver(post['receiver'])
+    item.add_control_up(river_url)
+    return item
+
+
 class User(Resource):
     '''
     Resource has the basic information of a specific user.
@@ -553,6 +1558,8 @@ class User(Resource):
         OUTPUT:
          * Return 200 if the nickname exists.
          * Return 404 if the nickname is not stored in the system.
+         * Return 304 if the ETag in If-None-Match or the date in
+           If-Modified-Since are still valid.
 
         RESPONSE ENTITY BODY:
 
@@ -566,7 +1573,18 @@ class User(Resource):
         user-river, user-ratings, profile, up
 
         Semantic descriptors used: nickname, givenName, familyName, avatar,
-        bio, email, birthday, telephone, gender
+        bio, email, birthday, telephone, gender, reputation
+
+        QUERY PARAMETERS:
+         * fields: comma separated list of the semantic descriptors to include.
+         * embed: comma separated list of sub-resources to include, so a
+           profile is read in one request:
+            * counts: the counters of the user, as in UserCounts.
+            * ratings: ratingsSummary with the count and the average of the
+              ratings received.
+            * river: the newest posts of the river, at most 5.
+           The sub-resources are read concurrently. The documents with
+           embedded sub-resources have no validators and are not cached.
 
         NOTE:
          * The attribute givenName is obtained from the column users_profile.firstname
@@ -574,6 +1592,11 @@ class User(Resource):
          * The attribute telephone is obtained from the column users_profile.mobile
          * The rest of attributes match one-to-one with column names in the
            database.
+         * The reputation is computed in batch by app/reputation.py, 1 is the
+           reputation of an average user. It is null until the first
+           computation after the user was created. The version of the
+           document includes the last computation, so the validators change
+           when the reputation is computed again.
 
         NOTE:
         The: py: method:`Connection.get_user()` returns a dictionary with the
@@ -598,10 +1621,55 @@ class User(Resource):
             }
         '''
 
+        try:
+            fields, columns = parse_fields(USER_DESCRIPTORS, ("nickname",))
+            embeds = parse_embed_arg(USER_EMBEDS)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+
+        if embeds:
+            # The version of the user does not cover the sub-resources
+            version = None
+        else:
+            # Answer the clients whose copy is up to date without reading it
+            version = g.con.get_change_version(entity="user",
+                                               entity_id=nickname)
+            if version[0] and (fields is None or "reputation" in fields):
+                # The reputation changes without any change of the user
+                seq, computed = g.con.get_reputation_state()
+                if computed is not None:
+                    version = ("%d.%d" % (version[0], seq),
+                               max(version[1], computed))
+            not_modified = not_modified_response(version)
+            if not_modified is not None:
+                return not_modified
+            cached = cached_response(version)
+            if cached is not None:
+                return cached
+
         # PERFORM OPERATIONS
-        user_db = g.con.get_user(nickname)
+        # The sub-resources are read by other threads while this one reads
+        # the user, before the deadline of the request. They are dropped if
+        # the user does not exist.
+        budget = g.con.time_left()
+        reads = {
+            "counts": lambda con: con.get_user_counts(nickname),
+            "ratings": lambda con: con.get_rating_stats(receiver=nickname),
+            "river": lambda con: con.get_posts(receiver=nickname, public=True,
+                                               limit=RIVER_PREVIEW_SIZE)
+        }
+        futures = dict((embed, embed_executor.submit(read_embedded,
+                                                     reads[embed], budget))
+                       for embed in embeds)
+        user_db = g.con.get_user(nickname, fields=columns)
+        embedded = dict((embed, future.result())
+                        for embed, future in futures.items())
         if not user_db:
             return create_error_response(404, "User not found.")
+        reputation = None
+        if fields is None or "reputation" in fields:
+            reputation = g.con.get_reputation(nickname)
 
         summary = user_db['summary']
         details = user_db['details']
@@ -617,8 +1685,10 @@ class User(Resource):
             email=details.get('email', None),
             birthdate=details.get('birthdate', None),
             telephone=details.get('mobile', None),
-            gender=details.get('gender', None)
+            gender=details.get('gender', None),
+            reputation=reputation
         )
+        envelope.restrict_fields(fields)
 
         envelope.add_namespace("critique", LINK_RELATIONS_URL)
 
@@ -630,10 +1700,39 @@ class User(Resource):
         envelope.add_control_user_inbox(nickname)
         envelope.add_control_user_river(nickname)
         envelope.add_control_user_ratings(nickname)
+        envelope.add_control_user_counts(nickname)
         envelope.add_control_up(api.url_for(Users))
 
+        counts = embedded.get("counts")
+        if counts is not None:
+            envelope["counts"] = CritiqueObject(
+                inbox=counts["inbox"],
+                river=counts["river"],
+                ratingsReceived=counts["ratings"],
+                postsSent=counts["sent"])
+            envelope["counts"].add_control("self", href=api.url_for(
+                UserCounts, nickname=nickname))
+        if "ratings" in embedded:
+            stats = embedded["ratings"]
+            envelope["ratingsSummary"] = CritiqueObject(
+                count=stats[0]["count"] if stats else 0,
+                average=stats[0]["average"] if stats else None,
+                bestRating=10)
+            envelope["ratingsSummary"].add_control("self", href=api.url_for(
+                UserRatings, nickname=nickname))
+        if "river" in embedded:
+            river_url = api.url_for(UserRiver, nickname=nickname)
+            envelope["river"] = CritiqueObject(
+                items=[create_river_item(post, river_url)
+                       for post in embedded["river"]])
+            envelope["river"].add_control("self", href=river_url)
+
         # +";" + CRITIQUE_USER_PROFILE)
-        return Response(json.dumps(envelope), 200, mimetype=MASON)
+        response = Response(json.dumps(envelope), 200, mimetype=MASON)
+        if embeds:
+            return response
+        return cache_response(add_validators(response, version),
+                              [("user", nickname)], version)
 
     def put(self, nickname):
         '''
@@ -688,6 +1787,14 @@ class User(Resource):
             return create_error_response(415, "UnsupportedMediaType",
                                          "Use a JSON compatible format")
 
+        try:
+            request_body = parse_request_body(validate_edit_user)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if not request_body:
+            return create_error_response(415, "Format of the input is not json.")
+
         user_db = g.con.get_user(nickname)
         if not user_db:
             return create_error_response(404, "User not found.")
@@ -695,10 +1802,6 @@ class User(Resource):
         summary = user_db['summary']
         details = user_db['details']
 
-        request_body = request.get_json()
-        if not request_body:
-            return create_error_response(415, "Format of the input is not json.")
-
         email = request_body.get('email', None)
         if email is not None and details['email'] != email and g.con.contains_user_email(email):
             return create_error_response(
@@ -769,6 +1872,21 @@ class UserRatings(Resource):
     track of the ratings.
     '''
 
+    admission_class = "list"
+    # The retries of the POST requests are not run twice
+    method_decorators = {"post": [idempotent]}
+
+    def head(self, nickname):
+        '''
+        Tells the number of ratings received by the user in the
+        X-Total-Count header, without reading them.
+
+        RESPONSE STATUS CODE:
+         * Returns 200, even if there are none.
+         * Returns 404 if the user is not found.
+        '''
+        return count_response(nickname, "ratings")
+
     def post(self, nickname):
         '''
         Adds a new rating in the database.
@@ -812,7 +1930,11 @@ class UserRatings(Resource):
             abort(415)
 
         # PARSE THE REQUEST:
-        request_body = request.get_json(force=True)
+        try:
+            request_body = parse_request_body(validate_create_rating)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
         if not request_body:
             return create_error_response(415,
                                          "Unsupported Media Type")
@@ -821,14 +1943,8 @@ class UserRatings(Resource):
         if not userExist:
             return create_error_response(404, "User not found.")
 
-        # pick up rating_id so we can check for conflicts
-        try:
-            sender = request_body["sender"]
-            rating = request_body["ratingValue"]
-        except KeyError:
-            return create_error_response(400,
-                                         "Wrong request format")
-        # optional fields
+        sender = request_body["sender"]
+        rating = request_body["ratingValue"]
 
         userExist = g.con.contains_user(sender)
         if not userExist:
@@ -856,6 +1972,8 @@ class UserRatings(Resource):
         OUTPUT:
             * Return 200 if the nickname exists.
             * Return 404 if the nickname not found.
+            * Return 304 if the ETag in If-None-Match or the date in
+              If-Modified-Since are still valid.
 
         RESPONSE ENTITY BODY:
 
@@ -873,6 +1991,10 @@ class UserRatings(Resource):
 
         Semantic descriptors used in template: items
 
+        QUERY PARAMETERS:
+            * fields: comma separated list of the semantic descriptors to
+              include in the items.
+
         NOTE:
             * The attribute ratingId is obtained from the column ratings.rating_id
             * The attribute ratingValue is obtained from the column ratings.rating
@@ -888,36 +2010,53 @@ class UserRatings(Resource):
                 }
         '''
 
+        try:
+            fields, columns = parse_fields(
+                RATING_DESCRIPTORS, ("rating_id", "sender", "receiver"))
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+
+        # Answer the clients whose copy is up to date without reading it
+        version = g.con.get_change_version(owner=nickname)
+        not_modified = not_modified_response(version)
+        if not_modified is not None:
+            return not_modified
+        cached = cached_response(version)
+        if cached is not None:
+            return cached
+
         userExist = g.con.contains_user(nickname)
         if not userExist:
             return create_error_response(404, "User not found.")
 
         # PERFORM OPERATIONS
         # create ratings list
-        ratings_db = g.con.get_ratings(receiver=nickname)
+        ratings_db = g.con.iter_ratings(receiver=nickname, fields=columns)
 
         # FILTER AND GENERATE THE RESPONSE
         # Create the envelope
         envelope = CritiqueObject()
 
-        items = envelope["items"] = []
-
-        for rating in ratings_db:
-            item = CritiqueObject(
-                ratingId=rating["rating_id"],
-                bestRating=10,
-                ratingValue=rating['rating'],
-                sender=rating['sender'],
-                receiver=rating['receiver']
-            )
-
-            items.append(item)
-            item.add_control_sender(rating['sender'])
-            item.add_control_receiver(rating['receiver'])
-            item.add_control("self",
-                             href=api.url_for(Rating, nickname=nickname, ratingId=rating["rating_id"]))
-            item.add_control("profile", href=CRITIQUE_RATING_PROFILE)
-            item.add_control_up(api.url_for(UserRatings, nickname=nickname))
+        def generate_items():
+            up_url = api.url_for(UserRatings, nickname=nickname)
+            for rating in ratings_db:
+                item = CritiqueObject(
+                    ratingId=rating["rating_id"],
+                    bestRating=10,
+                    ratingValue=rating['rating'],
+                    sender=rating['sender'],
+                    receiver=rating['receiver']
+                )
+                item.restrict_fields(fields)
+
+                item.add_control_sender(rating['sender'])
+                item.add_control_receiver(rating['receiver'])
+                item.add_control("self",
+                                 href=api.url_for(Rating, nickname=nickname, ratingId=rating["rating_id"]))
+                item.add_control("profile", href=CRITIQUE_RATING_PROFILE)
+                item.add_control_up(up_url)
+                yield item
 
         envelope.add_namespace("critique", LINK_RELATIONS_URL)
 
@@ -928,7 +2067,9 @@ class UserRatings(Resource):
 
         # RENDER
         # +";" + CRITIQUE_RATING_PROFILE)
-        return Response(json.dumps(envelope), 200, mimetype=MASON)
+        response = create_collection_response(envelope, generate_items())
+        return cache_response(add_validators(response, version),
+                              [("ratings", nickname)], version)
 
 
 class UserInbox(Resource):
@@ -938,6 +2079,10 @@ class UserInbox(Resource):
     however, rating is optional in the message.
     '''
 
+    admission_class = "list"
+    # The retries of the POST requests are not run twice
+    method_decorators = {"post": [idempotent]}
+
     def get(self, nickname):
         '''
         Get posts sent to the user which are currently not public
@@ -952,6 +2097,8 @@ class UserInbox(Resource):
         OUTPUT:
             * Return 200 if the nickname exists.
             * Return 404 if the nickname not found.
+            * Return 304 if the ETag in If-None-Match or the date in
+              If-Modified-Since are still valid.
 
         RESPONSE ENTITY BODY:
 
@@ -969,7 +2116,27 @@ class UserInbox(Resource):
 
         Semantic descriptors used in template: items
 
+        QUERY PARAMETERS:
+         * fields: comma separated list of the semantic descriptors to include
+           in the items. The text of the posts is only read if body is
+           requested.
+
         '''
+        try:
+            fields, columns = parse_fields(
+                POST_DESCRIPTORS, ("post_id", "sender", "receiver", "public"))
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+
+        # Answer the clients whose copy is up to date without reading it
+        version = g.con.get_change_version(owner=nickname)
+        not_modified = not_modified_response(version)
+        if not_modified is not None:
+            return not_modified
+        cached = cached_response(version)
+        if cached is not None:
+            return cached
 
         userExist = g.con.contains_user(nickname)
         if not userExist:
@@ -979,33 +2146,35 @@ class UserInbox(Resource):
         # Create the envelope
         envelope = CritiqueObject()
 
-        items = envelope["items"] = []
-
         # PEFORM OPERATIONS INITIAL CHECKS
         # Get the post from db
-        post_db = g.con.get_posts_by_user(nickname, False)
-        if not post_db:
+        post_db = g.con.iter_posts_by_user(nickname, False, fields=columns)
+        first_post = next(post_db, None)
+        if first_post is None:
             return create_error_response(404, "Posts not found",
                                          "There is no posts for %s" % nickname)
 
-        for post in post_db:
-            item = CritiqueObject(
-                postId=post["post_id"],
-                sender=post['sender'],
-                timestamp=post['timestamp'],
-                bestRating=10,
-                ratingValue=post['rating'],
-                receiver=post['receiver'],
-                replyTo=post['reply_to'],
-                body=post['post_text'],
-                anonymous=post['anonymous'],
-                public=post['public']
-            )
-            if (post['public'] == 0):
-                # check if the post is not public and then append
-                items.append(item)
+        def generate_items():
+            up_url = api.url_for(UserInbox, nickname=nickname)
+            for post in chain([first_post], post_db):
+                if (post['public'] != 0):
+                    # only the posts that are not public are in the inbox
+                    continue
+                item = CritiqueObject(
+                    postId=post["post_id"],
+                    sender=post['sender'],
+                    timestamp=post['timestamp'],
+                    bestRating=10,
+                    ratingValue=post['rating'],
+                    receiver=post['receiver'],
+                    replyTo=post['reply_to'],
+                    body=post['post_text'],
+                    anonymous=post['anonymous'],
+                    public=post['public']
+                )
+                item.restrict_fields(fields)
                 item.add_control("self",
-                                    href=api.url_for(Post, postId=post['post_id']))
+                                 href=api.url_for(Post, postId=post['post_id']))
                 item.add_control("profile", href=CRITIQUE_POST_PROFILE)
                 item.add_control_delete_post(post['post_id'])
                 item.add_control_edit_post(post['post_id'])
@@ -1013,17 +2182,32 @@ class UserInbox(Resource):
                 if post["receiver"] is not None:
                     item.add_control_receiver(post["receiver"])
                 item.add_control_add_reply(post['post_id'])
-                item.add_control_up(api.url_for(UserInbox, nickname=nickname))
+                item.add_control_up(up_url)
+                yield item
 
         envelope.add_namespace("critique", LINK_RELATIONS_URL)
         envelope.add_control("profile", href=CRITIQUE_POST_PROFILE)
         envelope.add_control("self", href=api.url_for(
             UserInbox, nickname=nickname))
         envelope.add_control_up(api.url_for(User, nickname=nickname))
+        envelope.add_control_inbox_actions(nickname)
 
         # RENDER
         # +";" + CRITIQUE_POST_PROFILE)
-        return Response(json.dumps(envelope), 200, mimetype=MASON)
+        response = create_collection_response(envelope, generate_items())
+        return cache_response(add_validators(response, version),
+                              [("inbox", nickname)], version)
+
+    def head(self, nickname):
+        '''
+        Tells the number of private posts of the inbox in the X-Total-Count
+        header, without reading them.
+
+        RESPONSE STATUS CODE:
+         * Returns 200, even if there are none.
+         * Returns 404 if the user is not found.
+        '''
+        return count_response(nickname, "inbox")
 
     def post(self, nickname):
         '''
@@ -1069,7 +2253,11 @@ class UserInbox(Resource):
             abort(415)
 
         # PARSE REQUEST
-        request_body = request.get_json(force=True)
+        try:
+            request_body = parse_request_body(validate_create_posts)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
         if not request_body:
             return create_error_response(415,
                                          "Unsupported Media Type")
@@ -1079,13 +2267,9 @@ class UserInbox(Resource):
         if not userExist:
             return create_error_response(404, "User not found")
 
-        # check mandatory fields
-        try:
-            post_text = request_body["body"]
-            sender_nickname = request_body["sender"]
-            anonymous = request_body["anonymous"]
-        except KeyError:
-            return create_error_response(400, "Wrong request format")
+        post_text = request_body["body"]
+        sender_nickname = request_body["sender"]
+        anonymous = request_body["anonymous"]
 
         userExist = g.con.contains_user(sender_nickname)
         if not userExist:
@@ -1107,46 +2291,215 @@ class UserInbox(Resource):
         return Response(status=201,  headers={"Location": url})
 
 
-class UserRiver(Resource):
+def count_response(nickname, counter):
     '''
-    Contains public posts sent to the user, it should include text as the actual post,
-    however, rating is optional in the posts.
+    Answers a HEAD request of a collection of a user with its number of items
+    in the TOTAL_COUNT_HEADER header, read from the counters of the user
+    instead of the collection.
+
+    : param str nickname: the nickname of the user.
+    : param str counter: the key of the counter in
+        :py:meth:`database.Connection.get_user_counts`.
     '''
+    counts = g.con.get_user_counts(nickname)
+    if counts is None:
+        return create_error_response(404, "User not found")
+    response = Response(status=200, mimetype=MASON)
+    response.headers[TOTAL_COUNT_HEADER] = str(counts[counter])
+    return response
 
-    def get(self, nickname):
+
+def is_post_id(post_id):
+    '''
+    : returns: True if ``post_id`` is a post id of the API, ``p-`` and a
+        number.
+    '''
+    return isinstance(post_id, str) and re.match(r"p-\d+$", post_id) is not None
+
+
+class UserInboxActions(Resource):
+
+    '''
+    Publishes, unpublishes, rates, answers or deletes several posts received
+    by a user in one request.
+    '''
+
+    def post(self, nickname):
         '''
-        Get posts sent to the user which are currently public
+        Runs an action on several posts received by the user. The action is
+        one statement in one transaction, whatever the number of posts.
 
-        INPUT PARAMETER:
+        REQUEST ENTITY BODY:
+         * Media type: JSON
 
-       :param user_id: default is None, takes the user id of the user
-            that you want the posts of. if the parameter is None, it
-            will raise a ValueError exception.
-        :type nickname: nickname of the user
+            {"action": "publish", "posts": ["p-1", "p-3"]}
 
-        OUTPUT:
-            * Return 200 if the nickname exists.
-            * Return 404 if the nickname not found.
+         * action: publish, unpublish, rate, reply or delete.
+         * posts: ids of at most 500 posts.
+         * ratingValue: the rating given by the rate action.
+         * body: the text of the replies of the reply action.
 
         RESPONSE ENTITY BODY:
 
         OUTPUT:
             * Media type: application/vnd.mason+json
                 https://github.com/JornWildt/Mason
-            * Profile: River
-                /profiles/post_profile
-
-        Link relations used in items: self, profile
-
-        Semantic descriptions used in items: sender, receiver, timestamp, postId, replyTo, body, anonymous, public
-
-        Link relations used in links: self, add-post, add-reply
 
-        Semantic descriptors used in template: items
+        Semantic descriptors used in template: items, one per post with its
+        postId and the status of the action on it: 200 if done, 400 if the
+        id is malformed and 404 if the user did not receive the post. The
+        items of the reply action have a reply link to the new post.
 
+        RESPONSE STATUS CODE:
+         * Returns 200 if the action was run, even if some posts were not
+           found.
+         * Returns 400 if the body is not well formed.
+         * Returns 404 if the user is not found.
+         * Returns 415 if it receives a media type != application/json
         '''
 
-        userExist = g.con.contains_user(nickname)
+        if JSON != request.headers.get("Content-Type", ""):
+            return create_error_response(415, "Unsupported Media Type",
+                                         "Use a JSON compatible format")
+
+        # PARSE THE REQUEST
+        try:
+            request_body = parse_request_body(validate_inbox_actions)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if not request_body:
+            return create_error_response(415, "Unsupported Media Type")
+        action = request_body["action"]
+        post_ids = request_body["posts"]
+        if len(post_ids) > INBOX_ACTION_MAX_POSTS:
+            return create_error_response(
+                400, "Wrong request format",
+                "An action can not have more than %d posts" %
+                INBOX_ACTION_MAX_POSTS)
+        if action == "rate" and "ratingValue" not in request_body:
+            return create_error_response(400, "Wrong request format",
+                                         "ratingValue is required to rate")
+        if action == "reply" and "body" not in request_body:
+            return create_error_response(400, "Wrong request format",
+                                         "body is required to reply")
+
+        if not g.con.contains_user(nickname):
+            return create_error_response(404, "User not found")
+
+        valid = [post_id for post_id in post_ids if is_post_id(post_id)]
+
+        # PERFORM OPERATIONS
+        replies = {}
+        if action == "publish":
+            done = g.con.modify_posts_publicity(nickname, valid, 1)
+        elif action == "unpublish":
+            done = g.con.modify_posts_publicity(nickname, valid, 0)
+        elif action == "rate":
+            done = g.con.modify_posts_rating(nickname, valid,
+                                             request_body["ratingValue"])
+        elif action == "reply":
+            replies = g.con.create_replies(nickname, valid,
+                                           request_body["body"])
+            done = list(replies)
+        else:
+            done = g.con.delete_posts(nickname, valid)
+        # The ids are matched by number: "p-04" is the post p-4
+        done = set(int(post_id[2:]) for post_id in done)
+        replies = dict((int(post_id[2:]), reply_id)
+                       for post_id, reply_id in replies.items())
+
+        # GENERATE THE RESPONSE
+        items = []
+        for post_id in post_ids:
+            item = CritiqueObject(postId=post_id)
+            number = int(post_id[2:]) if is_post_id(post_id) else None
+            if number is None:
+                item["status"] = 400
+                item["message"] = "The post id is malformed"
+            elif number in done:
+                item["status"] = 200
+                if number in replies:
+                    item.add_control("reply", href=api.url_for(
+                        Post, postId=replies[number]))
+            else:
+                item["status"] = 404
+                item["message"] = "%s did not receive %s" % (nickname,
+                                                             post_id)
+            items.append(item)
+
+        envelope = CritiqueObject(items=items)
+        envelope.add_namespace("critique", LINK_RELATIONS_URL)
+        envelope.add_control("self", href=api.url_for(UserInboxActions,
+                                                      nickname=nickname))
+        envelope.add_control_up(api.url_for(UserInbox, nickname=nickname))
+        return Response(json.dumps(envelope), 200, mimetype=MASON)
+
+
+class UserRiver(Resource):
+    '''
+    Contains public posts sent to the user, it should include text as the actual post,
+    however, rating is optional in the posts.
+    '''
+
+    admission_class = "list"
+
+    def get(self, nickname):
+        '''
+        Get posts sent to the user which are currently public
+
+        INPUT PARAMETER:
+
+       :param user_id: default is None, takes the user id of the user
+            that you want the posts of. if the parameter is None, it
+            will raise a ValueError exception.
+        :type nickname: nickname of the user
+
+        OUTPUT:
+            * Return 200 if the nickname exists.
+            * Return 404 if the nickname not found.
+            * Return 304 if the ETag in If-None-Match or the date in
+              If-Modified-Since are still valid.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+            * Profile: River
+                /profiles/post_profile
+
+        Link relations used in items: self, profile
+
+        Semantic descriptions used in items: sender, receiver, timestamp, postId, replyTo, body, anonymous, public
+
+        Link relations used in links: self, add-post, add-reply
+
+        Semantic descriptors used in template: items
+
+        QUERY PARAMETERS:
+         * fields: comma separated list of the semantic descriptors to include
+           in the items. The text of the posts is only read if body is
+           requested.
+
+        '''
+        try:
+            fields, columns = parse_fields(
+                POST_DESCRIPTORS, ("post_id", "sender", "receiver", "public"))
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+
+        # Answer the clients whose copy is up to date without reading it
+        version = g.con.get_change_version(owner=nickname)
+        not_modified = not_modified_response(version)
+        if not_modified is not None:
+            return not_modified
+        cached = cached_response(version)
+        if cached is not None:
+            return cached
+
+        userExist = g.con.contains_user(nickname)
         if not userExist:
             return create_error_response(404, "User not found.",
                                          "can't find a user to retrieve their river")
@@ -1155,40 +2508,21 @@ class UserRiver(Resource):
         # Create the envelope
         envelope = CritiqueObject()
 
-        items = envelope["items"] = []
-
         # PEFORM OPERATIONS INITIAL CHECKS
         # Get the post from db and create posts list
-        post_db = g.con.get_posts_by_user(nickname, False)
-        if not post_db:
+        post_db = g.con.iter_posts_by_user(nickname, False, fields=columns)
+        first_post = next(post_db, None)
+        if first_post is None:
             return create_error_response(404, "Message not found",
                                          "There is no a message with id %s" % nickname)
 
-        for post in post_db:
-            item = CritiqueObject(
-                postId=post["post_id"],
-                ratingValue=post['rating'],
-                receiver=post['receiver'],
-                replyTo=post['reply_to'],
-                body=post['post_text'],
-                timestamp=post['timestamp'],
-                bestRating=10,
-                anonymous=post['anonymous'],
-                public=post['public'],
-                sender=post["sender"]
-            )
-
-            if (post['public'] == 1):
-                # check if the post is public and then append
-                items.append(item)
-                item.add_control("self",
-                                 href=api.url_for(UserRiver, nickname=post['receiver']))
-                item.add_control("profile", href=CRITIQUE_POST_PROFILE)
-                item.add_control_delete_post(post['post_id'])
-                item.add_control_edit_post(post['post_id'])
-                item.add_control_sender(post['sender'])
-                item.add_control_receiver(post['receiver'])
-                item.add_control_up(api.url_for(UserRiver, nickname=post['receiver']))
+        def generate_items():
+            river_url = api.url_for(UserRiver, nickname=nickname)
+            for post in chain([first_post], post_db):
+                if (post['public'] != 1):
+                    # only the public posts are in the river
+                    continue
+                yield create_river_item(post, river_url, fields)
 
         envelope.add_namespace("critique", LINK_RELATIONS_URL)
         envelope.add_control_user_river(nickname)
@@ -1206,9 +2540,131 @@ class UserRiver(Resource):
 
         # RENDER
         # +";" + CRITIQUE_POST_PROFILE)
+        response = create_collection_response(envelope, generate_items())
+        return cache_response(add_validators(response, version),
+                              [("river", nickname)], version)
+
+    def head(self, nickname):
+        '''
+        Tells the number of public posts of the river in the X-Total-Count
+        header, without reading them.
+
+        RESPONSE STATUS CODE:
+         * Returns 200, even if there are none.
+         * Returns 404 if the user is not found.
+        '''
+        return count_response(nickname, "river")
+
+
+class UserCounts(Resource):
+
+    '''
+    Numbers of posts and ratings of a user, e.g. for the badges of a client,
+    read with one lookup of counters kept up to date by the database.
+    '''
+
+    def get(self, nickname):
+        '''
+        Gets the counters of the user.
+
+        OUTPUT:
+            * Return 200 if the nickname exists.
+            * Return 404 if the nickname not found.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+
+        Semantic descriptors used: nickname, inbox (private posts received),
+        river (public posts received), ratingsReceived and postsSent (posts
+        and replies).
+
+        Link relations used: self, up, user-inbox, user-river, user-ratings
+        '''
+        counts = g.con.get_user_counts(nickname)
+        if counts is None:
+            return create_error_response(404, "User not found",
+                                         "There is no user %s" % nickname)
+
+        envelope = CritiqueObject(nickname=nickname,
+                                  inbox=counts["inbox"],
+                                  river=counts["river"],
+                                  ratingsReceived=counts["ratings"],
+                                  postsSent=counts["sent"])
+        envelope.add_namespace("critique", LINK_RELATIONS_URL)
+        envelope.add_control("self", href=api.url_for(UserCounts,
+                                                      nickname=nickname))
+        envelope.add_control_up(api.url_for(User, nickname=nickname))
+        envelope.add_control_user_inbox(nickname)
+        envelope.add_control_user_river(nickname)
+        envelope.add_control_user_ratings(nickname)
         return Response(json.dumps(envelope), 200, mimetype=MASON)
 
 
+class UserEvents(Resource):
+
+    '''
+    Stream of server-sent events telling a user about the posts they receive,
+    the replies to their posts and the publicity changes of their posts.
+    '''
+
+    def get(self, nickname):
+        '''
+        Opens the event stream of a user. The connection stays open and the
+        events are written as they happen.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: text/event-stream
+                https://html.spec.whatwg.org/multipage/server-sent-events.html
+
+        Events: post, reply, publicity and reset. The data of the first three
+        is a JSON object with postId, sender, receiver, replyTo, public,
+        timestamp and href. A reset means that events were lost: the client
+        has to read again its inbox or use the change feed.
+
+        A comment is written when nothing happened for a while to keep the
+        connection open.
+
+        REQUEST HEADERS:
+         * Last-Event-ID: id of the last event received, sent by the browsers
+           when they reconnect. The missed events are sent first.
+
+        QUERY PARAMETERS:
+         * lastEventId: same as the Last-Event-ID header, for clients that
+           can not set it.
+
+        RESPONSE STATUS CODE:
+         * Returns 200 and the stream.
+         * Returns 400 if the last event id is not valid.
+         * Returns 404 if the nickname is not found.
+        '''
+        last_event_id = request.headers.get("Last-Event-ID",
+                                            request.args.get("lastEventId"))
+        if last_event_id is not None:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                return create_error_response(400, "Wrong request format",
+                                             "The last event id must be an "
+                                             "integer")
+
+        if not g.con.contains_user(nickname):
+            return create_error_response(404, "User not found.")
+
+        # The stream does not use the database, so it does not need the
+        # request context
+        subscription = event_hub.subscribe(nickname, last_event_id)
+        body = event_hub.stream(subscription,
+                                heartbeat=app.config["EVENTS_HEARTBEAT"])
+        return Response(body, mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
+
+
 class Ratings(Resource):
     '''
     Contains the ratings list with ratings from all other users to this specific user.
@@ -1217,8 +2673,137 @@ class Ratings(Resource):
     track of the ratings.
     '''
 
+    admission_class = "list"
+
     def get(self):
-        return Response('NOT IMPLEMENTED', 200)
+        '''
+        Gets a page of all the ratings in the database or, with the group
+        parameter, the aggregated ratings of each user.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+            * Profile: Rating
+                /profiles/rating-profile
+
+        Link relations used in items: self, profile, sender, receiver, up,
+            user-ratings
+
+        Semantic descriptions used in items: ratingId, bestRating, ratingValue, sender, receiver
+            With group: nickname, ratingCount, ratingValue (the average),
+            bestRating, histogram
+
+        Link relations used in links: self, profile, next, all-users
+
+        Semantic descriptors used in template: items
+
+        QUERY PARAMETERS:
+         * sender: nickname of the user who gave the ratings.
+         * receiver: nickname of the user who received the ratings.
+         * group: receiver or sender. Instead of the ratings, returns for each
+           user the number of ratings received (or given), their average and
+           a histogram with the number of ratings of each value.
+         * limit: number of items of the page, 20 by default and 100 at most.
+         * after: cursor of the next page, taken from the next control.
+         * fields: comma separated list of the semantic descriptors to include
+           in the items. Not used with group.
+
+        RESPONSE STATUS CODE:
+         * Returns 200 if the ratings are returned, even if none matches.
+         * Returns 400 if a query parameter is not valid.
+        '''
+        try:
+            fields, columns = parse_fields(
+                RATING_DESCRIPTORS, ("rating_id", "sender", "receiver"))
+            limit = parse_int_arg("limit", 1, MAX_PAGE_SIZE)
+            group = request.args.get("group", None)
+            if group not in (None, "receiver", "sender"):
+                raise ValueError("group must be receiver or sender")
+            after = request.args.get("after", None)
+            if after is not None and group is None:
+                match = re.match(r"rtg-(\d+)$", after)
+                if match is None:
+                    raise ValueError("after is not a valid cursor")
+                after = int(match.group(1))
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if limit is None:
+            limit = PAGE_SIZE
+        sender = request.args.get("sender", None)
+        receiver = request.args.get("receiver", None)
+
+        # PERFORM OPERATIONS
+        # Read one item more than requested to know if there is a next page
+        if group is None:
+            ratings_db = g.con.get_ratings(sender=sender, receiver=receiver,
+                                           fields=columns, after=after,
+                                           limit=limit + 1)
+        else:
+            ratings_db = g.con.get_rating_stats(group_by=group, sender=sender,
+                                                receiver=receiver, after=after,
+                                                limit=limit + 1)
+        has_next = len(ratings_db) > limit
+        ratings_db = ratings_db[:limit]
+
+        # FILTER AND GENERATE THE RESPONSE
+        # Create the envelope
+        envelope = CritiqueObject()
+
+        def generate_items():
+            ratings_url = api.url_for(Ratings)
+            for rating in ratings_db:
+                item = CritiqueObject(
+                    ratingId=rating["rating_id"],
+                    bestRating=10,
+                    ratingValue=rating["rating"],
+                    sender=rating["sender"],
+                    receiver=rating["receiver"]
+                )
+                item.restrict_fields(fields)
+                item.add_control("self", href=api.url_for(
+                    Rating, nickname=rating["receiver"],
+                    ratingId=rating["rating_id"]))
+                item.add_control("profile", href=CRITIQUE_RATING_PROFILE)
+                item.add_control_sender(rating["sender"])
+                item.add_control_receiver(rating["receiver"])
+                item.add_control_up(ratings_url)
+                yield item
+
+        def generate_groups():
+            for stats in ratings_db:
+                item = CritiqueObject(
+                    nickname=stats["nickname"],
+                    ratingCount=stats["count"],
+                    ratingValue=stats["average"],
+                    bestRating=10,
+                    histogram=dict((str(value), count) for value, count
+                                   in stats["histogram"].items())
+                )
+                item.add_control("self", href=api.url_for(
+                    User, nickname=stats["nickname"]))
+                item.add_control("profile", href=CRITIQUE_RATING_PROFILE)
+                item.add_control_user_ratings(stats["nickname"])
+                yield item
+
+        args = request.args.to_dict()
+        envelope.add_namespace("critique", LINK_RELATIONS_URL)
+        envelope.add_control("self", href=api.url_for(Ratings, **args))
+        envelope.add_control("profile", href=CRITIQUE_RATING_PROFILE)
+        envelope.add_control_all_users()
+        if has_next:
+            last = ratings_db[-1]
+            args["after"] = last["rating_id"] if group is None \
+                else last["nickname"]
+            envelope.add_control("next", href=api.url_for(Ratings, **args),
+                                 title="Next page")
+
+        # RENDER
+        if group is None:
+            return create_collection_response(envelope, generate_items())
+        return create_collection_response(envelope, generate_groups())
 
 
 class Post(Resource):
@@ -1231,6 +2816,9 @@ class Post(Resource):
     While anonymous is the same but indicates whether the user wants to post it without being known.
     '''
 
+    # The retries of the POST requests are not run twice
+    method_decorators = {"post": [idempotent]}
+
     def get(self, postId):
         '''
         Extracts a post and all it's information.
@@ -1240,6 +2828,8 @@ class Post(Resource):
         OUTPUT:
          * Return 200 if the post exists.
          * Return 404 if the post is not found.
+         * Return 304 if the ETag in If-None-Match or the date in
+           If-Modified-Since are still valid.
          * Return 500 in case of system failure.
 
         RESPONSE ENTITY BODY:
@@ -1252,8 +2842,28 @@ class Post(Resource):
 
         Link relations used: self, profile, add-reply, delete, edit,
         collection, up, sender, receiver
+
+        QUERY PARAMETERS:
+         * fields: comma separated list of the semantic descriptors to include.
         '''
-        post_db = g.con.get_post(postId)
+        try:
+            fields, columns = parse_fields(
+                POST_DESCRIPTORS,
+                ("post_id", "sender", "receiver", "public", "reply_to"))
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+
+        # Answer the clients whose copy is up to date without reading it
+        version = g.con.get_change_version(entity="post", entity_id=postId)
+        not_modified = not_modified_response(version)
+        if not_modified is not None:
+            return not_modified
+        cached = cached_response(version)
+        if cached is not None:
+            return cached
+
+        post_db = g.con.get_post(postId, fields=columns)
         if not post_db:
             return create_error_response(404, "Post not found.")
 
@@ -1269,6 +2879,7 @@ class Post(Resource):
             bestRating=10,
             ratingValue=post_db["rating"]
         )
+        envelope.restrict_fields(fields)
         envelope.add_namespace("critique", LINK_RELATIONS_URL)
 
         envelope.add_control("self", href=api.url_for(Post, postId=postId))
@@ -1288,7 +2899,9 @@ class Post(Resource):
             envelope.add_control_receiver(nickname=post_db["receiver"])
 
         # +";"+ CRITIQUE_POST_PROFILE)
-        return Response(json.dumps(envelope), 200, mimetype=MASON)
+        response = Response(json.dumps(envelope), 200, mimetype=MASON)
+        return cache_response(add_validators(response, version),
+                              [("post", str(post_db["post_id"]))], version)
 
     def post(self, postId):
         '''
@@ -1323,23 +2936,23 @@ class Post(Resource):
         if JSON != request.headers.get("Content-Type", ""):
             abort(415)
 
+        # parse request
+        try:
+            request_body = parse_request_body(validate_create_reply)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if not request_body:
+            return create_error_response(415, "Unsupported Media Type")
+
         # check if postId is available
         postExists = g.con.contains_post(post_id=postId)
         if not postExists:
             return create_error_response(404, "Post not found",
                                          "There is no post with id %s" % postId)
 
-        # parse request
-        request_body = request.get_json(force=True)
-        if not request_body:
-            return create_error_response(415, "Unsupported Media Type")
-
-        try:
-            sender = request_body['sender']
-            post_text = request_body['body']
-        except KeyError:
-            return create_error_response(400, "Wrong request format",
-                                         "Post body missing or sender nickname invalid")
+        sender = request_body['sender']
+        post_text = request_body['body']
 
         userExist = g.con.contains_user(sender)
         if not userExist:
@@ -1398,6 +3011,7 @@ class Post(Resource):
 
         RESPONSE STATUS CODE:
          * Returns 204 + the url of the edited resource in the Location header
+         * Return 400 Post info is not well formed.
          * Return 404 If post not found with given id.
          * Return 415 if it receives a media type != application/json
 
@@ -1407,27 +3021,25 @@ class Post(Resource):
            database.
         '''
 
-        post_db = g.con.get_post(postId)
-        if not post_db:
-            return create_error_response(404, "Post not found.")
-
         if JSON != request.headers.get("Content-Type", ""):
             return create_error_response(415, "UnsupportedMediaType",
                                          "Use a JSON compatible format")
 
-        request_body = request.get_json(force=True)
-        if not request_body:
-            return create_error_response(415, "Format of the input is not json.")
         try:
-            post_db['post_text'] = request_body.get(
-                'body', post_db['post_text'])
-            post_db['rating'] = request_body.get(
-                'ratingValue', post_db['rating'])
-            post_db['public'] = request_body.get(
-                'public', post_db['public'])
-        except KeyError:
+            request_body = parse_request_body(validate_edit_post)
+        except ValueError as error:
             return create_error_response(400, "Wrong request format",
-                                         "Can't acquire, either post body, rating or public value")
+                                         str(error))
+        if not request_body:
+            return create_error_response(415, "Format of the input is not json.")
+
+        post_db = g.con.get_post(postId)
+        if not post_db:
+            return create_error_response(404, "Post not found.")
+
+        post_db['post_text'] = request_body.get('body', post_db['post_text'])
+        post_db['rating'] = request_body.get('ratingValue', post_db['rating'])
+        post_db['public'] = request_body.get('public', post_db['public'])
         if not g.con.modify_post(postId, post_db['post_text'], post_db['rating'], post_db['public']):
             return create_error_response(500, "The system has failed. Please, contact the administrator.")
 
@@ -1467,7 +3079,16 @@ class Rating(Resource):
 
         Link relations used: add-rating, edit, delete, self, profile, collection.
 
+        QUERY PARAMETERS:
+         * fields: comma separated list of the semantic descriptors to include.
+
         '''
+        try:
+            fields, columns = parse_fields(
+                RATING_DESCRIPTORS, ("rating_id", "sender", "receiver"))
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
 
         ratingExist = g.con.contains_rating(ratingId)
         if not ratingExist:
@@ -1481,7 +3102,7 @@ class Rating(Resource):
         # Filter and generate the response
         # Create the envelope
         # get the rating from DB
-        rating_db = g.con.get_rating(ratingId)
+        rating_db = g.con.get_rating(ratingId, fields=columns)
         item = CritiqueObject(
             bestRating=10,
             ratingValue=rating_db["rating"],
@@ -1489,6 +3110,7 @@ class Rating(Resource):
             sender=rating_db["sender"],
             receiver=rating_db["receiver"]
         )
+        item.restrict_fields(fields)
         item.add_namespace("critique", LINK_RELATIONS_URL)
 
         item.add_control("self", href=api.url_for(
@@ -1519,6 +3141,7 @@ class Rating(Resource):
 
         RESPONSE STATUS CODE:
          * Returns 204 + the url of the edited resource in the Location header
+         * Return 400 Rating info is not well formed.
          * Return 404 If rating not found with given id.
          * Return 415 if it receives a media type != application/json
          * Return 500 if there was a db error
@@ -1531,23 +3154,23 @@ class Rating(Resource):
            database.
         '''
 
-        rating_db = g.con.get_rating(ratingId)
-        if not rating_db:
-            return create_error_response(404, "User not found.")
-
         if JSON != request.headers.get("Content-Type", ""):
             return create_error_response(415, "UnsupportedMediaType",
                                          "Use a JSON compatible format")
 
-        request_body = request.get_json(force=True)
-        if not request_body:
-            return create_error_response(415, "Format of the input is not json.")
         try:
-            rating_db['rating'] = request_body.get(
-                'ratingValue', rating_db['rating'])
-        except KeyError:
+            request_body = parse_request_body(validate_edit_rating)
+        except ValueError as error:
             return create_error_response(400, "Wrong request format",
-                                         "rating missing")
+                                         str(error))
+        if not request_body:
+            return create_error_response(415, "Format of the input is not json.")
+
+        rating_db = g.con.get_rating(ratingId)
+        if not rating_db:
+            return create_error_response(404, "User not found.")
+
+        rating_db['rating'] = request_body.get('ratingValue', rating_db['rating'])
 
         if not g.con.modify_rating(ratingId, rating_db['rating']):
             return create_error_response(500, "The system has failed. Please, contact the administrator.")
@@ -1585,8 +3208,676 @@ class Rating(Resource):
 
 
 class Posts(Resource):
+
+    '''
+    All the posts of the service, for moderation and analytics.
+    '''
+
+    admission_class = "list"
+
     def get(self):
-        return Response('NOT IMPLEMENTED', 200)
+        '''
+        Gets a page of the posts in the database, newest first by default.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+            * Profile: Post
+                /profiles/post_profile
+
+        Link relations used in items: self, profile, sender, receiver, up
+
+        Semantic descriptions used in items: postId, sender, receiver, timestamp, replyTo, body, ratingValue, bestRating, anonymous, public
+
+        Link relations used in links: self, profile, next, all-users
+
+        Semantic descriptors used in template: items
+
+        QUERY PARAMETERS:
+         * sender: nickname of the sender of the posts.
+         * receiver: nickname of the receiver of the posts.
+         * since: only posts with this UNIX timestamp or a later one.
+         * until: only posts with this UNIX timestamp or an older one.
+         * min_rating: only posts rated with at least this value (1-10).
+         * public: true or false to get only the public or private posts.
+         * replies_only: true to get only replies to other posts.
+         * order: desc (default, newest first) or asc.
+         * limit: number of posts of the page, 20 by default and 100 at most.
+         * after: cursor of the next page, taken from the next control.
+         * fields: comma separated list of the semantic descriptors to include
+           in the items.
+         * ids: comma separated list of post ids, e.g. p-1,p-7. Only these
+           posts are returned, in the same order and read with one query. An
+           id that does not exist gets an item with just the postId and an
+           @error. It can only be combined with fields.
+
+        RESPONSE STATUS CODE:
+         * Returns 200 if the posts are returned, even if no post matches.
+         * Returns 400 if a query parameter is not valid.
+        '''
+        try:
+            fields, columns = parse_fields(
+                POST_DESCRIPTORS,
+                ("post_id", "sender", "receiver", "timestamp"))
+            since = parse_int_arg("since")
+            until = parse_int_arg("until")
+            min_rating = parse_int_arg("min_rating", 1, 10)
+            public = parse_bool_arg("public")
+            replies_only = parse_bool_arg("replies_only")
+            limit = parse_int_arg("limit", 1, MAX_PAGE_SIZE)
+            order = request.args.get("order", "desc")
+            if order not in ("asc", "desc"):
+                raise ValueError("order must be asc or desc")
+            after = request.args.get("after", None)
+            if after is not None:
+                timestamp, _, post_id = after.partition("-")
+                try:
+                    after = (int(timestamp), int(post_id))
+                except ValueError:
+                    raise ValueError("after is not a valid cursor")
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if limit is None:
+            limit = PAGE_SIZE
+
+        post_ids = request.args.get("ids", None)
+        if post_ids is not None:
+            return self._get_by_ids(post_ids, fields, columns)
+
+        # PERFORM OPERATIONS
+        # Read one post more than requested to know if there is a next page
+        posts_db = g.con.get_posts(
+            sender=request.args.get("sender", None),
+            receiver=request.args.get("receiver", None),
+            since=since, until=until, min_rating=min_rating, public=public,
+            replies_only=bool(replies_only), descending=order == "desc",
+            after=after, limit=limit + 1, fields=columns)
+        has_next = len(posts_db) > limit
+        posts_db = posts_db[:limit]
+
+        # FILTER AND GENERATE THE RESPONSE
+        # Create the envelope
+        envelope = CritiqueObject()
+
+        def generate_items():
+            for post in posts_db:
+                yield self._create_item(post, fields)
+
+        args = request.args.to_dict()
+        self._add_envelope_controls(envelope, args)
+        if has_next:
+            last = posts_db[-1]
+            args["after"] = "%s-%s" % (last["timestamp"], last["post_id"])
+            envelope.add_control("next", href=api.url_for(Posts, **args),
+                                 title="Next page")
+
+        # RENDER
+        return create_collection_response(envelope, generate_items())
+
+    def _get_by_ids(self, post_ids, fields, columns):
+        '''
+        Gets the posts listed in the ids query parameter.
+        '''
+        if set(request.args) - set(("ids", "fields")):
+            return create_error_response(
+                400, "Wrong request format",
+                "ids can only be combined with fields")
+        post_ids = [post_id.strip() for post_id in post_ids.split(",")
+                    if post_id.strip()]
+        if not 0 < len(post_ids) <= MAX_PAGE_SIZE:
+            return create_error_response(
+                400, "Wrong request format",
+                "Between 1 and %d ids can be requested" % MAX_PAGE_SIZE)
+
+        # PERFORM OPERATIONS
+        posts_db = g.con.get_posts_by_ids(post_ids, fields=columns)
+
+        # FILTER AND GENERATE THE RESPONSE
+        envelope = CritiqueObject()
+
+        def generate_items():
+            for post_id, post in zip(post_ids, posts_db):
+                if post is None:
+                    item = CritiqueObject(postId=post_id)
+                    item.add_error("Post not found",
+                                   "There is no post with id %s" % post_id)
+                    yield item
+                else:
+                    yield self._create_item(post, fields)
+
+        self._add_envelope_controls(envelope, request.args.to_dict())
+
+        # RENDER
+        return create_collection_response(envelope, generate_items())
+
+    def _create_item(self, post, fields):
+        '''
+        Creates the item of the collection for a post of the database.
+        '''
+        item = CritiqueObject(
+            postId=post["post_id"],
+            sender=post["sender"],
+            receiver=post["receiver"],
+            timestamp=post["timestamp"],
+            replyTo=post["reply_to"],
+            body=post["post_text"],
+            ratingValue=post["rating"],
+            bestRating=10,
+            anonymous=post["anonymous"],
+            public=post["public"]
+        )
+        item.restrict_fields(fields)
+        item.add_control("self",
+                         href=api.url_for(Post, postId=post["post_id"]))
+        item.add_control("profile", href=CRITIQUE_POST_PROFILE)
+        item.add_control_sender(post["sender"])
+        if post["receiver"] is not None:
+            item.add_control_receiver(post["receiver"])
+        item.add_control_up(api.url_for(Posts))
+        return item
+
+    def _add_envelope_controls(self, envelope, args):
+        '''
+        Adds the controls of the collection, self pointing to the current
+        query.
+        '''
+        envelope.add_namespace("critique", LINK_RELATIONS_URL)
+        envelope.add_control("self", href=api.url_for(Posts, **args))
+        envelope.add_control("profile", href=CRITIQUE_POST_PROFILE)
+        envelope.add_control_all_users()
+
+
+class UserLeaderboard(Resource):
+
+    '''
+    The users with the best average rating.
+    '''
+
+    admission_class = "list"
+
+    def get(self):
+        '''
+        Gets a page of the users ranked by the average of the ratings they
+        received, best first.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+            * Profile: Rating
+                /profiles/rating-profile
+
+        Link relations used in items: self, profile, user-ratings
+
+        Semantic descriptions used in items: nickname, ratingCount,
+            ratingValue (the average), bestRating
+
+        Link relations used in links: self, profile, next, all-users
+
+        Semantic descriptors used in template: items
+
+        QUERY PARAMETERS:
+         * since: only the ratings given this UNIX timestamp or later. It is
+           rounded down to the start of its day (UTC).
+         * min_count: only the users with at least this number of ratings, 3
+           by default.
+         * limit: number of users of the page, 20 by default and 100 at most.
+         * after: cursor of the next page, taken from the next control.
+
+        RESPONSE STATUS CODE:
+         * Returns 200, even if no user is ranked.
+         * Returns 400 if a query parameter is not valid.
+        '''
+        try:
+            since = parse_int_arg("since", 0)
+            min_count = parse_int_arg("min_count", 1)
+            limit = parse_int_arg("limit", 1, MAX_PAGE_SIZE)
+            after = request.args.get("after", None)
+            if after is not None:
+                average, _, user_id = after.rpartition("_")
+                try:
+                    after = (float(average), int(user_id))
+                except ValueError:
+                    raise ValueError("after is not a valid cursor")
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if min_count is None:
+            min_count = LEADERBOARD_MIN_RATINGS
+        if limit is None:
+            limit = PAGE_SIZE
+
+        # PERFORM OPERATIONS
+        # Read one user more than requested to know if there is a next page
+        users_db = g.con.get_user_leaderboard(since=since, min_count=min_count,
+                                              after=after, limit=limit + 1)
+        has_next = len(users_db) > limit
+        users_db = users_db[:limit]
+
+        # FILTER AND GENERATE THE RESPONSE
+        envelope = CritiqueObject()
+
+        def generate_items():
+            for user in users_db:
+                item = CritiqueObject(
+                    nickname=user["nickname"],
+                    ratingCount=user["count"],
+                    ratingValue=user["average"],
+                    bestRating=10
+                )
+                item.add_control("self", href=api.url_for(
+                    User, nickname=user["nickname"]))
+                item.add_control("profile", href=CRITIQUE_RATING_PROFILE)
+                item.add_control_user_ratings(user["nickname"])
+                yield item
+
+        args = request.args.to_dict()
+        envelope.add_namespace("critique", LINK_RELATIONS_URL)
+        envelope.add_control("self", href=api.url_for(UserLeaderboard, **args))
+        envelope.add_control("profile", href=CRITIQUE_RATING_PROFILE)
+        envelope.add_control_all_users()
+        if has_next:
+            last = users_db[-1]
+            args["after"] = "%r_%d" % (last["average"], last["user_id"])
+            envelope.add_control("next",
+                                 href=api.url_for(UserLeaderboard, **args),
+                                 title="Next page")
+
+        # RENDER
+        return create_collection_response(envelope, generate_items())
+
+
+class PostLeaderboard(Posts):
+
+    '''
+    The public posts with the best rating. The items are the ones of Posts.
+    '''
+
+    def get(self):
+        '''
+        Gets a page of the public posts ranked by rating, best first, and
+        from the newest to the oldest for the same rating. The posts without
+        rating are not ranked.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+            * Profile: Post
+                /profiles/post_profile
+
+        Link relations used in items: self, profile, sender, receiver, up
+
+        Semantic descriptions used in items: postId, sender, receiver, timestamp, replyTo, body, ratingValue, bestRating, anonymous, public
+
+        Link relations used in links: self, profile, next, all-users
+
+        Semantic descriptors used in template: items
+
+        QUERY PARAMETERS:
+         * since: only the posts with this UNIX timestamp or a later one.
+         * limit: number of posts of the page, 20 by default and 100 at most.
+         * after: cursor of the next page, taken from the next control.
+         * fields: comma separated list of the semantic descriptors to include
+           in the items.
+
+        RESPONSE STATUS CODE:
+         * Returns 200, even if no post is ranked.
+         * Returns 400 if a query parameter is not valid.
+        '''
+        try:
+            fields, columns = parse_fields(
+                POST_DESCRIPTORS, ("post_id", "sender", "receiver"))
+            since = parse_int_arg("since", 0)
+            limit = parse_int_arg("limit", 1, MAX_PAGE_SIZE)
+            after = request.args.get("after", None)
+            if after is not None:
+                try:
+                    after = tuple(int(value) for value in after.split("-"))
+                except ValueError:
+                    raise ValueError("after is not a valid cursor")
+                if len(after) != 3:
+                    raise ValueError("after is not a valid cursor")
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if limit is None:
+            limit = PAGE_SIZE
+
+        # PERFORM OPERATIONS
+        # Read one post more than requested to know if there is a next page
+        posts_db = g.con.get_post_leaderboard(since=since, after=after,
+                                              limit=limit + 1, fields=columns)
+        has_next = len(posts_db) > limit
+        posts_db = posts_db[:limit]
+
+        # FILTER AND GENERATE THE RESPONSE
+        envelope = CritiqueObject()
+
+        def generate_items():
+            for post in posts_db:
+                yield self._create_item(post, fields)
+
+        args = request.args.to_dict()
+        envelope.add_namespace("critique", LINK_RELATIONS_URL)
+        envelope.add_control("self", href=api.url_for(PostLeaderboard, **args))
+        envelope.add_control("profile", href=CRITIQUE_POST_PROFILE)
+        envelope.add_control_all_users()
+        if has_next:
+            last = posts_db[-1]
+            args["after"] = "%s-%s-%s" % (last["rating"], last["timestamp"],
+                                          last["post_id"])
+            envelope.add_control("next",
+                                 href=api.url_for(PostLeaderboard, **args),
+                                 title="Next page")
+
+        # RENDER
+        return create_collection_response(envelope, generate_items())
+
+
+class Changes(Resource):
+
+    '''
+    Feed of the changes of users, posts and ratings, used by the clients to
+    synchronize their copy of the data.
+    '''
+
+    admission_class = "list"
+
+    def get(self):
+        '''
+        Gets the changes made after a given sequence number. Only the last
+        change of each user, post or rating is returned.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+
+        Link relations used in items: self (not present for deletes)
+
+        Semantic descriptions used in items: seq, timestamp, entity, id,
+            owner, action
+
+        Semantic descriptors used in template: items, lastSeq
+
+        Link relations used in links: self, next
+
+        QUERY PARAMETERS:
+         * since: lastSeq of the previous response, 0 (default) to get
+           everything.
+         * owner: only the changes concerning this nickname: the user, the
+           ratings they received and the posts they received.
+         * limit: number of changes of the page, 100 by default and 1000 at
+           most.
+
+        The client stores lastSeq and sends it as since in the next request.
+        If there is a next control more changes are waiting.
+
+        RESPONSE STATUS CODE:
+         * Returns 200.
+         * Returns 400 if a query parameter is not valid.
+        '''
+        try:
+            since = parse_int_arg("since", 0)
+            limit = parse_int_arg("limit", 1, CHANGES_MAX_PAGE_SIZE)
+        except ValueError as error:
+            return create_error_response(400, "Wrong request format",
+                                         str(error))
+        if since is None:
+            since = 0
+        if limit is None:
+            limit = CHANGES_PAGE_SIZE
+        owner = request.args.get("owner", None)
+
+        # PERFORM OPERATIONS
+        # Read one change more than requested to know if there is a next page
+        changes_db = g.con.get_changes(since=since, owner=owner,
+                                       limit=limit + 1)
+        has_next = len(changes_db) > limit
+        changes_db = changes_db[:limit]
+        last_seq = changes_db[-1]["seq"] if changes_db else since
+
+        # FILTER AND GENERATE THE RESPONSE
+        envelope = CritiqueObject(lastSeq=last_seq)
+
+        def generate_items():
+            for change in changes_db:
+                item = CritiqueObject(
+                    seq=change["seq"],
+                    timestamp=change["timestamp"],
+                    entity=change["entity"],
+                    id=change["entity_id"],
+                    owner=change["owner"],
+                    action=change["action"]
+                )
+                # Deleted resources can not be linked
+                href = None
+                if change["action"] != "delete":
+                    if change["entity"] == "user":
+                        href = api.url_for(User, nickname=change["entity_id"])
+                    elif change["entity"] == "post":
+                        href = api.url_for(Post, postId=change["entity_id"])
+                    elif change["owner"] is not None:
+                        href = api.url_for(Rating, nickname=change["owner"],
+                                           ratingId=change["entity_id"])
+                if href is not None:
+                    item.add_control("self", href=href)
+                yield item
+
+        args = request.args.to_dict()
+        envelope.add_control("self", href=api.url_for(Changes, **args))
+        if has_next:
+            args["since"] = last_seq
+            envelope.add_control("next", href=api.url_for(Changes, **args),
+                                 title="Next changes")
+
+        # RENDER
+        return create_collection_response(envelope, generate_items())
+
+
+class BatchAborted(Exception):
+    '''
+    Raised to roll back an atomic batch when one of its writes fails.
+    '''
+
+
+# Executor running the independent reads of the batches.
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+
+def dispatch_subrequest(subrequest, con=None, remote_addr=None):
+    '''
+    Runs one sub-request of a batch through the same resources as a normal
+    request, in its own application and request contexts.
+
+    : param dict subrequest: dictionary with the keys ``method``, ``path``
+        and, optionally, ``body`` and ``headers``.
+    : param con: :py:class:`database.Connection` used by the sub-request. If
+        None a new one is opened and closed, which is what the concurrent
+        reads do since a sqlite connection can not be shared by threads.
+    : param str remote_addr: address of the client of the batch, whose
+        buckets are charged by :py:func:`check_admission`.
+    : returns: dictionary with the ``status``, the ``headers`` and the
+        ``body`` of the response.
+    '''
+
+    headers = dict(subrequest.get("headers") or {})
+    data = None
+    if subrequest.get("body") is not None:
+        data = json.dumps(subrequest["body"])
+        headers.setdefault("Content-Type", JSON)
+
+    path, _, query_string = subrequest["path"].partition("?")
+    environ = {}
+    if remote_addr is not None:
+        environ["REMOTE_ADDR"] = remote_addr
+    with app.app_context():
+        if con is not None:
+            g.con = con
+        with app.test_request_context(path, method=subrequest["method"],
+                                      query_string=query_string,
+                                      headers=headers, data=data,
+                                      environ_base=environ):
+            try:
+                response = app.full_dispatch_request()
+                # Read the body while the context, and the connection, of
+                # streamed responses are still available
+                body = response.get_data(as_text=True)
+            finally:
+                if con is not None:
+                    # The connection belongs to the batch, it must not be
+                    # closed when the sub-request ends
+                    g.pop("con", None)
+
+    if body and response.mimetype in (MASON, JSON):
+        body = json.loads(body)
+    response_headers = dict((name, value) for name, value
+                            in response.headers.items()
+                            if name in ("Location", "Content-Type"))
+    return {
+        "status": response.status_code,
+        "headers": response_headers,
+        "body": body or None
+    }
+
+
+class Batch(Resource):
+
+    '''
+    Runs several operations of the API in one HTTP request.
+    '''
+
+    def post(self):
+        '''
+        Runs the sub-requests of the batch in order and returns all their
+        responses in one document.
+
+        REQUEST ENTITY BODY:
+         * Media type: JSON
+
+            {
+                "requests": [
+                    {"method": "GET", "path": "/critique/api/users/Scott/"},
+                    {"method": "POST",
+                     "path": "/critique/api/users/Kim/ratings/",
+                     "body": {"sender": "Scott", "ratingValue": 7}}
+                ],
+                "atomic": true
+            }
+
+         * requests: list of at most 20 sub-requests. Each one has a method
+           (GET, POST, PUT or DELETE), a path, which may include a query
+           string, and optionally a JSON body and headers.
+         * atomic: if true, the writes of the batch are committed together
+           and none of them is kept if one fails. False by default.
+
+        The sub-requests share the database connection of the batch.
+        Consecutive GET sub-requests are independent and run concurrently,
+        unless the batch is atomic and has already written something they
+        must see. Each sub-request is admitted like a request of its own,
+        see check_admission.
+
+        RESPONSE ENTITY BODY:
+
+        OUTPUT:
+            * Media type: application/vnd.mason+json
+                https://github.com/JornWildt/Mason
+
+        Semantic descriptors used in template: items, each one with the
+        status, headers and body of a sub-request in the order of the batch.
+
+        RESPONSE STATUS CODE:
+         * Returns 200 if the batch was run, even if some sub-requests failed.
+         * Returns 400 if the batch is not well formed.
+         * Returns 409 if an atomic batch was rolled back. The items show
+           which sub-request failed.
+         * Returns 415 if it receives a media type != application/json
+        '''
+
+        if JSON != request.headers.get("Content-Type", ""):
+            return create_error_response(415, "Unsupported Media Type",
+                                         "Use a JSON compatible format")
+
+        # PARSE THE REQUEST
+        request_body = request.get_json(force=True, silent=True)
+        if not isinstance(request_body, dict) or \
+                not isinstance(request_body.get("requests"), list):
+            return create_error_response(400, "Wrong request format",
+                                         "The batch must have a list of requests")
+        subrequests = request_body["requests"]
+        atomic = bool(request_body.get("atomic", False))
+        if len(subrequests) > BATCH_MAX_REQUESTS:
+            return create_error_response(
+                400, "Wrong request format",
+                "A batch can not have more than %d requests" % BATCH_MAX_REQUESTS)
+
+        batch_url = api.url_for(Batch)
+        for index, subrequest in enumerate(subrequests):
+            if not isinstance(subrequest, dict) or \
+                    subrequest.get("method") not in BATCH_METHODS or \
+                    not isinstance(subrequest.get("path"), str) or \
+                    not subrequest["path"].startswith("/"):
+                return create_error_response(
+                    400, "Wrong request format",
+                    "Request %d needs a method and an absolute path" % index)
+            if subrequest["path"].partition("?")[0] == batch_url:
+                return create_error_response(
+                    400, "Wrong request format",
+                    "Request %d is a batch, batches can not be nested" % index)
+
+        # PERFORM OPERATIONS
+        remote_addr = request.remote_addr
+        responses = [None] * len(subrequests)
+        written = False
+        failed = None
+        try:
+            # Without a transaction every write is committed on its own
+            with g.con.transaction() if atomic else ExitStack():
+                index = 0
+                while index < len(subrequests):
+                    # Group the consecutive reads
+                    end = index
+                    while end < len(subrequests) and \
+                            subrequests[end]["method"] == "GET":
+                        end += 1
+                    if end - index > 1 and not (atomic and written):
+                        reads = batch_executor.map(
+                            functools.partial(dispatch_subrequest,
+                                              remote_addr=remote_addr),
+                            subrequests[index:end])
+                        responses[index:end] = list(reads)
+                        index = end
+                        continue
+
+                    subrequest = subrequests[index]
+                    responses[index] = dispatch_subrequest(subrequest, g.con,
+                                                           remote_addr)
+                    if subrequest["method"] != "GET":
+                        written = True
+                        if atomic and responses[index]["status"] >= 400:
+                            failed = index
+                            raise BatchAborted()
+                    index += 1
+        except BatchAborted:
+            pass
+
+        # GENERATE THE RESPONSE
+        envelope = CritiqueObject(items=responses)
+        envelope.add_control("self", href=batch_url)
+        if failed is not None:
+            envelope.add_error(
+                "Batch rolled back",
+                "Request %d failed with status %d, none of the changes of "
+                "the batch were saved" % (failed, responses[failed]["status"]))
+            return Response(json.dumps(envelope), 409, mimetype=MASON)
+        return Response(json.dumps(envelope), 200, mimetype=MASON)
 
 
 # Add the Regex Converter so we can use regex expressions when we define the
@@ -1602,12 +3893,29 @@ api.add_resource(User, "/critique/api/users/<nickname>/",
                  endpoint="user")
 api.add_resource(UserInbox, "/critique/api/users/<nickname>/inbox/",
                  endpoint="inbox")
+api.add_resource(UserInboxActions,
+                 "/critique/api/users/<nickname>/inbox/actions/",
+                 endpoint="inbox_actions")
 api.add_resource(UserRiver, "/critique/api/users/<nickname>/river/",
                  endpoint="river")
+api.add_resource(UserCounts, "/critique/api/users/<nickname>/counts/",
+                 endpoint="counts")
+api.add_resource(UserEvents, "/critique/api/users/<nickname>/events/",
+                 endpoint="events")
 api.add_resource(UserRatings, "/critique/api/users/<nickname>/ratings/",
                  endpoint="user-ratings")
 api.add_resource(Rating, "/critique/api/users/<nickname>/ratings/<regex('rtg-\d+'):ratingId>/",
                  endpoint="rating")
+api.add_resource(Ratings, "/critique/api/ratings/",
+                 endpoint="ratings")
+api.add_resource(Changes, "/critique/api/changes/",
+                 endpoint="changes")
+api.add_resource(UserLeaderboard, "/critique/api/leaderboards/users/",
+                 endpoint="user-leaderboard")
+api.add_resource(PostLeaderboard, "/critique/api/leaderboards/posts/",
+                 endpoint="post-leaderboard")
+api.add_resource(Batch, "/critique/api/batch/",
+                 endpoint="batch")
 api.add_resource(Posts, "/critique/api/posts/",
                  endpoint="posts")
 api.add_resource(Post, "/critique/api/posts/<postId>/",
@@ -0,0 +1,145 @@
+'''
+Created on 19.10.2026
+
+In-memory prefix index of the users of the critique API, used to complete
+nicknames and names as they are typed.
+
+:py:class:`PrefixIndex` keeps a sorted list of ``(word, nickname)`` pairs
+with the nickname, the given name and the family name of every user, in
+lower case. The words starting with a prefix are consecutive in the list, so
+a search is a binary search followed by reading the first matches: it costs
+``O(log n + k)`` whatever the number of users. Adding or removing a user
+moves the end of the list, which is a fast memory copy even with millions of
+entries.
+
+The index is local to the process. The resources keep it up to date from the
+change feed of the database (see :py:meth:`PrefixIndex.update`), so it also
+sees the users written by other processes.
+'''
+
+import threading
+
+from bisect import bisect_left, insort
+
+
+def index_words(nickname, firstname=None, lastname=None):
+    '''
+    :returns: the set of words under which a user is found: the nickname and
+        each word of the given and family names, in lower case.
+    '''
+    words = {nickname.casefold()}
+    for name in (firstname, lastname):
+        if name:
+            words.update(word.casefold() for word in name.split())
+    return words
+
+
+class PrefixIndex(object):
+    '''
+    Sorted index of the words of the names of the users. It is safe to share
+    between threads.
+
+    ``seq`` is the sequence number of the last change of the database applied
+    to the index, None until the index is loaded, and ``source`` names the
+    database it was loaded from.
+    '''
+
+    def __init__(self):
+        super(PrefixIndex, self).__init__()
+        self._entries = []
+        # nickname -> words indexed for the user
+        self._words = {}
+        self._lock = threading.Lock()
+        self.seq = None
+        self.source = None
+
+    def load(self, users, seq, source=None):
+        '''
+        Replaces the content of the index.
+
+        :param users: iterable of dictionaries with the keys ``nickname``,
+            ``firstname`` and ``lastname``.
+        :param int seq: the sequence number of the last change included.
+        :param source: identifies the database the users were read from.
+        '''
+        words = dict((user['nickname'],
+                      index_words(user['nickname'], user['firstname'],
+                                  user['lastname']))
+                     for user in users)
+        entries = sorted((word, nickname) for nickname in words
+                         for word in words[nickname])
+        with self._lock:
+            self._entries = entries
+            self._words = words
+            self.seq = seq
+            self.source = source
+
+    def update(self, users, removed, seq):
+        '''
+        Applies the changes read from the database after ``seq``. Ignored if
+        a more recent update was applied meanwhile by another thread.
+
+        :param users: iterable of dictionaries with the keys ``nickname``,
+            ``firstname`` and ``lastname`` of the users added or modified.
+        :param removed: nicknames of the users deleted.
+        :param int seq: the sequence number of the last change read.
+        :returns: True if the changes were applied.
+        '''
+        with self._lock:
+            if self.seq is None or seq <= self.seq:
+                return False
+            for nickname in removed:
+                self._remove(nickname)
+            for user in users:
+                self._remove(user['nickname'])
+                words = index_words(user['nickname'], user['firstname'],
+                                    user['lastname'])
+                self._words[user['nickname']] = words
+                for word in words:
+                    insort(self._entries, (word, user['nickname']))
+            self.seq = seq
+            return True
+
+    def _remove(self, nickname):
+        for word in self._words.pop(nickname, ()):
+            position = bisect_left(self._entries, (word, nickname))
+            if position < len(self._entries) and \
+                    self._entries[position] == (word, nickname):
+                del self._entries[position]
+
+    def search(self, prefix, limit):
+        '''
+        Finds the users with a word starting with ``prefix``, ignoring the
+        case.
+
+        :param str prefix: the beginning of a nickname or of a name.
+        :param int limit: maximum number of users returned.
+        :returns: list of nicknames, ordered by the word matched.
+        '''
+        prefix = prefix.strip().casefold()
+        found = []
+        if not prefix:
+            return found
+        with self._lock:
+            position = bisect_left(self._entries, (prefix,))
+            while len(found) < limit and position < len(self._entries):
+                word, nickname = self._entries[position]
+                if not word.startswith(prefix):
+                    break
+                if nickname not in found:
+                    found.append(nickname)
+                position += 1
+        return found
+
+    def __len__(self):
+        return len(self._words)
+
+    def clear(self):
+        '''
+        Empties the index, it is loaded again by the next search.
+        '''
+        with self._lock:
+            self._entries = []
+            self._words = {}
+            self.seq = None
+            self.source = None
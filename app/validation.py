@@ -0,0 +1,278 @@
+'''
+Created on 19.10.2026
+
+Validation of the request bodies of the critique API against the JSON
+schemas in app/schema.
+
+The schemas are compiled once into plain Python functions, so validating a
+body costs a few dictionary lookups and type checks per property instead of
+interpreting the schema at every request. The subset of JSON Schema used by
+the API is supported: ``type``, ``properties``, ``required``,
+``additionalProperties`` (as a boolean), ``enum``, ``minimum``, ``maximum``,
+``minLength`` and ``maxLength``. The annotations (``title``,
+``description``...) are ignored and any other keyword is refused when
+compiling, so a schema never silently accepts more than it says.
+
+Run ``python -m app.validation`` from the project root to measure the cost of
+validating a body against each schema.
+'''
+
+import json
+import os
+import timeit
+
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), "schema")
+
+# Python types of the JSON values decoded by the json module, by JSON type.
+# bool is not an integer and an integer is a number.
+JSON_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "null": (type(None),),
+    "object": (dict,),
+    "array": (list,)
+}
+# JSON type reported for each Python type in the error messages.
+TYPE_NAMES = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    type(None): "null",
+    dict: "object",
+    list: "array"
+}
+
+ANNOTATIONS = frozenset(("title", "description", "default", "examples",
+                         "$schema", "$id", "$comment"))
+KEYWORDS = frozenset(("type", "properties", "required",
+                      "additionalProperties", "enum", "minimum", "maximum",
+                      "minLength", "maxLength"))
+
+
+class ValidationError(ValueError):
+    '''
+    Raised when a document does not match its schema.
+
+    :param str message: what is wrong.
+    :param tuple path: keys leading from the document to the wrong value.
+    '''
+
+    def __init__(self, message, path=()):
+        self.message = message
+        self.path = tuple(path)
+        if self.path:
+            message = "%s: %s" % (".".join(str(key) for key in self.path),
+                                  message)
+        super(ValidationError, self).__init__(message)
+
+
+def _check_type(types):
+    names = [types] if isinstance(types, str) else list(types)
+    allowed = set()
+    for name in names:
+        if name not in JSON_TYPES:
+            raise ValueError("Unknown type %r" % name)
+        allowed.update(JSON_TYPES[name])
+    allowed = frozenset(allowed)
+    expected = " or ".join(names)
+
+    def check(value, path):
+        # Exact types: True must not pass as an integer
+        if type(value) not in allowed:
+            raise ValidationError(
+                "expected %s, got %s" %
+                (expected, TYPE_NAMES.get(type(value), "unknown")), path)
+    return check
+
+
+def _check_enum(values):
+    # Compare the types too, 1 == True in Python
+    allowed = frozenset((type(value), value) for value in values)
+
+    def check(value, path):
+        try:
+            if (type(value), value) in allowed:
+                return
+        except TypeError:
+            # Unhashable, i.e. an object or an array
+            pass
+        raise ValidationError("must be one of %s" %
+                              ", ".join(json.dumps(v) for v in values), path)
+    return check
+
+
+def _bounds(minimum, maximum):
+    if minimum is None:
+        return "at most %s" % maximum
+    if maximum is None:
+        return "at least %s" % minimum
+    return "between %s and %s" % (minimum, maximum)
+
+
+def _check_range(minimum, maximum):
+    message = "must be " + _bounds(minimum, maximum)
+
+    def check(value, path):
+        if type(value) not in (int, float):
+            return
+        if (minimum is not None and value < minimum) or \
+                (maximum is not None and value > maximum):
+            raise ValidationError(message, path)
+    return check
+
+
+def _check_length(min_length, max_length):
+    message = "length must be " + _bounds(min_length, max_length)
+
+    def check(value, path):
+        if type(value) is not str:
+            return
+        if (min_length is not None and len(value) < min_length) or \
+                (max_length is not None and len(value) > max_length):
+            raise ValidationError(message, path)
+    return check
+
+
+def _check_object(properties, required, additional):
+    required = tuple(required)
+    properties = tuple(properties.items())
+
+    def check(value, path):
+        if type(value) is not dict:
+            return
+        for name in required:
+            if name not in value:
+                raise ValidationError("%s is required" % name, path)
+        for name, validator in properties:
+            if name in value:
+                validator(value[name], path + (name,))
+        if not additional:
+            known = set(name for name, _ in properties)
+            for name in value:
+                if name not in known:
+                    raise ValidationError("%s is not allowed" % name, path)
+    return check
+
+
+def _compile(schema):
+    unknown = set(schema) - KEYWORDS - ANNOTATIONS
+    if unknown:
+        raise ValueError("Unsupported keywords: %s" %
+                         ", ".join(sorted(unknown)))
+
+    checks = []
+    if "type" in schema:
+        checks.append(_check_type(schema["type"]))
+    if "enum" in schema:
+        checks.append(_check_enum(schema["enum"]))
+    if "minimum" in schema or "maximum" in schema:
+        checks.append(_check_range(schema.get("minimum"),
+                                   schema.get("maximum")))
+    if "minLength" in schema or "maxLength" in schema:
+        checks.append(_check_length(schema.get("minLength"),
+                                    schema.get("maxLength")))
+    if "properties" in schema or "required" in schema or \
+            "additionalProperties" in schema:
+        additional = schema.get("additionalProperties", True)
+        if not isinstance(additional, bool):
+            raise ValueError("additionalProperties must be a boolean")
+        properties = dict((name, _compile(subschema)) for name, subschema
+                          in schema.get("properties", {}).items())
+        checks.append(_check_object(properties, schema.get("required", ()),
+                                    additional))
+
+    if len(checks) == 1:
+        return checks[0]
+    checks = tuple(checks)
+
+    def validate(value, path):
+        for check in checks:
+            check(value, path)
+    return validate
+
+
+def compile_schema(schema):
+    '''
+    Compiles a JSON schema into a validator function.
+
+    :param dict schema: the schema, as loaded from app/schema.
+    :returns: a function receiving a decoded JSON document and returning it
+        if it matches the schema.
+    :raises ValueError: if the schema uses unsupported keywords.
+
+    :Example:
+
+    >>> validate = compile_schema({"type": "object", "required": ["sender"]})
+    >>> validate({})
+    Traceback (most recent call last):
+    ...
+    app.validation.ValidationError: sender is required
+    '''
+    check = _compile(schema)
+
+    def validate(document):
+        check(document, ())
+        return document
+    return validate
+
+
+def load_schema(name):
+    '''
+    :param str name: name of a schema file in app/schema, without extension.
+    :returns: the schema as a dictionary.
+    '''
+    with open(os.path.join(SCHEMA_DIR, name + ".json")) as schema_file:
+        return json.load(schema_file)
+
+
+# Valid and invalid bodies of each schema measured by benchmark.
+BENCHMARK_DOCUMENTS = {
+    "create_user": ({"nickname": "Wallace", "givenName": "Wallace",
+                     "email": "wallace@mail.com", "bio": "Roommate"},
+                    {"nickname": "Wallace", "email": 42}),
+    "edit_user": ({"givenName": "Wallace", "telephone": None},
+                  {"givenName": None}),
+    "create_rating": ({"sender": "Kim", "ratingValue": 7},
+                      {"sender": "Kim", "ratingValue": "seven"}),
+    "edit_rating": ({"ratingValue": 7}, {"ratingValue": 11}),
+    "create_posts": ({"sender": "Kim", "body": "Hi Scott!", "anonymous": 0},
+                     {"sender": "Kim", "body": "Hi Scott!"}),
+    "create_reply": ({"sender": "Kim", "body": "Me too"},
+                     {"sender": "Kim", "body": 1}),
+    "edit_post": ({"body": "Hi Scott!", "public": 1}, {"public": 2})
+}
+
+
+def benchmark(number=100000):
+    '''
+    Measures the validation of a valid and an invalid body with each schema.
+
+    :param int number: validations measured per body.
+    :returns: dictionary with the name of each schema mapped to the
+        microseconds taken to validate its valid and its invalid body.
+    '''
+    results = {}
+    for name, (valid, invalid) in BENCHMARK_DOCUMENTS.items():
+        validate = compile_schema(load_schema(name))
+
+        def reject():
+            try:
+                validate(invalid)
+            except ValidationError:
+                pass
+            else:
+                raise AssertionError("%s accepted %r" % (name, invalid))
+
+        results[name] = (
+            timeit.timeit(lambda: validate(valid), number=number) / number * 1e6,
+            timeit.timeit(reject, number=number) / number * 1e6)
+    return results
+
+
+if __name__ == "__main__":
+    print("%-14s %10s %10s" % ("schema", "valid us", "invalid us"))
+    for name, (valid, invalid) in sorted(benchmark().items()):
+        print("%-14s %10.2f %10.2f" % (name, valid, invalid))
@@ -33,6 +33,16 @@ CREATE TABLE IF NOT EXISTS posts (
   FOREIGN KEY(receiver_id) REFERENCES users(user_id) ON DELETE CASCADE,
   FOREIGN KEY(reply_to) REFERENCES posts(post_id) ON DELETE CASCADE);
 
+CREATE INDEX IF NOT EXISTS posts_timestamp ON posts(timestamp);
+CREATE INDEX IF NOT EXISTS posts_sender_timestamp ON posts(sender_id, timestamp);
+CREATE INDEX IF NOT EXISTS posts_receiver_timestamp ON posts(receiver_id, timestamp);
+CREATE INDEX IF NOT EXISTS posts_public_timestamp ON posts(public, timestamp);
+CREATE INDEX IF NOT EXISTS posts_sender_public_timestamp ON posts(sender_id, public, timestamp);
+CREATE INDEX IF NOT EXISTS posts_receiver_public_timestamp ON posts(receiver_id, public, timestamp);
+CREATE INDEX IF NOT EXISTS posts_rating_timestamp ON posts(rating, timestamp);
+CREATE INDEX IF NOT EXISTS posts_replies_timestamp ON posts(timestamp) WHERE reply_to IS NOT NULL;
+CREATE INDEX IF NOT EXISTS posts_reply_to ON posts(reply_to);
+
 CREATE TABLE IF NOT EXISTS ratings(
   rating_id INTEGER PRIMARY KEY AUTOINCREMENT,
   timestamp INTEGER NOT NULL,
@@ -42,5 +52,270 @@ CREATE TABLE IF NOT EXISTS ratings(
   FOREIGN KEY(sender_id) REFERENCES users(user_id) ON DELETE CASCADE,
   FOREIGN KEY(receiver_id) REFERENCES users(user_id) ON DELETE CASCADE);
 
+CREATE INDEX IF NOT EXISTS ratings_receiver_rating ON ratings(receiver_id, rating);
+CREATE INDEX IF NOT EXISTS ratings_sender_rating ON ratings(sender_id, rating);
+-- The ratings of a user in order of id, for the pages of the ratings.
+CREATE INDEX IF NOT EXISTS ratings_receiver ON ratings(receiver_id);
+CREATE INDEX IF NOT EXISTS ratings_sender ON ratings(sender_id);
+
+-- Change log used by the change feed. Every insert, update and delete of
+-- users, posts and ratings is recorded by the triggers below with an
+-- increasing sequence number. owner is the nickname of the user the change
+-- concerns: the user itself, the receiver of a rating or of a post (the
+-- sender for replies).
+CREATE TABLE IF NOT EXISTS changes(
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  timestamp INTEGER NOT NULL,
+  entity TEXT NOT NULL CHECK(entity IN ('user','post','rating')),
+  entity_id TEXT NOT NULL,
+  owner TEXT,
+  action TEXT NOT NULL CHECK(action IN ('insert','update','delete','publish','unpublish')));
+
+CREATE INDEX IF NOT EXISTS changes_owner_seq ON changes(owner, seq);
+CREATE INDEX IF NOT EXISTS changes_entity_seq ON changes(entity, entity_id, seq);
+CREATE INDEX IF NOT EXISTS changes_kind_seq ON changes(entity, seq);
+
+CREATE TRIGGER IF NOT EXISTS users_insert_change AFTER INSERT ON users
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'user', NEW.nickname, NEW.nickname, 'insert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_delete_change AFTER DELETE ON users
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'user', OLD.nickname, OLD.nickname, 'delete');
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_profile_update_change AFTER UPDATE ON users_profile
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  SELECT CAST(strftime('%s','now') AS INTEGER), 'user', nickname, nickname, 'update'
+  FROM users WHERE user_id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_insert_change AFTER INSERT ON posts
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'post', CAST(NEW.post_id AS TEXT),
+          (SELECT nickname FROM users WHERE user_id = COALESCE(NEW.receiver_id, NEW.sender_id)),
+          'insert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_update_change AFTER UPDATE ON posts
+WHEN OLD.public = NEW.public
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'post', CAST(NEW.post_id AS TEXT),
+          (SELECT nickname FROM users WHERE user_id = COALESCE(NEW.receiver_id, NEW.sender_id)),
+          'update');
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_publicity_change AFTER UPDATE ON posts
+WHEN OLD.public <> NEW.public
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'post', CAST(NEW.post_id AS TEXT),
+          (SELECT nickname FROM users WHERE user_id = COALESCE(NEW.receiver_id, NEW.sender_id)),
+          CASE NEW.public WHEN 1 THEN 'publish' ELSE 'unpublish' END);
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_delete_change AFTER DELETE ON posts
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'post', CAST(OLD.post_id AS TEXT),
+          (SELECT nickname FROM users WHERE user_id = COALESCE(OLD.receiver_id, OLD.sender_id)),
+          'delete');
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_insert_change AFTER INSERT ON ratings
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'rating', 'rtg-' || NEW.rating_id,
+          (SELECT nickname FROM users WHERE user_id = NEW.receiver_id), 'insert');
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_update_change AFTER UPDATE ON ratings
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'rating', 'rtg-' || NEW.rating_id,
+          (SELECT nickname FROM users WHERE user_id = NEW.receiver_id), 'update');
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_delete_change AFTER DELETE ON ratings
+BEGIN
+  INSERT INTO changes(timestamp, entity, entity_id, owner, action)
+  VALUES (CAST(strftime('%s','now') AS INTEGER), 'rating', 'rtg-' || OLD.rating_id,
+          (SELECT nickname FROM users WHERE user_id = OLD.receiver_id), 'delete');
+END;
+
+-- Counters of each user, kept up to date by the triggers below so that they
+-- are read with one lookup: inbox is the number of private posts received,
+-- river the number of public posts received, ratings the number of ratings
+-- received and sent the number of posts (and replies) sent.
+CREATE TABLE IF NOT EXISTS user_counters(
+  user_id INTEGER PRIMARY KEY,
+  inbox INTEGER NOT NULL DEFAULT 0,
+  river INTEGER NOT NULL DEFAULT 0,
+  ratings INTEGER NOT NULL DEFAULT 0,
+  sent INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+-- Counters of the users created before the table
+INSERT OR IGNORE INTO user_counters(user_id, inbox, river, ratings, sent)
+  SELECT user_id,
+         (SELECT COUNT(*) FROM posts WHERE receiver_id = users.user_id AND public = 0),
+         (SELECT COUNT(*) FROM posts WHERE receiver_id = users.user_id AND public = 1),
+         (SELECT COUNT(*) FROM ratings WHERE receiver_id = users.user_id),
+         (SELECT COUNT(*) FROM posts WHERE sender_id = users.user_id)
+  FROM users;
+
+CREATE TRIGGER IF NOT EXISTS users_insert_counters AFTER INSERT ON users
+BEGIN
+  INSERT OR IGNORE INTO user_counters(user_id) VALUES (NEW.user_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_insert_counters AFTER INSERT ON posts
+BEGIN
+  UPDATE user_counters SET inbox = inbox + (NEW.public = 0), river = river + (NEW.public = 1)
+  WHERE user_id = NEW.receiver_id;
+  UPDATE user_counters SET sent = sent + 1 WHERE user_id = NEW.sender_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_update_counters
+AFTER UPDATE OF sender_id, receiver_id, public ON posts
+BEGIN
+  UPDATE user_counters SET inbox = inbox - (OLD.public = 0), river = river - (OLD.public = 1)
+  WHERE user_id = OLD.receiver_id;
+  UPDATE user_counters SET inbox = inbox + (NEW.public = 0), river = river + (NEW.public = 1)
+  WHERE user_id = NEW.receiver_id;
+  UPDATE user_counters SET sent = sent - 1 WHERE user_id = OLD.sender_id;
+  UPDATE user_counters SET sent = sent + 1 WHERE user_id = NEW.sender_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS posts_delete_counters AFTER DELETE ON posts
+BEGIN
+  UPDATE user_counters SET inbox = inbox - (OLD.public = 0), river = river - (OLD.public = 1)
+  WHERE user_id = OLD.receiver_id;
+  UPDATE user_counters SET sent = sent - 1 WHERE user_id = OLD.sender_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_insert_counters AFTER INSERT ON ratings
+BEGIN
+  UPDATE user_counters SET ratings = ratings + 1 WHERE user_id = NEW.receiver_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_update_counters AFTER UPDATE OF receiver_id ON ratings
+BEGIN
+  UPDATE user_counters SET ratings = ratings - 1 WHERE user_id = OLD.receiver_id;
+  UPDATE user_counters SET ratings = ratings + 1 WHERE user_id = NEW.receiver_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_delete_counters AFTER DELETE ON ratings
+BEGIN
+  UPDATE user_counters SET ratings = ratings - 1 WHERE user_id = OLD.receiver_id;
+END;
+
+-- Number and sum of the ratings received by each user, in total and per day
+-- (UTC), kept up to date by the triggers below for the leaderboards.
+-- rating_totals_average keeps the users sorted by their average rating, so
+-- the best ones are read without aggregating the ratings, and a rating
+-- written only moves one entry of the index. The windowed leaderboards add
+-- up the days of the window from rating_days, for every page. The rows left
+-- without ratings are deleted.
+CREATE TABLE IF NOT EXISTS rating_totals(
+  user_id INTEGER PRIMARY KEY,
+  count INTEGER NOT NULL DEFAULT 0,
+  total INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+CREATE INDEX IF NOT EXISTS rating_totals_average
+  ON rating_totals(total * 1.0 / count, user_id);
+
+CREATE TABLE IF NOT EXISTS rating_days(
+  day INTEGER NOT NULL,
+  user_id INTEGER NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  total INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(day, user_id),
+  FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS rating_days_user ON rating_days(user_id);
+
+-- Totals of the ratings written before the tables
+INSERT OR IGNORE INTO rating_totals(user_id, count, total)
+  SELECT receiver_id, COUNT(*), SUM(rating) FROM ratings GROUP BY receiver_id;
+INSERT OR IGNORE INTO rating_days(day, user_id, count, total)
+  SELECT timestamp / 86400, receiver_id, COUNT(*), SUM(rating) FROM ratings
+  GROUP BY timestamp / 86400, receiver_id;
+
+CREATE TRIGGER IF NOT EXISTS ratings_insert_totals AFTER INSERT ON ratings
+BEGIN
+  INSERT INTO rating_totals(user_id, count, total) VALUES (NEW.receiver_id, 1, NEW.rating)
+  ON CONFLICT(user_id) DO UPDATE SET count = count + 1, total = total + excluded.total;
+  INSERT INTO rating_days(day, user_id, count, total)
+  VALUES (NEW.timestamp / 86400, NEW.receiver_id, 1, NEW.rating)
+  ON CONFLICT(day, user_id) DO UPDATE SET count = count + 1, total = total + excluded.total;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_update_totals
+AFTER UPDATE OF timestamp, receiver_id, rating ON ratings
+BEGIN
+  UPDATE rating_totals SET count = count - 1, total = total - OLD.rating
+  WHERE user_id = OLD.receiver_id;
+  UPDATE rating_days SET count = count - 1, total = total - OLD.rating
+  WHERE day = OLD.timestamp / 86400 AND user_id = OLD.receiver_id;
+  DELETE FROM rating_totals WHERE user_id = OLD.receiver_id AND count = 0;
+  DELETE FROM rating_days
+  WHERE day = OLD.timestamp / 86400 AND user_id = OLD.receiver_id AND count = 0;
+  INSERT INTO rating_totals(user_id, count, total) VALUES (NEW.receiver_id, 1, NEW.rating)
+  ON CONFLICT(user_id) DO UPDATE SET count = count + 1, total = total + excluded.total;
+  INSERT INTO rating_days(day, user_id, count, total)
+  VALUES (NEW.timestamp / 86400, NEW.receiver_id, 1, NEW.rating)
+  ON CONFLICT(day, user_id) DO UPDATE SET count = count + 1, total = total + excluded.total;
+END;
+
+CREATE TRIGGER IF NOT EXISTS ratings_delete_totals AFTER DELETE ON ratings
+BEGIN
+  UPDATE rating_totals SET count = count - 1, total = total - OLD.rating
+  WHERE user_id = OLD.receiver_id;
+  UPDATE rating_days SET count = count - 1, total = total - OLD.rating
+  WHERE day = OLD.timestamp / 86400 AND user_id = OLD.receiver_id;
+  DELETE FROM rating_totals WHERE user_id = OLD.receiver_id AND count = 0;
+  DELETE FROM rating_days
+  WHERE day = OLD.timestamp / 86400 AND user_id = OLD.receiver_id AND count = 0;
+END;
+
+-- Public posts by rating, newest first within a rating, for the
+-- leaderboard of the posts.
+CREATE INDEX IF NOT EXISTS posts_public_rating ON posts(public, rating, timestamp);
+
+-- Reputation of the users, computed in batch from the graph of the ratings
+-- by app/reputation.py. score is 1 for an average user. reputation_state
+-- has one row with the sequence number of the last change included in the
+-- scores and the UNIX time they were computed.
+CREATE TABLE IF NOT EXISTS reputation(
+  user_id INTEGER PRIMARY KEY,
+  score REAL NOT NULL,
+  FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE);
+
+CREATE TABLE IF NOT EXISTS reputation_state(
+  id INTEGER PRIMARY KEY CHECK(id = 0),
+  seq INTEGER NOT NULL,
+  computed INTEGER NOT NULL);
+
+-- Outcome of the POST requests sent with an Idempotency-Key header, sent
+-- again when the request is retried. fingerprint identifies the method, the
+-- path and the body of the first request. created is the UNIX time of its
+-- execution: the keys older than their time to live are deleted in bulk.
+CREATE TABLE IF NOT EXISTS idempotency_keys(
+  idempotency_key TEXT PRIMARY KEY,
+  fingerprint TEXT NOT NULL,
+  status INTEGER NOT NULL,
+  location TEXT,
+  created INTEGER NOT NULL) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys(created);
+
 COMMIT;
 PRAGMA foreign_keys=ON;
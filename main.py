@@ -1,9 +1,23 @@
+import sys
+
 from werkzeug.serving import run_simple
-from werkzeug.wsgi import DispatcherMiddleware
+try:
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+except ImportError:  # Werkzeug < 0.15
+    from werkzeug.wsgi import DispatcherMiddleware
 from app.resources import app as critique
+from app.asgi import ASGIApplication
+from app.compression import CompressionMiddleware
 # from forum_admin.application import app as forum_admin
 
-application = DispatcherMiddleware(critique)
+application = CompressionMiddleware(
+    DispatcherMiddleware(critique),
+    level=critique.config.get("COMPRESSION_LEVEL", 6),
+    min_size=critique.config.get("COMPRESSION_MIN_SIZE", 500))
+# Same API for the asyncio servers, e.g. uvicorn main:asgi_application
+asgi_application = ASGIApplication(critique, application)
 if __name__ == '__main__':
-    run_simple('localhost', 5000, application,
-               use_reloader=True, use_debugger=True, use_evalex=True)
+    # Development server. Use server.py in production.
+    critique.debug = "--debug" in sys.argv[1:]
+    run_simple('localhost', 5000, application, use_reloader=True,
+               use_debugger=critique.debug, use_evalex=critique.debug)
@@ -2,3 +2,5 @@
 set -ex
 
 python -m tests.critique_api_tests;
+python -m tests.server_tests;
+python -m tests.asgi_tests;
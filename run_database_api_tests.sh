@@ -3,4 +3,6 @@ set -ex
 
 python -m tests.database_api_tests_user;
 python -m tests.database_api_tests_ratings;
-python -m tests.database_api_tests_posts;
\ No newline at end of file
+python -m tests.database_api_tests_posts;
+python -m tests.database_api_tests_changes;
+python -m tests.database_api_tests_reputation;
@@ -0,0 +1,449 @@
+'''
+Created on 19.10.2026
+
+Production launcher of the critique API.
+
+A pre-fork server: the master process binds the listening socket and forks
+the worker processes, which inherit it and accept the connections directly,
+so the kernel spreads them over all the cores. Each worker serves the
+connections with a fixed pool of threads and only accepts a connection when
+one of them is free, leaving the others to the idle workers. With
+``--reuse-port`` each worker binds its own socket with ``SO_REUSEPORT``
+instead and the kernel balances the connections between the sockets.
+
+The application is imported by the master before forking (``--preload``,
+the default) so the workers share its memory and an import error stops the
+launcher at once. With ``--no-preload`` every worker imports it, which lets a
+graceful restart load new code.
+
+Signals handled by the master:
+ * TERM, INT: graceful stop. The workers stop accepting connections and end
+   the requests in progress, for at most ``--graceful-timeout`` seconds.
+ * HUP: graceful restart. New workers are started and the old ones are
+   stopped gracefully.
+
+Connections are kept alive between requests and closed after ``--keepalive``
+idle seconds. Request bodies bigger than ``--max-request-size`` bytes are
+answered with 413; the request line and the headers are limited by
+:py:mod:`http.server` (64 KiB per line, 100 headers). A request waiting for
+the database longer than ``--deadline`` seconds is answered with 503.
+
+Note that every worker has its own response cache and its own hub of
+server-sent events: an event stream only receives the events of the writes
+handled by its worker. A single worker runs by default and the launcher
+warns when ``--workers`` asks for more, so only raise it when the event
+streams are not used.
+
+Usage::
+
+    python server.py --bind 0.0.0.0:5000 --threads 8
+
+``python main.py`` runs the development server, with the reloader.
+'''
+
+import argparse
+import importlib
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, \
+    get_sockaddr, select_address_family
+
+logger = logging.getLogger("critique.server")
+
+# Exit status of a worker which could not load the application.
+WORKER_BOOT_ERROR = 3
+# Seconds between two checks of the workers by the master.
+MASTER_INTERVAL = 0.2
+
+
+class RequestHandler(WSGIRequestHandler):
+    '''
+    Request handler of the workers. HTTP/1.1 keeps the connections alive
+    between requests; idle connections are closed after ``timeout`` seconds.
+    '''
+
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+
+
+class PoolWSGIServer(BaseWSGIServer):
+    '''
+    WSGI server handling its connections with a fixed pool of threads. A
+    connection is accepted only when a thread is free, otherwise it is left
+    in the queue of the listening socket for another worker.
+
+    :param str host: the host name or address to bind.
+    :param int port: the port to bind.
+    :param app: the WSGI application.
+    :param int threads: number of threads of the pool.
+    :param handler: the request handler class.
+    :param int fd: descriptor of a listening socket to use instead of
+        binding a new one.
+    '''
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, handler=RequestHandler,
+                 fd=None):
+        super(PoolWSGIServer, self).__init__(host, port, app,
+                                             handler=handler, fd=fd)
+        # Several workers wait for the same socket: the ones that lose the
+        # race must not block in accept()
+        self.socket.setblocking(False)
+        self.threads = threads
+        self._slots = threading.BoundedSemaphore(threads)
+        self._executor = ThreadPoolExecutor(threads)
+        self._stopping = threading.Event()
+
+    def _handle_request_noblock(self):
+        # Wait for a free thread before accepting
+        while not self._slots.acquire(timeout=0.5):
+            if self._stopping.is_set():
+                return
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            self._slots.release()
+            return
+        request.setblocking(True)
+        try:
+            self._executor.submit(self._process, request, client_address)
+        except BaseException:
+            self._slots.release()
+            self.shutdown_request(request)
+            raise
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def stop(self):
+        '''
+        Stops accepting connections. :py:meth:`serve_forever` returns once
+        the requests in progress are done. Safe to call from a signal
+        handler.
+        '''
+        if not self._stopping.is_set():
+            self._stopping.set()
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            super(PoolWSGIServer, self).serve_forever(poll_interval)
+        finally:
+            self.server_close()
+            self._executor.shutdown(wait=True)
+
+
+def parse_bind(bind):
+    '''
+    :param str bind: ``HOST:PORT`` or ``PORT``.
+    :returns: tuple with the host and the port.
+    :raises ValueError: if the port is not a number.
+    '''
+    host, _, port = bind.rpartition(":")
+    return host.strip("[]") or "127.0.0.1", int(port)
+
+
+def bind_socket(host, port, reuse_port=False, backlog=1024):
+    '''
+    Creates a listening socket.
+
+    :param bool reuse_port: set ``SO_REUSEPORT``, so several processes can
+        bind the same address.
+    :returns: the :py:class:`socket.socket`.
+    '''
+    family = select_address_family(host, port)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(get_sockaddr(host, port, family))
+        sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    sock.set_inheritable(True)
+    return sock
+
+
+def load_application(options):
+    '''
+    Imports the WSGI application and applies the options of the launcher to
+    the critique application.
+
+    :param options: the parsed command line.
+    :returns: the WSGI application.
+    '''
+    module_name, _, name = options.app.partition(":")
+    application = getattr(importlib.import_module(module_name),
+                          name or "application")
+
+    from app import database
+    from app.resources import app as critique, warm_user_index
+    critique.debug = False
+    critique.config["MAX_CONTENT_LENGTH"] = options.max_request_size
+    critique.config["REQUEST_DEADLINE"] = options.deadline or None
+    critique.config["Engine"] = database.Engine(options.database,
+                                                options.busy_timeout)
+    # Loaded before the workers are forked when the application is preloaded
+    warm_user_index()
+    return application
+
+
+class Master(object):
+    '''
+    Starts the workers, replaces the ones that die and handles the signals.
+
+    :param options: the parsed command line.
+    '''
+
+    def __init__(self, options):
+        super(Master, self).__init__()
+        self.options = options
+        self.host, self.port = parse_bind(options.bind)
+        self.socket = None
+        self.application = None
+        # pid of each worker mapped to its generation, which grows at every
+        # graceful restart
+        self.workers = {}
+        self.generation = 0
+        self.stopping = False
+        self.restarting = False
+        self.status = 0
+
+    def run(self):
+        '''
+        Serves until a TERM or INT signal.
+
+        :returns: the exit status of the launcher.
+        '''
+        if self.options.reuse_port:
+            if self.port == 0:
+                raise ValueError("--reuse-port needs a fixed port")
+        else:
+            self.socket = bind_socket(self.host, self.port)
+            self.port = self.socket.getsockname()[1]
+        if self.options.preload:
+            self.application = load_application(self.options)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restart)
+        if self.options.workers > 1:
+            logger.warning("The %d workers have their own hub of events: an "
+                           "event stream only receives the events of the "
+                           "writes handled by its worker",
+                           self.options.workers)
+        logger.info("Listening on http://%s:%d with %d workers of %d threads"
+                    " (master %d)", self.host, self.port,
+                    self.options.workers, self.options.threads, os.getpid())
+
+        try:
+            while not self.stopping:
+                self.reap_workers()
+                if self.restarting:
+                    self.restarting = False
+                    self.restart_workers()
+                if not self.stopping:
+                    self.spawn_workers()
+                time.sleep(MASTER_INTERVAL)
+        finally:
+            self.stop_workers()
+            if self.socket is not None:
+                self.socket.close()
+        logger.info("Stopped (master %d)", os.getpid())
+        return self.status
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _restart(self, signum, frame):
+        self.restarting = True
+
+    def spawn_workers(self):
+        '''
+        Starts workers until there are ``--workers`` of the current
+        generation.
+        '''
+        current = [pid for pid, generation in self.workers.items()
+                   if generation == self.generation]
+        for _ in range(self.options.workers - len(current)):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    status = self.run_worker()
+                except BaseException:
+                    logger.exception("Worker %d crashed", os.getpid())
+                finally:
+                    # Never return to the loop of the master
+                    os._exit(status)
+            self.workers[pid] = self.generation
+            logger.info("Booted worker %d", pid)
+
+    def run_worker(self):
+        '''
+        Body of a worker process.
+
+        :returns: its exit status.
+        '''
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            application = self.application or \
+                load_application(self.options)
+            sock = self.socket or bind_socket(self.host, self.port,
+                                              reuse_port=True)
+        except Exception:
+            logger.exception("Worker %d failed to boot", os.getpid())
+            return WORKER_BOOT_ERROR
+
+        handler = type("RequestHandler", (RequestHandler,), {
+            "timeout": self.options.keepalive or self.options.timeout,
+            "protocol_version": "HTTP/1.1" if self.options.keepalive
+            else "HTTP/1.0"})
+        server = PoolWSGIServer(self.host, self.port, application,
+                                threads=self.options.threads,
+                                handler=handler, fd=sock.fileno())
+        sock.close()
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+        server.serve_forever()
+        return 0
+
+    def reap_workers(self):
+        '''
+        Forgets the workers that exited. Stops the launcher if one could not
+        load the application.
+        '''
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            if os.WIFEXITED(status) and \
+                    os.WEXITSTATUS(status) == WORKER_BOOT_ERROR:
+                logger.error("Worker %d failed to boot, stopping", pid)
+                self.stopping = True
+                self.status = WORKER_BOOT_ERROR
+            elif generation == self.generation and not self.stopping:
+                logger.warning("Worker %d exited unexpectedly", pid)
+
+    def restart_workers(self):
+        '''
+        Starts a new generation of workers and stops the previous one
+        gracefully.
+        '''
+        old = list(self.workers)
+        self.generation += 1
+        self.spawn_workers()
+        for pid in old:
+            self.kill_worker(pid, signal.SIGTERM)
+        logger.info("Restarted the workers")
+
+    def stop_workers(self):
+        '''
+        Stops all the workers gracefully, and kills them if they are not
+        done after ``--graceful-timeout`` seconds.
+        '''
+        for pid in list(self.workers):
+            self.kill_worker(pid, signal.SIGTERM)
+        deadline = time.time() + self.options.graceful_timeout
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(MASTER_INTERVAL / 2)
+        for pid in list(self.workers):
+            logger.warning("Killing worker %d", pid)
+            self.kill_worker(pid, signal.SIGKILL)
+        while self.workers:
+            self.reap_workers()
+            time.sleep(MASTER_INTERVAL / 2)
+
+    def kill_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+
+def parse_args(argv=None):
+    '''
+    :param list argv: the command line arguments, sys.argv by default.
+    :returns: the parsed options.
+    '''
+    parser = argparse.ArgumentParser(
+        description="Runs the critique API with several worker processes.")
+    parser.add_argument("--bind", default="127.0.0.1:5000",
+                        help="address to listen on, HOST:PORT")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, more than one "
+                        "splits the event streams (default: 1)")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="threads of each worker (default: 8)")
+    parser.add_argument("--preload", action="store_true", default=True,
+                        help="load the application before forking the "
+                        "workers (default)")
+    parser.add_argument("--no-preload", dest="preload", action="store_false",
+                        help="load the application in every worker")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="bind a socket per worker with SO_REUSEPORT "
+                        "instead of sharing the socket of the master")
+    parser.add_argument("--keepalive", type=float, default=5,
+                        help="seconds an idle connection is kept open, "
+                        "0 disables keep-alive (default: 5)")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds to wait for a slow client when "
+                        "keep-alive is disabled (default: 30)")
+    parser.add_argument("--graceful-timeout", type=float, default=30,
+                        help="seconds the workers have to end their "
+                        "requests when stopping (default: 30)")
+    parser.add_argument("--max-request-size", type=int,
+                        default=1024 * 1024,
+                        help="largest request body in bytes "
+                        "(default: 1 MiB)")
+    parser.add_argument("--busy-timeout", type=float, default=5,
+                        help="seconds to wait for the database locked by "
+                        "another writer (default: 5)")
+    parser.add_argument("--deadline", type=float, default=10,
+                        help="seconds a request may spend on the database "
+                        "before being answered with 503, 0 disables the "
+                        "limit (default: 10)")
+    parser.add_argument("--database",
+                        help="path of the SQLite database "
+                        "(default: db/critique.db)")
+    parser.add_argument("--app", default="main:application",
+                        help="WSGI application, MODULE:NAME "
+                        "(default: main:application)")
+    options = parser.parse_args(argv)
+    if options.workers < 1 or options.threads < 1:
+        parser.error("--workers and --threads must be at least 1")
+    return options
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(process)d] %(levelname)s %(message)s")
+    return Master(parse_args(argv)).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
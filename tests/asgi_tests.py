@@ -0,0 +1,278 @@
+"""
+Created on 19.10.2026
+Testing of the ASGI entry point of the API, app/asgi.py.
+"""
+
+import asyncio
+import json
+import threading
+import unittest
+
+import app.resources as resources
+from app.asgi import ASGIApplication
+from app.ratelimit import RateLimiter
+from tests import critique_api_tests as api_tests
+
+JSON = "application/json"
+
+
+def run(coroutine):
+    """
+    Runs a coroutine in a new event loop, like asyncio.run of Python 3.7
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class ASGITestCase(api_tests.ResourcesAPITestCase):
+    """
+    Test cases of the ASGI application
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(ASGITestCase, cls).setUpClass()
+        cls.application = ASGIApplication(resources.app, threads=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.application.db.close()
+        super(ASGITestCase, cls).tearDownClass()
+
+    def scope(self, method, path, headers=(), query_string=b""):
+        return {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "root_path": "",
+            "query_string": query_string,
+            "headers": [(b"host", b"localhost:5000")] + list(headers),
+            "server": ("localhost", 5000),
+            "client": ("127.0.0.1", 40000)
+        }
+
+    async def call(self, method, path, body=None, headers=(),
+                   query_string=b""):
+        """
+        Sends a request to the application and returns the status, the
+        headers and the body of the response
+        """
+        headers = list(headers)
+        chunks = [b""]
+        if body is not None:
+            chunks = [json.dumps(body).encode("utf-8")]
+            headers.append((b"content-type", JSON.encode()))
+        messages = []
+
+        async def receive():
+            if chunks:
+                chunk = chunks.pop(0)
+                return {"type": "http.request", "body": chunk,
+                        "more_body": bool(chunks)}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        await self.application(self.scope(method, path, headers,
+                                          query_string), receive, send)
+        self.assertEqual(messages[0]["type"], "http.response.start")
+        self.assertFalse(messages[-1].get("more_body", False))
+        return (messages[0]["status"],
+                dict((name.decode(), value.decode())
+                     for name, value in messages[0]["headers"]),
+                b"".join(message.get("body", b"")
+                         for message in messages[1:]))
+
+    def test_same_representations(self):
+        """
+        Checks that the ASGI application sends the documents of the WSGI one
+        """
+        print("("+self.test_same_representations.__name__+")",
+              self.test_same_representations.__doc__)
+        for url in ("/critique/api/users/", "/critique/api/users/Scott/",
+                    "/critique/api/users/Scott/ratings/",
+                    "/critique/api/posts/p-1/"):
+            status, headers, body = run(self.call("GET", url))
+            self.assertEqual(status, 200)
+            resp = self.client.get(url)
+            self.assertEqual(json.loads(body.decode("utf-8")),
+                             json.loads(resp.data.decode("utf-8")))
+
+        status, headers, body = run(
+            self.call("GET", "/critique/api/users/Moamen/"))
+        self.assertEqual(status, 404)
+        self.assertIn("@error", json.loads(body.decode("utf-8")))
+
+    def test_write(self):
+        """
+        Checks that the writes are run by the writer thread
+        """
+        print("("+self.test_write.__name__+")", self.test_write.__doc__)
+        status, headers, body = run(self.call(
+            "POST", "/critique/api/users/Stephen/ratings/",
+            {"sender": "Knives", "ratingValue": 7}))
+        self.assertEqual(status, 201)
+        status, _, body = run(self.call(
+            "GET", headers["location"].replace("http://localhost:5000", "")))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode("utf-8"))["ratingValue"], 7)
+
+        status, _, _ = run(self.call(
+            "POST", "/critique/api/users/Scott/ratings/",
+            {"sender": "Knives", "ratingValue": "seven"}))
+        self.assertEqual(status, 400)
+
+        async def thread_name(write):
+            return await self.application.db.run(
+                lambda: threading.current_thread().name, write=write)
+        self.assertTrue(run(thread_name(True))
+                        .startswith("critique-write"))
+        self.assertTrue(run(thread_name(False))
+                        .startswith("critique-read"))
+
+    def test_request_too_large(self):
+        """
+        Checks that a body bigger than MAX_CONTENT_LENGTH is refused
+        """
+        print("("+self.test_request_too_large.__name__+")",
+              self.test_request_too_large.__doc__)
+        limit = resources.app.config["MAX_CONTENT_LENGTH"]
+        resources.app.config["MAX_CONTENT_LENGTH"] = 10
+        try:
+            status, _, _ = run(self.call(
+                "POST", "/critique/api/users/Scott/ratings/",
+                {"sender": "Knives", "ratingValue": 7}))
+        finally:
+            resources.app.config["MAX_CONTENT_LENGTH"] = limit
+        self.assertEqual(status, 413)
+
+    def test_async_database(self):
+        """
+        Checks the asynchronous database facade
+        """
+        print("("+self.test_async_database.__name__+")",
+              self.test_async_database.__doc__)
+        db = self.application.db
+
+        async def use():
+            user, post = await asyncio.gather(db.get_user("Scott"),
+                                              db.get_post("p-1"))
+            rating_id = await db.create_rating("Knives", "Kim", 3)
+            return user, post, await db.get_rating(rating_id)
+
+        user, post, rating = run(use())
+        self.assertEqual(user["summary"]["nickname"], "Scott")
+        self.assertEqual(post["sender"], "Scott")
+        self.assertEqual(rating["rating"], 3)
+        with self.assertRaises(AttributeError):
+            db._con
+
+    def test_events(self):
+        """
+        Checks that the event streams are served by coroutines and closed
+        when the client leaves
+        """
+        print("("+self.test_events.__name__+")", self.test_events.__doc__)
+        hub = resources.event_hub
+
+        async def stream():
+            messages = asyncio.Queue()
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {"type": "http.disconnect"}
+
+            task = asyncio.ensure_future(self.application(
+                self.scope("GET", "/critique/api/users/Scott/events/"),
+                receive, messages.put))
+            start = await messages.get()
+            retry = await messages.get()
+            self.assertEqual(hub.subscriber_count("Scott"), 1)
+
+            status = await self.call(
+                "POST", "/critique/api/users/Scott/inbox/",
+                {"sender": "Kim", "body": "Hi Scott!", "anonymous": 0})
+            event = await asyncio.wait_for(messages.get(), 10)
+
+            disconnect.set()
+            await asyncio.wait_for(task, 10)
+            return start, retry, status, event
+
+        start, retry, status, event = run(stream())
+        self.assertEqual(start["status"], 200)
+        self.assertIn((b"content-type", b"text/event-stream; charset=utf-8"),
+                      start["headers"])
+        self.assertEqual(retry["body"], b"retry: 3000\n\n")
+        self.assertEqual(status[0], 201)
+        event = event["body"].decode("utf-8")
+        self.assertIn("event: post\n", event)
+        self.assertEqual(json.loads(event.split("data: ")[1])["sender"],
+                         "Kim")
+        self.assertEqual(hub.subscriber_count("Scott"), 0)
+
+    def test_events_wrong(self):
+        """
+        Checks the errors of the event streams
+        """
+        print("("+self.test_events_wrong.__name__+")",
+              self.test_events_wrong.__doc__)
+        status, _, _ = run(
+            self.call("GET", "/critique/api/users/Moamen/events/"))
+        self.assertEqual(status, 404)
+        status, headers, body = run(self.call(
+            "GET", "/critique/api/users/Scott/events/",
+            query_string=b"lastEventId=first"))
+        self.assertEqual(status, 400)
+        self.assertEqual(headers["content-type"], api_tests.MASON_JSON)
+
+    def test_events_rate_limit(self):
+        """
+        Checks that the event streams take tokens of the read bucket of the
+        client
+        """
+        print("("+self.test_events_rate_limit.__name__+")",
+              self.test_events_rate_limit.__doc__)
+        self.addCleanup(resources.rate_limiters.__setitem__, "read",
+                        resources.rate_limiters["read"])
+        resources.rate_limiters["read"] = RateLimiter(0.01, 1)
+        status, _, _ = run(
+            self.call("GET", "/critique/api/users/Moamen/events/"))
+        self.assertEqual(status, 404)
+        status, headers, _ = run(
+            self.call("GET", "/critique/api/users/Scott/events/"))
+        self.assertEqual(status, 429)
+        self.assertEqual(headers["retry-after"], "100")
+        self.assertEqual(headers["x-ratelimit-remaining"], "0")
+        self.assertEqual(headers["content-type"], api_tests.MASON_JSON)
+
+    def test_lifespan(self):
+        """
+        Checks that the application answers the lifespan messages
+        """
+        print("("+self.test_lifespan.__name__+")", self.test_lifespan.__doc__)
+        application = ASGIApplication(resources.app, threads=1)
+        messages = [{"type": "lifespan.startup"},
+                    {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        run(application({"type": "lifespan"}, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete",
+                                "lifespan.shutdown.complete"])
+
+
+if __name__ == "__main__":
+    print("Start running tests")
+    unittest.main()
@@ -9,12 +9,24 @@ Created on 01.05.2018
 
 import unittest
 import copy
+import gzip
 import json
+import sqlite3
+import threading
+import time
+import zlib
 
 import flask
 
 import app.resources as resources
 import app.database as database
+from app.cache import ResponseCache, SingleFlight
+from app.compression import CompressionMiddleware, negotiate_encoding
+from app.events import EventHub
+from app.ratelimit import ConcurrencyLimiter, RateLimiter
+from app.reputation import refresh_reputation
+from app.search import PrefixIndex
+from app.validation import ValidationError, benchmark, compile_schema
 
 DB_PATH = "db/critique_test.db"
 ENGINE = database.Engine(DB_PATH)
@@ -40,6 +52,22 @@ scott_ratings_count = 4
 scott_posts_count = 2
 scott_inbox_count = 1
 
+def create_user_elsewhere(nickname):
+    """
+    Creates a user with its own connection, as another worker process would,
+    so the listeners of this process are not called
+    """
+    con = ENGINE.connect()
+    try:
+        con.create_user(nickname, {
+            "summary": {"nickname": nickname, "bio": None, "avatar": None},
+            "details": {"firstname": nickname, "lastname": "Elsewhere",
+                        "email": nickname + "@example.com", "mobile": None,
+                        "gender": None, "birthdate": None}})
+    finally:
+        con.close()
+
+
 class ResourcesAPITestCase(unittest.TestCase): # Borrowed from lab exercises [1]
     # INITIATION AND TEARDOWN METHODS
     @classmethod
@@ -63,6 +91,14 @@ class ResourcesAPITestCase(unittest.TestCase): # Borrowed from lab exercises [1]
         """
         # This method load the initial values from critique_data_dump.sql
         ENGINE.populate_tables()
+        # The database was written behind the back of the application
+        resources.response_cache.clear()
+        # Every test starts with full token buckets and no collection being
+        # served, whatever the streams left open by the previous tests
+        for limiter in resources.rate_limiters.values():
+            limiter.clear()
+        resources.list_limiter = ConcurrencyLimiter(
+            resources.app.config["LIST_CONCURRENCY"])
         # Activate app_context for using url_for
         self.app_context = resources.app.app_context()
         self.app_context.push()
@@ -203,6 +239,73 @@ class UsersTestCase (ResourcesAPITestCase):
                 resources.Users, _external=False))
 
 
+    def test_get_users_fields(self):
+        """
+        Checks that GET users with the fields parameter only returns the
+        requested semantic descriptors
+        """
+        print("("+self.test_get_users_fields.__name__+")",
+              self.test_get_users_fields.__doc__)
+        resp = self.client.get(self.url + "?fields=nickname,avatar")
+        self.assertEqual(resp.status_code, 200)
+
+        data = json.loads(resp.data.decode("utf-8"))
+        items = data["items"]
+        self.assertEqual(len(items), initial_users)
+        for item in items:
+            self.assertEqual(set(item.keys()),
+                             {"nickname", "avatar", "@controls"})
+            self.assertIn("self", item["@controls"])
+
+        # Unknown descriptors are rejected
+        resp = self.client.get(self.url + "?fields=nickname,password")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_users_by_nickname(self):
+        """
+        Checks that GET users with a list of nicknames returns those users in
+        the same order, marking the ones that do not exist
+        """
+        print("("+self.test_get_users_by_nickname.__name__+")",
+              self.test_get_users_by_nickname.__doc__)
+        resp = self.client.get(self.url + "?nickname=Young,Nobody,Scott")
+        self.assertEqual(resp.status_code, 200)
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual([item["nickname"] for item in items],
+                         ["Young", "Nobody", "Scott"])
+        self.assertNotIn("@error", items[0])
+        self.assertEqual(items[0]["familyName"], "Neil")
+        self.assertIn("@error", items[1])
+        self.assertNotIn("self", items[1]["@controls"])
+        self.assertIn("self", items[2]["@controls"])
+
+        resp = self.client.get(self.url + "?nickname=,")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_users_streamed(self):
+        """
+        Checks that the users collection is streamed in several chunks and
+        that the chunks form a valid document
+        """
+        print("("+self.test_get_users_streamed.__name__+")",
+              self.test_get_users_streamed.__doc__)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("Content-Length", resp.headers)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(len(data["items"]), initial_users)
+
+        # Many items are sent in batches of about STREAM_CHUNK_SIZE bytes
+        items = ({"index": i, "text": "x" * 100} for i in range(1000))
+        with resources.app.test_request_context():
+            resp = resources.create_collection_response(
+                resources.CritiqueObject(), items)
+            chunks = list(resp.iter_encoded())
+        self.assertGreater(len(chunks), 1)
+        data = json.loads(b"".join(chunks).decode("utf-8"))
+        self.assertEqual([item["index"] for item in data["items"]],
+                         list(range(1000)))
+
     def test_get_users_mimetype(self):
         """
         Checks that GET users return correct status code and data format
@@ -323,6 +426,117 @@ class UsersTestCase (ResourcesAPITestCase):
         self.assertEqual(resp.status_code, 415)
 
 
+class UserSearchTestCase(ResourcesAPITestCase):
+    """
+    Class to test the prefix search of the users
+    """
+
+    def setUp(self):
+        super(UserSearchTestCase, self).setUp()
+        self.url = resources.api.url_for(resources.Users, _external=False)
+
+    def search(self, query):
+        resp = self.client.get(self.url + query)
+        self.assertEqual(resp.status_code, 200)
+        return [item["nickname"] for item
+                in json.loads(resp.data.decode("utf-8"))["items"]]
+
+    def test_search_users(self):
+        """
+        Checks that GET users with a prefix finds the users by nickname,
+        given name or family name, ignoring the case
+        """
+        print("("+self.test_search_users.__name__+")",
+              self.test_search_users.__doc__)
+        self.assertEqual(self.search("?prefix=s"), ["Scott", "Stephen"])
+        self.assertEqual(self.search("?prefix=P"), ["Scott", "Kim"])
+        self.assertEqual(self.search("?prefix=K"), ["Kim", "Knives"])
+        self.assertEqual(self.search("?prefix=k&limit=1"), ["Kim"])
+        self.assertEqual(self.search("?prefix=ramona"), [])
+        self.assertEqual(self.search("?prefix="), [])
+
+        resp = self.client.get(self.url + "?prefix=ne&fields=familyName")
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual(items[0]["familyName"], "Neil")
+        self.assertNotIn("bio", items[0])
+
+        resp = self.client.get(self.url + "?prefix=k&limit=0")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(self.url + "?prefix=k&nickname=Kim")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_search_users_changed(self):
+        """
+        Checks that the users created, modified and deleted, by this process
+        or another one, are searched with their new names
+        """
+        print("("+self.test_search_users_changed.__name__+")",
+              self.test_search_users_changed.__doc__)
+        self.assertEqual(self.search("?prefix=wall"), [])
+        resp = self.client.post(self.url, headers={"Content-Type": JSON},
+                                data=json.dumps({"nickname": "Wallace",
+                                                 "givenName": "Wallace",
+                                                 "familyName": "Wells",
+                                                 "email": "wallace@mail.com"}))
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(self.search("?prefix=wall"), ["Wallace"])
+
+        resp = self.client.put(
+            resources.api.url_for(resources.User, nickname="Young"),
+            headers={"Content-Type": JSON},
+            data=json.dumps({"givenName": "Neil", "familyName": "Young"}))
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(self.search("?prefix=young"), ["Young"])
+        self.assertEqual(self.search("?prefix=ne"), ["Young"])
+
+        self.client.delete(resources.api.url_for(resources.User,
+                                                 nickname="Knives"))
+        self.assertEqual(self.search("?prefix=k"), ["Kim"])
+
+        # Written by another process, the searches are not cached
+        self.assertEqual(self.search("?prefix=zz"), [])
+        create_user_elsewhere("zzTop")
+        self.assertEqual(self.search("?prefix=zz"), ["zzTop"])
+        con = ENGINE.connect()
+        try:
+            con.delete_user("Kim")
+        finally:
+            con.close()
+        self.assertEqual(self.search("?prefix=k"), [])
+        resp = self.client.get(self.url + "?prefix=k")
+        self.assertNotIn("X-Cache", resp.headers)
+
+    def test_prefix_index(self):
+        """
+        Checks the updates and the searches of the prefix index
+        """
+        print("("+self.test_prefix_index.__name__+")",
+              self.test_prefix_index.__doc__)
+        index = PrefixIndex()
+        self.assertFalse(index.update([], [], 1))
+        index.load([{"nickname": "Scott", "firstname": "Scott",
+                     "lastname": "Pilgrim"},
+                    {"nickname": "Ramona", "firstname": "Ramona",
+                     "lastname": "Victoria Flowers"}], 10)
+        self.assertEqual(len(index), 2)
+        # Each user is found once, even if several words match
+        self.assertEqual(index.search("SC", 10), ["Scott"])
+        self.assertEqual(index.search("vic", 10), ["Ramona"])
+        self.assertEqual(index.search("f", 10), ["Ramona"])
+
+        self.assertTrue(index.update(
+            [{"nickname": "Scott", "firstname": "Scott", "lastname": None},
+             {"nickname": "Stephen", "firstname": "Stephen",
+              "lastname": "Stills"}], ["Ramona"], 12))
+        self.assertEqual(index.search("s", 10), ["Scott", "Stephen"])
+        self.assertEqual(index.search("s", 1), ["Scott"])
+        self.assertEqual(index.search("pil", 10), [])
+        self.assertEqual(index.search("f", 10), [])
+        # Older than the changes applied
+        self.assertFalse(index.update([], ["Scott"], 11))
+        self.assertEqual(index.search("scott", 10), ["Scott"])
+
+
 class UserTestCase(ResourcesAPITestCase):
     """
     Class to test user related cases
@@ -436,6 +650,65 @@ class UserTestCase(ResourcesAPITestCase):
             self.assertIn("telephone", data)
             self.assertIn("gender", data)
 
+    def test_get_user_fields(self):
+        """
+        Checks that GET user with the fields parameter only returns the
+        requested semantic descriptors and keeps the controls
+        """
+        print("("+self.test_get_user_fields.__name__+")",
+              self.test_get_user_fields.__doc__)
+        resp = self.client.get(self.url + "?fields=givenName,telephone")
+        self.assertEqual(resp.status_code, 200)
+
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(data["givenName"], "Scott")
+        self.assertIn("telephone", data)
+        self.assertNotIn("email", data)
+        self.assertNotIn("bio", data)
+        self.assertIn("edit", data["@controls"])
+        self.assertIn("critique", data["@namespaces"])
+
+        resp = self.client.get(self.url_wrong + "?fields=givenName")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_get_user_embed(self):
+        """
+        Checks that GET user with the embed parameter includes the counters,
+        the ratings summary and the newest posts of the river
+        """
+        print("("+self.test_get_user_embed.__name__+")",
+              self.test_get_user_embed.__doc__)
+        resp = self.client.get(self.url +
+                               "?embed=counts,ratings,river&fields=givenName")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.headers.get("ETag"))
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(data["givenName"], "Scott")
+        self.assertNotIn("bio", data)
+
+        self.assertEqual((data["counts"]["inbox"], data["counts"]["river"]),
+                         (1, 2))
+        self.assertEqual(data["ratingsSummary"]["count"], 4)
+        self.assertEqual(data["ratingsSummary"]["bestRating"], 10)
+        self.assertTrue(data["ratingsSummary"]["@controls"]["self"]["href"]
+                        .endswith("/critique/api/users/Scott/ratings/"))
+
+        river = json.loads(self.client.get(self.url + "river/")
+                           .data.decode("utf-8"))
+        self.assertEqual(data["river"]["items"],
+                         river["items"][:resources.RIVER_PREVIEW_SIZE])
+
+        resp = self.client.get(self.url + "?embed=counts")
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertIn("counts", data)
+        self.assertNotIn("river", data)
+        self.assertIn("bio", data)
+
+        resp = self.client.get(self.url + "?embed=inbox")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(self.url_wrong + "?embed=counts,river")
+        self.assertEqual(resp.status_code, 404)
+
     def test_get_user_mimetype(self):
         """
         Checks that GET user return correct status code and data format
@@ -507,6 +780,108 @@ class UserTestCase(ResourcesAPITestCase):
         self.assertEqual(resp.status_code, 404)
 
 
+class UserCountsTestCase(ResourcesAPITestCase):
+    """
+    Class to test the counters of the users
+    """
+
+    def test_get_counts(self):
+        """
+        Checks the counters of a user and that they follow the writes
+        """
+        print("("+self.test_get_counts.__name__+")",
+              self.test_get_counts.__doc__)
+        url = resources.api.url_for(resources.UserCounts, nickname="Scott")
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual((data["inbox"], data["river"],
+                          data["ratingsReceived"], data["postsSent"]),
+                         (1, 2, 4, 4))
+        self.assertTrue(data["@controls"]["critique:user-inbox"]["href"]
+                        .endswith("/critique/api/users/Scott/inbox/"))
+
+        resp = self.client.get(resources.api.url_for(resources.User,
+                                                     nickname="Scott"))
+        controls = json.loads(resp.data.decode("utf-8"))["@controls"]
+        self.assertTrue(controls["critique:user-counts"]["href"]
+                        .endswith("/critique/api/users/Scott/counts/"))
+
+        self.client.post(resources.api.url_for(resources.UserInbox,
+                                               nickname="Scott"),
+                         data=json.dumps({"sender": "Kim", "body": "Hi!",
+                                          "anonymous": 0}),
+                         headers={"Content-Type": JSON})
+        data = json.loads(self.client.get(url).data.decode("utf-8"))
+        self.assertEqual(data["inbox"], 2)
+
+        resp = self.client.get(resources.api.url_for(resources.UserCounts,
+                                                     nickname="Moamen"))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_head_collections(self):
+        """
+        Checks that HEAD requests of the collections of a user send their
+        number of items
+        """
+        print("("+self.test_head_collections.__name__+")",
+              self.test_head_collections.__doc__)
+        for resource, count in ((resources.UserInbox, "1"),
+                                (resources.UserRiver, "2"),
+                                (resources.UserRatings, "4")):
+            resp = self.client.head(resources.api.url_for(resource,
+                                                          nickname="Scott"))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["X-Total-Count"], count)
+            self.assertEqual(resp.data, b"")
+            resp = self.client.head(resources.api.url_for(resource,
+                                                          nickname="Moamen"))
+            self.assertEqual(resp.status_code, 404)
+
+
+class UserReputationTestCase(ResourcesAPITestCase):
+    """
+    Class to test the reputation of the users
+    """
+
+    def test_get_reputation(self):
+        """
+        Checks that the reputation of a user is sent once computed and that
+        a new computation changes the validators
+        """
+        print("("+self.test_get_reputation.__name__+")",
+              self.test_get_reputation.__doc__)
+        url = resources.api.url_for(resources.User, nickname="Scott")
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(json.loads(resp.data.decode("utf-8"))["reputation"])
+        etag = resp.headers["ETag"]
+
+        con = ENGINE.connect()
+        try:
+            refresh_reputation(con)
+            scores = con.get_reputation_scores()
+        finally:
+            con.close()
+        resp = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertAlmostEqual(data["reputation"], scores[1])
+        self.assertGreater(data["reputation"], 1)
+        resp = self.client.get(url, headers={"If-None-Match":
+                                             resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(url + "?fields=nickname,reputation")
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertAlmostEqual(data["reputation"], scores[1])
+        self.assertNotIn("bio", data)
+        resp = self.client.get(url + "?fields=nickname")
+        self.assertNotIn("reputation", json.loads(resp.data.decode("utf-8")))
+        self.assertEqual(resp.headers["ETag"], etag)
+
+
 class UserRatingsTestCase(ResourcesAPITestCase):
     """
     Class to test ratings related cases, related to ratings list
@@ -946,6 +1321,107 @@ class UserInboxTestCase(ResourcesAPITestCase):
                                 data=json.dumps(self.post_create_bad_flag))
         self.assertEqual(resp.status_code, 400)
 
+class UserInboxActionsTestCase(ResourcesAPITestCase):
+    """
+    Class to test the actions on several posts of an inbox
+    """
+
+    def act(self, body, nickname="Scott"):
+        return self.client.post(
+            resources.api.url_for(resources.UserInboxActions,
+                                  nickname=nickname),
+            data=json.dumps(body), headers={"Content-Type": JSON})
+
+    def test_publish(self):
+        """
+        Checks that the posts of the inbox are published with an outcome per
+        post
+        """
+        print("("+self.test_publish.__name__+")", self.test_publish.__doc__)
+        inbox = self.client.get(resources.api.url_for(resources.UserInbox,
+                                                      nickname="Scott"))
+        controls = json.loads(inbox.data.decode("utf-8"))["@controls"]
+        self.assertEqual(controls["critique:inbox-actions"]["href"],
+                         "/critique/api/users/Scott/inbox/actions/")
+
+        resp = self.act({"action": "publish",
+                         "posts": ["p-4", "p-0", "four", 4]})
+        self.assertEqual(resp.status_code, 200)
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual([item["status"] for item in items],
+                         [200, 404, 400, 400])
+        self.assertEqual(items[0]["postId"], "p-4")
+
+        resp = self.client.get(resources.api.url_for(resources.Post,
+                                                     postId="p-4"))
+        self.assertEqual(json.loads(resp.data.decode("utf-8"))["public"], 1)
+
+    def test_zero_padded_ids(self):
+        """
+        Checks that the outcome of a zero-padded post id is the outcome of
+        the action on its post
+        """
+        print("("+self.test_zero_padded_ids.__name__+")",
+              self.test_zero_padded_ids.__doc__)
+        resp = self.act({"action": "reply", "posts": ["p-08"],
+                         "body": "Thanks!"})
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual(items[0]["postId"], "p-08")
+        self.assertEqual(items[0]["status"], 200)
+        self.assertIn("reply", items[0]["@controls"])
+
+        resp = self.act({"action": "delete", "posts": ["p-04", "p-4"]})
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual([item["status"] for item in items], [200, 200])
+        resp = self.client.get(resources.api.url_for(resources.Post,
+                                                     postId="p-4"))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_reply_and_delete(self):
+        """
+        Checks that several posts are answered and deleted at once
+        """
+        print("("+self.test_reply_and_delete.__name__+")",
+              self.test_reply_and_delete.__doc__)
+        resp = self.act({"action": "reply", "posts": ["p-8", "p-11"],
+                         "body": "Thanks!"})
+        self.assertEqual(resp.status_code, 200)
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        for item in items:
+            self.assertEqual(item["status"], 200)
+            reply = self.client.get(item["@controls"]["reply"]["href"])
+            reply = json.loads(reply.data.decode("utf-8"))
+            self.assertEqual(reply["body"], "Thanks!")
+            self.assertEqual(reply["sender"], "Scott")
+
+        resp = self.act({"action": "rate", "posts": ["p-8"],
+                         "ratingValue": 2})
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.act({"action": "delete", "posts": ["p-8", "p-11"]})
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(resources.api.url_for(resources.Post,
+                                                     postId="p-11"))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_wrong_actions(self):
+        """
+        Checks the errors of the inbox actions
+        """
+        print("("+self.test_wrong_actions.__name__+")",
+              self.test_wrong_actions.__doc__)
+        for body in ({"action": "archive", "posts": ["p-4"]},
+                     {"action": "publish"},
+                     {"action": "rate", "posts": ["p-4"]},
+                     {"action": "reply", "posts": ["p-4"]},
+                     {"action": "delete",
+                      "posts": ["p-4"] * (resources.INBOX_ACTION_MAX_POSTS + 1)}):
+            resp = self.act(body)
+            self.assertEqual(resp.status_code, 400, body)
+        resp = self.act({"action": "delete", "posts": ["p-4"]}, "Moamen")
+        self.assertEqual(resp.status_code, 404)
+
+
 class UserRatingTestCase(ResourcesAPITestCase):
     """
     Class to test user rating related cases
@@ -1173,7 +1649,8 @@ class UserRatingTestCase(ResourcesAPITestCase):
     def test_create_rating_value_not_number(self):
         """
         Checks creating a faulty rating as a value instead of a number
-        Response code is 404: Rating not found as it should be refenced with number (ID)
+        Response code is 400: the body is validated before looking for the
+        receiver
         """
         print("("+self.test_create_rating_value_not_number.__name__+")",
               self.test_create_rating_value_not_number.__doc__)
@@ -1182,7 +1659,10 @@ class UserRatingTestCase(ResourcesAPITestCase):
                                 nickname = self.rating_create_bad_value['receiver']),
                                 headers={"Content-Type": JSON},
                                 data=json.dumps(self.rating_create_bad_value))
-        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.status_code, 400)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(data["@error"]["@messages"],
+                         ["ratingValue: expected integer, got string"])
 
 class PostTestCase(ResourcesAPITestCase):
     """
@@ -1331,6 +1811,23 @@ class PostTestCase(ResourcesAPITestCase):
         
 
 
+    def test_get_post_fields(self):
+        """
+        Checks that GET post with the fields parameter does not return the
+        text of the post unless it is requested
+        """
+        print("("+self.test_get_post_fields.__name__+")",
+              self.test_get_post_fields.__doc__)
+        resp = self.client.get(self.url + "?fields=sender,ratingValue")
+        self.assertEqual(resp.status_code, 200)
+
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(data["sender"], "Scott")
+        self.assertEqual(data["ratingValue"], 10)
+        self.assertNotIn("body", data)
+        self.assertIn("up", data["@controls"])
+        self.assertIn("critique:receiver", data["@controls"])
+
     def test_modify_post(self):
         """
         Modify an existing post and check that the post has been modified correctly in the server
@@ -1436,6 +1933,1462 @@ class PostTestCase(ResourcesAPITestCase):
                                 data=json.dumps(self.reply_create_good))
         self.assertEqual(resp.status_code, 404)
 
+class PostsTestCase(ResourcesAPITestCase):
+    """
+    Class to test the posts collection
+    """
+
+    def setUp(self):
+        super(PostsTestCase, self).setUp()
+        self.url = resources.api.url_for(resources.Posts, _external=False)
+
+    def test_url(self):
+        """
+        Checks that the URL points to the right resource
+        """
+        _url = "/critique/api/posts/"
+        print("("+self.test_url.__name__+")", self.test_url.__doc__)
+        with resources.app.test_request_context(_url):
+            rule = flask.request.url_rule
+            view_point = resources.app.view_functions[rule.endpoint].view_class
+            self.assertEqual(view_point, resources.Posts)
+
+    def test_get_posts(self):
+        """
+        Checks that GET posts returns the newest posts first with their
+        controls
+        """
+        print("("+self.test_get_posts.__name__+")", self.test_get_posts.__doc__)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data.decode("utf-8"))
+
+        controls = data["@controls"]
+        self.assertEqual(controls["self"]["href"], self.url)
+        self.assertIn("critique:all-users", controls)
+        self.assertNotIn("next", controls)
+
+        items = data["items"]
+        self.assertEqual(len(items), 12)
+        timestamps = [item["timestamp"] for item in items]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+        for item in items:
+            self.assertEqual(item["@controls"]["self"]["href"],
+                             resources.api.url_for(resources.Post,
+                                                   postId=item["postId"],
+                                                   _external=False))
+            self.assertIn("critique:sender", item["@controls"])
+            self.assertEqual(item["@controls"]["up"]["href"], self.url)
+
+    def test_get_posts_filters(self):
+        """
+        Checks the filters and the ordering of GET posts
+        """
+        print("("+self.test_get_posts_filters.__name__+")",
+              self.test_get_posts_filters.__doc__)
+
+        def post_ids(query):
+            resp = self.client.get(self.url + query)
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data.decode("utf-8"))
+            return [item["postId"] for item in data["items"]]
+
+        self.assertEqual(post_ids("?sender=Scott&order=asc"),
+                         ["1", "3", "2", "0"])
+        self.assertEqual(post_ids("?receiver=Scott&public=false"), ["4"])
+        self.assertEqual(post_ids("?replies_only=true"), ["7", "10"])
+        self.assertEqual(post_ids("?min_rating=10"), ["11", "1"])
+        self.assertEqual(post_ids("?since=1362017281&until=1362020481"),
+                         ["10", "0", "2"])
+        self.assertEqual(post_ids("?sender=Nobody"), [])
+
+    def test_get_posts_paging(self):
+        """
+        Checks that following the next control returns every post once
+        """
+        print("("+self.test_get_posts_paging.__name__+")",
+              self.test_get_posts_paging.__doc__)
+        href = self.url + "?limit=5&fields=postId"
+        post_ids = []
+        pages = 0
+        while href is not None:
+            resp = self.client.get(href)
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data.decode("utf-8"))
+            for item in data["items"]:
+                self.assertEqual(set(item.keys()), {"postId", "@controls"})
+            post_ids.extend(item["postId"] for item in data["items"])
+            href = data["@controls"].get("next", {}).get("href")
+            pages += 1
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(post_ids), 12)
+        self.assertEqual(len(set(post_ids)), 12)
+
+    def test_get_posts_by_ids(self):
+        """
+        Checks that GET posts with a list of ids returns those posts in the
+        same order, marking the ones that do not exist
+        """
+        print("("+self.test_get_posts_by_ids.__name__+")",
+              self.test_get_posts_by_ids.__doc__)
+        resp = self.client.get(self.url + "?ids=p-7,p-100,p-4&fields=postId,body")
+        self.assertEqual(resp.status_code, 200)
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual([item["postId"] for item in items],
+                         ["7", "p-100", "4"])
+        self.assertEqual(items[0]["body"], "No,  I am the best!")
+        self.assertNotIn("critique:receiver", items[0]["@controls"])
+        self.assertIn("@error", items[1])
+        self.assertEqual(items[2]["body"], "Go and die scott!")
+
+        resp = self.client.get(self.url + "?ids=p-1&sender=Scott")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_posts_wrong_parameters(self):
+        """
+        Checks that invalid query parameters return 400
+        """
+        print("("+self.test_get_posts_wrong_parameters.__name__+")",
+              self.test_get_posts_wrong_parameters.__doc__)
+        for query in ("?limit=0", "?limit=1000", "?since=yesterday",
+                      "?min_rating=11", "?public=maybe", "?order=up",
+                      "?after=abc"):
+            resp = self.client.get(self.url + query)
+            self.assertEqual(resp.status_code, 400, query)
+
+
+class RatingsTestCase(ResourcesAPITestCase):
+    """
+    Class to test the ratings collection
+    """
+
+    def setUp(self):
+        super(RatingsTestCase, self).setUp()
+        self.url = resources.api.url_for(resources.Ratings, _external=False)
+
+    def test_url(self):
+        """
+        Checks that the URL points to the right resource
+        """
+        _url = "/critique/api/ratings/"
+        print("("+self.test_url.__name__+")", self.test_url.__doc__)
+        with resources.app.test_request_context(_url):
+            rule = flask.request.url_rule
+            view_point = resources.app.view_functions[rule.endpoint].view_class
+            self.assertEqual(view_point, resources.Ratings)
+
+    def test_get_ratings(self):
+        """
+        Checks that following the next control returns every rating once
+        """
+        print("("+self.test_get_ratings.__name__+")",
+              self.test_get_ratings.__doc__)
+        href = self.url + "?limit=10"
+        rating_ids = []
+        while href is not None:
+            resp = self.client.get(href)
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data.decode("utf-8"))
+            for item in data["items"]:
+                self.assertEqual(item["@controls"]["self"]["href"],
+                                 resources.api.url_for(
+                                     resources.Rating,
+                                     nickname=item["receiver"],
+                                     ratingId=item["ratingId"],
+                                     _external=False))
+                self.assertIn("critique:sender", item["@controls"])
+            rating_ids.extend(item["ratingId"] for item in data["items"])
+            href = data["@controls"].get("next", {}).get("href")
+        self.assertEqual(rating_ids, ["rtg-%d" % i for i in range(1, 18)])
+
+        resp = self.client.get(self.url + "?receiver=Scott")
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual([item["ratingId"] for item in data["items"]],
+                         ["rtg-5", "rtg-9", "rtg-13", "rtg-17"])
+
+    def test_get_ratings_grouped(self):
+        """
+        Checks the ratings aggregated by receiver
+        """
+        print("("+self.test_get_ratings_grouped.__name__+")",
+              self.test_get_ratings_grouped.__doc__)
+        resp = self.client.get(self.url + "?group=receiver")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data.decode("utf-8"))
+        items = data["items"]
+        self.assertEqual([item["nickname"] for item in items],
+                         ["Kim", "Knives", "Scott", "Stephen", "Young"])
+        scott = items[2]
+        self.assertEqual(scott["ratingCount"], scott_ratings_count)
+        self.assertEqual(scott["ratingValue"], 8.0)
+        self.assertEqual(sum(scott["histogram"].values()), scott_ratings_count)
+        self.assertEqual(scott["@controls"]["critique:user-ratings"]["href"],
+                         resources.api.url_for(resources.UserRatings,
+                                               nickname="Scott",
+                                               _external=False))
+
+        resp = self.client.get(self.url + "?group=sender&limit=3")
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(len(data["items"]), 3)
+        resp = self.client.get(data["@controls"]["next"]["href"])
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual([item["nickname"] for item in data["items"]],
+                         ["Stephen", "Young"])
+
+    def test_get_ratings_wrong_parameters(self):
+        """
+        Checks that invalid query parameters return 400
+        """
+        print("("+self.test_get_ratings_wrong_parameters.__name__+")",
+              self.test_get_ratings_wrong_parameters.__doc__)
+        for query in ("?limit=0", "?group=rating", "?after=5",
+                      "?fields=password"):
+            resp = self.client.get(self.url + query)
+            self.assertEqual(resp.status_code, 400, query)
+
+
+class LeaderboardTestCase(ResourcesAPITestCase):
+    """
+    Class to test the leaderboards of the users and of the posts
+    """
+
+    def pages(self, url):
+        """
+        Follows the next controls from url and returns all the items
+        """
+        items = []
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data.decode("utf-8"))
+            items.extend(data["items"])
+            url = data["@controls"].get("next", {}).get("href")
+        return items
+
+    def test_user_leaderboard(self):
+        """
+        Checks that the users are ranked by average rating and paged
+        """
+        print("("+self.test_user_leaderboard.__name__+")",
+              self.test_user_leaderboard.__doc__)
+        url = resources.api.url_for(resources.UserLeaderboard)
+        items = self.pages(url + "?limit=2")
+        self.assertEqual([item["nickname"] for item in items],
+                         ["Scott", "Young", "Kim", "Stephen", "Knives"])
+        self.assertEqual(items[0]["ratingCount"], 4)
+        self.assertEqual(items[0]["ratingValue"], 8.0)
+        self.assertIn("critique:user-ratings", items[0]["@controls"])
+
+        self.assertEqual([item["nickname"] for item
+                          in self.pages(url + "?min_count=4")],
+                         ["Scott", "Knives"])
+        self.assertEqual(self.pages(url + "?since=2000000000"), [])
+
+        for query in ("?min_count=0", "?after=best", "?since=-1"):
+            resp = self.client.get(url + query)
+            self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(url + "?min_count=-1")
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(data["@error"]["@messages"],
+                         ["min_count must be at least 1"])
+
+    def test_post_leaderboard(self):
+        """
+        Checks that the public posts are ranked by rating and paged
+        """
+        print("("+self.test_post_leaderboard.__name__+")",
+              self.test_post_leaderboard.__doc__)
+        url = resources.api.url_for(resources.PostLeaderboard)
+        items = self.pages(url + "?limit=4")
+        self.assertEqual([item["postId"] for item in items],
+                         ["11", "1", "2", "3", "9", "8", "0", "6", "5"])
+
+        items = self.pages(url + "?limit=1&fields=ratingValue")
+        self.assertEqual(items[0], {"ratingValue": 10,
+                                    "@controls": items[0]["@controls"]})
+        self.assertEqual(len(items), 9)
+        self.assertIn("critique:sender", items[0]["@controls"])
+
+        items = self.pages(url + "?since=1362017000")
+        self.assertEqual([item["postId"] for item in items],
+                         ["11", "2", "3", "0"])
+
+        for query in ("?after=10-1", "?after=a-b-c", "?limit=0"):
+            resp = self.client.get(url + query)
+            self.assertEqual(resp.status_code, 400)
+
+
+class ChangesTestCase(ResourcesAPITestCase):
+    """
+    Class to test the change feed
+    """
+
+    def setUp(self):
+        super(ChangesTestCase, self).setUp()
+        self.url = resources.api.url_for(resources.Changes, _external=False)
+
+    def test_get_changes(self):
+        """
+        Checks that a client syncing with since only receives the new changes
+        """
+        print("("+self.test_get_changes.__name__+")",
+              self.test_get_changes.__doc__)
+        # Initial sync in pages
+        href = self.url + "?limit=20"
+        items = []
+        while href is not None:
+            resp = self.client.get(href)
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data.decode("utf-8"))
+            items.extend(data["items"])
+            href = data["@controls"].get("next", {}).get("href")
+        self.assertEqual(len(items), 5 + 12 + 17)
+        last_seq = data["lastSeq"]
+        self.assertEqual(last_seq, items[-1]["seq"])
+
+        # Nothing changed
+        resp = self.client.get(self.url + "?since=%d" % last_seq)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(data["items"], [])
+        self.assertEqual(data["lastSeq"], last_seq)
+
+        # Edit a user and delete a post
+        user_url = resources.api.url_for(resources.User, nickname="Scott",
+                                         _external=False)
+        resp = self.client.put(user_url, headers={"Content-Type": JSON},
+                               data=json.dumps({"givenName": "Scotty"}))
+        resp = self.client.delete(resources.api.url_for(
+            resources.Post, postId="p-8", _external=False))
+        self.assertEqual(resp.status_code, 204)
+
+        resp = self.client.get(self.url + "?since=%d" % last_seq)
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual([(item["entity"], item["id"], item["action"])
+                          for item in items],
+                         [("user", "Scott", "update"),
+                          ("post", "8", "delete")])
+        self.assertEqual(items[0]["@controls"]["self"]["href"], user_url)
+        self.assertNotIn("self", items[1]["@controls"])
+
+        resp = self.client.get(self.url + "?since=-1")
+        self.assertEqual(resp.status_code, 400)
+
+
+class EventsTestCase(ResourcesAPITestCase):
+    """
+    Class to test the event hub and the event streams of the users
+    """
+
+    def setUp(self):
+        super(EventsTestCase, self).setUp()
+        self.url = resources.api.url_for(resources.UserEvents,
+                                         nickname="Scott", _external=False)
+        self.wrong_url = resources.api.url_for(resources.UserEvents,
+                                               nickname="Moamen",
+                                               _external=False)
+
+    def test_url(self):
+        """
+        Checks that the URL points to the right resource
+        """
+        print("("+self.test_url.__name__+")", self.test_url.__doc__)
+        url = "/critique/api/users/Scott/events/"
+        with resources.app.test_request_context(url):
+            rule = flask.request.url_rule
+            view_point = resources.app.view_functions[rule.endpoint].view_class
+            self.assertEqual(view_point, resources.UserEvents)
+
+    def test_hub_publish(self):
+        """
+        Checks that the events only reach the subscribers of their nickname
+        """
+        print("("+self.test_hub_publish.__name__+")",
+              self.test_hub_publish.__doc__)
+        hub = EventHub()
+        scott = hub.subscribe("Scott")
+        kim = hub.subscribe("Kim")
+        self.assertEqual(hub.subscriber_count(), 2)
+
+        first = hub.publish("Scott", "post", {"postId": "p-1"})
+        hub.publish("Scott", "reply", {"postId": "p-2"})
+        events = scott.wait(0)
+        self.assertEqual([event.id for event in events], [first, first + 1])
+        self.assertEqual(events[1].event, "reply")
+        self.assertEqual(events[1].data, {"postId": "p-2"})
+        self.assertEqual(scott.wait(0), [])
+        self.assertEqual(kim.wait(0), [])
+
+        scott.close()
+        kim.close()
+        self.assertEqual(hub.subscriber_count(), 0)
+
+    def test_hub_resume(self):
+        """
+        Checks that a subscriber resuming with the last event id receives the
+        missed events, or a reset if they are not buffered anymore
+        """
+        print("("+self.test_hub_resume.__name__+")",
+              self.test_hub_resume.__doc__)
+        hub = EventHub(buffer_size=3)
+        for i in range(4):
+            last_id = hub.publish("Scott", "post", {"postId": "p-%d" % i})
+            hub.publish("Kim", "post", {"postId": "p-%d" % i})
+
+        # Only the events of Scott after last_id - 2
+        events = hub.subscribe("Scott", last_id - 2).wait(0)
+        self.assertEqual([event.id for event in events], [last_id])
+        # Unknown id, the server restarted
+        self.assertEqual(hub.subscribe("Scott", last_id + 2).wait(0)[0].event,
+                         "reset")
+        # Out of the buffer
+        events = hub.subscribe("Scott", 1).wait(0)
+        self.assertEqual([event.event for event in events], ["reset"])
+
+    def test_hub_slow_subscriber(self):
+        """
+        Checks that a subscriber not reading its events gets a reset instead
+        of an unbounded queue
+        """
+        print("("+self.test_hub_slow_subscriber.__name__+")",
+              self.test_hub_slow_subscriber.__doc__)
+        hub = EventHub(buffer_size=2)
+        subscription = hub.subscribe("Scott")
+        for i in range(3):
+            hub.publish("Scott", "post", {})
+        events = subscription.wait(0)
+        self.assertEqual([event.event for event in events], ["reset"])
+
+    def test_get_events(self):
+        """
+        Checks that the stream of a user receives the posts, replies and
+        publicity changes concerning them
+        """
+        print("("+self.test_get_events.__name__+")",
+              self.test_get_events.__doc__)
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertEqual(resp.headers["Cache-Control"], "no-cache")
+        body = iter(resp.response)
+        self.assertTrue(next(body).startswith(b"retry:"))
+        self.assertEqual(resources.event_hub.subscriber_count("Scott"), 1)
+
+        # A post to Scott
+        post = {"sender": "Kim", "receiver": "Scott", "body": "Hi Scott!",
+                "anonymous": 0, "public": 1}
+        resp2 = self.client.post(resources.api.url_for(
+            resources.UserInbox, nickname="Scott", _external=False),
+            headers={"Content-Type": JSON}, data=json.dumps(post))
+        self.assertEqual(resp2.status_code, 201)
+        chunk = next(body).decode("utf-8")
+        self.assertIn("event: post\n", chunk)
+        data = json.loads(chunk.split("data: ")[1])
+        self.assertEqual(data["sender"], "Kim")
+        self.assertEqual(data["receiver"], "Scott")
+        self.assertEqual(data["postId"], "p-12")
+        last_event_id = int(chunk.split("id: ")[1].split("\n")[0])
+
+        # Kim answers the post of Scott to Stephen, Scott publishes post 4
+        resp2 = self.client.post(resources.api.url_for(
+            resources.Post, postId="1", _external=False),
+            headers={"Content-Type": JSON},
+            data=json.dumps({"sender": "Kim", "body": "Me too"}))
+        self.assertEqual(resp2.status_code, 201)
+        resp2 = self.client.put(resources.api.url_for(
+            resources.Post, postId="p-4", _external=False),
+            headers={"Content-Type": JSON}, data=json.dumps({"public": 1}))
+        self.assertEqual(resp2.status_code, 204)
+        chunks = next(body).decode("utf-8")
+        if "publicity" not in chunks:
+            chunks += next(body).decode("utf-8")
+        self.assertIn("event: reply\n", chunks)
+        self.assertIn("event: publicity\n", chunks)
+        resp.close()
+        self.assertEqual(resources.event_hub.subscriber_count("Scott"), 0)
+
+        # Resume after the first event
+        resp = self.client.get(self.url,
+                               headers={"Last-Event-ID": str(last_event_id)})
+        body = iter(resp.response)
+        next(body)
+        chunks = next(body).decode("utf-8")
+        self.assertNotIn("event: post\n", chunks)
+        self.assertIn("event: reply\n", chunks)
+        self.assertIn("event: publicity\n", chunks)
+        resp.close()
+
+    def test_get_events_wrong(self):
+        """
+        Checks the errors of the event stream
+        """
+        print("("+self.test_get_events_wrong.__name__+")",
+              self.test_get_events_wrong.__doc__)
+        resp = self.client.get(self.wrong_url)
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get(self.url, headers={"Last-Event-ID": "abc"})
+        self.assertEqual(resp.status_code, 400)
+
+
+class ConditionalGetTestCase(ResourcesAPITestCase):
+    """
+    Class to test the validators and the 304 responses of the read resources
+    """
+
+    def setUp(self):
+        super(ConditionalGetTestCase, self).setUp()
+        self.urls = [
+            resources.api.url_for(resources.User, nickname="Scott",
+                                  _external=False),
+            resources.api.url_for(resources.UserRatings, nickname="Scott",
+                                  _external=False),
+            resources.api.url_for(resources.UserInbox, nickname="Scott",
+                                  _external=False),
+            resources.api.url_for(resources.UserRiver, nickname="Scott",
+                                  _external=False),
+            resources.api.url_for(resources.Post, postId="p-4",
+                                  _external=False)
+        ]
+
+    def test_not_modified(self):
+        """
+        Checks that the resources send validators and answer 304 while they
+        are not modified
+        """
+        print("("+self.test_not_modified.__name__+")",
+              self.test_not_modified.__doc__)
+        for url in self.urls:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith('W/"'))
+            last_modified = resp.headers["Last-Modified"]
+
+            resp = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304, url)
+            self.assertEqual(resp.data, b"")
+            self.assertEqual(resp.headers["ETag"], etag)
+
+            resp = self.client.get(url, headers={
+                "If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 304, url)
+
+            resp = self.client.get(url, headers={"If-None-Match": '"0"'})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_modified(self):
+        """
+        Checks that a write changes the ETag of the resources concerned only
+        """
+        print("("+self.test_modified.__name__+")",
+              self.test_modified.__doc__)
+        etags = [self.client.get(url).headers["ETag"] for url in self.urls]
+
+        # Post 4 is in the inbox of Scott
+        resp = self.client.put(self.urls[4], headers={"Content-Type": JSON},
+                               data=json.dumps({"public": 1}))
+        self.assertEqual(resp.status_code, 204)
+        statuses = [self.client.get(url, headers={"If-None-Match": etag})
+                    .status_code for url, etag in zip(self.urls, etags)]
+        # The user profile does not change, the collections and the post do
+        self.assertEqual(statuses, [304, 200, 200, 200, 200])
+
+    def test_unknown_resource(self):
+        """
+        Checks that unknown resources are still not found with validators
+        """
+        print("("+self.test_unknown_resource.__name__+")",
+              self.test_unknown_resource.__doc__)
+        url = resources.api.url_for(resources.User, nickname="Moamen",
+                                    _external=False)
+        resp = self.client.get(url, headers={"If-None-Match": "*"})
+        self.assertEqual(resp.status_code, 404)
+        self.assertNotIn("ETag", resp.headers)
+
+
+class ResponseCacheTestCase(ResourcesAPITestCase):
+    """
+    Class to test the cache of rendered responses
+    """
+
+    def setUp(self):
+        super(ResponseCacheTestCase, self).setUp()
+        self.user_url = resources.api.url_for(resources.User,
+                                              nickname="Scott",
+                                              _external=False)
+        self.users_url = resources.api.url_for(resources.Users,
+                                               _external=False)
+        self.river_url = resources.api.url_for(resources.UserRiver,
+                                               nickname="Scott",
+                                               _external=False)
+        self.ratings_url = resources.api.url_for(resources.UserRatings,
+                                                 nickname="Kim",
+                                                 _external=False)
+
+    def test_cache(self):
+        """
+        Checks the LRU eviction, the tags and the versions of the cache
+        """
+        print("("+self.test_cache.__name__+")", self.test_cache.__doc__)
+        cache = ResponseCache(max_entries=2)
+        cache.put("a", b"A", 1, [("user", "Scott")])
+        cache.put("b", b"B", 1, [("user", "Kim"), ("users",)])
+        self.assertEqual(cache.get("a").body, b"A")
+        cache.put("c", b"C", 1, [("users",)])
+        # b was the least recently used
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.invalidate(("users",)), 1)
+        self.assertIsNone(cache.get("c"))
+        # Built from an older version
+        self.assertIsNone(cache.get("a", 2))
+
+        generation = cache.generation
+        cache.invalidate(("user", "Kim"))
+        cache.put("d", b"D", 1, [("user", "Kim")], generation)
+        self.assertIsNone(cache.get("d"))
+
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 0)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["invalidations"], 2)
+
+        # Only the invalidations of its tags drop a response being built
+        generation = cache.generation
+        cache.invalidate(("user", "Kim"))
+        cache.put("e", b"E", 1, [("user", "Scott")], generation)
+        self.assertEqual(cache.get("e").body, b"E")
+        # Unless the invalidations of the tags were forgotten
+        cache.invalidate(("inbox", "Kim"), ("river", "Kim"))
+        cache.put("f", b"F", 1, [("user", "Stephen")], generation)
+        self.assertIsNone(cache.get("f"))
+        generation = cache.generation
+        cache.clear()
+        cache.put("g", b"G", 1, [("user", "Scott")], generation)
+        self.assertIsNone(cache.get("g"))
+
+    def test_cached_responses(self):
+        """
+        Checks that the second request is served from the cache with the same
+        body
+        """
+        print("("+self.test_cached_responses.__name__+")",
+              self.test_cached_responses.__doc__)
+        for url in (self.user_url, self.users_url, self.river_url,
+                    self.user_url + "?fields=bio"):
+            resp = self.client.get(url)
+            self.assertEqual(resp.headers["X-Cache"], "MISS")
+            # Streamed responses are stored once they have been sent
+            body = resp.data
+            resp2 = self.client.get(url)
+            self.assertEqual(resp2.headers["X-Cache"], "HIT")
+            self.assertEqual(resp2.data, body)
+            self.assertEqual(resp2.headers.get("ETag"),
+                             resp.headers.get("ETag"))
+
+        resp = self.client.get(resources.api.url_for(
+            resources.User, nickname="Moamen", _external=False))
+        self.assertEqual(resp.status_code, 404)
+        self.assertNotIn("X-Cache", resp.headers)
+
+    def test_invalidation(self):
+        """
+        Checks that the writes only invalidate the responses they change
+        """
+        print("("+self.test_invalidation.__name__+")",
+              self.test_invalidation.__doc__)
+        urls = [self.user_url, self.users_url, self.river_url,
+                self.ratings_url]
+        def cache_status():
+            status = []
+            for url in urls:
+                resp = self.client.get(url)
+                resp.get_data()
+                status.append(resp.headers["X-Cache"])
+            return status
+
+        self.assertEqual(cache_status(), ["MISS"] * 4)
+
+        # A rating to Kim
+        resp = self.client.post(self.ratings_url,
+                                headers={"Content-Type": JSON},
+                                data=json.dumps({"sender": "Knives",
+                                                 "ratingValue": 7}))
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(cache_status(), ["HIT", "HIT", "HIT", "MISS"])
+        data = json.loads(self.client.get(self.ratings_url).data.decode(
+            "utf-8"))
+        self.assertIn("Knives", [item["sender"] for item in data["items"]])
+
+        # Scott edits his profile
+        resp = self.client.put(self.user_url, headers={"Content-Type": JSON},
+                               data=json.dumps({"givenName": "Scotty"}))
+        self.assertEqual(resp.status_code, 204)
+        # The river of Scott is dropped too, by its version: the version of
+        # the collections of a user covers all the changes they own
+        self.assertEqual(cache_status(), ["MISS", "MISS", "MISS", "HIT"])
+        data = json.loads(self.client.get(self.user_url).data.decode("utf-8"))
+        self.assertEqual(data["givenName"], "Scotty")
+
+        # A public post to Scott
+        post = {"sender": "Kim", "receiver": "Scott", "body": "Hi Scott!",
+                "anonymous": 0, "public": 1}
+        resp = self.client.post(resources.api.url_for(
+            resources.UserInbox, nickname="Scott", _external=False),
+            headers={"Content-Type": JSON}, data=json.dumps(post))
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(cache_status(), ["HIT", "HIT", "MISS", "HIT"])
+
+        stats = resources.response_cache.stats()
+        self.assertGreater(stats["hitRatio"], 0)
+        self.assertGreater(stats["invalidations"], 0)
+
+    def test_too_big(self):
+        """
+        Checks that a streamed response bigger than the biggest body stored
+        is sent completely but not cached
+        """
+        print("("+self.test_too_big.__name__+")", self.test_too_big.__doc__)
+        body = self.client.get(self.users_url).data
+        resources.response_cache.clear()
+        max_bytes = resources.response_cache.max_bytes
+        resources.response_cache.max_bytes = 10 * (len(body) - 1)
+        try:
+            resp = self.client.get(self.users_url)
+            self.assertEqual(resp.headers["X-Cache"], "MISS")
+            self.assertEqual(resp.data, body)
+            resp = self.client.get(self.users_url)
+            self.assertEqual(resp.headers["X-Cache"], "MISS")
+            self.assertEqual(resources.response_cache.stats()["entries"], 0)
+        finally:
+            resources.response_cache.max_bytes = max_bytes
+
+    def test_write_elsewhere(self):
+        """
+        Checks that the list of users is not served from the cache after a
+        user was created by another process
+        """
+        print("("+self.test_write_elsewhere.__name__+")",
+              self.test_write_elsewhere.__doc__)
+        resp = self.client.get(self.users_url)
+        self.assertEqual(len(json.loads(resp.data.decode("utf-8"))["items"]),
+                         initial_users)
+        etag = resp.headers["ETag"]
+        resp = self.client.get(self.users_url)
+        self.assertEqual(resp.headers["X-Cache"], "HIT")
+        resp = self.client.get(self.users_url,
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+
+        create_user_elsewhere("Wallace")
+        resp = self.client.get(self.users_url,
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["X-Cache"], "MISS")
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(len(data["items"]), initial_users + 1)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+
+class SingleFlightTestCase(ResourcesAPITestCase):
+    """
+    Class to test the coalescing of identical concurrent requests
+    """
+
+    def setUp(self):
+        super(SingleFlightTestCase, self).setUp()
+        self.url = resources.api.url_for(resources.UserRiver,
+                                         nickname="Scott", _external=False)
+        self.key = (self.url, b"")
+        self.timeout = resources.app.config["SINGLE_FLIGHT_TIMEOUT"]
+
+    def tearDown(self):
+        resources.app.config["SINGLE_FLIGHT_TIMEOUT"] = self.timeout
+        super(SingleFlightTestCase, self).tearDown()
+
+    def get_in_thread(self):
+        """
+        Starts a GET of the river of Scott in another thread.
+        :returns: the thread and a list receiving the response.
+        """
+        responses = []
+
+        def get():
+            client = resources.app.test_client()
+            resp = client.get(self.url)
+            resp.get_data()
+            responses.append(resp)
+        thread = threading.Thread(target=get)
+        thread.start()
+        return thread, responses
+
+    def test_single_flight(self):
+        """
+        Checks that only the first caller of a key is the leader
+        """
+        print("("+self.test_single_flight.__name__+")",
+              self.test_single_flight.__doc__)
+        flights = SingleFlight()
+        flight, leader = flights.join("a")
+        self.assertTrue(leader)
+        flight2, leader2 = flights.join("a")
+        self.assertFalse(leader2)
+        self.assertIs(flight, flight2)
+        self.assertTrue(flights.join("b")[1])
+        self.assertEqual(flights.in_flight(), 2)
+
+        flights.leave("a", flight)
+        self.assertTrue(flight2.wait(0))
+        self.assertTrue(flights.join("a")[1])
+        self.assertEqual((flights.leaders, flights.followers), (3, 1))
+
+    def test_follower_shares_response(self):
+        """
+        Checks that a request waits for the identical request in flight and
+        sends the response it stored
+        """
+        print("("+self.test_follower_shares_response.__name__+")",
+              self.test_follower_shares_response.__doc__)
+        # Version of the river
+        with resources.app.test_request_context(self.url):
+            resources.connect_db()
+            version = flask.g.con.get_change_version(owner="Scott")
+            resources.close_connection(None)
+
+        flight, leader = resources.single_flight.join(self.key)
+        self.assertTrue(leader)
+        thread, responses = self.get_in_thread()
+        thread.join(0.2)
+        # Still waiting for the leader
+        self.assertTrue(thread.is_alive())
+        resources.response_cache.put(self.key, b'{"items": []}', version,
+                                     [("river", "Scott")])
+        resources.single_flight.leave(self.key, flight)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(responses[0].headers["X-Cache"], "HIT")
+        self.assertEqual(responses[0].data, b'{"items": []}')
+
+    def test_follower_fallback(self):
+        """
+        Checks that a request waiting for a too slow identical request builds
+        the response itself
+        """
+        print("("+self.test_follower_fallback.__name__+")",
+              self.test_follower_fallback.__doc__)
+        resources.app.config["SINGLE_FLIGHT_TIMEOUT"] = 0.1
+        flight, leader = resources.single_flight.join(self.key)
+        try:
+            thread, responses = self.get_in_thread()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(responses[0].status_code, 200)
+            self.assertEqual(responses[0].headers["X-Cache"], "MISS")
+            data = json.loads(responses[0].data.decode("utf-8"))
+            self.assertEqual(len(data["items"]), 2)
+        finally:
+            resources.single_flight.leave(self.key, flight)
+
+        # The leader left, the next request leads and stores the response
+        resp = self.client.get(self.url)
+        resp.get_data()
+        self.assertEqual(resources.single_flight.in_flight(), 0)
+
+
+class ValidationTestCase(ResourcesAPITestCase):
+    """
+    Test cases of the validation of the request bodies
+    """
+
+    def test_compile_schema(self):
+        """
+        Checks the validators compiled from the schemas
+        """
+        print("("+self.test_compile_schema.__name__+")",
+              self.test_compile_schema.__doc__)
+        validate = compile_schema({
+            "type": "object",
+            "properties": {
+                "sender": {"type": "string", "minLength": 1},
+                "ratingValue": {"type": "integer", "minimum": 1,
+                                "maximum": 10},
+                "public": {"type": ["integer", "boolean"]},
+                "gender": {"enum": ["female", "male", None]}
+            },
+            "required": ["sender"],
+            "additionalProperties": False
+        })
+        body = {"sender": "Kim", "ratingValue": 10, "public": True,
+                "gender": None}
+        self.assertIs(validate(body), body)
+
+        for wrong, message in (
+                ([], "expected object, got array"),
+                ({}, "sender is required"),
+                ({"sender": ""}, "sender: length must be at least 1"),
+                ({"sender": "Kim", "ratingValue": True},
+                 "ratingValue: expected integer, got boolean"),
+                ({"sender": "Kim", "ratingValue": 11},
+                 "ratingValue: must be between 1 and 10"),
+                ({"sender": "Kim", "public": "yes"},
+                 "public: expected integer or boolean, got string"),
+                ({"sender": "Kim", "gender": 0},
+                 'gender: must be one of "female", "male", null'),
+                ({"sender": "Kim", "receiver": "Scott"},
+                 "receiver is not allowed")):
+            with self.assertRaises(ValidationError) as context:
+                validate(wrong)
+            self.assertEqual(str(context.exception), message)
+
+        with self.assertRaises(ValueError):
+            compile_schema({"type": "object", "patternProperties": {}})
+        with self.assertRaises(ValueError):
+            compile_schema({"type": "date"})
+
+    def test_resource_schemas(self):
+        """
+        Checks that the bodies of the tests match the schemas of the
+        resources and that the validation can be measured
+        """
+        print("("+self.test_resource_schemas.__name__+")",
+              self.test_resource_schemas.__doc__)
+        resources.validate_create_user(UsersTestCase.user_2_request)
+        resources.validate_edit_user(UserTestCase.user_mod_req_1)
+        resources.validate_create_posts(UserInboxTestCase.post_create_good)
+        resources.validate_create_reply(PostTestCase.reply_create_good)
+        resources.validate_edit_post(PostTestCase.post_mod_req_1)
+        resources.validate_create_rating(UserRatingTestCase.rating_create_good)
+        resources.validate_edit_rating(UserRatingTestCase.rating_mod_req_1)
+
+        results = benchmark(number=10)
+        self.assertEqual(len(results), 7)
+        for valid, invalid in results.values():
+            self.assertGreater(valid, 0)
+            self.assertGreater(invalid, 0)
+
+    def test_invalid_bodies(self):
+        """
+        Checks that malformed bodies are rejected with 400 before looking
+        for the resource
+        """
+        print("("+self.test_invalid_bodies.__name__+")",
+              self.test_invalid_bodies.__doc__)
+        for method, url, body, message in (
+                ("post", resources.api.url_for(resources.Users),
+                 {"nickname": "Wallace", "givenName": 1, "email": "w@mail.com"},
+                 "givenName: expected string, got integer"),
+                ("put", resources.api.url_for(resources.User,
+                                              nickname="Moamen"),
+                 {"givenName": None}, "givenName: expected string, got null"),
+                ("post", resources.api.url_for(resources.UserInbox,
+                                               nickname="Moamen"),
+                 {"sender": "Kim", "body": "Hi", "anonymous": 2},
+                 "anonymous: must be between 0 and 1"),
+                ("post", resources.api.url_for(resources.Post, postId="p-200"),
+                 {"sender": "Kim", "body": 42},
+                 "body: expected string, got integer"),
+                ("put", resources.api.url_for(resources.Post, postId="p-200"),
+                 {"ratingValue": 0}, "ratingValue: must be between 1 and 10"),
+                ("put", resources.api.url_for(resources.Rating,
+                                              nickname="Kim",
+                                              ratingId="rtg-200"),
+                 {"ratingValue": 4.5},
+                 "ratingValue: expected integer, got number")):
+            resp = getattr(self.client, method)(
+                url, headers={"Content-Type": JSON}, data=json.dumps(body))
+            self.assertEqual(resp.status_code, 400)
+            data = json.loads(resp.data.decode("utf-8"))
+            self.assertEqual(data["@error"]["@messages"], [message])
+
+
+class BatchTestCase(ResourcesAPITestCase):
+    """
+    Class to test the batch resource
+    """
+
+    def setUp(self):
+        super(BatchTestCase, self).setUp()
+        self.url = resources.api.url_for(resources.Batch, _external=False)
+
+    def post_batch(self, batch):
+        return self.client.post(self.url, headers={"Content-Type": JSON},
+                                data=json.dumps(batch))
+
+    def test_batch(self):
+        """
+        Checks that the sub-requests are run in order and that their
+        responses are returned in the same order
+        """
+        print("("+self.test_batch.__name__+")", self.test_batch.__doc__)
+        ratings_url = resources.api.url_for(resources.UserRatings,
+                                            nickname="Kim", _external=False)
+        resp = self.post_batch({"requests": [
+            {"method": "GET", "path": "/critique/api/users/Scott/"},
+            {"method": "GET", "path": "/critique/api/users/?fields=nickname"},
+            {"method": "POST", "path": ratings_url,
+             "body": {"sender": "Knives", "ratingValue": 7}},
+            {"method": "GET", "path": ratings_url + "?fields=ratingId"},
+            {"method": "GET", "path": "/critique/api/users/Nobody/"}
+        ]})
+        self.assertEqual(resp.status_code, 200)
+        items = json.loads(resp.data.decode("utf-8"))["items"]
+        self.assertEqual([item["status"] for item in items],
+                         [200, 200, 201, 200, 404])
+        self.assertEqual(items[0]["body"]["nickname"], "Scott")
+        self.assertEqual(len(items[1]["body"]["items"]), initial_users)
+        self.assertIn("Location", items[2]["headers"])
+        self.assertIsNone(items[2]["body"])
+        # The read after the write sees the new rating
+        self.assertEqual(len(items[3]["body"]["items"]), 4)
+
+    def test_batch_atomic(self):
+        """
+        Checks that an atomic batch keeps none of its writes if one fails
+        """
+        print("("+self.test_batch_atomic.__name__+")",
+              self.test_batch_atomic.__doc__)
+        ratings_url = resources.api.url_for(resources.UserRatings,
+                                            nickname="Kim", _external=False)
+        batch = {"atomic": True, "requests": [
+            {"method": "POST", "path": ratings_url,
+             "body": {"sender": "Knives", "ratingValue": 7}},
+            {"method": "GET", "path": ratings_url},
+            {"method": "POST", "path": ratings_url,
+             "body": {"sender": "Nobody", "ratingValue": 3}}
+        ]}
+        resp = self.post_batch(batch)
+        self.assertEqual(resp.status_code, 409)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertIn("@error", data)
+        self.assertEqual([item and item["status"] for item in data["items"]],
+                         [201, 200, 404])
+        # Inside the transaction the rating was visible
+        self.assertEqual(len(data["items"][1]["body"]["items"]), 4)
+
+        resp = self.client.get(ratings_url)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(len(data["items"]), 3)
+
+        # Without atomic the first rating is kept
+        batch["atomic"] = False
+        resp = self.post_batch(batch)
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(ratings_url)
+        data = json.loads(resp.data.decode("utf-8"))
+        self.assertEqual(len(data["items"]), 4)
+
+    def test_batch_wrong(self):
+        """
+        Checks that malformed batches return 400 and 415
+        """
+        print("("+self.test_batch_wrong.__name__+")",
+              self.test_batch_wrong.__doc__)
+        resp = self.client.post(self.url, data=json.dumps({"requests": []}))
+        self.assertEqual(resp.status_code, 415)
+        for batch in ({}, {"requests": {}},
+                      {"requests": [{"method": "PATCH",
+                                     "path": "/critique/api/users/"}]},
+                      {"requests": [{"method": "GET", "path": "users"}]},
+                      {"requests": [{"method": "POST", "path": self.url}]},
+                      {"requests": [{"method": "GET",
+                                     "path": "/critique/api/users/"}] *
+                       (resources.BATCH_MAX_REQUESTS + 1)}):
+            resp = self.post_batch(batch)
+            self.assertEqual(resp.status_code, 400, batch)
+
+
+class DeadlineTestCase(ResourcesAPITestCase):
+    """
+    Test cases of the time budget of the requests
+    """
+
+    def setUp(self):
+        super(DeadlineTestCase, self).setUp()
+        resources.response_cache.clear()
+
+    def test_deadline_exhausted(self):
+        """
+        Checks that a request without time left is answered with 503
+        """
+        print("("+self.test_deadline_exhausted.__name__+")",
+              self.test_deadline_exhausted.__doc__)
+        url = resources.api.url_for(resources.User, nickname="Scott")
+        resp = self.client.get(url, headers={"X-Request-Timeout": "0"})
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"],
+                         str(database.BUSY_RETRY_AFTER))
+        self.assertEqual(resp.headers["Content-Type"], MASON_JSON)
+        self.assertIn("@error", json.loads(resp.data.decode("utf-8")))
+
+        # A malformed budget is ignored
+        resp = self.client.get(url, headers={"X-Request-Timeout": "soon"})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_database_locked(self):
+        """
+        Checks that a write waiting for a locked database gives up when the
+        budget of the request is exhausted
+        """
+        print("("+self.test_database_locked.__name__+")",
+              self.test_database_locked.__doc__)
+        url = resources.api.url_for(resources.UserRatings, nickname="Stephen")
+        body = json.dumps({"sender": "Knives", "ratingValue": 7})
+        other = sqlite3.connect(DB_PATH)
+        self.addCleanup(other.close)
+        other.execute("BEGIN EXCLUSIVE")
+        start = time.monotonic()
+        resp = self.client.post(url, data=body,
+                                headers={"Content-Type": JSON,
+                                         "X-Request-Timeout": "0.2"})
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("Retry-After", resp.headers)
+        other.rollback()
+
+        resp = self.client.post(url, data=body,
+                                headers={"Content-Type": JSON})
+        self.assertEqual(resp.status_code, 201)
+
+
+class IdempotencyTestCase(ResourcesAPITestCase):
+    """
+    Test cases of the Idempotency-Key header
+    """
+
+    def post(self, url, body, key):
+        return self.client.post(url, data=json.dumps(body),
+                                headers={"Content-Type": JSON,
+                                         "Idempotency-Key": key})
+
+    def test_retry_replayed(self):
+        """
+        Checks that a retried POST is not run again
+        """
+        print("("+self.test_retry_replayed.__name__+")",
+              self.test_retry_replayed.__doc__)
+        url = resources.api.url_for(resources.UserInbox, nickname="Scott")
+        body = {"sender": "Kim", "body": "Hi Scott!", "anonymous": 0}
+        resp = self.post(url, body, "retry-1")
+        self.assertEqual(resp.status_code, 201)
+        location = resp.headers["Location"]
+        self.assertNotIn("Idempotent-Replayed", resp.headers)
+
+        con = ENGINE.connect()
+        self.addCleanup(con.close)
+        posts = len(con.get_posts(receiver="Scott"))
+        queries = []
+        open_connection = resources.open_connection
+
+        def traced_connection():
+            con = open_connection()
+            con.con.set_trace_callback(queries.append)
+            return con
+        resources.open_connection = traced_connection
+        try:
+            resp = self.post(url, body, "retry-1")
+        finally:
+            resources.open_connection = open_connection
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.headers["Location"], location)
+        self.assertEqual(resp.headers["Idempotent-Replayed"], "true")
+        self.assertTrue(queries)
+        self.assertFalse([query for query in queries
+                          if "posts" in query or "users" in query], queries)
+        self.assertEqual(len(con.get_posts(receiver="Scott")), posts)
+
+        # Another key runs the request again
+        resp = self.post(url, body, "retry-2")
+        self.assertEqual(resp.status_code, 201)
+        self.assertNotEqual(resp.headers["Location"], location)
+
+    def test_key_reused(self):
+        """
+        Checks that a key sent with another request is refused and that the
+        failed requests do not record their key
+        """
+        print("("+self.test_key_reused.__name__+")",
+              self.test_key_reused.__doc__)
+        url = resources.api.url_for(resources.UserRatings, nickname="Stephen")
+        resp = self.post(url, {"sender": "Knives", "ratingValue": 11}, "k")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.post(url, {"sender": "Knives", "ratingValue": 7}, "k")
+        self.assertEqual(resp.status_code, 201)
+        resp = self.post(url, {"sender": "Knives", "ratingValue": 8}, "k")
+        self.assertEqual(resp.status_code, 422)
+        self.assertEqual(resp.headers["Content-Type"], MASON_JSON)
+        resp = self.post(url, {"sender": "Knives", "ratingValue": 7}, "")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_expired_keys(self):
+        """
+        Checks that the expired keys are forgotten and deleted
+        """
+        print("("+self.test_expired_keys.__name__+")",
+              self.test_expired_keys.__doc__)
+        con = ENGINE.connect()
+        self.addCleanup(con.close)
+        con.create_idempotency_key("old", "f", 201, "/old/")
+        con.create_idempotency_key("new", "f", 201, "/new/")
+        with self.assertRaises(ValueError):
+            con.create_idempotency_key("new", "g", 201)
+        created = con.get_idempotency_key("old")["created"]
+        self.assertIsNone(con.get_idempotency_key("old", created + 1))
+
+        # An expired key is used again
+        con.create_idempotency_key("old", "g", 200, since=created + 1)
+        self.assertEqual(con.get_idempotency_key("old")["fingerprint"], "g")
+        self.assertEqual(con.delete_idempotency_keys(created + 1000), 2)
+        self.assertIsNone(con.get_idempotency_key("new"))
+
+
+class AdmissionTestCase(ResourcesAPITestCase):
+    """
+    Test cases of the rate limits and of the concurrency cap
+    """
+
+    def test_rate_limiter(self):
+        """
+        Checks the token buckets
+        """
+        print("("+self.test_rate_limiter.__name__+")",
+              self.test_rate_limiter.__doc__)
+        limiter = RateLimiter(1, 2, max_keys=2)
+        self.assertTrue(limiter.acquire("Scott", now=0).allowed)
+        admission = limiter.acquire("Scott", now=0)
+        self.assertEqual(admission, (True, 2, 0, 2, 0))
+        admission = limiter.acquire("Scott", now=0.5)
+        self.assertFalse(admission.allowed)
+        self.assertEqual(admission.retry_after, 0.5)
+        self.assertTrue(limiter.acquire("Scott", now=1).allowed)
+        self.assertTrue(limiter.acquire("Kim", now=1).allowed)
+
+        # The least recently used bucket is dropped
+        limiter.acquire("Stephen", now=1)
+        self.assertEqual(len(limiter), 2)
+        self.assertEqual(limiter.acquire("Scott", now=1).remaining, 1)
+        self.assertEqual(limiter.refused, 1)
+
+        with self.assertRaises(ValueError):
+            RateLimiter(0, 1)
+
+    def test_too_many_requests(self):
+        """
+        Checks that the requests beyond the rate of a client are answered
+        with 429
+        """
+        print("("+self.test_too_many_requests.__name__+")",
+              self.test_too_many_requests.__doc__)
+        self.addCleanup(resources.rate_limiters.__setitem__, "write",
+                        resources.rate_limiters["write"])
+        resources.rate_limiters["write"] = RateLimiter(0.5, 1)
+        url = resources.api.url_for(resources.UserRatings, nickname="Stephen")
+        body = json.dumps({"sender": "Knives", "ratingValue": 7})
+
+        resp = self.client.post(url, data=body,
+                                headers={"Content-Type": JSON})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.headers["X-RateLimit-Limit"], "1")
+        self.assertEqual(resp.headers["X-RateLimit-Remaining"], "0")
+        self.assertEqual(resp.headers["X-RateLimit-Reset"], "2")
+
+        resp = self.client.post(url, data=body,
+                                headers={"Content-Type": JSON})
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers["Retry-After"], "2")
+        self.assertEqual(resp.headers["Content-Type"], MASON_JSON)
+
+        # The reads have their own bucket
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_batch_admission(self):
+        """
+        Checks that every sub-request of a batch is charged to the bucket of
+        its class and takes a slot of LIST_CONCURRENCY
+        """
+        print("("+self.test_batch_admission.__name__+")",
+              self.test_batch_admission.__doc__)
+        self.addCleanup(resources.rate_limiters.__setitem__, "list",
+                        resources.rate_limiters["list"])
+        resources.rate_limiters["list"] = RateLimiter(0.01, 2)
+        users_url = resources.api.url_for(resources.Users, _external=False)
+        user_url = resources.api.url_for(resources.User, nickname="Scott",
+                                         _external=False)
+
+        def batch(paths):
+            resp = self.client.post(
+                resources.api.url_for(resources.Batch),
+                headers={"Content-Type": JSON},
+                data=json.dumps({"requests": [{"method": "GET", "path": path}
+                                              for path in paths]}))
+            self.assertEqual(resp.status_code, 200)
+            return [item["status"] for item in
+                    json.loads(resp.data.decode("utf-8"))["items"]]
+
+        statuses = batch([users_url + "?fields=nickname", users_url,
+                          users_url + "?fields=bio", user_url])
+        self.assertEqual(sorted(statuses[:3]), [200, 200, 429])
+        self.assertEqual(statuses[3], 200)
+        # The bucket is the one of the client of the batch
+        resp = self.client.get(users_url)
+        self.assertEqual(resp.status_code, 429)
+
+        resources.rate_limiters["list"] = RateLimiter(1, 100)
+        limiter = resources.list_limiter
+        self.addCleanup(setattr, limiter, "limit", limiter.limit)
+        limiter.limit = 1
+        self.assertTrue(limiter.try_acquire())
+        try:
+            self.assertEqual(batch([users_url, user_url]), [503, 200])
+        finally:
+            limiter.release()
+        # The slots are released when the sub-requests end
+        self.assertEqual(batch([users_url, user_url]), [200, 200])
+        self.assertEqual(limiter.active, 0)
+
+    def test_list_concurrency(self):
+        """
+        Checks that the collections beyond LIST_CONCURRENCY are answered with
+        503
+        """
+        print("("+self.test_list_concurrency.__name__+")",
+              self.test_list_concurrency.__doc__)
+        limiter = resources.list_limiter
+        self.addCleanup(setattr, limiter, "limit", limiter.limit)
+        limiter.limit = 1
+        self.assertTrue(limiter.try_acquire())
+        try:
+            resp = self.client.get(resources.api.url_for(resources.Users))
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn("Retry-After", resp.headers)
+            resp = self.client.get(resources.api.url_for(resources.User,
+                                                         nickname="Scott"))
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            limiter.release()
+
+        resp = self.client.get(resources.api.url_for(resources.Users))
+        self.assertEqual(resp.status_code, 200)
+        # The slot is kept until the streamed body is sent
+        resp.close()
+        self.assertEqual(limiter.active, 0)
+
+
+class CompressionTestCase(ResourcesAPITestCase):
+    """
+    Class to test the compression of the responses
+    """
+
+    def setUp(self):
+        super(CompressionTestCase, self).setUp()
+        # Wrap the WSGI application so the test client goes through the
+        # middleware
+        self.wsgi_app = resources.app.wsgi_app
+        self.middleware = CompressionMiddleware(self.wsgi_app, level=6,
+                                                min_size=500)
+        resources.app.wsgi_app = self.middleware
+        self.url = resources.api.url_for(resources.User, nickname="Scott",
+                                         _external=False)
+        self.collection_url = resources.api.url_for(resources.Users,
+                                                    _external=False)
+
+    def tearDown(self):
+        resources.app.wsgi_app = self.wsgi_app
+        super(CompressionTestCase, self).tearDown()
+
+    def test_negotiate_encoding(self):
+        """
+        Checks the negotiation of the content coding
+        """
+        print("("+self.test_negotiate_encoding.__name__+")",
+              self.test_negotiate_encoding.__doc__)
+        self.assertEqual(negotiate_encoding("gzip, deflate"), "gzip")
+        self.assertEqual(negotiate_encoding("deflate"), "deflate")
+        self.assertEqual(negotiate_encoding("gzip;q=0.5, deflate"), "deflate")
+        self.assertEqual(negotiate_encoding("gzip;q=0, *"), "deflate")
+        self.assertIsNone(negotiate_encoding("br"))
+        self.assertIsNone(negotiate_encoding(""))
+        self.assertIsNone(negotiate_encoding(None))
+
+    def test_gzip_response(self):
+        """
+        Checks that a large response is compressed with gzip and that the
+        compressed body is the same document
+        """
+        print("("+self.test_gzip_response.__name__+")",
+              self.test_gzip_response.__doc__)
+        plain = self.client.get(self.url)
+        self.assertNotIn("Content-Encoding", plain.headers)
+
+        resp = self.client.get(self.url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertEqual(int(resp.headers["Content-Length"]), len(resp.data))
+        self.assertLess(len(resp.data), len(plain.data))
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+        resp = self.client.get(self.url,
+                               headers={"Accept-Encoding": "deflate"})
+        self.assertEqual(resp.headers["Content-Encoding"], "deflate")
+        self.assertEqual(zlib.decompress(resp.data), plain.data)
+
+    def test_small_response_not_compressed(self):
+        """
+        Checks that bodies under the size threshold are sent as they are
+        """
+        print("("+self.test_small_response_not_compressed.__name__+")",
+              self.test_small_response_not_compressed.__doc__)
+        resp = self.client.get(self.url + "?fields=nickname")
+        self.middleware.min_size = len(resp.data) + 1
+        resp = self.client.get(self.url + "?fields=nickname",
+                               headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        json.loads(resp.data.decode("utf-8"))
+
+    def test_compressed_body_cached(self):
+        """
+        Checks that the same representation is compressed only once
+        """
+        print("("+self.test_compressed_body_cached.__name__+")",
+              self.test_compressed_body_cached.__doc__)
+        cache = self.middleware.cache
+        first = self.client.get(self.url, headers={"Accept-Encoding": "gzip"})
+        hits = cache.hits
+        second = self.client.get(self.url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(first.data, second.data)
+
+    def test_streamed_response_compressed(self):
+        """
+        Checks that a streamed collection is compressed chunk by chunk and
+        that the compressed body is the same document
+        """
+        print("("+self.test_streamed_response_compressed.__name__+")",
+              self.test_streamed_response_compressed.__doc__)
+        plain = self.client.get(self.collection_url)
+        self.assertNotIn("Content-Length", plain.headers)
+        # Send it completely, the identical requests below wait for it
+        plain.get_data()
+
+        # Built again, not sent from the response cache
+        resources.response_cache.clear()
+        resp = self.client.get(self.collection_url,
+                               headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertNotIn("Content-Length", resp.headers)
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+        resources.response_cache.clear()
+        resp = self.client.get(self.collection_url,
+                               headers={"Accept-Encoding": "deflate"})
+        self.assertEqual(resp.headers["Content-Encoding"], "deflate")
+        self.assertEqual(zlib.decompress(resp.data), plain.data)
+
+
 if __name__ == "__main__": # Borrowed from lab exercises [1]
     print("Start running tests")
     unittest.main()
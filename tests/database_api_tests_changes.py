@@ -0,0 +1,227 @@
+'''
+Created on 19.10.2026
+Database interface testing for the change log.
+
+A change object is a dictionary which contains the following keys:
+      - seq: sequence number of the change (int)
+      - timestamp: UNIX timestamp (long integer) of the change.
+      - entity: 'user', 'post' or 'rating'
+      - entity_id: nickname of the user, id of the post or id of the rating
+      - owner: nickname of the user the change concerns
+      - action: 'insert', 'update', 'delete', 'publish' or 'unpublish'
+
+REFERENCEs:
+-   Programmable Web Projects, Exercise 1, database_api_tests_messages.py
+'''
+
+import unittest
+
+from app import database
+
+#Path to the database file, different from the deployment db
+DB_PATH = 'db/critique_test.db'
+ENGINE = database.Engine(DB_PATH)
+
+# One insert per user, post and rating of critique_data_dump.sql
+INITIAL_SIZE = 5 + 12 + 17
+
+
+class ChangeDBAPITestCase(unittest.TestCase):
+    '''
+    Test cases for the change log.
+    '''
+    #INITIATION AND TEARDOWN METHODS
+    @classmethod
+    def setUpClass(cls):
+        '''
+        Creates the database structure. Removes first any preexisting
+            database file
+        '''
+        print("Testing ", cls.__name__)
+        ENGINE.remove_database()
+        ENGINE.create_tables()
+
+    @classmethod
+    def tearDownClass(cls):
+        '''
+        Remove the testing database
+        '''
+        print("Testing ENDED for ", cls.__name__)
+        ENGINE.remove_database()
+
+    def setUp(self):
+        '''
+        Populates the database
+        '''
+        #This method load the initial values from critique_data_dump.sql
+        ENGINE.populate_tables()
+        #Creates a Connection instance to use the API
+        self.connection = ENGINE.connect()
+
+    def tearDown(self):
+        '''
+        Close underlying connection and remove all records from database
+        '''
+        self.connection.close()
+        ENGINE.clear()
+
+    def test_initial_changes(self):
+        '''
+        Check that populating the database recorded one insert per row
+        '''
+        print('('+self.test_initial_changes.__name__+')',
+              self.test_initial_changes.__doc__)
+        changes = self.connection.get_changes()
+        self.assertEqual(len(changes), INITIAL_SIZE)
+        for change in changes:
+            self.assertEqual(change['action'], 'insert')
+        seqs = [change['seq'] for change in changes]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual(self.connection.get_last_change_seq(), seqs[-1])
+
+        # Post 7 is a reply, its owner is the sender
+        post = [change for change in changes if change['entity'] == 'post'
+                and change['entity_id'] == '7'][0]
+        self.assertEqual(post['owner'], 'Kim')
+
+    def test_write_changes(self):
+        '''
+        Check that updates, publicity flips and deletes are recorded and
+        compacted to the last change of each entity
+        '''
+        print('('+self.test_write_changes.__name__+')',
+              self.test_write_changes.__doc__)
+        since = self.connection.get_last_change_seq()
+        self.assertEqual(self.connection.get_changes(since), [])
+
+        self.connection.modify_post_publicity(4, 1)
+        self.connection.modify_rating('rtg-1', 3)
+        changes = self.connection.get_changes(since)
+        self.assertEqual([(change['entity'], change['entity_id'],
+                           change['owner'], change['action'])
+                          for change in changes],
+                         [('post', '4', 'Scott', 'publish'),
+                          ('rating', 'rtg-1', 'Kim', 'update')])
+
+        self.connection.modify_post_publicity(4, 0)
+        self.connection.delete_rating('rtg-1')
+        changes = self.connection.get_changes(since)
+        self.assertEqual([(change['entity_id'], change['action'])
+                          for change in changes],
+                         [('4', 'unpublish'), ('rtg-1', 'delete')])
+
+        # Filter by owner and limit
+        changes = self.connection.get_changes(since, owner='Kim')
+        self.assertEqual([change['entity_id'] for change in changes],
+                         ['rtg-1'])
+        changes = self.connection.get_changes(since, limit=1)
+        self.assertEqual([change['entity_id'] for change in changes], ['4'])
+
+    def test_delete_user_changes(self):
+        '''
+        Check that deleting a user records the deletes of its posts and
+        ratings too
+        '''
+        print('('+self.test_delete_user_changes.__name__+')',
+              self.test_delete_user_changes.__doc__)
+        since = self.connection.get_last_change_seq()
+        self.connection.delete_user('Knives')
+        changes = self.connection.get_changes(since)
+        self.assertEqual(changes[-1]['entity'], 'user')
+        self.assertEqual(changes[-1]['entity_id'], 'Knives')
+        self.assertEqual(changes[-1]['action'], 'delete')
+        # Ratings 4, 8, 12, 16 and 17 and posts 3, 5, 9, 10 and 11
+        self.assertEqual(len(changes), 11)
+        for change in changes:
+            self.assertEqual(change['action'], 'delete')
+
+    def test_get_changes_of_entity(self):
+        '''
+        Check that the changes can be filtered by entity and that the bounds
+        of the change log follow its writes
+        '''
+        print('('+self.test_get_changes_of_entity.__name__+')',
+              self.test_get_changes_of_entity.__doc__)
+        first, last = self.connection.get_change_bounds()
+        self.assertEqual(last, self.connection.get_last_change_seq())
+        self.assertLessEqual(first, last)
+        users = self.connection.get_changes(entity='user')
+        self.assertEqual([change['entity_id'] for change in users],
+                         ['Scott', 'Kim', 'Stephen', 'Young', 'Knives'])
+
+        self.connection.modify_post_publicity(4, 1)
+        self.assertEqual(self.connection.get_changes(last, entity='user'), [])
+        self.connection.delete_user('Knives')
+        changes = self.connection.get_changes(last, entity='user')
+        self.assertEqual([(change['entity_id'], change['action'])
+                          for change in changes], [('Knives', 'delete')])
+        self.assertEqual(self.connection.get_change_bounds(),
+                         (first, self.connection.get_last_change_seq()))
+
+        # Only the changes after since are read
+        cur = self.connection.con.cursor()
+        cur.execute('EXPLAIN QUERY PLAN SELECT * FROM changes '
+                    'WHERE seq > ? AND entity = ?', (last, 'user'))
+        plan = ' '.join(row[-1] for row in cur.fetchall())
+        self.assertIn('changes_kind_seq', plan)
+
+    def test_get_change_version(self):
+        '''
+        Check that the version of an entity or of an owner only changes when
+        they are written
+        '''
+        print('('+self.test_get_change_version.__name__+')',
+              self.test_get_change_version.__doc__)
+        post = self.connection.get_change_version('post', 'p-4')
+        self.assertEqual(post, self.connection.get_change_version('post', '4'))
+        scott = self.connection.get_change_version(owner='Scott')
+        kim = self.connection.get_change_version(owner='Kim')
+        self.assertGreater(post[0], 0)
+        self.assertIsNotNone(post[1])
+        self.assertEqual(self.connection.get_change_version('user', 'Moamen'),
+                         (0, None))
+
+        # Post 4 was sent to Scott
+        self.connection.modify_post_publicity(4, 1)
+        self.assertGreater(self.connection.get_change_version('post', '4')[0],
+                           post[0])
+        self.assertGreater(
+            self.connection.get_change_version(owner='Scott')[0], scott[0])
+        self.assertEqual(self.connection.get_change_version(owner='Kim'), kim)
+
+        # Any user
+        users = self.connection.get_change_version('user')
+        self.assertGreater(users[0], 0)
+        self.connection.modify_post_publicity(4, 0)
+        self.assertEqual(self.connection.get_change_version('user'), users)
+        kim_user = self.connection.get_user('Kim')
+        self.connection.modify_user('Kim', kim_user['summary'],
+                                    kim_user['details'])
+        self.assertGreater(self.connection.get_change_version('user')[0],
+                           users[0])
+
+        with self.assertRaises(ValueError):
+            self.connection.get_change_version()
+
+    def test_get_change_version_query_plan(self):
+        '''
+        Check that the versions are read from an index
+        '''
+        print('('+self.test_get_change_version_query_plan.__name__+')',
+              self.test_get_change_version_query_plan.__doc__)
+        cur = self.connection.con.cursor()
+        for condition, pvalue in (('entity = ? AND entity_id = ?',
+                                   ('post', '4')),
+                                  ('owner = ?', ('Kim',)),
+                                  ('entity = ?', ('user',))):
+            cur.execute('EXPLAIN QUERY PLAN SELECT seq, timestamp FROM changes '
+                        'WHERE ' + condition + ' ORDER BY seq DESC LIMIT 1',
+                        pvalue)
+            plan = ' '.join(row[-1] for row in cur.fetchall())
+            self.assertIn('USING INDEX', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+if __name__ == '__main__':
+    print('Start running tests')
+    unittest.main()
@@ -250,6 +250,138 @@ class PostDBAPITestCase(unittest.TestCase):
                 self.assertEqual(len(post), 8)
                 self.assertDictContainsSubset(post, POST1)
 
+    def test_get_posts_by_user_fields(self):
+        '''
+        Test that get_posts_by_user does not read the text of the posts
+        unless it is requested
+        '''
+        print('('+self.test_get_posts_by_user_fields.__name__+')',
+              self.test_get_posts_by_user_fields.__doc__)
+        posts = self.connection.get_posts_by_user(
+            VALID_USER_NICKNAME, fields=('receiver', 'rating'))
+        self.assertEqual(len(posts), 4)
+        for post in posts:
+            self.assertIsNone(post['post_text'])
+            self.assertIsNotNone(post['post_id'])
+            self.assertIsNotNone(post['receiver'])
+            self.assertIsNotNone(post['rating'])
+
+    def test_get_posts(self):
+        '''
+        Test that get_posts filters, orders and pages the posts
+        '''
+        print('('+self.test_get_posts.__name__+')',
+              self.test_get_posts.__doc__)
+        # All the posts, replies included, newest first
+        posts = self.connection.get_posts()
+        self.assertEqual(len(posts), INITIAL_SIZE)
+        timestamps = [post['timestamp'] for post in posts]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
+        posts = self.connection.get_posts(sender=VALID_USER_NICKNAME,
+                                          descending=False)
+        self.assertEqual([post['post_id'] for post in posts],
+                         ['1', '3', '2', '0'])
+        posts = self.connection.get_posts(receiver=VALID_USER_NICKNAME)
+        self.assertEqual([post['post_id'] for post in posts],
+                         ['11', '8', '4'])
+        posts = self.connection.get_posts(receiver=VALID_USER_NICKNAME,
+                                          public=False)
+        self.assertEqual([post['post_id'] for post in posts], ['4'])
+        posts = self.connection.get_posts(replies_only=True)
+        self.assertEqual([post['post_id'] for post in posts], ['7', '10'])
+        posts = self.connection.get_posts(min_rating=10)
+        self.assertEqual([post['post_id'] for post in posts], ['11', '1'])
+        # The posts of each rating are merged in order
+        def rated(posts):
+            return [post['post_id'] for post in posts
+                    if post['rating'] is not None and post['rating'] >= 5]
+        for kwargs in ({}, {'descending': False}, {'public': True},
+                       {'receiver': VALID_USER_NICKNAME}):
+            posts = self.connection.get_posts(min_rating=5, **kwargs)
+            self.assertEqual([post['post_id'] for post in posts],
+                             rated(self.connection.get_posts(**kwargs)))
+        posts = self.connection.get_posts(min_rating=5, limit=3,
+                                          fields=['post_text'])
+        self.assertEqual([post['post_id'] for post in posts],
+                         rated(self.connection.get_posts())[:3])
+        posts = self.connection.get_posts(since=1362017281, until=1362020481)
+        self.assertEqual([post['post_id'] for post in posts],
+                         ['10', '0', '2'])
+        self.assertEqual(self.connection.get_posts(sender=INVALID_USER_NICKNAME), [])
+
+        # Keyset paging returns every post once
+        pages = []
+        after = None
+        while True:
+            page = self.connection.get_posts(after=after, limit=5)
+            if not page:
+                break
+            pages.extend(post['post_id'] for post in page)
+            after = (page[-1]['timestamp'], int(page[-1]['post_id']))
+        self.assertEqual(pages, [post['post_id'] for post in
+                                 self.connection.get_posts()])
+
+    def test_get_posts_by_ids(self):
+        '''
+        Test that get_posts_by_ids returns the posts in the requested order
+        and None for the ids that do not exist
+        '''
+        print('('+self.test_get_posts_by_ids.__name__+')',
+              self.test_get_posts_by_ids.__doc__)
+        posts = self.connection.get_posts_by_ids(
+            ['p-' + str(POST1_ID), 'p-' + str(WRONG_POST_ID), 'p-7',
+             str(POST0_ID), 'wrong'])
+        self.assertEqual(len(posts), 5)
+        self.assertEqual(posts[0]['post_id'], str(POST1_ID))
+        self.assertEqual(posts[0]['post_text'], POST1['post_text'])
+        self.assertIsNone(posts[1])
+        # Replies have no receiver
+        self.assertIsNone(posts[2]['receiver'])
+        self.assertEqual(posts[3]['sender'], POST0['sender'])
+        self.assertIsNone(posts[4])
+        self.assertEqual(self.connection.get_posts_by_ids([]), [])
+
+    def test_get_posts_query_plan(self):
+        '''
+        Test that every filter of get_posts is answered with an index,
+        without scanning or sorting the posts table
+        '''
+        print('('+self.test_get_posts_query_plan.__name__+')',
+              self.test_get_posts_query_plan.__doc__)
+        # Without a sender or a receiver, iter_posts replaces min_rating by
+        # one query per rating
+        filters = [
+            {},
+            {'sender_id': 1},
+            {'receiver_id': 1},
+            {'receiver_id': 1, 'public': False},
+            {'sender_id': 1, 'public': True},
+            {'since': 1362012381, 'until': 1362020481},
+            {'rating': 5},
+            {'rating': 5, 'since': 1362012381},
+            {'rating': 5, 'public': True},
+            {'rating': 5, 'replies_only': True},
+            {'sender_id': 1, 'min_rating': 5},
+            {'receiver_id': 1, 'min_rating': 5, 'public': True},
+            {'public': True},
+            {'replies_only': True},
+            {'sender_id': 1, 'descending': False, 'after': (1362012481, 1)}
+        ]
+        for kwargs in filters:
+            query, pvalue = self.connection._posts_query(limit=20, **kwargs)
+            cur = self.connection.con.execute('EXPLAIN QUERY PLAN ' + query,
+                                              pvalue)
+            plan = [row[3] for row in cur.fetchall()]
+            posts_plan = [step for step in plan if ' posts ' in step + ' ']
+            self.assertEqual(len(posts_plan), 1, plan)
+            self.assertIn('USING INDEX posts_', posts_plan[0])
+            # posts_replies_timestamp only has the replies, reading all of
+            # it is not a scan of the posts
+            if kwargs and kwargs != {'replies_only': True}:
+                self.assertNotIn('SCAN', posts_plan[0], kwargs)
+            self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)
+
     def test_delete_post(self):
         '''
         Test that post with post_id = 1, has been deleted
@@ -326,6 +458,138 @@ class PostDBAPITestCase(unittest.TestCase):
                                               post_text="This is a newly-created post", anonymous=1, public=1)
         self.assertIsNone(post_id)
 
+    def test_identity_map(self):
+        '''
+        Test that a post is read once per connection until it is written,
+        and that the callers get their own copies
+        '''
+        print('('+self.test_identity_map.__name__+')',
+              self.test_identity_map.__doc__)
+        queries = []
+        self.connection.con.set_trace_callback(queries.append)
+        post = self.connection.get_post('p-'+str(POST0_ID))
+        post['post_text'] = 'changed by the caller'
+        self.assertTrue(self.connection.contains_post('p-'+str(POST0_ID)))
+        projected = self.connection.get_post(str(POST0_ID), fields=('sender',))
+        self.assertEqual(projected['sender'], 'Scott')
+        self.assertIsNone(projected['post_text'])
+        self.assertFalse(self.connection.contains_post('p-200'))
+        self.assertIsNone(self.connection.get_post('p-200'))
+        selects = [query for query in queries if query.startswith('SELECT')]
+        self.assertEqual(len(selects), 2)
+
+        # Written posts are read again
+        self.connection.modify_post_publicity(POST0_ID, 0)
+        post = self.connection.get_post('p-'+str(POST0_ID))
+        self.assertEqual(post['public'], 0)
+        self.assertNotEqual(post['post_text'], 'changed by the caller')
+
+        # A reply resolves the post answered and the users once
+        del queries[:]
+        self.connection.contains_user('Kim')
+        reply_id = self.connection.create_post(sender_nickname='Kim',
+                                               reply_to='p-'+str(POST0_ID),
+                                               post_text='A reply')
+        self.assertEqual(self.connection.get_post(reply_id)['reply_to'],
+                         POST0_ID)
+        self.connection.con.set_trace_callback(None)
+        selects = [query for query in queries if query.startswith('SELECT')]
+        # Kim and the new post
+        self.assertEqual(len(selects), 2, selects)
+
+    def test_bulk_posts(self):
+        '''
+        Test that several posts received by a user are modified, answered and
+        deleted with one statement
+        '''
+        print('('+self.test_bulk_posts.__name__+')', \
+              self.test_bulk_posts.__doc__)
+        changes = []
+        self.connection.add_listener(changes.append)
+        queries = []
+        self.connection.con.set_trace_callback(queries.append)
+        # Scott received 4, 8 and 11 but not 0
+        done = self.connection.modify_posts_publicity(
+            'Scott', ['p-4', 'p-8', 'p-0', '4'], 1)
+        self.connection.con.set_trace_callback(None)
+        self.assertEqual(done, ['p-4', 'p-8'])
+        # The statement is traced again for each trigger it fires
+        updates = set(query for query in queries
+                      if query.startswith('UPDATE'))
+        self.assertEqual(len(updates), 1, queries)
+        # The listeners get the posts before and after the update with one
+        # query each
+        selects = [query for query in queries
+                   if query.startswith('SELECT') and 'post_text' in query]
+        self.assertEqual(len(selects), 2, queries)
+        self.assertEqual(self.connection.get_post('p-4')['public'], 1)
+        self.assertEqual([(change['action'], change['post']['post_id'])
+                          for change in changes],
+                         [('publish', 4), ('update', 8)])
+
+        self.assertEqual(self.connection.modify_posts_rating(
+            'Scott', ['p-8', 'p-11'], 3), ['p-8', 'p-11'])
+        self.assertEqual(self.connection.get_post('p-11')['rating'], 3)
+
+        replies = self.connection.create_replies('Scott', ['p-11', 'p-8'],
+                                                 'Thanks!')
+        self.assertEqual(sorted(replies), ['p-11', 'p-8'])
+        for post_id, reply_id in replies.items():
+            reply = self.connection.get_post(reply_id)
+            self.assertEqual(reply['reply_to'], int(post_id[2:]))
+            self.assertEqual(reply['sender'], 'Scott')
+            self.assertEqual(reply['post_text'], 'Thanks!')
+
+        self.assertEqual(changes[-1]['parent']['post_id'], 8)
+        self.assertEqual(changes[-1]['post']['reply_to'], 8)
+
+        self.assertEqual(self.connection.delete_posts('Scott',
+                                                      ['p-8', 'p-0']),
+                         ['p-8'])
+        self.assertEqual(changes[-1]['action'], 'delete')
+        self.assertEqual(changes[-1]['post']['post_id'], 8)
+        self.assertIsNone(self.connection.get_post('p-8'))
+        # With its reply
+        self.assertIsNone(self.connection.get_post(replies['p-8']))
+        self.assertIsNotNone(self.connection.get_post('p-0'))
+
+        self.assertEqual(self.connection.delete_posts('Moamen', ['p-0']), [])
+        with self.assertRaises(ValueError):
+            self.connection.delete_posts('Scott', ['post-4'])
+
+    def test_create_replies_concurrent(self):
+        '''
+        Test that the replies committed by another connection while
+        create_replies runs are not taken for the new ones
+        '''
+        print('('+self.test_create_replies_concurrent.__name__+')', \
+              self.test_create_replies_concurrent.__doc__)
+        other = sqlite3.connect(DB_PATH)
+        self.addCleanup(other.close)
+
+        def reply_elsewhere(query):
+            # Before the INSERT of create_replies takes the write lock
+            if query == 'BEGIN ':
+                self.connection.con.set_trace_callback(None)
+                other.executemany('INSERT INTO posts (timestamp, sender_id, \
+                                   receiver_id, reply_to, post_text, \
+                                   rating, anonymous, public) \
+                                   VALUES (0, ?, NULL, ?, ?, NULL, 0, 1)',
+                                  [(2, 11, 'From Kim'),
+                                   (1, 8, 'From elsewhere')])
+                other.commit()
+        self.connection.con.set_trace_callback(reply_elsewhere)
+        replies = self.connection.create_replies('Scott', ['p-11', 'p-8'],
+                                                 'Thanks!')
+        self.connection.con.set_trace_callback(None)
+        cur = self.connection.con.execute('SELECT COUNT(*) FROM posts WHERE \
+                                           post_text LIKE \'From %\'')
+        self.assertEqual(cur.fetchone()[0], 2)
+        for post_id in ('p-11', 'p-8'):
+            reply = self.connection.get_post(replies[post_id])
+            self.assertEqual(reply['post_text'], 'Thanks!')
+            self.assertEqual(reply['reply_to'], int(post_id[2:]))
+
 
 if __name__ == '__main__':
     '''
@@ -18,7 +18,7 @@ REFERENCEs:
 -   Programmable Web Projects, Exercise 1, database_api_tests_messages.py
 '''
 
-import sqlite3, unittest
+import sqlite3, threading, time, unittest
 
 from app import database
 
@@ -272,6 +272,88 @@ class RatingDBAPITestCase(unittest.TestCase):
             self.assertIn(rating['rating_id'],
                           ('rtg-1', 'rtg-2', 'rtg-3', 'rtg-4'))
 
+    def test_get_ratings_paging(self):
+        '''
+        Read the ratings in pages of 5. Check that every rating is returned
+        once and in order of id.
+        '''
+        print('('+self.test_get_ratings_paging.__name__+')',
+              self.test_get_ratings_paging.__doc__)
+        rating_ids = []
+        after = None
+        while True:
+            ratings = self.connection.get_ratings(after=after, limit=5)
+            if not ratings:
+                break
+            self.assertLessEqual(len(ratings), 5)
+            rating_ids.extend(rating['rating_id'] for rating in ratings)
+            after = int(ratings[-1]['rating_id'][len('rtg-'):])
+        self.assertEqual(rating_ids,
+                         ['rtg-%d' % i for i in range(1, INITIAL_SIZE + 1)])
+
+    def test_get_ratings_query_plan(self):
+        '''
+        Check that a page of the ratings of a user is a range of an index,
+        without sorting the ratings
+        '''
+        print('('+self.test_get_ratings_query_plan.__name__+')',
+              self.test_get_ratings_query_plan.__doc__)
+        for kwargs in ({'sender': 'Knives'}, {'receiver': 'Scott'},
+                       {'receiver': 'Scott', 'after': 5, 'limit': 2},
+                       {'sender': 'Kim', 'receiver': 'Scott'}):
+            queries = []
+            self.connection.con.set_trace_callback(queries.append)
+            self.connection.get_ratings(**kwargs)
+            self.connection.con.set_trace_callback(None)
+            query = [query for query in queries
+                     if query.startswith('SELECT') and 'ratings' in query][-1]
+            cur = self.connection.con.execute('EXPLAIN QUERY PLAN ' + query)
+            plan = [row[3] for row in cur.fetchall()]
+            ratings_plan = [step for step in plan if ' ratings ' in step]
+            self.assertEqual(len(ratings_plan), 1, plan)
+            self.assertIn('USING INDEX ratings_', ratings_plan[0])
+            self.assertFalse(any('TEMP B-TREE' in step for step in plan),
+                             plan)
+        self.assertEqual(self.connection.get_ratings(receiver='Moamen'), [])
+        self.assertEqual([rating['rating_id'] for rating in
+                          self.connection.get_ratings(receiver='Scott',
+                                                      after=5)],
+                         ['rtg-9', 'rtg-13', 'rtg-17'])
+
+    def test_get_rating_stats(self):
+        '''
+        Check the number, average and histogram of the ratings of each user
+        '''
+        print('('+self.test_get_rating_stats.__name__+')',
+              self.test_get_rating_stats.__doc__)
+        stats = self.connection.get_rating_stats()
+        self.assertEqual([user['nickname'] for user in stats],
+                         ['Kim', 'Knives', 'Scott', 'Stephen', 'Young'])
+        self.assertEqual(sum(user['count'] for user in stats), INITIAL_SIZE)
+
+        # Scott received the ratings 5, 9, 13 and 17
+        scott = stats[2]
+        ratings = [self.connection.get_rating(rating_id)['rating'] for
+                   rating_id in ('rtg-5', 'rtg-9', 'rtg-13', 'rtg-17')]
+        self.assertEqual(scott['count'], 4)
+        self.assertAlmostEqual(scott['average'], sum(ratings) / 4.0)
+        for value in range(1, 11):
+            self.assertEqual(scott['histogram'][value], ratings.count(value))
+
+        # Ratings given by Scott, grouped by receiver and paged
+        stats = self.connection.get_rating_stats(sender='Scott', limit=2)
+        self.assertEqual([user['nickname'] for user in stats],
+                         ['Kim', 'Knives'])
+        stats = self.connection.get_rating_stats(sender='Scott',
+                                                 after='Knives')
+        self.assertEqual([user['nickname'] for user in stats],
+                         ['Stephen', 'Young'])
+
+        stats = self.connection.get_rating_stats(group_by='sender')
+        self.assertEqual(sum(user['count'] for user in stats), INITIAL_SIZE)
+        with self.assertRaises(ValueError):
+            self.connection.get_rating_stats(group_by='rating')
+
     def test_modify_rating(self):
         '''
         Test that the rating rtg-1 is modifed
@@ -327,6 +409,93 @@ class RatingDBAPITestCase(unittest.TestCase):
         resp2 = self.connection.get_rating(rating_id)
         self.assertDictContainsSubset(new_rating, resp2)
 
+    def test_user_leaderboard(self):
+        '''
+        Check that the users are ranked by average rating and that the
+        ranking follows the writes of the ratings
+        '''
+        print('('+self.test_user_leaderboard.__name__+')',
+              self.test_user_leaderboard.__doc__)
+
+        def ranking(**kwargs):
+            return [user['nickname'] for user in
+                    self.connection.get_user_leaderboard(**kwargs)]
+
+        self.assertEqual(ranking(),
+                         ['Scott', 'Young', 'Kim', 'Stephen', 'Knives'])
+        self.assertEqual(ranking(min_count=4), ['Scott', 'Knives'])
+        first = self.connection.get_user_leaderboard(limit=2)
+        self.assertEqual(first[0]['count'], 4)
+        self.assertAlmostEqual(first[0]['average'], 8.0)
+        last = first[-1]
+        self.assertEqual(ranking(after=(last['average'], last['user_id'])),
+                         ['Kim', 'Stephen', 'Knives'])
+
+        rating_id = self.connection.create_rating('Knives', 'Stephen', 10)
+        self.connection.modify_rating('rtg-17', 1)
+        self.assertEqual(ranking(),
+                         ['Young', 'Stephen', 'Kim', 'Knives', 'Scott'])
+        self.connection.delete_rating(rating_id)
+        self.assertEqual(ranking(),
+                         ['Young', 'Kim', 'Stephen', 'Knives', 'Scott'])
+
+        # Only the ratings of the window
+        since = int(time.time())
+        self.assertEqual(ranking(since=since), [])
+        self.connection.create_rating('Knives', 'Kim', 2)
+        self.assertEqual(ranking(since=since, min_count=1), ['Kim'])
+        self.assertEqual(ranking(since=since, min_count=2), [])
+        self.assertEqual(ranking(since=0, min_count=4),
+                         ['Knives', 'Scott', 'Kim'])
+
+        # The totals of a user are deleted with its last rating
+        for rating in self.connection.get_ratings(receiver='Scott'):
+            self.connection.delete_rating(rating['rating_id'])
+        cur = self.connection.con.cursor()
+        for table in ('rating_totals', 'rating_days'):
+            cur.execute('SELECT COUNT(*) FROM ' + table +
+                        ' WHERE user_id = 1 OR count = 0')
+            self.assertEqual(cur.fetchone()[0], 0, table)
+
+        # The global ranking is read in order from its index
+        cur = self.connection.con.cursor()
+        cur.execute('EXPLAIN QUERY PLAN SELECT user_id FROM rating_totals '
+                    'WHERE count >= 3 ORDER BY total * 1.0 / count DESC, '
+                    'user_id DESC LIMIT 10')
+        plan = ' '.join(row[-1] for row in cur.fetchall())
+        self.assertIn('rating_totals_average', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_post_leaderboard(self):
+        '''
+        Check that the public posts are ranked by rating and paged
+        '''
+        print('('+self.test_post_leaderboard.__name__+')',
+              self.test_post_leaderboard.__doc__)
+        posts = self.connection.get_post_leaderboard()
+        # Post 4 is private, posts 7 and 10 are not rated
+        self.assertEqual([post['post_id'] for post in posts],
+                         ['11', '1', '2', '3', '9', '8', '0', '6', '5'])
+        ratings = [post['rating'] for post in posts]
+        self.assertEqual(ratings, sorted(ratings, reverse=True))
+
+        page = self.connection.get_post_leaderboard(limit=4, fields=['sender'])
+        self.assertIsNone(page[0]['post_text'])
+        last = page[-1]
+        after = (last['rating'], last['timestamp'], int(last['post_id']))
+        self.assertEqual(
+            [post['post_id'] for post in
+             self.connection.get_post_leaderboard(after=after, limit=3)],
+            ['9', '8', '0'])
+
+        self.assertEqual([post['post_id'] for post in self.connection
+                          .get_post_leaderboard(since=1362017000)],
+                         ['11', '2', '3', '0'])
+        self.connection.modify_post_rating(0, 10)
+        self.assertEqual([post['post_id'] for post in
+                          self.connection.get_post_leaderboard(limit=3)],
+                         ['11', '0', '1'])
+
     def test_crate_rating_unregistered_user(self):
         '''
         Test that a new rating can not be created with unregistered user
@@ -357,6 +526,101 @@ class RatingDBAPITestCase(unittest.TestCase):
         self.assertTrue(self.connection.contains_rating(RATING1_ID))
         self.assertTrue(self.connection.contains_rating(RATING2_ID))
 
+    def test_identity_map(self):
+        '''
+        Check that the users and ratings already read by the connection are
+        not read again until they are written
+        '''
+        print('('+self.test_identity_map.__name__+')',
+              self.test_identity_map.__doc__)
+        queries = []
+        self.connection.con.set_trace_callback(queries.append)
+        self.assertTrue(self.connection.contains_rating(RATING1_ID))
+        rating = self.connection.get_rating(RATING1_ID)
+        self.assertTrue(self.connection.contains_user('Knives'))
+        self.assertTrue(self.connection.contains_user('Kim'))
+        self.assertTrue(self.connection.contains_user('Kim'))
+        selects = [query for query in queries if query.startswith('SELECT')]
+        self.assertEqual(len(selects), 3)
+
+        # The users are not resolved again
+        del queries[:]
+        rating_id = self.connection.create_rating('Knives', 'Kim', 6)
+        self.connection.con.set_trace_callback(None)
+        self.assertFalse(any('FROM users, users_profile' in query
+                             for query in queries), queries)
+        self.assertEqual(self.connection.get_rating(rating_id)['rating'], 6)
+
+        self.connection.modify_rating(RATING1_ID, rating['rating'] % 10 + 1)
+        self.assertEqual(self.connection.get_rating(RATING1_ID)['rating'],
+                         rating['rating'] % 10 + 1)
+        self.connection.delete_rating(RATING1_ID)
+        self.assertFalse(self.connection.contains_rating(RATING1_ID))
+
+    def test_database_busy(self):
+        '''
+        Checks that the operations give up when another connection keeps the
+        database locked, and that the idempotent ones are attempted again
+        '''
+        print('('+self.test_database_busy.__name__+')', \
+              self.test_database_busy.__doc__)
+        con = database.Engine(DB_PATH, busy_timeout=0.1).connect()
+        self.addCleanup(con.close)
+        other = sqlite3.connect(DB_PATH, check_same_thread=False)
+        self.addCleanup(other.close)
+
+        other.execute('BEGIN EXCLUSIVE')
+        start = time.monotonic()
+        with self.assertRaises(database.DatabaseBusyError) as context:
+            con.create_rating('Knives', 'Stephen', 5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(context.exception.retry_after,
+                         database.BUSY_RETRY_AFTER)
+        other.rollback()
+        # The failed insert is not committed later
+        con.close()
+        self.assertEqual(self.connection.get_ratings(sender='Knives',
+                                                     receiver='Stephen'), [])
+
+        # The update waits for the lock to be released
+        con = database.Engine(DB_PATH, busy_timeout=0.1).connect()
+        self.addCleanup(con.close)
+        other.execute('BEGIN EXCLUSIVE')
+        release = threading.Timer(0.15, other.rollback)
+        release.start()
+        self.addCleanup(release.join)
+        self.assertEqual(con.modify_rating(RATING1_ID, 4), RATING1_ID)
+        self.assertEqual(con.get_rating(RATING1_ID)['rating'], 4)
+
+        # The time left shrinks from the budget
+        self.assertIsNone(con.time_left())
+        con.set_deadline(10)
+        self.assertTrue(0 < con.time_left() <= 10)
+
+        # Nothing runs after the deadline
+        con.set_deadline(0)
+        with self.assertRaises(database.DatabaseBusyError):
+            con.get_rating(RATING1_ID)
+        con.set_deadline(None)
+        self.assertEqual(con.get_rating(RATING1_ID)['rating'], 4)
+
+        # A statement still running at the deadline is interrupted
+        count = database.busy_aware()(lambda self: self.con.execute(
+            'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+            'SELECT i + 1 FROM n) SELECT count(*) FROM n').fetchone())
+        con.set_deadline(0.1)
+        start = time.monotonic()
+        with self.assertRaises(database.DatabaseBusyError):
+            count(con)
+        self.assertLess(time.monotonic() - start, 1)
+        con.set_deadline(None)
+
+        # The streamed reads fail when called, not while they are read
+        other.execute('BEGIN EXCLUSIVE')
+        with self.assertRaises(database.DatabaseBusyError):
+            con.iter_ratings(receiver='Scott')
+        other.rollback()
+
 if __name__ == '__main__':
     '''
 
@@ -0,0 +1,199 @@
+'''
+Created on 19.10.2026
+Testing of the reputation computed from the ratings graph, app/reputation.py,
+and of the database API storing it.
+
+REFERENCEs:
+-   Programmable Web Projects, Exercise 1, database_api_tests_messages.py
+'''
+
+import unittest
+
+from app import database, reputation
+
+#Path to the database file, different from the deployment db
+DB_PATH = 'db/critique_test.db'
+ENGINE = database.Engine(DB_PATH)
+
+USER1_ID = 1
+USER5_ID = 5
+USER5_NICKNAME = 'Knives'
+# Users rated by Knives in critique_data_dump.sql
+FREE_RECEIVERS = ('Kim', 'Stephen', 'Young')
+
+
+class ReputationTestCase(unittest.TestCase):
+    '''
+    Test cases for the reputation of the users.
+    '''
+    #INITIATION AND TEARDOWN METHODS
+    @classmethod
+    def setUpClass(cls):
+        '''
+        Creates the database structure. Removes first any preexisting
+            database file
+        '''
+        print("Testing ", cls.__name__)
+        ENGINE.remove_database()
+        ENGINE.create_tables()
+
+    @classmethod
+    def tearDownClass(cls):
+        '''
+        Remove the testing database
+        '''
+        print("Testing ENDED for ", cls.__name__)
+        ENGINE.remove_database()
+
+    def setUp(self):
+        '''
+        Populates the database
+        '''
+        #This method load the initial values from critique_data_dump.sql
+        ENGINE.populate_tables()
+        #Creates a Connection instance to use the API
+        self.connection = ENGINE.connect()
+
+    def tearDown(self):
+        '''
+        Close underlying connection and remove all records from database
+        '''
+        self.connection.close()
+        ENGINE.clear()
+
+    def test_rank(self):
+        '''
+        Check the ranking of a small graph
+        '''
+        print('('+self.test_rank.__name__+')', self.test_rank.__doc__)
+        # 1 and 2 rate 3 with a 10, 3 rates 1 with a 5, 4 rates nobody
+        edges = [[(1, 3, 10), (2, 3, 10)], [(3, 1, 5)]]
+        ranking = reputation.rank([1, 2, 3, 4], edges)
+        scores = ranking.scores
+        self.assertEqual(len(scores), 4)
+        self.assertEqual(ranking.ratings, 3)
+        self.assertAlmostEqual(sum(scores), 4)
+        self.assertGreater(scores[2], scores[0])
+        self.assertGreater(scores[0], scores[1])
+        self.assertAlmostEqual(scores[1], scores[3])
+        # Nobody rated
+        ranking = reputation.rank([1, 2], [])
+        self.assertAlmostEqual(ranking.scores[0], 1)
+        self.assertAlmostEqual(ranking.scores[1], 1)
+        self.assertEqual(reputation.rank([], []).scores, [])
+
+    def test_rank_unknown_users(self):
+        '''
+        Check that the ratings of users missing from the nodes are ignored
+        '''
+        print('('+self.test_rank_unknown_users.__name__+')',
+              self.test_rank_unknown_users.__doc__)
+        edges = [[(1, 2, 8), (1, 5, 10), (0, 2, 10), (9, 1, 10)]]
+        ranking = reputation.rank_lists([1, 2, 3], edges)
+        self.assertEqual(ranking.ratings, 1)
+        self.assertAlmostEqual(sum(ranking.scores), 3)
+
+    @unittest.skipIf(reputation.numpy is None, 'NumPy is not installed')
+    def test_rank_arrays(self):
+        '''
+        Check that NumPy and pure Python give the same scores
+        '''
+        print('('+self.test_rank_arrays.__name__+')',
+              self.test_rank_arrays.__doc__)
+        nodes = list(self.connection.iter_user_ids())
+        edges = list(self.connection.iter_rating_edges(size=5))
+        self.assertEqual(sum(len(chunk) for chunk in edges), 17)
+        expected = reputation.rank_lists(nodes, edges)
+        ranking = reputation.rank_arrays(nodes, edges)
+        self.assertEqual(ranking.ratings, expected.ratings)
+        self.assertEqual(ranking.iterations, expected.iterations)
+        for score, expected_score in zip(ranking.scores, expected.scores):
+            self.assertAlmostEqual(score, expected_score)
+        edges.append([(1, 2, 8), (1, 9, 10), (0, 2, 10)])
+        ranking = reputation.rank_arrays(nodes, edges)
+        expected = reputation.rank_lists(nodes, edges)
+        self.assertEqual(ranking.ratings, 18)
+        for score, expected_score in zip(ranking.scores, expected.scores):
+            self.assertAlmostEqual(score, expected_score)
+
+    def test_refresh_reputation(self):
+        '''
+        Check that the reputation is stored and only computed again after
+        the ratings changed
+        '''
+        print('('+self.test_refresh_reputation.__name__+')',
+              self.test_refresh_reputation.__doc__)
+        self.assertEqual(self.connection.get_reputation_state(), (0, None))
+        self.assertIsNone(self.connection.get_reputation(USER5_NICKNAME))
+
+        ranking = reputation.refresh_reputation(self.connection)
+        self.assertEqual(len(ranking.scores), 5)
+        self.assertEqual(ranking.ratings, 17)
+        seq, computed = self.connection.get_reputation_state()
+        self.assertEqual(seq, self.connection.get_last_change_seq())
+        self.assertIsNotNone(computed)
+        scores = self.connection.get_reputation_scores()
+        self.assertEqual(len(scores), 5)
+        self.assertAlmostEqual(sum(scores.values()), 5)
+        self.assertEqual(self.connection.get_reputation(USER5_NICKNAME),
+                         scores[USER5_ID])
+        # Scott receives the best ratings
+        self.assertEqual(max(scores, key=scores.get), USER1_ID)
+
+        # Nothing changed
+        self.assertIsNone(reputation.refresh_reputation(self.connection))
+        # A new post does not change the reputation
+        self.connection.create_post('Kim', 'Scott', post_text='Hello',
+                                       public=True)
+        self.assertIsNone(reputation.refresh_reputation(self.connection))
+        # but the changes are not looked at again
+        self.assertEqual(self.connection.get_reputation_state(),
+                         (self.connection.get_last_change_seq(), computed))
+
+        # A new rating does, starting from the last scores
+        self.connection.create_rating(USER5_NICKNAME, FREE_RECEIVERS[0], 10)
+        ranking = reputation.refresh_reputation(self.connection)
+        self.assertIsNotNone(ranking)
+        new_scores = self.connection.get_reputation_scores()
+        self.assertGreater(new_scores[2], scores[2])
+        full = reputation.refresh_reputation(self.connection, full=True)
+        self.assertLessEqual(ranking.iterations, full.iterations)
+        for user_id, score in self.connection.get_reputation_scores().items():
+            self.assertAlmostEqual(score, new_scores[user_id], places=6)
+
+    def test_save_reputation_scores(self):
+        '''
+        Check that the scores are replaced, skipping the missing users
+        '''
+        print('('+self.test_save_reputation_scores.__name__+')',
+              self.test_save_reputation_scores.__doc__)
+        self.connection.save_reputation_scores([(1, 2.5), (5, 0.5)], 7)
+        self.assertEqual(self.connection.get_reputation_scores(),
+                         {1: 2.5, 5: 0.5})
+        self.assertEqual(self.connection.get_reputation_state()[0], 7)
+        self.connection.save_reputation_scores([(1, 1.5), (99, 1.0)], 8)
+        self.assertEqual(self.connection.get_reputation_scores(), {1: 1.5})
+        self.assertEqual(self.connection.get_reputation_state()[0], 8)
+        self.assertIsNone(self.connection.get_reputation(USER5_NICKNAME))
+        self.assertIsNone(self.connection.get_reputation('Unknown'))
+
+    def test_parse_args(self):
+        '''
+        Check the command line of the batch job
+        '''
+        print('('+self.test_parse_args.__name__+')',
+              self.test_parse_args.__doc__)
+        options = reputation.parse_args([])
+        self.assertEqual(options.database, database.DEFAULT_DB_PATH)
+        self.assertFalse(options.full)
+        self.assertEqual(options.damping, reputation.DAMPING)
+        options = reputation.parse_args(['--database', DB_PATH, '--full'])
+        self.assertEqual(options.database, DB_PATH)
+        self.assertTrue(options.full)
+        with self.assertRaises(SystemExit):
+            reputation.parse_args(['--damping', '1'])
+
+
+if __name__ == '__main__':
+    print('Start running tests')
+    unittest.main()
@@ -324,6 +324,34 @@ class UserDBAPITestCase(unittest.TestCase):
         user = self.connection.get_user(USER2['summary']['nickname'])
         self.assertDictContainsSubset(user, USER2)
 
+    def test_get_user_fields(self):
+        '''
+        Test that get_user only selects the requested fields
+        '''
+        print('('+self.test_get_user_fields.__name__+')',
+              self.test_get_user_fields.__doc__)
+
+        user = self.connection.get_user(USER1['summary']['nickname'],
+                                        fields=('avatar', 'firstname'))
+        self.assertEqual(user['summary']['nickname'],
+                         USER1['summary']['nickname'])
+        self.assertEqual(user['summary']['avatar'],
+                         USER1['summary']['avatar'])
+        self.assertEqual(user['details']['firstname'],
+                         USER1['details']['firstname'])
+        self.assertIsNone(user['summary']['bio'])
+        self.assertIsNone(user['details']['email'])
+
+        # Only columns of the users table
+        user = self.connection.get_user(USER1['summary']['nickname'],
+                                        fields=('registrationdate',))
+        self.assertEqual(user['summary']['registrationdate'],
+                         USER1['summary']['registrationdate'])
+
+        with self.assertRaises(ValueError):
+            self.connection.get_user(USER1['summary']['nickname'],
+                                     fields=('password',))
+
     def test_get_user_noexistingid(self):
         '''
         Test get_user with  msg-200 (no-existing)
@@ -360,6 +388,38 @@ class UserDBAPITestCase(unittest.TestCase):
                         key in test_user['details'])
                     self.assertTrue(containsKey)
 
+    def test_get_users_by_nicknames(self):
+        '''
+        Test that get_users_by_nicknames returns the users in the requested
+        order and None for the nicknames that do not exist
+        '''
+        print('('+self.test_get_users_by_nicknames.__name__+')',
+              self.test_get_users_by_nicknames.__doc__)
+        users = self.connection.get_users_by_nicknames(
+            [USER2['summary']['nickname'], USER_WRONG_NICKNAME,
+             USER1['summary']['nickname']])
+        self.assertEqual(len(users), 3)
+        self.assertEqual(users[0]['nickname'], USER2['summary']['nickname'])
+        self.assertEqual(users[0]['firstname'], USER2['details']['firstname'])
+        self.assertIsNone(users[1])
+        self.assertEqual(users[2]['bio'], USER1['summary']['bio'])
+
+    def test_iter_users(self):
+        '''
+        Test that iter_users yields the users one by one, the same way
+        get_users returns them
+        '''
+        print('('+self.test_iter_users.__name__+')',
+              self.test_iter_users.__doc__)
+        users = self.connection.iter_users(fields=('nickname',))
+        # A generator, not a list
+        self.assertFalse(isinstance(users, list))
+        first = next(users)
+        self.assertIsNone(first['firstname'])
+        nicknames = [first['nickname']] + [user['nickname'] for user in users]
+        self.assertEqual(sorted(nicknames), sorted(
+            user['nickname'] for user in self.connection.get_users()))
+
 
     def test_delete_user(self):
         '''
@@ -512,6 +572,50 @@ class UserDBAPITestCase(unittest.TestCase):
             USER2['summary']['nickname']))
 
 
+    def test_user_counts(self):
+        '''
+        Test that the counters of the users follow the writes of posts,
+        ratings and users
+        '''
+        print('('+self.test_user_counts.__name__+')', \
+              self.test_user_counts.__doc__)
+        con = self.connection
+
+        def check():
+            cur = con.con.cursor()
+            for nickname in ('Scott', 'Kim', 'Stephen', 'Young', 'Knives'):
+                user_id = con.get_user_id_w_nickname(nickname)
+                expected = {}
+                for key, condition in (
+                        ('inbox', 'receiver_id = ? AND public = 0'),
+                        ('river', 'receiver_id = ? AND public = 1'),
+                        ('sent', 'sender_id = ?')):
+                    cur.execute('SELECT COUNT(*) FROM posts WHERE ' +
+                                condition, (user_id,))
+                    expected[key] = cur.fetchone()[0]
+                cur.execute('SELECT COUNT(*) FROM ratings WHERE '
+                            'receiver_id = ?', (user_id,))
+                expected['ratings'] = cur.fetchone()[0]
+                if user_id is None:
+                    expected = None
+                self.assertEqual(con.get_user_counts(nickname), expected,
+                                 nickname)
+
+        check()
+        self.assertEqual(con.get_user_counts('Scott')['inbox'], 1)
+        post_id = con.create_post('Kim', 'Scott', post_text='Hi', public=0)
+        con.create_post('Scott', reply_to=post_id, post_text='Hello')
+        con.modify_post_publicity('p-8', 0)
+        con.modify_posts_publicity('Scott', ['p-4', 'p-11'], 1)
+        con.delete_post('p-0')
+        con.create_rating('Knives', 'Stephen', 5)
+        con.delete_rating('rtg-1')
+        check()
+        con.delete_user('Kim')
+        check()
+        self.assertIsNone(con.get_user_counts('Moamen'))
+
+
 if __name__ == '__main__':
     '''
 
@@ -0,0 +1,189 @@
+"""
+Created on 19.10.2026
+Testing of the production launcher, server.py.
+"""
+
+import http.client
+import json
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+import app.database as database
+import app.resources as resources
+import server
+from main import application
+
+# Path to the database file, different from the deployment db
+DB_PATH = "db/critique_server_test.db"
+ENGINE = database.Engine(DB_PATH)
+
+# Host matching the SERVER_NAME of the resources tests, if they ran before
+HOST = "localhost:5000"
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Test cases of the pre-fork server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        print("Testing ", cls.__name__)
+        ENGINE.remove_database()
+        ENGINE.create_tables()
+        ENGINE.populate_tables()
+
+    @classmethod
+    def tearDownClass(cls):
+        print("Testing ENDED for ", cls.__name__)
+        ENGINE.remove_database()
+
+    def setUp(self):
+        self.engine = resources.app.config["Engine"]
+        resources.app.config["Engine"] = ENGINE
+        resources.response_cache.clear()
+
+    def tearDown(self):
+        resources.app.config["Engine"] = self.engine
+
+    def start_server(self, threads=2):
+        """
+        Runs a worker server in a thread and returns it
+        """
+        pool = server.PoolWSGIServer("127.0.0.1", 0, application,
+                                     threads=threads)
+        thread = threading.Thread(target=pool.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 10)
+        self.addCleanup(pool.stop)
+        return pool
+
+    def start_master(self, *args):
+        """
+        Runs server.py and returns the process and the port it listens on
+        """
+        process = subprocess.Popen(
+            [sys.executable, "server.py", "--bind", "127.0.0.1:0",
+             "--database", DB_PATH] + list(args),
+            stderr=subprocess.PIPE, universal_newlines=True)
+        self.addCleanup(process.stderr.close)
+        self.addCleanup(process.wait, 30)
+        self.addCleanup(lambda: process.poll() is not None or
+                        process.kill())
+        lines = []
+        while True:
+            line = process.stderr.readline()
+            self.assertTrue(line, "".join(lines))
+            lines.append(line)
+            match = re.search(r"Listening on http://[^:]+:(\d+)", line)
+            if match:
+                break
+        # Keep reading the log, a full pipe would block the server
+        threading.Thread(target=process.stderr.read, daemon=True).start()
+        return process, int(match.group(1))
+
+    def get(self, port, url, connection=None):
+        connection = connection or http.client.HTTPConnection(
+            "127.0.0.1", port, timeout=10)
+        connection.request("GET", url, headers={"Host": HOST})
+        resp = connection.getresponse()
+        return resp, resp.read()
+
+    def test_keep_alive(self):
+        """
+        Checks that a connection serves several requests
+        """
+        print("("+self.test_keep_alive.__name__+")",
+              self.test_keep_alive.__doc__)
+        pool = self.start_server()
+        connection = http.client.HTTPConnection("127.0.0.1", pool.port,
+                                                timeout=10)
+        self.addCleanup(connection.close)
+        resp, body = self.get(pool.port, "/critique/api/users/Scott/",
+                              connection)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(body.decode("utf-8"))["nickname"],
+                         "Scott")
+        sock = connection.sock
+        resp, body = self.get(pool.port, "/critique/api/users/", connection)
+        self.assertEqual(resp.status, 200)
+        self.assertIs(connection.sock, sock)
+
+    def test_request_too_large(self):
+        """
+        Checks that bodies bigger than MAX_CONTENT_LENGTH are refused
+        without reading them
+        """
+        print("("+self.test_request_too_large.__name__+")",
+              self.test_request_too_large.__doc__)
+        pool = self.start_server()
+        connection = http.client.HTTPConnection("127.0.0.1", pool.port,
+                                                timeout=10)
+        self.addCleanup(connection.close)
+        size = resources.app.config["MAX_CONTENT_LENGTH"] + 1
+        connection.putrequest("POST", "/critique/api/users/",
+                              skip_host=True)
+        connection.putheader("Host", HOST)
+        connection.putheader("Content-Type", "application/json")
+        connection.putheader("Content-Length", str(size))
+        connection.endheaders()
+        resp = connection.getresponse()
+        self.assertEqual(resp.status, 413)
+
+    def test_master(self):
+        """
+        Checks that the workers of the master serve the requests, are
+        restarted with HUP and stopped with TERM
+        """
+        print("("+self.test_master.__name__+")", self.test_master.__doc__)
+        process, port = self.start_master("--workers", "2", "--threads", "2")
+        resp, body = self.get(port, "/critique/api/users/")
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(len(json.loads(body.decode("utf-8"))["items"]), 5)
+
+        process.send_signal(signal.SIGHUP)
+        time.sleep(2 * server.MASTER_INTERVAL)
+        resp, body = self.get(port, "/critique/api/users/Kim/")
+        self.assertEqual(resp.status, 200)
+
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(process.wait(30), 0)
+
+    def test_worker_boot_error(self):
+        """
+        Checks that the master stops if the workers can not load the
+        application
+        """
+        print("("+self.test_worker_boot_error.__name__+")",
+              self.test_worker_boot_error.__doc__)
+        process, port = self.start_master("--workers", "1", "--no-preload",
+                                          "--app", "tests.missing:app")
+        self.assertEqual(process.wait(30), server.WORKER_BOOT_ERROR)
+
+    def test_parse_args(self):
+        """
+        Checks the command line of the launcher
+        """
+        print("("+self.test_parse_args.__name__+")",
+              self.test_parse_args.__doc__)
+        options = server.parse_args([])
+        self.assertEqual(options.workers, 1)
+        self.assertTrue(options.preload)
+        self.assertFalse(options.reuse_port)
+        self.assertEqual(options.deadline, 10)
+        self.assertEqual(server.parse_bind(options.bind),
+                         ("127.0.0.1", 5000))
+        self.assertEqual(server.parse_bind("[::1]:8000"), ("::1", 8000))
+        self.assertEqual(server.parse_bind("8000"), ("127.0.0.1", 8000))
+        with self.assertRaises(SystemExit):
+            server.parse_args(["--workers", "0"])
+
+
+if __name__ == "__main__":
+    print("Start running tests")
+    unittest.main()